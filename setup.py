@@ -99,7 +99,7 @@ CONDITIONAL_REQUIREMENTS["all"] = list(ALL_OPTIONAL_REQUIREMENTS)
 setup(
     name="matrix-synapse",
     version=version,
-    packages=find_packages(exclude=["tests", "tests.*"]),
+    packages=find_packages(exclude=["tests", "tests.*", "synmark", "synmark.*"]),
     description="Reference homeserver for the Matrix decentralised comms protocol",
     install_requires=REQUIREMENTS,
     extras_require=CONDITIONAL_REQUIREMENTS,
@@ -28,7 +28,9 @@ from twisted.protocols.tls import TLSMemoryBIOFactory
 import synapse
 from synapse.app import check_bind_error
 from synapse.crypto import context_factory
+from synapse.storage.util.cache_snapshot import setup_cache_snapshots
 from synapse.util import PreserveLoggingContext
+from synapse.util.caches.lrucache import set_cache_memory_budget
 from synapse.util.rlimit import change_resource_limit
 from synapse.util.versionstring import get_version_string
 
@@ -269,10 +271,14 @@ def start(hs, listeners=None):
         # Load the certificate from disk.
         refresh_certificate(hs)
 
+        set_cache_memory_budget(hs.config.cache_memory_budget)
+
         # It is now safe to start your Synapse.
         hs.start_listening(listeners)
         hs.get_datastore().start_profiling()
 
+        setup_cache_snapshots(hs)
+
         setup_sentry(hs)
     except Exception:
         traceback.print_exc(file=sys.stderr)
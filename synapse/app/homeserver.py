@@ -439,6 +439,10 @@ def setup(config_options):
 
             hs.get_pusherpool().start()
             hs.get_datastore().start_doing_background_updates()
+            run_as_background_process(
+                "resume_purges",
+                hs.get_pagination_handler().resume_unfinished_purges,
+            )
         except Exception:
             # Print the exception and bail out.
             print("Error during startup:", file=sys.stderr)
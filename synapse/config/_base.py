@@ -54,7 +54,7 @@ class Config(object):
     def parse_size(value):
         if isinstance(value, integer_types):
             return value
-        sizes = {"K": 1024, "M": 1024 * 1024}
+        sizes = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
         size = 1
         suffix = value[-1]
         if suffix in sizes:
@@ -14,7 +14,7 @@
 # limitations under the License.
 import os
 
-from ._base import Config
+from ._base import Config, ConfigError
 
 
 class DatabaseConfig(Config):
@@ -24,6 +24,34 @@ class DatabaseConfig(Config):
             config.get("event_cache_size", "10K")
         )
 
+        self.cache_memory_budget = config.get("cache_memory_budget")
+        if self.cache_memory_budget is not None:
+            self.cache_memory_budget = self.parse_size(self.cache_memory_budget)
+
+        shared_cache_config = config.get("shared_cache") or {}
+        self.shared_cache_directory = shared_cache_config.get("directory")
+        if self.shared_cache_directory is not None:
+            self.shared_cache_directory = self.abspath(self.shared_cache_directory)
+        self.shared_event_cache_size = self.parse_size(
+            shared_cache_config.get("event_cache_size", "256M")
+        )
+        self.shared_state_group_cache_size = self.parse_size(
+            shared_cache_config.get("state_group_cache_size", "256M")
+        )
+
+        cache_snapshot_config = config.get("cache_snapshot") or {}
+        self.cache_snapshot_path = cache_snapshot_config.get("path")
+        if self.cache_snapshot_path is not None:
+            self.cache_snapshot_path = self.abspath(self.cache_snapshot_path)
+        self.cache_snapshot_caches = cache_snapshot_config.get(
+            "caches",
+            [
+                "getEvent", "stateGroupCache",
+                "get_rooms_for_user", "get_users_in_room",
+            ],
+        )
+        self.cache_snapshot_max_keys = cache_snapshot_config.get("max_keys", 10000)
+
         self.database_config = config.get("database")
 
         if self.database_config is None:
@@ -44,6 +72,13 @@ class DatabaseConfig(Config):
         else:
             raise RuntimeError("Unsupported database type '%s'" % (name,))
 
+        self.database_lanes = self.database_config.get("lanes") or {}
+        for lane, limit in self.database_lanes.items():
+            if not isinstance(limit, int) or limit < 1:
+                raise ConfigError(
+                    "database.lanes.%s must be a positive integer" % (lane,)
+                )
+
         self.set_databasepath(config.get("database_path"))
 
     def default_config(self, data_dir_path, **kwargs):
@@ -58,8 +93,75 @@ class DatabaseConfig(Config):
             # Path to the database
             database: "%(database_path)s"
 
+          # The most transactions of each class which may use the database
+          # connection pool at once. Any more wait their turn, so that, for
+          # example, a burst of expensive reads can't starve event persistence
+          # of connections. The classes are:
+          #
+          #   persist: persisting events and their state
+          #   read: anything else, which is mostly reads
+          #   background: background updates to the database
+          #   admin: admin APIs, such as purging history
+          #
+          # Classes which aren't listed are unlimited. This is only useful with
+          # postgres, as sqlite only has one connection.
+          #
+          #lanes:
+          #  read: 6
+          #  background: 1
+          #  admin: 1
+
         # Number of events to cache in memory.
         event_cache_size: "10K"
+
+        # Limit the total memory used by the in-memory caches, as estimated
+        # from the size of the cached entries. Once the caches reach the
+        # limit, the least recently used entries are evicted, whichever cache
+        # they are in.
+        #
+        # The caches are still limited in their number of entries as well (by
+        # event_cache_size and the SYNAPSE_CACHE_FACTOR environment variables),
+        # so when setting this you may want to increase SYNAPSE_CACHE_FACTOR
+        # so that the budget is the limit which applies.
+        #
+        #cache_memory_budget: "4G"
+
+        # Share the event and state group caches between the processes on this
+        # machine, i.e. between synapse and its workers, so that they don't
+        # each have to fetch the same events and state from the database.
+        #
+        # The caches are kept in files in the given directory, which should be
+        # on a memory-backed filesystem such as /dev/shm. Every process must
+        # use the same directory and sizes. The sizes only take effect when
+        # the files are created, so to change them, stop all of the processes
+        # and delete the files.
+        #
+        #shared_cache:
+        #  directory: "/dev/shm/synapse"
+        #  event_cache_size: "256M"
+        #  state_group_cache_size: "256M"
+
+        # Write the keys of the most recently used entries in some of the
+        # caches to a file when shutting down, and fetch them again in bulk
+        # when starting up, so that a restarted process doesn't spend a long
+        # time with cold caches. How long it takes to fetch them is logged and
+        # exported as the synapse_util_caches_warm_start_seconds metric.
+        #
+        # Each process needs its own file, so when using workers, set the path
+        # in each worker's config.
+        #
+        # `caches` can include getEvent, stateGroupCache, and the names of any
+        # other cached functions on the store. `max_keys` is the most keys to
+        # keep from each cache.
+        #
+        #cache_snapshot:
+        #  path: "/var/lib/synapse/cache_snapshot.json"
+        #  caches:
+        #    - getEvent
+        #    - stateGroupCache
+        #    - get_rooms_for_user
+        #    - get_users_in_room
+        #  max_keys: 10000
         """ % locals()
 
     def read_arguments(self, args):
@@ -78,6 +78,12 @@ class ServerConfig(Config):
 
         self.filter_timeline_limit = config.get("filter_timeline_limit", -1)
 
+        # How long the notifier collects notifications for before waking up
+        # the clients waiting on them, and how many clients it wakes up at a
+        # time.
+        self.notifier_batch_window_ms = config.get("notifier_batch_window_ms", 10)
+        self.notifier_batch_size = config.get("notifier_batch_size", 1000)
+
         # Whether we should block invites sent to users on this server
         # (other than those sent by local server admins)
         self.block_non_admin_invites = config.get(
@@ -121,6 +127,32 @@ class ServerConfig(Config):
             for domain in federation_domain_whitelist:
                 self.federation_domain_whitelist[domain] = True
 
+        # Connections we keep open to other servers between requests
+        federation_connection_pool = config.get("federation_connection_pool") or {}
+        self.federation_max_idle_connections_per_destination = (
+            federation_connection_pool.get("max_idle_connections_per_destination", 5)
+        )
+        self.federation_idle_connection_timeout = self.parse_duration(
+            federation_connection_pool.get("idle_timeout", "2m")
+        ) / 1000.
+
+        # How many transactions we can have in flight to each server at once
+        self.federation_transactions_in_flight_per_destination = config.get(
+            "federation_transactions_in_flight_per_destination", 1,
+        )
+        if self.federation_transactions_in_flight_per_destination < 1:
+            raise ConfigError(
+                "federation_transactions_in_flight_per_destination must be at least 1"
+            )
+
+        # How many PDUs and EDUs we queue in memory for each server
+        self.federation_max_pending_pdus_per_destination = config.get(
+            "federation_max_pending_pdus_per_destination", 1000,
+        )
+        self.federation_max_pending_edus_per_destination = config.get(
+            "federation_max_pending_edus_per_destination", 5000,
+        )
+
         if self.public_baseurl is not None:
             if self.public_baseurl[-1] != '/':
                 self.public_baseurl += '/'
@@ -318,6 +350,15 @@ class ServerConfig(Config):
         #
         #filter_timeline_limit: 5000
 
+        # When an event arrives in a room, everyone in the room waiting for
+        # updates is woken up. To smooth out the resulting load in large rooms,
+        # notifications are collected for this many milliseconds and then
+        # clients are woken up in batches of `notifier_batch_size`. Set the
+        # window to 0 to wake clients up immediately.
+        #
+        #notifier_batch_window_ms: 10
+        #notifier_batch_size: 1000
+
         # Whether room invites to users on this server should be blocked
         # (except those sent by local server admins). The default is False.
         #
@@ -341,6 +382,38 @@ class ServerConfig(Config):
         #  - nyc.example.com
         #  - syd.example.com
 
+        # Connections to other servers are kept open after a request, so that
+        # later requests to the same server don't need to connect (and do a TLS
+        # handshake) again. This sets how many idle connections are kept open
+        # to each server, and for how long. The defaults are shown below.
+        #
+        #federation_connection_pool:
+        #  max_idle_connections_per_destination: 5
+        #  idle_timeout: 2m
+
+        # How many transactions may be sent to each server at once. By default
+        # we wait for each transaction to a server to complete before sending
+        # the next one. Allowing more lets a slow server work on several
+        # transactions at once, rather than letting a backlog build up.
+        #
+        # Events in the same room are never in more than one of the
+        # transactions at a time, so they still arrive in order, and EDUs are
+        # only sent one transaction at a time. When this is more than 1, the
+        # number of events in each transaction is reduced if the server is
+        # slow to respond, to spread them across the transactions.
+        #
+        #federation_transactions_in_flight_per_destination: 4
+
+        # The most events and EDUs to queue in memory for sending to each
+        # server. If a server falls further behind than this, the queued
+        # events are dropped, and once it has caught up with the rest it is
+        # sent the latest event in each room it missed events in (it can then
+        # fetch any earlier events it needs itself). The oldest EDUs, such as
+        # typing notifications and read receipts, are dropped.
+        #
+        #federation_max_pending_pdus_per_destination: 1000
+        #federation_max_pending_edus_per_destination: 5000
+
         # List of ports that Synapse should listen on, their purpose and their
         # configuration.
         #
@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from ._base import Config
+from ._base import Config, ConfigError
 
 
 class WorkerConfig(Config):
@@ -43,6 +43,17 @@ class WorkerConfig(Config):
         # The port on the main synapse for HTTP replication endpoint
         self.worker_replication_http_port = config.get("worker_replication_http_port")
 
+        # The framing to use for TCP replication: "text", or "binary", which
+        # is cheaper to encode and decode but needs the main synapse to
+        # support it.
+        self.worker_replication_protocol = config.get(
+            "worker_replication_protocol", "text",
+        )
+        if self.worker_replication_protocol not in ("text", "binary"):
+            raise ConfigError(
+                "worker_replication_protocol must be either 'text' or 'binary'"
+            )
+
         self.worker_name = config.get("worker_name", self.worker_app)
 
         self.worker_main_http_uri = config.get("worker_main_http_uri", None)
@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
 from collections import namedtuple
 
@@ -34,7 +35,8 @@ from signedjson.sign import (
 )
 from unpaddedbase64 import decode_base64
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
 
 from synapse.api.errors import (
     Codes,
@@ -42,7 +44,9 @@ from synapse.api.errors import (
     RequestSendFailed,
     SynapseError,
 )
-from synapse.util import logcontext, unwrapFirstError
+from synapse.util import batch_iter, logcontext, unwrapFirstError
+from synapse.util.async_helpers import ObservableDeferred
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.logcontext import (
     LoggingContext,
     PreserveLoggingContext,
@@ -54,6 +58,11 @@ from synapse.util.retryutils import NotRetryingDestination
 
 logger = logging.getLogger(__name__)
 
+# How many signatures to check in each job on the thread pool
+SIGNATURE_CHECK_BATCH_SIZE = 50
+
+# How many successful signature checks to remember
+VERIFIED_SIGNATURES_CACHE_SIZE = 10000
 
 VerifyKeyRequest = namedtuple("VerifyRequest", (
     "server_name", "key_ids", "json_object", "deferred"
@@ -93,6 +102,22 @@ class Keyring(object):
         # These are regular, logcontext-agnostic Deferreds.
         self.key_downloads = {}
 
+        # map from (server_name, key_id, verify key, signature) to an
+        # ObservableDeferred for a signature check with those parameters which
+        # is waiting for, or running on, the thread pool. Other checks of the
+        # same signature wait for it, so that identical checks are only done
+        # once.
+        self._signature_checks_in_flight = {}
+
+        # the signature checks which are waiting to be sent to the thread pool,
+        # as (cache key, server_name, json_object, verify_key, verified hash,
+        # deferred, is in flight) tuples.
+        self._pending_signature_checks = []
+
+        # map from (server_name, key_id, verify key, signature) to the hash of
+        # the object which the signature was last successfully checked on.
+        self._verified_signatures = LruCache(VERIFIED_SIGNATURES_CACHE_SIZE)
+
     def verify_json_for_server(self, server_name, json_object):
         return logcontext.make_deferred_yieldable(
             self.verify_json_objects_for_server(
@@ -142,7 +167,7 @@ class Keyring(object):
 
         # Pass those keys to handle_key_deferred so that the json object
         # signatures can be verified
-        handle = preserve_fn(_handle_key_deferred)
+        handle = preserve_fn(self._handle_key_deferred)
         return [
             handle(rq) for rq in verify_requests
         ]
@@ -668,63 +693,186 @@ class Keyring(object):
             consumeErrors=True,
         ).addErrback(unwrapFirstError))
 
+    @defer.inlineCallbacks
+    def _handle_key_deferred(self, verify_request):
+        """Waits for the key to become available, and then performs a verification
+
+        Args:
+            verify_request (VerifyKeyRequest):
+
+        Returns:
+            Deferred[None]
+
+        Raises:
+            SynapseError if there was a problem performing the verification
+        """
+        server_name = verify_request.server_name
+        try:
+            with PreserveLoggingContext():
+                _, key_id, verify_key = yield verify_request.deferred
+        except (IOError, RequestSendFailed) as e:
+            logger.warn(
+                "Got IOError when downloading keys for %s: %s %s",
+                server_name, type(e).__name__, str(e),
+            )
+            raise SynapseError(
+                502,
+                "Error downloading keys for %s" % (server_name,),
+                Codes.UNAUTHORIZED,
+            )
+        except Exception as e:
+            logger.exception(
+                "Got Exception when downloading keys for %s: %s %s",
+                server_name, type(e).__name__, str(e),
+            )
+            raise SynapseError(
+                401,
+                "No key for %s with id %s" % (server_name, verify_request.key_ids),
+                Codes.UNAUTHORIZED,
+            )
+
+        json_object = verify_request.json_object
+
+        logger.debug("Got key %s %s:%s for server %s, verifying" % (
+            key_id, verify_key.alg, verify_key.version, server_name,
+        ))
+        try:
+            yield self._verify_signed_json(
+                json_object, server_name, key_id, verify_key,
+            )
+        except SignatureVerifyException as e:
+            logger.debug(
+                "Error verifying signature for %s:%s:%s with key %s: %s",
+                server_name, verify_key.alg, verify_key.version,
+                encode_verify_key_base64(verify_key),
+                str(e),
+            )
+            raise SynapseError(
+                401,
+                "Invalid signature for server %s with key %s:%s: %s" % (
+                    server_name, verify_key.alg, verify_key.version, str(e),
+                ),
+                Codes.UNAUTHORIZED,
+            )
+
+    @defer.inlineCallbacks
+    def _verify_signed_json(self, json_object, server_name, key_id, verify_key):
+        """Checks a signature on a JSON object.
+
+        The checks are done on the reactor's thread pool, in batches of the
+        checks which were asked for in the same reactor tick. Checks of a
+        signature which we have already checked only compare the hash of the
+        object with the one that was checked.
+
+        Args:
+            json_object (dict): The JSON object to check
+            server_name (str): The server whose signature to check
+            key_id (str): The ID of the key to check the signature with
+            verify_key (nacl.signing.VerifyKey): The key itself
 
-@defer.inlineCallbacks
-def _handle_key_deferred(verify_request):
-    """Waits for the key to become available, and then performs a verification
+        Returns:
+            Deferred: resolves once the signature has been checked. Follows
+                the synapse rules of logcontext preservation.
+
+        Raises:
+            SignatureVerifyException if the signature is invalid.
+        """
+        signature = json_object["signatures"][server_name][key_id]
+        cache_key = (server_name, key_id, verify_key.encode(), signature)
+
+        observable = self._signature_checks_in_flight.get(cache_key)
+        if observable is not None:
+            # wait for the other check of this signature, so that we can use
+            # its result. If it failed, we check the signature ourselves, as
+            # it may have failed because the other object was changed.
+            try:
+                yield logcontext.make_deferred_yieldable(observable.observe())
+            except Exception:
+                pass
+
+        verified_hash = self._verified_signatures.get(cache_key)
+
+        deferred = defer.Deferred()
+        result = deferred
+        in_flight = cache_key not in self._signature_checks_in_flight
+        if in_flight:
+            observable = ObservableDeferred(deferred, consumeErrors=True)
+            self._signature_checks_in_flight[cache_key] = observable
+            result = observable.observe()
+
+        # we send the checks to the thread pool on the next reactor tick, so
+        # that we can batch up all the checks from the same request.
+        if not self._pending_signature_checks:
+            with PreserveLoggingContext():
+                self.hs.get_reactor().callLater(0, self._run_signature_checks)
+        self._pending_signature_checks.append((
+            cache_key, server_name, json_object, verify_key, verified_hash,
+            deferred, in_flight,
+        ))
+
+        yield logcontext.make_deferred_yieldable(result)
+
+    def _run_signature_checks(self):
+        """Sends the pending signature checks to the thread pool"""
+        checks = self._pending_signature_checks
+        self._pending_signature_checks = []
+
+        reactor = self.hs.get_reactor()
+        for batch in batch_iter(checks, SIGNATURE_CHECK_BATCH_SIZE):
+            d = threads.deferToThreadPool(
+                reactor, reactor.getThreadPool(), _check_signatures,
+                [check[1:5] for check in batch],
+            )
+            d.addBoth(self._on_signature_checks_done, batch)
+
+    def _on_signature_checks_done(self, results, checks):
+        if isinstance(results, Failure):
+            results = [(None, results)] * len(checks)
+
+        for (object_hash, error), check in zip(results, checks):
+            cache_key, _, _, _, _, deferred, in_flight = check
+            if in_flight:
+                del self._signature_checks_in_flight[cache_key]
+
+            if error is None:
+                self._verified_signatures[cache_key] = object_hash
+                deferred.callback(None)
+            else:
+                deferred.errback(error)
+
+
+def _hash_signed_json(json_object):
+    """Hashes the parts of a JSON object which are covered by its signatures"""
+    signed_json = dict(json_object)
+    signed_json.pop("signatures", None)
+    signed_json.pop("unsigned", None)
+    return hashlib.sha256(encode_canonical_json(signed_json)).digest()
+
+
+def _check_signatures(checks):
+    """Checks some signatures. This is run on the thread pool.
 
     Args:
-        verify_request (VerifyKeyRequest):
+        checks (list[(str, dict, nacl.signing.VerifyKey, bytes|None)]): list of
+            (server_name, json_object, verify_key, verified_hash) tuples to
+            check, where verified_hash is the hash of an object which the same
+            signature has already been checked on, if any.
 
     Returns:
-        Deferred[None]
-
-    Raises:
-        SynapseError if there was a problem performing the verification
+        list[(bytes, SignatureVerifyException|None)]: for each check, the hash
+            of the object, and the reason the check failed, or None if it
+            succeeded.
     """
-    server_name = verify_request.server_name
-    try:
-        with PreserveLoggingContext():
-            _, key_id, verify_key = yield verify_request.deferred
-    except (IOError, RequestSendFailed) as e:
-        logger.warn(
-            "Got IOError when downloading keys for %s: %s %s",
-            server_name, type(e).__name__, str(e),
-        )
-        raise SynapseError(
-            502,
-            "Error downloading keys for %s" % (server_name,),
-            Codes.UNAUTHORIZED,
-        )
-    except Exception as e:
-        logger.exception(
-            "Got Exception when downloading keys for %s: %s %s",
-            server_name, type(e).__name__, str(e),
-        )
-        raise SynapseError(
-            401,
-            "No key for %s with id %s" % (server_name, verify_request.key_ids),
-            Codes.UNAUTHORIZED,
-        )
+    results = []
+    for server_name, json_object, verify_key, verified_hash in checks:
+        object_hash = _hash_signed_json(json_object)
+        if object_hash == verified_hash:
+            results.append((object_hash, None))
+            continue
 
-    json_object = verify_request.json_object
-
-    logger.debug("Got key %s %s:%s for server %s, verifying" % (
-        key_id, verify_key.alg, verify_key.version, server_name,
-    ))
-    try:
-        verify_signed_json(json_object, server_name, verify_key)
-    except SignatureVerifyException as e:
-        logger.debug(
-            "Error verifying signature for %s:%s:%s with key %s: %s",
-            server_name, verify_key.alg, verify_key.version,
-            encode_verify_key_base64(verify_key),
-            str(e),
-        )
-        raise SynapseError(
-            401,
-            "Invalid signature for server %s with key %s:%s: %s" % (
-                server_name, verify_key.alg, verify_key.version, str(e),
-            ),
-            Codes.UNAUTHORIZED,
-        )
+        try:
+            verify_signed_json(json_object, server_name, verify_key)
+            results.append((object_hash, None))
+        except SignatureVerifyException as e:
+            results.append((object_hash, e))
+    return results
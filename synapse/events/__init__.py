@@ -19,10 +19,12 @@ from distutils.util import strtobool
 
 import six
 
+from canonicaljson import encode_canonical_json
 from unpaddedbase64 import encode_base64
 
 from synapse.api.constants import KNOWN_ROOM_VERSIONS, EventFormatVersions, RoomVersions
-from synapse.util.caches import intern_dict
+from synapse.util.caches import intern_string
+from synapse.util.encodedjson import EncodedJsonObject
 from synapse.util.frozenutils import freeze
 
 # Whether we should use frozen_dict in FrozenEvent. Using frozen_dicts prevents
@@ -35,12 +37,69 @@ from synapse.util.frozenutils import freeze
 USE_FROZEN_DICTS = strtobool(os.environ.get("SYNAPSE_USE_FROZEN_DICTS", "0"))
 
 
+# The fields of the internal metadata which we know about. Each gets a slot on
+# _EventInternalMetadata, which is much more compact than a dict per event.
+_INTERNAL_METADATA_FIELDS = (
+    "outlier",
+    "out_of_band_membership",
+    "send_on_behalf_of",
+    "recheck_redaction",
+    "stream_ordering",
+    "txn_id",
+    "token_id",
+    # these are only set on events returned by pagination
+    "before",
+    "after",
+    "order",
+)
+
+
 class _EventInternalMetadata(object):
+    __slots__ = _INTERNAL_METADATA_FIELDS + ("_extra",)
+
     def __init__(self, internal_metadata_dict):
-        self.__dict__ = dict(internal_metadata_dict)
+        for key, value in six.iteritems(internal_metadata_dict):
+            setattr(self, key, value)
+
+    def __getattr__(self, name):
+        # This is only called for attributes which aren't set, so look for
+        # unknown fields in `_extra`.
+        if name in self.__slots__:
+            raise AttributeError(name)
+
+        try:
+            return self._extra[name]
+        except (AttributeError, KeyError):
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self.__slots__:
+            object.__setattr__(self, name, value)
+            return
+
+        # Unknown fields are rare (they might turn up in old rows in the
+        # database), so we don't give every event a dict for them.
+        try:
+            extra = self._extra
+        except AttributeError:
+            extra = {}
+            object.__setattr__(self, "_extra", extra)
+        extra[name] = value
 
     def get_dict(self):
-        return dict(self.__dict__)
+        d = {}
+        for key in _INTERNAL_METADATA_FIELDS:
+            try:
+                d[key] = getattr(self, key)
+            except AttributeError:
+                pass
+
+        try:
+            d.update(self._extra)
+        except AttributeError:
+            pass
+
+        return d
 
     def is_outlier(self):
         return getattr(self, "outlier", False)
@@ -78,60 +137,106 @@ class _EventInternalMetadata(object):
         return getattr(self, "recheck_redaction", False)
 
 
-def _event_dict_property(key):
-    # We want to be able to use hasattr with the event dict properties.
-    # However, (on python3) hasattr expects AttributeError to be raised. Hence,
-    # we need to transform the KeyError into an AttributeError
-    def getter(self):
-        try:
-            return self._event_dict[key]
-        except KeyError:
-            raise AttributeError(key)
+# The top level keys of an event which we store in a slot of the same name,
+# rather than in a dict. Any other keys (which aren't in the spec, but may turn
+# up over federation or in old events) go in `_extra_fields`.
+#
+# (event_id is also stored in a slot for v1 events; see FrozenEvent.)
+_EVENT_FIELDS = (
+    "auth_events",
+    "content",
+    "depth",
+    "hashes",
+    "origin",
+    "origin_server_ts",
+    "prev_events",
+    "prev_state",
+    "redacts",
+    "room_id",
+    "sender",
+    "state_key",
+    "type",
+)
+
+# Keys whose values we intern, because the same values turn up in lots of
+# events (which adds up when caching).
+_INTERNED_FIELDS = frozenset((
+    "event_id", "room_id", "sender", "state_key", "type", "origin",
+))
+
+
+def _intern_event_ids(event_refs):
+    """Intern the event IDs in an auth_events or prev_events list.
+
+    The same few event IDs (eg, the room's create and power level events) are
+    referenced by lots of events, so this saves a lot of copies.
+    """
+    if not isinstance(event_refs, list):
+        return event_refs
 
-    def setter(self, v):
-        try:
-            self._event_dict[key] = v
-        except KeyError:
-            raise AttributeError(key)
+    return [
+        # v1 events refer to events by an (event_id, hashes) pair
+        [intern_string(ref[0])] + ref[1:] if isinstance(ref, list)
+        else intern_string(ref) if isinstance(ref, six.string_types)
+        else ref
+        for ref in event_refs
+    ]
 
-    def delete(self):
-        try:
-            del self._event_dict[key]
-        except KeyError:
-            raise AttributeError(key)
-
-    return property(
-        getter,
-        setter,
-        delete,
+
+class EventBase(object):
+    """An event, with its top level fields stored in slots rather than in a
+    dict, as there are a lot of these in the caches.
+
+    The fields can be read as attributes (which raise AttributeError if the
+    field isn't present), or with `event[key]` and `event.get(key)`.
+    """
+
+    __slots__ = _EVENT_FIELDS + (
+        "_extra_fields",
+        "_encoded_fields",
+        "signatures",
+        "unsigned",
+        "rejected_reason",
+        "internal_metadata",
     )
 
+    # The names of the slots holding the event's top level fields, for this
+    # event format.
+    _fields = _EVENT_FIELDS
 
-class EventBase(object):
     def __init__(self, event_dict, signatures={}, unsigned={},
                  internal_metadata_dict={}, rejected_reason=None):
         self.signatures = signatures
         self.unsigned = unsigned
         self.rejected_reason = rejected_reason
 
-        self._event_dict = event_dict
+        extra = None
+        fields = self._fields
+        for key, value in six.iteritems(event_dict):
+            if key in _INTERNED_FIELDS and isinstance(value, six.string_types):
+                value = intern_string(value)
+            elif key in ("auth_events", "prev_events"):
+                value = _intern_event_ids(value)
+
+            if USE_FROZEN_DICTS:
+                value = freeze(value)
+
+            if key in fields:
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[intern_string(key)] = value
+        self._extra_fields = extra
+        self._encoded_fields = None
 
         self.internal_metadata = _EventInternalMetadata(
             internal_metadata_dict
         )
 
-    auth_events = _event_dict_property("auth_events")
-    depth = _event_dict_property("depth")
-    content = _event_dict_property("content")
-    hashes = _event_dict_property("hashes")
-    origin = _event_dict_property("origin")
-    origin_server_ts = _event_dict_property("origin_server_ts")
-    prev_events = _event_dict_property("prev_events")
-    prev_state = _event_dict_property("prev_state")
-    redacts = _event_dict_property("redacts")
-    room_id = _event_dict_property("room_id")
-    sender = _event_dict_property("sender")
-    user_id = _event_dict_property("sender")
+    @property
+    def user_id(self):
+        return self.sender
 
     @property
     def membership(self):
@@ -140,8 +245,24 @@ class EventBase(object):
     def is_state(self):
         return hasattr(self, "state_key") and self.state_key is not None
 
+    def _get_event_dict(self):
+        """Reassemble the event's top level fields into a dict (not including
+        signatures and unsigned).
+        """
+        d = {}
+        for key in self._fields:
+            try:
+                d[key] = getattr(self, key)
+            except AttributeError:
+                pass
+
+        if self._extra_fields:
+            d.update(self._extra_fields)
+
+        return d
+
     def get_dict(self):
-        d = dict(self._event_dict)
+        d = self._get_event_dict()
         d.update({
             "signatures": self.signatures,
             "unsigned": dict(self.unsigned),
@@ -150,38 +271,99 @@ class EventBase(object):
         return d
 
     def get(self, key, default=None):
-        return self._event_dict.get(key, default)
+        if key in self._fields:
+            return getattr(self, key, default)
+
+        if self._extra_fields:
+            return self._extra_fields.get(key, default)
+
+        return default
 
     def get_internal_metadata_dict(self):
         return self.internal_metadata.get_dict()
 
+    def get_encoded_fields(self, event_format=None):
+        """Get the JSON encoding of the event's top level fields (not including
+        signatures and unsigned, which can change).
+
+        The encodings are cached on the event, so that we don't have to encode
+        the event again every time we send it to someone.
+
+        Args:
+            event_format (callable|None): a function to apply to the dict of
+                fields before encoding it, such as one of the client event
+                formats in synapse.events.utils.
+
+        Returns:
+            bytes
+        """
+        if self._encoded_fields is None:
+            self._encoded_fields = {}
+
+        encoded = self._encoded_fields.get(event_format)
+        if encoded is None:
+            d = self._get_event_dict()
+            if event_format is not None:
+                d = event_format(d)
+            encoded = encode_canonical_json(d)
+            self._encoded_fields[event_format] = encoded
+
+        return encoded
+
     def get_pdu_json(self, time_now=None):
         pdu_json = self.get_dict()
+        pdu_json["unsigned"] = self._get_pdu_unsigned(time_now)
+        return pdu_json
 
-        if time_now is not None and "age_ts" in pdu_json["unsigned"]:
-            age = time_now - pdu_json["unsigned"]["age_ts"]
-            pdu_json.setdefault("unsigned", {})["age"] = int(age)
-            del pdu_json["unsigned"]["age_ts"]
+    def get_encoded_pdu_json(self, time_now=None):
+        """Like get_pdu_json, but returns the event as an EncodedJsonObject,
+        which can be spliced into a response without encoding the event again.
+
+        Returns:
+            EncodedJsonObject
+        """
+        return EncodedJsonObject(self.get_encoded_fields(), {
+            "signatures": self.signatures,
+            "unsigned": self._get_pdu_unsigned(time_now),
+        })
+
+    def _get_pdu_unsigned(self, time_now):
+        unsigned = dict(self.unsigned)
+
+        if time_now is not None and "age_ts" in unsigned:
+            unsigned["age"] = int(time_now - unsigned.pop("age_ts"))
 
         # This may be a frozen event
-        pdu_json["unsigned"].pop("redacted_because", None)
+        unsigned.pop("redacted_because", None)
 
-        return pdu_json
+        return unsigned
 
     def __set__(self, instance, value):
         raise AttributeError("Unrecognized attribute %s" % (instance,))
 
     def __getitem__(self, field):
-        return self._event_dict[field]
+        if field in self._fields:
+            try:
+                return getattr(self, field)
+            except AttributeError:
+                raise KeyError(field)
+
+        if self._extra_fields:
+            return self._extra_fields[field]
+
+        raise KeyError(field)
 
     def __contains__(self, field):
-        return field in self._event_dict
+        if field in self._fields:
+            return hasattr(self, field)
+
+        return bool(self._extra_fields) and field in self._extra_fields
 
     def items(self):
-        return list(self._event_dict.items())
+        return list(self._get_event_dict().items())
 
     def keys(self):
-        return six.iterkeys(self._event_dict)
+        return six.iterkeys(self._get_event_dict())
 
     def prev_event_ids(self):
         """Returns the list of prev event IDs. The order matches the order
@@ -202,37 +384,37 @@ class EventBase(object):
         return [e for e, _ in self.auth_events]
 
 
+def _copy_signatures(signatures):
+    # Signatures is a dict of dicts, and this is faster than doing a
+    # copy.deepcopy. We intern the server names and key IDs, as there are
+    # relatively few of them.
+    return {
+        intern_string(name): {
+            intern_string(sig_id): sig for sig_id, sig in sigs.items()
+        }
+        for name, sigs in signatures.items()
+    }
+
+
 class FrozenEvent(EventBase):
+    __slots__ = ("event_id",)
+
+    _fields = EventBase._fields + ("event_id",)
+
     format_version = EventFormatVersions.V1  # All events of this type are V1
 
     def __init__(self, event_dict, internal_metadata_dict={}, rejected_reason=None):
         event_dict = dict(event_dict)
 
-        # Signatures is a dict of dicts, and this is faster than doing a
-        # copy.deepcopy
-        signatures = {
-            name: {sig_id: sig for sig_id, sig in sigs.items()}
-            for name, sigs in event_dict.pop("signatures", {}).items()
-        }
-
+        signatures = _copy_signatures(event_dict.pop("signatures", {}))
         unsigned = dict(event_dict.pop("unsigned", {}))
 
-        # We intern these strings because they turn up a lot (especially when
-        # caching).
-        event_dict = intern_dict(event_dict)
-
-        if USE_FROZEN_DICTS:
-            frozen_dict = freeze(event_dict)
-        else:
-            frozen_dict = event_dict
-
-        self.event_id = event_dict["event_id"]
-        self.type = event_dict["type"]
-        if "state_key" in event_dict:
-            self.state_key = event_dict["state_key"]
+        for key in ("event_id", "type"):
+            if key not in event_dict:
+                raise KeyError(key)
 
         super(FrozenEvent, self).__init__(
-            frozen_dict,
+            event_dict,
             signatures=signatures,
             unsigned=unsigned,
             internal_metadata_dict=internal_metadata_dict,
@@ -251,38 +433,26 @@ class FrozenEvent(EventBase):
 
 
 class FrozenEventV2(EventBase):
+    __slots__ = ("_event_id",)
+
     format_version = EventFormatVersions.V2  # All events of this type are V2
 
     def __init__(self, event_dict, internal_metadata_dict={}, rejected_reason=None):
         event_dict = dict(event_dict)
 
-        # Signatures is a dict of dicts, and this is faster than doing a
-        # copy.deepcopy
-        signatures = {
-            name: {sig_id: sig for sig_id, sig in sigs.items()}
-            for name, sigs in event_dict.pop("signatures", {}).items()
-        }
+        signatures = _copy_signatures(event_dict.pop("signatures", {}))
 
         assert "event_id" not in event_dict
 
         unsigned = dict(event_dict.pop("unsigned", {}))
 
-        # We intern these strings because they turn up a lot (especially when
-        # caching).
-        event_dict = intern_dict(event_dict)
-
-        if USE_FROZEN_DICTS:
-            frozen_dict = freeze(event_dict)
-        else:
-            frozen_dict = event_dict
+        if "type" not in event_dict:
+            raise KeyError("type")
 
         self._event_id = None
-        self.type = event_dict["type"]
-        if "state_key" in event_dict:
-            self.state_key = event_dict["state_key"]
 
         super(FrozenEventV2, self).__init__(
-            frozen_dict,
+            event_dict,
             signatures=signatures,
             unsigned=unsigned,
             internal_metadata_dict=internal_metadata_dict,
@@ -297,7 +467,9 @@ class FrozenEventV2(EventBase):
 
         if self._event_id:
             return self._event_id
-        self._event_id = "$" + encode_base64(compute_event_reference_hash(self)[1])
+        self._event_id = intern_string(
+            "$" + encode_base64(compute_event_reference_hash(self)[1])
+        )
         return self._event_id
 
     def prev_event_ids(self):
@@ -20,6 +20,7 @@ from six import string_types
 from frozendict import frozendict
 
 from synapse.api.constants import EventTypes
+from synapse.util.encodedjson import EncodedJsonObject
 
 from . import EventBase
 
@@ -226,9 +227,12 @@ def format_event_for_client_v1(d):
         "age", "redacted_because", "replaces_state", "prev_content",
         "invite_room_state",
     )
+    # we may be formatting just the event's top level fields, without unsigned;
+    # see serialize_event_json.
+    unsigned = d.get("unsigned", {})
     for key in copy_keys:
-        if key in d["unsigned"]:
-            d[key] = d["unsigned"][key]
+        if key in unsigned:
+            d[key] = unsigned[key]
 
     return d
 
@@ -275,39 +279,115 @@ def serialize_event(e, time_now_ms, as_client_event=True,
     time_now_ms = int(time_now_ms)
 
     # Should this strip out None's?
-    d = {k: v for k, v in e.get_dict().items()}
+    d = e.get_dict()
 
     d["event_id"] = e.event_id
 
-    if "age_ts" in d["unsigned"]:
-        d["unsigned"]["age"] = time_now_ms - d["unsigned"]["age_ts"]
-        del d["unsigned"]["age_ts"]
+    d["unsigned"] = _serialize_unsigned(
+        e, time_now_ms, token_id, is_invite,
+        lambda redaction: serialize_event(
+            redaction, time_now_ms, event_format=event_format,
+        ),
+    )
+
+    if as_client_event:
+        d = event_format(d)
+
+    if only_event_fields:
+        if (not isinstance(only_event_fields, list) or
+                not all(isinstance(f, string_types) for f in only_event_fields)):
+            raise TypeError("only_event_fields must be a list of strings")
+        d = only_fields(d, only_event_fields)
+
+    return d
+
+
+def serialize_event_json(e, time_now_ms, as_client_event=True,
+                         event_format=format_event_for_client_v1,
+                         token_id=None, only_event_fields=None, is_invite=False):
+    """Serialize event for clients, as an EncodedJsonObject which can be spliced
+    into a response without encoding the whole event again.
+
+    Takes the same arguments as serialize_event. `event_format` must only look
+    at the event's top level fields and `unsigned`, as the encoding of the top
+    level fields is cached on the event.
+
+    Returns:
+        EncodedJsonObject|dict
+    """
+    if not isinstance(e, EventBase) or only_event_fields:
+        return serialize_event(
+            e, time_now_ms, as_client_event=as_client_event,
+            event_format=event_format, token_id=token_id,
+            only_event_fields=only_event_fields, is_invite=is_invite,
+        )
+
+    time_now_ms = int(time_now_ms)
+    formatter = event_format if as_client_event else format_event_raw
+
+    fields = formatter({
+        "signatures": e.signatures,
+        "unsigned": _serialize_unsigned(
+            e, time_now_ms, token_id, is_invite,
+            lambda redaction: serialize_event_json(
+                redaction, time_now_ms, event_format=event_format,
+            ),
+        ),
+    })
+
+    # The client v1 format copies some fields out of unsigned, which had better
+    # not clash with the event's own fields.
+    if any(key in e for key in fields):
+        return serialize_event(
+            e, time_now_ms, as_client_event=as_client_event,
+            event_format=event_format, token_id=token_id, is_invite=is_invite,
+        )
+
+    if "event_id" not in e:
+        # the event ID isn't one of the event's fields in newer room versions
+        fields["event_id"] = e.event_id
 
-    if "redacted_because" in e.unsigned:
-        d["unsigned"]["redacted_because"] = serialize_event(
-            e.unsigned["redacted_because"], time_now_ms,
-            event_format=event_format
+    # the raw format gives the same encoding as the federation format
+    if formatter is format_event_raw:
+        formatter = None
+
+    return EncodedJsonObject(e.get_encoded_fields(formatter), fields)
+
+
+def _serialize_unsigned(e, time_now_ms, token_id, is_invite, serialize_redaction):
+    """Get the unsigned section of an event, for sending to clients.
+
+    Args:
+        e (EventBase)
+        time_now_ms (int)
+        token_id (int|None)
+        is_invite (bool)
+        serialize_redaction (callable[EventBase]): used to serialize the
+            redaction of a redacted event.
+
+    Returns:
+        dict
+    """
+    unsigned = dict(e.unsigned)
+
+    if "age_ts" in unsigned:
+        unsigned["age"] = time_now_ms - unsigned.pop("age_ts")
+
+    if "redacted_because" in unsigned:
+        unsigned["redacted_because"] = serialize_redaction(
+            unsigned["redacted_because"],
         )
 
     if token_id is not None:
         if token_id == getattr(e.internal_metadata, "token_id", None):
             txn_id = getattr(e.internal_metadata, "txn_id", None)
             if txn_id is not None:
-                d["unsigned"]["transaction_id"] = txn_id
+                unsigned["transaction_id"] = txn_id
 
     # If this is an invite for somebody else, then we don't care about the
     # invite_room_state as that's meant solely for the invitee. Other clients
     # will already have the state since they're in the room.
     if not is_invite:
-        d["unsigned"].pop("invite_room_state", None)
-
-    if as_client_event:
-        d = event_format(d)
+        unsigned.pop("invite_room_state", None)
 
-    if only_event_fields:
-        if (not isinstance(only_event_fields, list) or
-                not all(isinstance(f, string_types) for f in only_event_fields)):
-            raise TypeError("only_event_fields must be a list of strings")
-        d = only_fields(d, only_event_fields)
-
-    return d
+    return unsigned
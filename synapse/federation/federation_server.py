@@ -347,8 +347,8 @@ class FederationServer(FederationBase):
                 )
 
         defer.returnValue({
-            "pdus": [pdu.get_pdu_json() for pdu in pdus],
-            "auth_chain": [pdu.get_pdu_json() for pdu in auth_chain],
+            "pdus": [pdu.get_encoded_pdu_json() for pdu in pdus],
+            "auth_chain": [pdu.get_encoded_pdu_json() for pdu in auth_chain],
         })
 
     @defer.inlineCallbacks
@@ -463,7 +463,9 @@ class FederationServer(FederationBase):
             time_now = self._clock.time_msec()
             auth_pdus = yield self.handler.on_event_auth(event_id)
             res = {
-                "auth_chain": [a.get_pdu_json(time_now) for a in auth_pdus],
+                "auth_chain": [
+                    a.get_encoded_pdu_json(time_now) for a in auth_pdus
+                ],
             }
         defer.returnValue((200, res))
 
@@ -591,7 +593,9 @@ class FederationServer(FederationBase):
             time_now = self._clock.time_msec()
 
         defer.returnValue({
-            "events": [ev.get_pdu_json(time_now) for ev in missing_events],
+            "events": [
+                ev.get_encoded_pdu_json(time_now) for ev in missing_events
+            ],
         })
 
     @log_function
@@ -604,7 +608,7 @@ class FederationServer(FederationBase):
         transmission.
         """
         time_now = self._clock.time_msec()
-        pdus = [p.get_pdu_json(time_now) for p in pdu_list]
+        pdus = [p.get_encoded_pdu_json(time_now) for p in pdu_list]
         return Transaction(
             origin=self.server_name,
             pdus=pdus,
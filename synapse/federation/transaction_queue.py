@@ -13,9 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import datetime
+import heapq
 import logging
+from collections import OrderedDict
 
-from six import itervalues
+from six import iteritems, itervalues
 
 from prometheus_client import Counter
 
@@ -37,6 +39,7 @@ from synapse.metrics import (
 )
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.util import logcontext
+from synapse.util.async_helpers import Linearizer
 from synapse.util.metrics import measure_func
 from synapse.util.retryutils import NotRetryingDestination, get_retry_limiter
 
@@ -66,10 +69,39 @@ sent_edus_by_type = Counter(
     ["type"],
 )
 
+dropped_edus_counter = Counter(
+    "synapse_federation_transaction_queue_dropped_edus",
+    "Number of EDUs dropped because too many were queued for the destination",
+)
+
+pdu_queue_overflow_counter = Counter(
+    "synapse_federation_transaction_queue_pdu_queue_overflows",
+    "Number of times we have dropped the PDUs queued for a destination, because"
+    " there were too many, and started catching it up instead",
+)
+
+# The most PDUs and EDUs the spec allows in a single transaction
+MAX_PDUS_PER_TRANSACTION = 50
+MAX_EDUS_PER_TRANSACTION = 100
+
+# When we send several transactions to a destination at once, we reduce the
+# number of PDUs in each if the destination takes longer than this to respond,
+# though never below MIN_PDUS_PER_TRANSACTION.
+TARGET_TRANSACTION_TIME_MS = 5 * 1000
+MIN_PDUS_PER_TRANSACTION = 5
+
+# How often to retry catching up destinations which we have failed to send
+# events to.
+CATCH_UP_WAKE_INTERVAL_MS = 60 * 1000
+
+# How many of the destinations with the most queued PDUs and EDUs to report
+# in the metrics.
+NUM_LARGEST_QUEUES_TO_REPORT = 10
+
 
 class TransactionQueue(object):
-    """This class makes sure we only have one transaction in flight at
-    a time for a given destination.
+    """This class makes sure we only have a limited number of transactions in
+    flight at a time for a given destination (by default, one).
 
     It batches pending PDUs into single transactions.
     """
@@ -87,17 +119,71 @@ class TransactionQueue(object):
         self.clock = hs.get_clock()
         self.is_mine_id = hs.is_mine_id
 
-        # Is a mapping from destinations -> deferreds. Used to keep track
+        # Is a mapping from destinations -> set of the transmission loops
+        # running for that destination (numbered from 0). Used to keep track
         # of which destinations have transactions in flight and when they are
         # done
         self.pending_transactions = {}
 
+        self._max_transactions_in_flight = (
+            hs.config.federation_transactions_in_flight_per_destination
+        )
+        self._max_pending_pdus = hs.config.federation_max_pending_pdus_per_destination
+        self._max_pending_edus = hs.config.federation_max_pending_edus_per_destination
+
+        # destination -> set of room IDs with PDUs in a transaction in flight
+        # to that destination. We don't send PDUs for those rooms in any other
+        # transaction until it completes, so that they arrive in order.
+        self._rooms_in_flight_by_dest = {}
+
+        # destination -> loop id -> the lowest stream ordering of the PDUs in
+        # the transaction which that loop has in flight to the destination.
+        self._stream_orderings_in_flight_by_dest = {}
+
+        # the stream orderings of the events which _process_event_queue_loop
+        # is working out where to send.
+        self._stream_orderings_being_queued = set()
+
+        # destination -> _TransactionBatchSizer. Only used when we can send
+        # more than one transaction at a time.
+        self._batch_sizers_by_dest = {}
+
+        # Destinations which we have failed to send events to. Rather than
+        # queuing up events for them in memory, we send them the latest event
+        # in each room they missed events in once they are back (see
+        # _catch_up_destination).
+        self._catching_up_dests = set()
+
+        # Destinations which have had new events while catching up, so that we
+        # don't stop catching up without sending them.
+        self._new_events_during_catch_up = set()
+
+        # Whether we have loaded the destinations which were still catching up
+        # when we last stopped.
+        self._loaded_catching_up_dests = False
+
+        # Used to make sure that updates to how far we have sent events to each
+        # destination are applied in order.
+        self._last_successful_stream_ordering_linearizer = Linearizer(
+            name="federation_last_successful_stream_ordering", clock=self.clock,
+        )
+
+        self.clock.looping_call(
+            self._wake_destinations_needing_catch_up, CATCH_UP_WAKE_INTERVAL_MS,
+        )
+
         LaterGauge(
             "synapse_federation_transaction_queue_pending_destinations",
             "",
             [],
             lambda: len(self.pending_transactions),
         )
+        LaterGauge(
+            "synapse_federation_transaction_queue_transactions_in_flight",
+            "",
+            [],
+            lambda: sum(map(len, self.pending_transactions.values())),
+        )
 
         # Is a mapping from destination -> list of
         # tuple(pending pdus, deferred, order)
@@ -116,7 +202,8 @@ class TransactionQueue(object):
 
         # Pending EDUs by their "key". Keyed EDUs are EDUs that get clobbered
         # based on their key (e.g. typing events by room_id)
-        # Map of destination -> (edu_type, key) -> Edu
+        # Map of destination -> (edu_type, key) -> Edu, with the least
+        # recently updated first.
         self.pending_edus_keyed_by_dest = edus_keyed = {}
 
         LaterGauge(
@@ -135,6 +222,18 @@ class TransactionQueue(object):
                 + sum(map(len, edus_keyed.values()))
             ),
         )
+        LaterGauge(
+            "synapse_federation_transaction_queue_catching_up_destinations",
+            "",
+            [],
+            lambda: len(self._catching_up_dests),
+        )
+        LaterGauge(
+            "synapse_federation_transaction_queue_largest_destination_queues",
+            "Number of PDUs and EDUs queued for the destinations with the most",
+            ["destination"],
+            self._get_largest_queues,
+        )
 
         # destination -> stream_id of last successfully sent to-device message.
         # NB: may be a long or an int.
@@ -173,6 +272,16 @@ class TransactionQueue(object):
     def _process_event_queue_loop(self):
         try:
             self._is_processing = True
+
+            # We need to know which destinations need catching up before we
+            # send any events: otherwise we could record that they have been
+            # sent events which are later than the ones they missed.
+            if not self._loaded_catching_up_dests:
+                destinations = yield self.store.get_destinations_needing_catch_up()
+                self._catching_up_dests.update(destinations)
+                self._loaded_catching_up_dests = True
+                self._wake_destinations_needing_catch_up()
+
             while True:
                 last_token = yield self.store.get_federation_out_pos("events")
                 next_token, events = yield self.store.get_all_new_events_stream(
@@ -210,6 +319,7 @@ class TransactionQueue(object):
                         return
 
                     destinations = set(destinations)
+                    destinations.discard(self.server_name)
 
                     if send_on_behalf_of is not None:
                         # If we are sending the event on behalf of another server
@@ -219,24 +329,45 @@ class TransactionQueue(object):
 
                     logger.debug("Sending %s to %r", event, destinations)
 
+                    if destinations:
+                        # Record that we are sending the event before we try, so
+                        # that we can catch the destinations up if we fail (or
+                        # are restarted before we get to it).
+                        yield self.store.store_destination_rooms_entries(
+                            destinations,
+                            event.room_id,
+                            event.internal_metadata.stream_ordering,
+                        )
+
                     self._send_pdu(event, destinations)
 
                 @defer.inlineCallbacks
                 def handle_room_events(events):
                     for event in events:
-                        yield handle_event(event)
+                        try:
+                            yield handle_event(event)
+                        finally:
+                            self._stream_orderings_being_queued.discard(
+                                event.internal_metadata.stream_ordering,
+                            )
 
                 events_by_room = {}
                 for event in events:
                     events_by_room.setdefault(event.room_id, []).append(event)
 
-                yield logcontext.make_deferred_yieldable(defer.gatherResults(
-                    [
-                        logcontext.run_in_background(handle_room_events, evs)
-                        for evs in itervalues(events_by_room)
-                    ],
-                    consumeErrors=True
-                ))
+                self._stream_orderings_being_queued = set(
+                    event.internal_metadata.stream_ordering for event in events
+                )
+                try:
+                    yield logcontext.make_deferred_yieldable(defer.gatherResults(
+                        [
+                            logcontext.run_in_background(handle_room_events, evs)
+                            for evs in itervalues(events_by_room)
+                        ],
+                        consumeErrors=True
+                    ))
+                finally:
+                    self._stream_orderings_being_queued = set()
 
                 yield self.store.update_federation_out_pos(
                     "events", next_token
@@ -284,9 +415,20 @@ class TransactionQueue(object):
         sent_pdus_destination_dist_count.inc()
 
         for destination in destinations:
-            self.pending_pdus_by_dest.setdefault(destination, []).append(
-                (pdu, order)
-            )
+            if destination in self._catching_up_dests:
+                # The destination will be sent the latest event in the room
+                # when it catches up, so we don't need to keep this one.
+                self._new_events_during_catch_up.add(destination)
+            else:
+                pending_pdus = self.pending_pdus_by_dest.setdefault(destination, [])
+                pending_pdus.append((pdu, order))
+
+                # Rather than letting the queue for a destination which can't
+                # keep up grow without bound, we drop it and catch the
+                # destination up from the database instead.
+                if len(pending_pdus) > self._max_pending_pdus:
+                    pdu_queue_overflow_counter.inc()
+                    self._start_catching_up(destination, [])
 
             self._attempt_new_transaction(destination)
 
@@ -374,11 +516,24 @@ class TransactionQueue(object):
             return
 
         if key:
-            self.pending_edus_keyed_by_dest.setdefault(
-                destination, {}
-            )[(edu.edu_type, key)] = edu
+            pending_edus = self.pending_edus_keyed_by_dest.setdefault(
+                destination, OrderedDict(),
+            )
+
+            # move the key to the end, so that it is dropped last
+            pending_edus.pop((edu.edu_type, key), None)
+            pending_edus[(edu.edu_type, key)] = edu
+
+            while len(pending_edus) > self._max_pending_edus:
+                pending_edus.popitem(last=False)
+                dropped_edus_counter.inc()
         else:
-            self.pending_edus_by_dest.setdefault(destination, []).append(edu)
+            pending_edus = self.pending_edus_by_dest.setdefault(destination, [])
+            pending_edus.append(edu)
+
+            if len(pending_edus) > self._max_pending_edus:
+                dropped_edus_counter.inc(len(pending_edus) - self._max_pending_edus)
+                del pending_edus[:-self._max_pending_edus]
 
         self._attempt_new_transaction(destination)
 
@@ -395,9 +550,10 @@ class TransactionQueue(object):
     def _attempt_new_transaction(self, destination):
         """Try to start a new transaction to this destination
 
-        If there is already a transaction in progress to this destination,
-        returns immediately. Otherwise kicks off the process of sending a
-        transaction in the background.
+        If there are already as many transactions in progress to this
+        destination as we allow (or there is nothing which another transaction
+        could send), returns immediately. Otherwise kicks off the process of
+        sending a transaction in the background.
 
         Args:
             destination (str):
@@ -405,8 +561,19 @@ class TransactionQueue(object):
         Returns:
             None
         """
-        # list of (pending_pdu, deferred, order)
-        if destination in self.pending_transactions:
+        active_loops = self.pending_transactions.get(destination, ())
+        if 0 not in active_loops:
+            # the first loop is the only one which sends EDUs, so we always
+            # want it running.
+            loop_id = 0
+        elif (
+            len(active_loops) < self._max_transactions_in_flight
+            and self._has_unclaimed_pdus(destination)
+        ):
+            loop_id = min(
+                set(range(self._max_transactions_in_flight)) - active_loops
+            )
+        else:
             # XXX: pending_transactions can get stuck on by a never-ending
             # request at which point pending_pdus_by_dest just keeps growing.
             # we need application-layer timeouts of some flavour of these
@@ -417,19 +584,32 @@ class TransactionQueue(object):
             )
             return
 
-        logger.debug("TX [%s] Starting transaction loop", destination)
+        logger.debug("TX [%s] Starting transaction loop %d", destination, loop_id)
 
         run_as_background_process(
             "federation_transaction_transmission_loop",
             self._transaction_transmission_loop,
             destination,
+            loop_id,
         )
 
     @defer.inlineCallbacks
-    def _transaction_transmission_loop(self, destination):
+    def _transaction_transmission_loop(self, destination, loop_id=0):
+        """Sends transactions to the destination until there is nothing left
+        for this loop to send.
+
+        Several of these can run at once for a destination, up to
+        federation_transactions_in_flight_per_destination. Only loop 0 sends
+        EDUs; the others just send PDUs.
+
+        Args:
+            destination (str)
+            loop_id (int): which of the destination's loops this is
+        """
         pending_pdus = []
+        failed = True
         try:
-            self.pending_transactions[destination] = 1
+            self.pending_transactions.setdefault(destination, set()).add(loop_id)
 
             # This will throw if we wouldn't retry. We do this here so we fail
             # quickly, but we will later check this again in the http client,
@@ -438,9 +618,18 @@ class TransactionQueue(object):
 
             pending_pdus = []
             while True:
-                device_message_edus, device_stream_id, dev_list_id = (
-                    yield self._get_new_device_messages(destination)
-                )
+                # We check this on each iteration, as we may have started
+                # catching up since the last one (if too many PDUs were queued,
+                # or another transaction failed).
+                if loop_id == 0 and destination in self._catching_up_dests:
+                    caught_up = yield self._catch_up_destination(destination)
+                    if not caught_up:
+                        return
+
+                if loop_id == 0:
+                    device_message_edus, device_stream_id, dev_list_id = (
+                        yield self._get_new_device_messages(destination)
+                    )
 
                 # BEGIN CRITICAL SECTION
                 #
@@ -451,43 +640,21 @@ class TransactionQueue(object):
                 # meantime, but not get sent because we hold the
                 # pending_transactions flag.
 
-                pending_pdus = self.pending_pdus_by_dest.pop(destination, [])
-
-                # We can only include at most 50 PDUs per transactions
-                pending_pdus, leftover_pdus = pending_pdus[:50], pending_pdus[50:]
-                if leftover_pdus:
-                    self.pending_pdus_by_dest[destination] = leftover_pdus
-
-                pending_edus = self.pending_edus_by_dest.pop(destination, [])
-
-                # We can only include at most 100 EDUs per transactions
-                pending_edus, leftover_edus = pending_edus[:100], pending_edus[100:]
-                if leftover_edus:
-                    self.pending_edus_by_dest[destination] = leftover_edus
-
-                pending_presence = self.pending_presence_by_dest.pop(destination, {})
-
-                pending_edus.extend(
-                    self.pending_edus_keyed_by_dest.pop(destination, {}).values()
-                )
+                pending_pdus, rooms = self._claim_pending_pdus(destination)
+                if pending_pdus:
+                    self._stream_orderings_in_flight_by_dest.setdefault(
+                        destination, {},
+                    )[loop_id] = min(
+                        pdu.internal_metadata.stream_ordering
+                        for pdu, _ in pending_pdus
+                    )
 
-                pending_edus.extend(device_message_edus)
-                if pending_presence:
-                    pending_edus.append(
-                        Edu(
-                            origin=self.server_name,
-                            destination=destination,
-                            edu_type="m.presence",
-                            content={
-                                "push": [
-                                    format_user_presence_state(
-                                        presence, self.clock.time_msec()
-                                    )
-                                    for presence in pending_presence.values()
-                                ]
-                            },
-                        )
+                if loop_id == 0:
+                    pending_edus = self._pop_pending_edus(
+                        destination, device_message_edus,
                     )
+                else:
+                    pending_edus = []
 
                 if pending_pdus:
                     logger.debug("TX [%s] len(pending_pdus_by_dest[dest]) = %d",
@@ -495,21 +662,54 @@ class TransactionQueue(object):
 
                 if not pending_pdus and not pending_edus:
                     logger.debug("TX [%s] Nothing to send", destination)
-                    self.last_device_stream_id_by_dest[destination] = (
-                        device_stream_id
-                    )
+                    if loop_id == 0:
+                        self.last_device_stream_id_by_dest[destination] = (
+                            device_stream_id
+                        )
+                    failed = False
                     return
 
                 # END CRITICAL SECTION
 
-                success = yield self._send_new_transaction(
-                    destination, pending_pdus, pending_edus,
-                )
+                start = self.clock.time_msec()
+                try:
+                    success = yield self._send_new_transaction(
+                        destination, pending_pdus, pending_edus,
+                    )
+                finally:
+                    self._release_rooms(destination, rooms)
+                    self._release_stream_orderings(destination, loop_id)
+
+                if success and pending_pdus:
+                    self._record_response_time(
+                        destination, self.clock.time_msec() - start,
+                    )
+
+                    # If we are catching up (because another transaction
+                    # failed), we mustn't move the position past the events
+                    # which failed.
+                    if destination not in self._catching_up_dests:
+                        yield self._set_last_successful_stream_ordering(
+                            destination,
+                            self._get_sent_stream_ordering(
+                                destination,
+                                max(
+                                    pdu.internal_metadata.stream_ordering
+                                    for pdu, _ in pending_pdus
+                                ),
+                            ),
+                        )
+
                 if success:
+                    pending_pdus = []
                     sent_transactions_counter.inc()
                     sent_edus_counter.inc(len(pending_edus))
                     for edu in pending_edus:
                         sent_edus_by_type.labels(edu.edu_type).inc()
+
+                    if loop_id != 0:
+                        continue
+
                     # Remove the acknowledged device messages from the database
                     # Only bother if we actually sent some device messages
                     if device_message_edus:
@@ -536,6 +736,7 @@ class TransactionQueue(object):
             )
         except FederationDeniedError as e:
             logger.info(e)
+            failed = False
         except HttpResponseException as e:
             logger.warning(
                 "TX [%s] Received %d response to transaction: %s",
@@ -556,8 +757,336 @@ class TransactionQueue(object):
                 logger.info("Failed to send event %s to %s", p.event_id,
                             destination)
         finally:
+            if failed:
+                self._start_catching_up(destination, pending_pdus)
+
+            self._release_stream_orderings(destination, loop_id)
+
             # We want to be *very* sure we delete this after we stop processing
-            self.pending_transactions.pop(destination, None)
+            active_loops = self.pending_transactions.get(destination)
+            if active_loops is not None:
+                active_loops.discard(loop_id)
+                if not active_loops:
+                    del self.pending_transactions[destination]
+
+    def _start_catching_up(self, destination, failed_pdus):
+        """Called when we fail to send a transaction to a destination, or too
+        many PDUs are queued for it.
+
+        If there were PDUs in the transaction, or waiting to be sent, we drop
+        them and will instead catch the destination up when it is back.
+
+        Args:
+            destination (str)
+            failed_pdus (list[tuple[FrozenEvent, int]]): the PDUs in the
+                transaction which failed, with their order.
+        """
+        failed_pdus = failed_pdus + self.pending_pdus_by_dest.pop(destination, [])
+        if not failed_pdus:
+            return
+
+        logger.info(
+            "TX [%s] Dropping %d unsent events: will catch up instead",
+            destination, len(failed_pdus),
+        )
+
+        self._catching_up_dests.add(destination)
+
+        # Make sure that the events which failed are after the position we have
+        # recorded, so that catching up picks them up.
+        stream_ordering = min(
+            pdu.internal_metadata.stream_ordering for pdu, _ in failed_pdus
+        )
+        run_as_background_process(
+            "federation_rewind_last_successful_stream_ordering",
+            self._set_last_successful_stream_ordering,
+            destination,
+            stream_ordering - 1,
+            True,
+        )
+
+    @defer.inlineCallbacks
+    def _set_last_successful_stream_ordering(
+        self, destination, stream_ordering, rewind=False,
+    ):
+        with (yield self._last_successful_stream_ordering_linearizer.queue(
+            destination,
+        )):
+            yield self.store.set_destination_last_successful_stream_ordering(
+                destination, stream_ordering, rewind,
+            )
+
+    @defer.inlineCallbacks
+    def _catch_up_destination(self, destination):
+        """Sends the destination the latest event we tried to send it in each
+        room where it has missed events, rather than every event it missed. It
+        can then fetch any of the missed events it needs itself.
+
+        Args:
+            destination (str)
+
+        Returns:
+            Deferred[bool]: whether the destination is now caught up. False if
+            we failed to send a transaction to it.
+        """
+        # anything queued in memory will be picked up from the database
+        self.pending_pdus_by_dest.pop(destination, None)
+
+        while True:
+            self._new_events_during_catch_up.discard(destination)
+
+            last_successful_stream_ordering = (
+                yield self.store.get_destination_last_successful_stream_ordering(
+                    destination,
+                )
+            )
+            rows = yield self.store.get_catch_up_room_event_ids(
+                destination,
+                last_successful_stream_ordering or 0,
+                MAX_PDUS_PER_TRANSACTION,
+            )
+
+            if not rows:
+                # we need to check this in the same reactor tick as we stop
+                # catching up, so that we can't miss any events.
+                if destination in self._new_events_during_catch_up:
+                    continue
+
+                logger.info("TX [%s] Caught up", destination)
+                self._catching_up_dests.discard(destination)
+                defer.returnValue(True)
+
+            event_ids = [event_id for _, event_id in rows if event_id is not None]
+            events = yield self.store.get_events(event_ids, allow_rejected=True)
+            pending_pdus = [
+                (events[event_id], order)
+                for order, event_id in enumerate(event_ids)
+                if event_id in events
+            ]
+
+            if pending_pdus:
+                logger.info(
+                    "TX [%s] Catching up with %d rooms", destination, len(pending_pdus),
+                )
+                success = yield self._send_new_transaction(
+                    destination, pending_pdus, [],
+                )
+                if not success:
+                    defer.returnValue(False)
+                sent_transactions_counter.inc()
+
+            yield self._set_last_successful_stream_ordering(destination, rows[-1][0])
+
+    def _wake_destinations_needing_catch_up(self):
+        """Tries to catch up the destinations we have failed to send events
+        to, in case they are back.
+        """
+        for destination in list(self._catching_up_dests):
+            if destination not in self.pending_transactions:
+                self._attempt_new_transaction(destination)
+
+    def _claim_pending_pdus(self, destination):
+        """Takes the PDUs for the next transaction to the destination off its
+        queue.
+
+        PDUs in rooms which are already in a transaction in flight to the
+        destination are left on the queue (along with any later PDUs in those
+        rooms), so that each room's PDUs are sent in order. The rooms of the
+        returned PDUs are marked as in flight; the caller must call
+        _release_rooms once the transaction is complete.
+
+        Args:
+            destination (str)
+
+        Returns:
+            tuple[list[tuple[FrozenEvent, int]], set[str]]: the PDUs, with
+            their order, and the rooms they are in.
+        """
+        pending_pdus = self.pending_pdus_by_dest.pop(destination, [])
+        limit = self._get_pdus_per_transaction(destination)
+        rooms_in_flight = self._rooms_in_flight_by_dest.get(destination, ())
+
+        claimed_pdus = []
+        leftover_pdus = []
+        for i, pdu_and_order in enumerate(pending_pdus):
+            if len(claimed_pdus) >= limit:
+                leftover_pdus.extend(pending_pdus[i:])
+                break
+
+            if pdu_and_order[0].room_id in rooms_in_flight:
+                leftover_pdus.append(pdu_and_order)
+            else:
+                claimed_pdus.append(pdu_and_order)
+
+        if leftover_pdus:
+            self.pending_pdus_by_dest[destination] = leftover_pdus
+
+        rooms = set(pdu.room_id for pdu, _ in claimed_pdus)
+        if rooms:
+            self._rooms_in_flight_by_dest.setdefault(destination, set()).update(rooms)
+
+        return claimed_pdus, rooms
+
+    def _release_rooms(self, destination, rooms):
+        """Marks rooms returned by _claim_pending_pdus as no longer in flight.
+
+        Args:
+            destination (str)
+            rooms (set[str])
+        """
+        rooms_in_flight = self._rooms_in_flight_by_dest.get(destination)
+        if rooms_in_flight is None:
+            return
+
+        rooms_in_flight.difference_update(rooms)
+        if not rooms_in_flight:
+            del self._rooms_in_flight_by_dest[destination]
+
+    def _release_stream_orderings(self, destination, loop_id):
+        """Marks the PDUs which a loop had in flight to a destination as no
+        longer in flight.
+
+        Args:
+            destination (str)
+            loop_id (int)
+        """
+        stream_orderings = self._stream_orderings_in_flight_by_dest.get(destination)
+        if stream_orderings is None:
+            return
+
+        stream_orderings.pop(loop_id, None)
+        if not stream_orderings:
+            del self._stream_orderings_in_flight_by_dest[destination]
+
+    def _get_sent_stream_ordering(self, destination, stream_ordering):
+        """Works out how far through the event stream the destination has been
+        sent everything, after a transaction up to stream_ordering succeeded.
+
+        That is up to stream_ordering, unless there are earlier PDUs for the
+        destination which are still in flight in another transaction, queued,
+        or yet to be queued, in which case it is up to just before the first
+        of those.
+
+        Args:
+            destination (str)
+            stream_ordering (int): the latest stream ordering of the PDUs in
+                the transaction which succeeded.
+
+        Returns:
+            int
+        """
+        unsent = list(itervalues(
+            self._stream_orderings_in_flight_by_dest.get(destination, {})
+        ))
+        unsent.extend(
+            pdu.internal_metadata.stream_ordering
+            for pdu, _ in self.pending_pdus_by_dest.get(destination, ())
+        )
+        unsent.extend(self._stream_orderings_being_queued)
+
+        if unsent:
+            stream_ordering = min(stream_ordering, min(unsent) - 1)
+        return stream_ordering
+
+    def _has_unclaimed_pdus(self, destination):
+        """Whether there are PDUs queued for the destination which aren't
+        blocked behind a transaction in flight.
+        """
+        rooms_in_flight = self._rooms_in_flight_by_dest.get(destination, ())
+        return any(
+            pdu.room_id not in rooms_in_flight
+            for pdu, _ in self.pending_pdus_by_dest.get(destination, ())
+        )
+
+    def _pop_pending_edus(self, destination, device_message_edus):
+        """Takes the EDUs for the next transaction to the destination off its
+        queues.
+
+        Args:
+            destination (str)
+            device_message_edus (list[Edu]): EDUs for the to-device messages
+                and device list updates to send.
+
+        Returns:
+            list[Edu]
+        """
+        pending_edus = self.pending_edus_by_dest.pop(destination, [])
+
+        pending_edus, leftover_edus = (
+            pending_edus[:MAX_EDUS_PER_TRANSACTION],
+            pending_edus[MAX_EDUS_PER_TRANSACTION:],
+        )
+        if leftover_edus:
+            self.pending_edus_by_dest[destination] = leftover_edus
+
+        pending_presence = self.pending_presence_by_dest.pop(destination, {})
+
+        # Take as many of the keyed EDUs as will fit, oldest first.
+        pending_edus_keyed = self.pending_edus_keyed_by_dest.get(destination, {})
+        while pending_edus_keyed and len(pending_edus) < MAX_EDUS_PER_TRANSACTION:
+            pending_edus.append(pending_edus_keyed.popitem(last=False)[1])
+        if not pending_edus_keyed:
+            self.pending_edus_keyed_by_dest.pop(destination, None)
+
+        pending_edus.extend(device_message_edus)
+        if pending_presence:
+            pending_edus.append(
+                Edu(
+                    origin=self.server_name,
+                    destination=destination,
+                    edu_type="m.presence",
+                    content={
+                        "push": [
+                            format_user_presence_state(
+                                presence, self.clock.time_msec()
+                            )
+                            for presence in pending_presence.values()
+                        ]
+                    },
+                )
+            )
+
+        return pending_edus
+
+    def _get_largest_queues(self):
+        """Gets the number of PDUs and EDUs queued for the destinations with
+        the most, for the metrics.
+
+        Returns:
+            dict[tuple[str], int]
+        """
+        queue_sizes = {}
+        for queues in (
+            self.pending_pdus_by_dest,
+            self.pending_edus_by_dest,
+            self.pending_edus_keyed_by_dest,
+            self.pending_presence_by_dest,
+        ):
+            for destination, queue in iteritems(queues):
+                queue_sizes[destination] = queue_sizes.get(destination, 0) + len(queue)
+
+        largest = heapq.nlargest(
+            NUM_LARGEST_QUEUES_TO_REPORT, iteritems(queue_sizes), key=lambda e: e[1],
+        )
+        return {(destination,): size for destination, size in largest}
+
+    def _get_pdus_per_transaction(self, destination):
+        batch_sizer = self._batch_sizers_by_dest.get(destination)
+        if batch_sizer is None:
+            return MAX_PDUS_PER_TRANSACTION
+        return batch_sizer.pdus_per_transaction
+
+    def _record_response_time(self, destination, response_time_ms):
+        # Smaller transactions only help if we can send several at once.
+        if self._max_transactions_in_flight == 1:
+            return
+
+        batch_sizer = self._batch_sizers_by_dest.get(destination)
+        if batch_sizer is None:
+            batch_sizer = _TransactionBatchSizer()
+            self._batch_sizers_by_dest[destination] = batch_sizer
+
+        batch_sizer.record_response_time(response_time_ms)
 
     @defer.inlineCallbacks
     def _get_new_device_messages(self, destination):
@@ -697,3 +1226,38 @@ class TransactionQueue(object):
             success = False
 
         defer.returnValue(success)
+
+
+class _TransactionBatchSizer(object):
+    """Decides how many PDUs to put in each transaction to a destination, based
+    on how long it has been taking to respond.
+
+    If transactions are taking longer than TARGET_TRANSACTION_TIME_MS, we halve
+    the number of PDUs in each, so that the PDUs are spread over more of the
+    transactions we send in parallel. Once the destination is responding well
+    within the target, we allow more again.
+    """
+
+    def __init__(self):
+        self.pdus_per_transaction = MAX_PDUS_PER_TRANSACTION
+
+        # exponentially weighted moving average of the response time
+        self.response_time_ms = None
+
+    def record_response_time(self, response_time_ms):
+        if self.response_time_ms is None:
+            self.response_time_ms = response_time_ms
+        else:
+            self.response_time_ms = (
+                0.7 * self.response_time_ms + 0.3 * response_time_ms
+            )
+
+        if self.response_time_ms > TARGET_TRANSACTION_TIME_MS:
+            self.pdus_per_transaction = max(
+                MIN_PDUS_PER_TRANSACTION, self.pdus_per_transaction // 2,
+            )
+        elif self.response_time_ms < TARGET_TRANSACTION_TIME_MS / 2:
+            self.pdus_per_transaction = min(
+                MAX_PDUS_PER_TRANSACTION,
+                self.pdus_per_transaction + MIN_PDUS_PER_TRANSACTION,
+            )
@@ -20,7 +20,7 @@ from twisted.python.failure import Failure
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import SynapseError
-from synapse.events.utils import serialize_event
+from synapse.events.utils import serialize_event_json
 from synapse.storage.state import StateFilter
 from synapse.types import RoomStreamToken
 from synapse.util.async_helpers import ReadWriteLock
@@ -40,6 +40,9 @@ class PurgeStatus(object):
     Attributes:
         status (int): Tracks whether this request has completed. One of
             STATUS_{ACTIVE,COMPLETE,FAILED}
+        events_processed (int): the number of events dealt with so far
+        events_total (int|None): the number of events to deal with, once we
+            know it
     """
 
     STATUS_ACTIVE = 0
@@ -54,10 +57,18 @@ class PurgeStatus(object):
 
     def __init__(self):
         self.status = PurgeStatus.STATUS_ACTIVE
+        self.events_processed = 0
+        self.events_total = None
+
+    def update_progress(self, events_processed, events_total):
+        self.events_processed = events_processed
+        self.events_total = events_total
 
     def asdict(self):
         return {
-            "status": PurgeStatus.STATUS_TEXT[self.status]
+            "status": PurgeStatus.STATUS_TEXT[self.status],
+            "events_processed": self.events_processed,
+            "events_total": self.events_total,
         }
 
 
@@ -112,6 +123,25 @@ class PaginationHandler(object):
         )
         return purge_id
 
+    @defer.inlineCallbacks
+    def resume_unfinished_purges(self):
+        """Carry on with any purges which were interrupted by a restart.
+
+        Returns:
+            Deferred
+        """
+        purges = yield self.store.get_unfinished_purges()
+        for purge in purges:
+            purge_id = purge["purge_id"]
+            logger.info("[purge] resuming purge_id %s", purge_id)
+
+            self._purges_by_id[purge_id] = PurgeStatus()
+            run_in_background(
+                self._purge_history,
+                purge_id, purge["room_id"], purge["token"],
+                bool(purge["delete_local_events"]),
+            )
+
     @defer.inlineCallbacks
     def _purge_history(self, purge_id, room_id, token,
                        delete_local_events):
@@ -132,6 +162,8 @@ class PaginationHandler(object):
             with (yield self.pagination_lock.write(room_id)):
                 yield self.store.purge_history(
                     room_id, token, delete_local_events,
+                    purge_id=purge_id,
+                    progress_callback=self._purges_by_id[purge_id].update_progress,
                 )
             logger.info("[purge] complete")
             self._purges_by_id[purge_id].status = PurgeStatus.STATUS_COMPLETE
@@ -279,7 +311,7 @@ class PaginationHandler(object):
 
         chunk = {
             "chunk": [
-                serialize_event(e, time_now, as_client_event)
+                serialize_event_json(e, time_now, as_client_event)
                 for e in events
             ],
             "start": pagin_config.from_token.to_string(),
@@ -288,7 +320,7 @@ class PaginationHandler(object):
 
         if state:
             chunk["state"] = [
-                serialize_event(e, time_now, as_client_event)
+                serialize_event_json(e, time_now, as_client_event)
                 for e in state
             ]
 
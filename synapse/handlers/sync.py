@@ -20,6 +20,7 @@ import logging
 
 from six import iteritems, itervalues
 
+from canonicaljson import encode_canonical_json
 from prometheus_client import Counter
 
 from twisted.internet import defer
@@ -30,12 +31,12 @@ from synapse.storage.roommember import MemberSummary
 from synapse.storage.state import StateFilter
 from synapse.types import RoomStreamToken
 from synapse.util.async_helpers import concurrently_execute
+from synapse.util.caches import get_cache_factor_for
 from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.caches.lrucache import LruCache
 from synapse.util.caches.response_cache import ResponseCache
 from synapse.util.logcontext import LoggingContext
 from synapse.util.metrics import Measure, measure_func
-from synapse.visibility import filter_events_for_client
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +61,15 @@ LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
 # avoiding redundantly sending the same lazy-loaded members to the client
 LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 100
 
+# How long we keep sync results around for, so that we can send them again if a
+# client repeats a sync request (typically because it didn't get the response
+# the first time).
+SYNC_RESULT_CACHE_MAX_AGE = 60 * 1000
+
+# The maximum number of sync results to keep around, before applying the cache
+# factor.
+SYNC_RESULT_CACHE_MAX_SIZE = 1000
+
 
 SyncConfig = collections.namedtuple("SyncConfig", [
     "user",
@@ -210,6 +220,7 @@ class SyncHandler(object):
         self.clock = hs.get_clock()
         self.response_cache = ResponseCache(hs, "sync")
         self.state = hs.get_state_handler()
+        self.client_event_filter = hs.get_client_event_filter()
         self.auth = hs.get_auth()
 
         # ExpiringCache((User, Device)) -> LruCache(state_key => event_id)
@@ -218,6 +229,15 @@ class SyncHandler(object):
             max_len=0, expiry_ms=LAZY_LOADED_MEMBERS_CACHE_MAX_AGE,
         )
 
+        # ExpiringCache((user_id, device_id, since, filter)) -> SyncResult
+        self.sync_result_cache = ExpiringCache(
+            "sync_result_cache", self.clock,
+            max_len=int(
+                SYNC_RESULT_CACHE_MAX_SIZE * get_cache_factor_for("sync_result_cache")
+            ),
+            expiry_ms=SYNC_RESULT_CACHE_MAX_AGE,
+        )
+
     @defer.inlineCallbacks
     def wait_for_sync_for_user(self, sync_config, since_token=None, timeout=0,
                                full_state=False):
@@ -254,6 +274,27 @@ class SyncHandler(object):
         if context:
             context.tag = sync_type
 
+        # We only cache the results of incremental syncs: initial syncs are
+        # rarer, and their results too big to keep around.
+        cache_key = None
+        if since_token is not None and not full_state:
+            cache_key = (
+                sync_config.user.to_string(),
+                sync_config.device_id,
+                since_token.to_string(),
+                encode_canonical_json(
+                    sync_config.filter_collection.get_filter_json()
+                ),
+            )
+
+        result = self.sync_result_cache.get(cache_key) if cache_key else None
+        if result is not None:
+            is_current = yield self._is_sync_result_current(sync_config, result)
+            if is_current:
+                logger.debug("Returning cached sync result for %r", cache_key)
+                defer.returnValue(result)
+            self.sync_result_cache.pop(cache_key, None)
+
         if timeout == 0 or since_token is None or full_state:
             # we are going to return immediately, so don't bother calling
             # notifier.wait_for_events.
@@ -276,8 +317,67 @@ class SyncHandler(object):
                 lazy_loaded = "false"
             non_empty_sync_counter.labels(sync_type, lazy_loaded).inc()
 
+            # If the sync didn't move the client on (which can happen if one of
+            # the streams has gone backwards), then sending the same result
+            # again would put the client in a loop.
+            if cache_key and result.next_batch.to_string() != cache_key[2]:
+                self.sync_result_cache[cache_key] = result
+
         defer.returnValue(result)
 
+    @defer.inlineCallbacks
+    def _is_sync_result_current(self, sync_config, sync_result):
+        """Check if a sync result we generated earlier is still up to date, so
+        that we can send it again rather than generating a new one.
+
+        We only check the streams where we can cheaply tell if anything has
+        changed for the user, using the stream change caches: their rooms, their
+        memberships, their account data and their device's inbox. Changes to
+        anything else (presence, typing, receipts, etc) will be picked up by the
+        client's next sync, so all we lose by ignoring them is a bit of latency,
+        which is bounded by SYNC_RESULT_CACHE_MAX_AGE.
+
+        Args:
+            sync_config (SyncConfig)
+            sync_result (SyncResult)
+
+        Returns:
+            Deferred[bool]: True if nothing has changed since the result was
+            generated.
+        """
+        user_id = sync_config.user.to_string()
+        since_token = sync_result.next_batch
+        now_token = yield self.event_sources.get_current_token()
+
+        room_ids = yield self.store.get_rooms_for_user(user_id)
+        if self.store.get_rooms_that_changed(room_ids, since_token.room_key):
+            defer.returnValue(False)
+
+        membership_changes = yield self.store.get_membership_changes_for_user(
+            user_id, since_token.room_key, now_token.room_key,
+        )
+        if membership_changes:
+            defer.returnValue(False)
+
+        account_data, account_data_by_room = (
+            yield self.store.get_updated_account_data_for_user(
+                user_id, since_token.account_data_key,
+            )
+        )
+        if account_data or account_data_by_room:
+            defer.returnValue(False)
+
+        if sync_config.device_id:
+            messages, _ = yield self.store.get_new_messages_for_device(
+                user_id, sync_config.device_id,
+                since_token.to_device_key, now_token.to_device_key,
+                limit=1,
+            )
+            if messages:
+                defer.returnValue(False)
+
+        defer.returnValue(True)
+
     def current_sync_for_user(self, sync_config, since_token=None,
                               full_state=False):
         """Get the sync for client needed to match what the server has now.
@@ -383,8 +483,7 @@ class SyncHandler(object):
                     current_state_ids = yield self.state.get_current_state_ids(room_id)
                     current_state_ids = frozenset(itervalues(current_state_ids))
 
-                recents = yield filter_events_for_client(
-                    self.store,
+                recents = yield self.client_event_filter.filter_events_for_client(
                     sync_config.user.to_string(),
                     recents,
                     always_include_ids=current_state_ids,
@@ -440,8 +539,7 @@ class SyncHandler(object):
                     current_state_ids = yield self.state.get_current_state_ids(room_id)
                     current_state_ids = frozenset(itervalues(current_state_ids))
 
-                loaded_recents = yield filter_events_for_client(
-                    self.store,
+                loaded_recents = yield self.client_event_filter.filter_events_for_client(
                     sync_config.user.to_string(),
                     loaded_recents,
                     always_include_ids=current_state_ids,
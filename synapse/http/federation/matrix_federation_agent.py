@@ -19,6 +19,7 @@ import time
 
 import attr
 from netaddr import IPAddress
+from prometheus_client import Counter, Histogram
 from zope.interface import implementer
 
 from twisted.internet import defer
@@ -50,6 +51,21 @@ WELL_KNOWN_MAX_CACHE_PERIOD = 48 * 3600
 logger = logging.getLogger(__name__)
 well_known_cache = TTLCache('well-known')
 
+connection_pool_hits_counter = Counter(
+    "synapse_http_federation_connection_pool_hits",
+    "Number of requests to remote servers which reused an idle connection",
+)
+
+new_connections_counter = Counter(
+    "synapse_http_federation_new_connections",
+    "Number of new connections (and hence TLS handshakes) made to remote servers",
+)
+
+connect_time_histogram = Histogram(
+    "synapse_http_federation_connect_time_seconds",
+    "Time taken to connect to remote servers",
+)
+
 
 @implementer(IAgent)
 class MatrixFederationAgent(object):
@@ -68,6 +84,12 @@ class MatrixFederationAgent(object):
             TLS policy to use for fetching .well-known files. None to use a default
             (browser-like) implementation.
 
+        max_idle_connections_per_host (int): how many idle connections to keep
+            open to each server, for later requests to reuse.
+
+        idle_connection_timeout (float): how long, in seconds, to keep idle
+            connections open.
+
         srv_resolver (SrvResolver|None):
             SRVResolver impl to use for looking up SRV records. None to use a default
             implementation.
@@ -75,6 +97,8 @@ class MatrixFederationAgent(object):
 
     def __init__(
         self, reactor, tls_client_options_factory,
+        max_idle_connections_per_host=5,
+        idle_connection_timeout=2 * 60,
         _well_known_tls_policy=None,
         _srv_resolver=None,
         _well_known_cache=well_known_cache,
@@ -87,10 +111,12 @@ class MatrixFederationAgent(object):
             _srv_resolver = SrvResolver()
         self._srv_resolver = _srv_resolver
 
-        self._pool = HTTPConnectionPool(reactor)
+        # connections are pooled by the matrix:// URI, so each destination gets
+        # its own set of idle connections.
+        self._pool = _MeasuredHTTPConnectionPool(reactor)
         self._pool.retryAutomatically = False
-        self._pool.maxPersistentPerHost = 5
-        self._pool.cachedConnectionTimeout = 2 * 60
+        self._pool.maxPersistentPerHost = max_idle_connections_per_host
+        self._pool.cachedConnectionTimeout = idle_connection_timeout
 
         agent_args = {}
         if _well_known_tls_policy is not None:
@@ -357,6 +383,31 @@ class MatrixFederationAgent(object):
         defer.returnValue((result, cache_period))
 
 
+class _MeasuredHTTPConnectionPool(HTTPConnectionPool):
+    """An HTTPConnectionPool which records metrics about how often connections
+    are reused, and how long it takes to make new ones.
+    """
+    def getConnection(self, key, endpoint):
+        # the pool will hand out the first quiescent connection it has for the
+        # key, if any.
+        connections = self._connections.get(key, ())
+        if any(c.state == "QUIESCENT" for c in connections):
+            connection_pool_hits_counter.inc()
+        return super(_MeasuredHTTPConnectionPool, self).getConnection(key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        new_connections_counter.inc()
+        start = self._reactor.seconds()
+
+        def _connected(res):
+            connect_time_histogram.observe(self._reactor.seconds() - start)
+            return res
+
+        d = super(_MeasuredHTTPConnectionPool, self)._newConnection(key, endpoint)
+        d.addCallback(_connected)
+        return d
+
+
 @implementer(IStreamClientEndpoint)
 class LoggingHostnameEndpoint(object):
     """A wrapper for HostnameEndpint which logs when it connects"""
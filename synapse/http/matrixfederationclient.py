@@ -177,6 +177,10 @@ class MatrixFederationHttpClient(object):
         self.agent = MatrixFederationAgent(
             hs.get_reactor(),
             tls_client_options_factory,
+            max_idle_connections_per_host=(
+                hs.config.federation_max_idle_connections_per_destination
+            ),
+            idle_connection_timeout=hs.config.federation_idle_connection_timeout,
         )
         self.clock = hs.get_clock()
         self._store = hs.get_datastore()
@@ -21,17 +21,15 @@ import logging
 from six import PY3
 from six.moves import http_client, urllib
 
-from canonicaljson import encode_canonical_json, encode_pretty_printed_json, json
+from zope.interface import implementer
 
-from twisted.internet import defer
+from twisted.internet import defer, interfaces
 from twisted.python import failure
 from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.static import NoRangeStaticProducer
 from twisted.web.util import redirectTo
 
-import synapse.events
-import synapse.metrics
 from synapse.api.errors import (
     CodeMessageException,
     Codes,
@@ -39,6 +37,7 @@ from synapse.api.errors import (
     UnrecognizedRequestError,
 )
 from synapse.util.caches import intern_dict
+from synapse.util.encodedjson import encode_json, iterencode_json
 from synapse.util.logcontext import preserve_fn
 
 if PY3:
@@ -48,6 +47,10 @@ else:
 
 logger = logging.getLogger(__name__)
 
+# Responses bigger than this are streamed to the client as they are encoded, in
+# chunks of (roughly) this size.
+JSON_RESPONSE_CHUNK_SIZE = 64 * 1024
+
 HTML_ERROR_TEMPLATE = """<!DOCTYPE html>
 <html lang=en>
   <head>
@@ -416,20 +419,36 @@ def respond_with_json(request, code, json_object, send_cors=False,
         return
 
     if pretty_print:
-        json_bytes = encode_pretty_printed_json(json_object) + b"\n"
-    else:
-        if canonical_json or synapse.events.USE_FROZEN_DICTS:
-            # canonicaljson already encodes to bytes
-            json_bytes = encode_canonical_json(json_object)
-        else:
-            json_bytes = json.dumps(json_object).encode("utf-8")
+        json_bytes = encode_json(json_object, pretty_print=True) + b"\n"
+        return respond_with_json_bytes(
+            request, code, json_bytes,
+            send_cors=send_cors,
+            response_code_message=response_code_message,
+        )
+
+    chunks = iterencode_json(json_object, canonical=canonical_json)
 
-    return respond_with_json_bytes(
-        request, code, json_bytes,
+    # Most responses are small, so we encode the first part of the response
+    # straight away. If that turns out to be the whole thing, we can send it
+    # with a Content-Length as normal; otherwise we stream the rest of it.
+    json_bytes, finished = _read_json_chunks(chunks)
+    if finished:
+        return respond_with_json_bytes(
+            request, code, json_bytes,
+            send_cors=send_cors,
+            response_code_message=response_code_message,
+        )
+
+    _set_json_response_headers(
+        request, code,
         send_cors=send_cors,
         response_code_message=response_code_message,
     )
 
+    producer = _JsonResponseProducer(request, json_bytes, chunks)
+    producer.start()
+    return NOT_DONE_YET
+
 
 def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
                             response_code_message=None):
@@ -444,13 +463,12 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
     Returns:
         twisted.web.server.NOT_DONE_YET"""
 
-    request.setResponseCode(code, message=response_code_message)
-    request.setHeader(b"Content-Type", b"application/json")
+    _set_json_response_headers(
+        request, code,
+        send_cors=send_cors,
+        response_code_message=response_code_message,
+    )
     request.setHeader(b"Content-Length", b"%d" % (len(json_bytes),))
-    request.setHeader(b"Cache-Control", b"no-cache, no-store, must-revalidate")
-
-    if send_cors:
-        set_cors_headers(request)
 
     # todo: we can almost certainly avoid this copy and encode the json straight into
     # the bytesIO, but it would involve faffing around with string->bytes wrappers.
@@ -461,6 +479,94 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
     return NOT_DONE_YET
 
 
+def _set_json_response_headers(request, code, send_cors=False,
+                               response_code_message=None):
+    request.setResponseCode(code, message=response_code_message)
+    request.setHeader(b"Content-Type", b"application/json")
+    request.setHeader(b"Cache-Control", b"no-cache, no-store, must-revalidate")
+
+    if send_cors:
+        set_cors_headers(request)
+
+
+def _read_json_chunks(chunks):
+    """Read up to JSON_RESPONSE_CHUNK_SIZE bytes (or so) of an encoded response
+
+    Args:
+        chunks (iterator[bytes]): the rest of the response
+
+    Returns:
+        Tuple[bytes, bool]: the bytes read, and whether that was the end of the
+            response.
+    """
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= JSON_RESPONSE_CHUNK_SIZE:
+            return b"".join(buf), False
+
+    return b"".join(buf), True
+
+
+@implementer(interfaces.IPullProducer)
+class _JsonResponseProducer(object):
+    """Writes a JSON response to a request as it is encoded.
+
+    Each time the request is ready for more data, we encode and write the next
+    part of the response, so that we don't have to hold the whole of a large
+    response in memory, or block the reactor while we encode it.
+    """
+
+    def __init__(self, request, json_bytes, chunks):
+        """
+        Args:
+            request (twisted.web.http.Request): The http request to respond to.
+            json_bytes (bytes): the start of the response, which has already
+                been encoded.
+            chunks (iterator[bytes]): the rest of the response.
+        """
+        self._request = request
+        self._json_bytes = json_bytes
+        self._chunks = chunks
+
+    def start(self):
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self._request:
+            return
+
+        json_bytes = self._json_bytes
+        if json_bytes is not None:
+            self._json_bytes = None
+            self._request.write(json_bytes)
+            return
+
+        try:
+            json_bytes, finished = _read_json_chunks(self._chunks)
+        except Exception:
+            # it's too late to send an error, so we can only drop the connection
+            logger.exception("Failed to encode JSON response")
+            self._request.unregisterProducer()
+            self._request.loseConnection()
+            self._request = None
+            return
+
+        if json_bytes:
+            self._request.write(json_bytes)
+
+        if finished:
+            self._request.unregisterProducer()
+            self._request.finish()
+            self._request = None
+
+    def stopProducing(self):
+        self._request = None
+        self._chunks = None
+
+
 def set_cors_headers(request):
     """Set the CORs headers so that javascript running in a web browsers can
     use this API
@@ -14,9 +14,9 @@
 # limitations under the License.
 
 import logging
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -30,7 +30,6 @@ from synapse.util.async_helpers import ObservableDeferred, timeout_deferred
 from synapse.util.logcontext import PreserveLoggingContext
 from synapse.util.logutils import log_function
 from synapse.util.metrics import Measure
-from synapse.visibility import filter_events_for_client
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +38,20 @@ notified_events_counter = Counter("synapse_notifier_notified_events", "")
 users_woken_by_stream_counter = Counter(
     "synapse_notifier_users_woken_by_stream", "", ["stream"])
 
+room_fan_out_streams = Histogram(
+    "synapse_notifier_room_fan_out_streams",
+    "Number of user streams woken up by a notification for some rooms",
+    ["stream"],
+    buckets=[1, 10, 100, 1000, 5000, 10000, 50000],
+)
+room_fan_out_latency = Histogram(
+    "synapse_notifier_room_fan_out_latency_seconds",
+    "Time taken to wake up all the user streams for a notification for some "
+    "rooms (sec)",
+    ["stream"],
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+)
+
 
 # TODO(paul): Should be shared somewhere
 def count(func, l):
@@ -95,15 +108,26 @@ class _NotifierUserStream(object):
             stream_id(str): The new id for the stream the event came from.
             time_now_ms(int): The current time in milliseconds.
         """
-        self.current_token = self.current_token.copy_and_advance(
-            stream_key, stream_id
-        )
+        self.notify_many([(stream_key, stream_id)], time_now_ms)
+
+    def notify_many(self, updates, time_now_ms):
+        """Notify any listeners for this user of new events from a number of
+        event sources, waking them up just once.
+        Args:
+            updates(list[tuple[str, str]]): The stream each event came from,
+                and the new id for that stream, in the order they happened.
+            time_now_ms(int): The current time in milliseconds.
+        """
+        for stream_key, stream_id in updates:
+            self.current_token = self.current_token.copy_and_advance(
+                stream_key, stream_id
+            )
+            users_woken_by_stream_counter.labels(stream_key).inc()
+
         self.last_notified_token = self.current_token
         self.last_notified_ms = time_now_ms
         noify_deferred = self.notify_deferred
 
-        users_woken_by_stream_counter.labels(stream_key).inc()
-
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
             noify_deferred.callback(self.current_token)
@@ -173,6 +197,18 @@ class Notifier(object):
             self.federation_sender = None
 
         self.state_handler = hs.get_state_handler()
+        self.client_event_filter = hs.get_client_event_filter()
+
+        self._batch_window_ms = hs.config.notifier_batch_window_ms
+        self._batch_size = hs.config.notifier_batch_size
+
+        # Notifications waiting for the batch window to end: a map from
+        # _NotifierUserStream to the list of (stream_key, new_token) updates
+        # for it, and a list of (stream_key, time) for each notification for
+        # some rooms, for the fan out latency metric.
+        self._pending_notifications = OrderedDict()
+        self._pending_room_notifications = []
+        self._wake_up_scheduled = False
 
         self.clock.looping_call(
             self.remove_expired_streams, self.UNUSED_STREAM_EXPIRY_MS
@@ -291,14 +327,90 @@ class Notifier(object):
                     user_streams |= self.room_to_user_streams.get(room, set())
 
                 time_now_ms = self.clock.time_msec()
-                for user_stream in user_streams:
-                    try:
-                        user_stream.notify(stream_key, new_token, time_now_ms)
-                    except Exception:
-                        logger.exception("Failed to notify listener")
+
+                if rooms:
+                    room_fan_out_streams.labels(stream_key).observe(
+                        len(user_streams),
+                    )
+
+                if self._batch_window_ms:
+                    # Wake the streams up once the batch window is over.
+                    for user_stream in user_streams:
+                        self._pending_notifications.setdefault(
+                            user_stream, [],
+                        ).append((stream_key, new_token))
+
+                    if rooms:
+                        self._pending_room_notifications.append(
+                            (stream_key, time_now_ms),
+                        )
+
+                    if not self._wake_up_scheduled:
+                        self._wake_up_scheduled = True
+                        self.clock.call_later(
+                            self._batch_window_ms / 1000., self._wake_up_pending,
+                        )
+                else:
+                    for user_stream in user_streams:
+                        try:
+                            user_stream.notify(stream_key, new_token, time_now_ms)
+                        except Exception:
+                            logger.exception("Failed to notify listener")
+
+                    if rooms:
+                        room_fan_out_latency.labels(stream_key).observe(
+                            (self.clock.time_msec() - time_now_ms) / 1000.,
+                        )
 
                 self.notify_replication()
 
+    def _wake_up_pending(self):
+        """Called at the end of a batch window to wake up the user streams
+        that have been notified during it.
+        """
+        pending = list(self._pending_notifications.items())
+        room_notifications = self._pending_room_notifications
+
+        # Any further notifications start a new window.
+        self._pending_notifications = OrderedDict()
+        self._pending_room_notifications = []
+        self._wake_up_scheduled = False
+
+        self._wake_up_streams(pending, 0, room_notifications)
+
+    def _wake_up_streams(self, pending, offset, room_notifications):
+        """Wake up a batch of the user streams that were notified during a
+        batch window, and schedule the rest to be woken up on the next reactor
+        tick, so that a big room doesn't block the reactor for too long.
+
+        Args:
+            pending (list[tuple[_NotifierUserStream, list[tuple[str, str]]]]):
+                the streams to wake up, and the updates for each of them
+            offset (int): the index into `pending` to start from
+            room_notifications (list[tuple[str, int]]): the stream key and
+                time of each notification for some rooms in the batch window
+        """
+        with Measure(self.clock, "notifier_wake_up_streams"):
+            end = offset + self._batch_size
+            time_now_ms = self.clock.time_msec()
+            for user_stream, updates in pending[offset:end]:
+                try:
+                    user_stream.notify_many(updates, time_now_ms)
+                except Exception:
+                    logger.exception("Failed to notify listener")
+
+        if end < len(pending):
+            self.clock.call_later(
+                0, self._wake_up_streams, pending, end, room_notifications,
+            )
+            return
+
+        time_now_ms = self.clock.time_msec()
+        for stream_key, notified_ms in room_notifications:
+            room_fan_out_latency.labels(stream_key).observe(
+                (time_now_ms - notified_ms) / 1000.,
+            )
+
     def on_new_replication_data(self):
         """Used to inform replication listeners that something has happend
         without waking up any of the normal user event streams"""
@@ -418,11 +530,14 @@ class Notifier(object):
                 )
 
                 if name == "room":
-                    new_events = yield filter_events_for_client(
-                        self.store,
-                        user.to_string(),
-                        new_events,
-                        is_peeking=is_peeking,
+                    # lots of users are likely to be woken up by the same
+                    # events, so we use the batching filter.
+                    new_events = yield (
+                        self.client_event_filter.filter_events_for_client(
+                            user.to_string(),
+                            new_events,
+                            is_peeking=is_peeking,
+                        )
                     )
                 elif name == "presence":
                     now = self.clock.time_msec()
@@ -157,7 +157,13 @@ class BulkPushRuleEvaluator(object):
             event, len(room_members), sender_power_level, power_levels,
         )
 
-        condition_cache = {}
+        # Most users in a room have the same push rules (the defaults, give or
+        # take a few changes), so rather than running through everyone's rules
+        # one by one, we group the users by their rules, and run through each
+        # distinct list of rules once for all the users who have it. The lists
+        # are built from the same base rule dicts, which are shared between
+        # users, so we can group them by the identities of their rules.
+        users_by_rules = {}
 
         for uid, rules in iteritems(rules_by_user):
             if event.sender == uid:
@@ -168,6 +174,10 @@ class BulkPushRuleEvaluator(object):
                 if is_ignored:
                     continue
 
+            key = tuple(map(id, rules))
+            users_by_rules.setdefault(key, (rules, []))[1].append(uid)
+
+        def get_display_name(uid):
             display_name = None
             profile_info = room_members.get(uid)
             if profile_info:
@@ -179,19 +189,14 @@ class BulkPushRuleEvaluator(object):
                 if event.type == EventTypes.Member and event.state_key == uid:
                     display_name = event.content.get("displayname", None)
 
-            for rule in rules:
-                if 'enabled' in rule and not rule['enabled']:
-                    continue
+            return display_name
 
-                matches = _condition_checker(
-                    evaluator, rule['conditions'], uid, display_name, condition_cache
-                )
-                if matches:
-                    actions = [x for x in rule['actions'] if x != 'dont_notify']
-                    if actions and 'notify' in actions:
-                        # Push rules say we should notify the user of this event
-                        actions_by_user[uid] = actions
-                    break
+        condition_cache = {}
+
+        for rules, uids in itervalues(users_by_rules):
+            actions_by_user.update(_actions_for_users(
+                evaluator, rules, uids, get_display_name, condition_cache,
+            ))
 
         # Mark in the DB staging area the push actions for users who should be
         # notified for this event. (This will then get handled when we persist
@@ -201,24 +206,101 @@ class BulkPushRuleEvaluator(object):
         )
 
 
-def _condition_checker(evaluator, conditions, uid, display_name, cache):
-    for cond in conditions:
-        _id = cond.get("_id", None)
-        if _id:
-            res = cache.get(_id, None)
-            if res is False:
-                return False
-            elif res is True:
+def _actions_for_users(evaluator, rules, user_ids, get_display_name, cache):
+    """Run through a list of push rules for all the users who have it.
+
+    Conditions which are the same for every user are only checked once per
+    event (and are cached across lists of rules), so we only have to look at
+    the users individually for the few rules which depend on who they are.
+
+    Args:
+        evaluator (PushRuleEvaluatorForEvent)
+        rules (list[dict]): the push rules of the users.
+        user_ids (list[str]): the users to evaluate the rules for.
+        get_display_name (callable[str]): function to get a user's display
+            name in the room.
+        cache (dict): cache of the results of conditions which don't depend on
+            the user.
+
+    Returns:
+        dict[str, list]: the actions for each user that should be notified.
+    """
+    actions_by_user = {}
+
+    for rule in rules:
+        if not user_ids:
+            break
+
+        if 'enabled' in rule and not rule['enabled']:
+            continue
+
+        user_conditions = []
+        matches = True
+        for cond in rule['conditions']:
+            if _is_user_specific_condition(cond):
+                user_conditions.append(cond)
+            elif not _check_condition(evaluator, cond, cache):
+                matches = False
+                break
+
+        if not matches:
+            continue
+
+        if user_conditions:
+            matched_user_ids = [
+                uid for uid in user_ids
+                if all(
+                    evaluator.matches(cond, uid, get_display_name(uid))
+                    for cond in user_conditions
+                )
+            ]
+            if not matched_user_ids:
                 continue
 
-        res = evaluator.matches(cond, uid, display_name)
-        if _id:
-            cache[_id] = bool(res)
+            matched = set(matched_user_ids)
+            user_ids = [uid for uid in user_ids if uid not in matched]
+        else:
+            matched_user_ids = user_ids
+            user_ids = []
+
+        actions = [x for x in rule['actions'] if x != 'dont_notify']
+        if actions and 'notify' in actions:
+            # Push rules say we should notify the users of this event
+            for uid in matched_user_ids:
+                actions_by_user[uid] = actions
 
-        if not res:
-            return False
+    return actions_by_user
 
-    return True
+
+def _is_user_specific_condition(condition):
+    """Whether the result of a push rule condition depends on the user"""
+    kind = condition.get("kind")
+    if kind == "contains_display_name":
+        return True
+    return kind == "event_match" and not condition.get("pattern")
+
+
+def _check_condition(evaluator, condition, cache):
+    """Check a push rule condition which doesn't depend on the user, using the
+    cached result if we've already checked it.
+    """
+    # the default rules have IDs for their conditions, which saves us working
+    # out a key.
+    key = condition.get("_id")
+    if not key:
+        try:
+            key = tuple(sorted(condition.items()))
+            hash(key)
+        except TypeError:
+            # not something we can cache, but this shouldn't happen.
+            return evaluator.matches(condition, None, None)
+
+    res = cache.get(key)
+    if res is None:
+        res = bool(evaluator.matches(condition, None, None))
+        cache[key] = res
+
+    return res
 
 
 class RulesForRoom(object):
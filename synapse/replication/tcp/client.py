@@ -45,6 +45,7 @@ class ReplicationClientFactory(ReconnectingClientFactory):
         self.client_name = client_name
         self.handler = handler
         self.server_name = hs.config.server_name
+        self.protocol_mode = hs.config.worker_replication_protocol
         self._clock = hs.get_clock()  # As self.clock is defined in super class
 
         hs.get_reactor().addSystemEventTrigger("before", "shutdown", self.stopTrying)
@@ -56,7 +57,8 @@ class ReplicationClientFactory(ReconnectingClientFactory):
         logger.info("Connected to replication: %r", addr)
         self.resetDelay()
         return ClientReplicationStreamProtocol(
-            self.client_name, self.server_name, self._clock, self.handler
+            self.client_name, self.server_name, self._clock, self.handler,
+            protocol_mode=self.protocol_mode,
         )
 
     def clientConnectionLost(self, connector, reason):
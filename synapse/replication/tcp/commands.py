@@ -30,6 +30,11 @@ else:
 
 logger = logging.getLogger(__name__)
 
+# The framings a connection can use. See ProtocolCommand.
+PROTOCOL_MODE_TEXT = "text"
+PROTOCOL_MODE_BINARY = "binary"
+PROTOCOL_MODES = (PROTOCOL_MODE_TEXT, PROTOCOL_MODE_BINARY)
+
 
 class Command(object):
     """The base command class.
@@ -59,6 +64,21 @@ class Command(object):
         """
         return self.data
 
+    @classmethod
+    def from_data(cls, data):
+        """Deserialises the body of a binary frame into this command. `data`
+        has already been decoded from msgpack.
+
+        By default the body is just the line that would be sent in text mode.
+        """
+        return cls.from_line(data)
+
+    def to_data(self):
+        """Serialises the command for a binary frame, as an object which can be
+        encoded with msgpack. Does not include the command name.
+        """
+        return self.to_line()
+
     def get_logcontext_id(self):
         """Get a suitable string for the logcontext when processing this command"""
 
@@ -122,10 +142,59 @@ class RdataCommand(Command):
             _json_encoder.encode(self.row),
         ))
 
+    @classmethod
+    def from_data(cls, data):
+        stream_name, token, row = data
+        return cls(stream_name, token, row)
+
+    def to_data(self):
+        return (self.stream_name, self.token, self.row)
+
     def get_logcontext_id(self):
         return "RDATA-" + self.stream_name
 
 
+class RdataBatchCommand(Command):
+    """Sent by server instead of a series of RDATA commands for the same stream,
+    once binary framing has been negotiated (see ProtocolCommand).
+
+    Format::
+
+        RDATA_BATCH <stream_name> <updates_json>
+
+    Where `<updates_json>` is a list of `[<token>, <row>]` pairs, each of which is
+    handled exactly as the equivalent RDATA would be. In particular, `<token>`
+    is null for all but the last of a series of rows with the same stream ID.
+    In a binary frame the body is `[<stream_name>, <updates>]`.
+    """
+    NAME = "RDATA_BATCH"
+
+    def __init__(self, stream_name, updates):
+        self.stream_name = stream_name
+        self.updates = updates
+
+    @classmethod
+    def from_line(cls, line):
+        stream_name, updates_json = line.split(" ", 1)
+        return cls(stream_name, json.loads(updates_json))
+
+    def to_line(self):
+        return " ".join((
+            self.stream_name, _json_encoder.encode(self.updates),
+        ))
+
+    @classmethod
+    def from_data(cls, data):
+        stream_name, updates = data
+        return cls(stream_name, updates)
+
+    def to_data(self):
+        return (self.stream_name, self.updates)
+
+    def get_logcontext_id(self):
+        return "RDATA_BATCH-" + self.stream_name
+
+
 class PositionCommand(Command):
     """Sent by the client to tell the client the stream postition without
     needing to send an RDATA.
@@ -165,6 +234,30 @@ class NameCommand(Command):
     NAME = "NAME"
 
 
+class ProtocolCommand(Command):
+    """Sent by either side to change the framing of every command it sends after
+    this one. The client sends it (if configured to) straight after NAME to
+    ask for binary framing, and the server echoes it back to agree.
+
+    Format::
+
+        PROTOCOL <mode>
+
+    Where <mode> is either "text" or "binary". See
+    synapse/replication/tcp/protocol.py for a description of the binary framing.
+    """
+    NAME = "PROTOCOL"
+
+    def __init__(self, mode):
+        if mode not in PROTOCOL_MODES:
+            raise Exception("Invalid PROTOCOL mode %r" % (mode,))
+        self.data = mode
+
+    @property
+    def mode(self):
+        return self.data
+
+
 class ReplicateCommand(Command):
     """Sent by the client to subscribe to the stream.
 
@@ -364,10 +457,12 @@ COMMAND_MAP = {
     for cmd in (
         ServerCommand,
         RdataCommand,
+        RdataBatchCommand,
         PositionCommand,
         ErrorCommand,
         PingCommand,
         NameCommand,
+        ProtocolCommand,
         ReplicateCommand,
         UserSyncCommand,
         FederationAckCommand,
@@ -382,15 +477,18 @@ COMMAND_MAP = {
 VALID_SERVER_COMMANDS = (
     ServerCommand.NAME,
     RdataCommand.NAME,
+    RdataBatchCommand.NAME,
     PositionCommand.NAME,
     ErrorCommand.NAME,
     PingCommand.NAME,
+    ProtocolCommand.NAME,
     SyncCommand.NAME,
 )
 
 # The commands the client is allowed to send
 VALID_CLIENT_COMMANDS = (
     NameCommand.NAME,
+    ProtocolCommand.NAME,
     ReplicateCommand.NAME,
     PingCommand.NAME,
     UserSyncCommand.NAME,
@@ -47,6 +47,23 @@ indicate which side is sending, these are *not* included on the wire::
     < PING 1490197675618
     > ERROR server stopping
     * connection closed by server *
+
+# Binary framing
+
+Encoding and decoding a line per row is expensive for busy streams, so the
+client can ask for binary framing by sending `PROTOCOL binary` (as a line)
+straight after its `NAME`. Everything a side sends after its own `PROTOCOL`
+command uses the new framing, so the server switches once it has echoed the
+command back.
+
+In binary framing each command is sent as a frame consisting of a four byte,
+big-endian length followed by that many bytes of msgpack encoding
+`[<command_name>, <body>]`. For most commands `<body>` is simply the line that
+would be sent in text mode, but the server sends rows as `RDATA_BATCH` commands,
+each of which carries many rows for a stream under a single header::
+
+    > RDATA_BATCH events [[14, ["$149019767112vOHxz:localhost:8823", ...]],
+        [15, ["$149019767113vOHxz:localhost:8823", ...]]]
 """
 
 import fcntl
@@ -54,12 +71,13 @@ import logging
 import struct
 from collections import defaultdict
 
-from six import iteritems, iterkeys
+from six import PY3, iteritems, iterkeys
 
+import msgpack
 from prometheus_client import Counter
 
 from twisted.internet import defer
-from twisted.protocols.basic import LineOnlyReceiver
+from twisted.protocols.basic import LineReceiver
 from twisted.python.failure import Failure
 
 from synapse.metrics import LaterGauge
@@ -69,12 +87,16 @@ from synapse.util.stringutils import random_string
 
 from .commands import (
     COMMAND_MAP,
+    PROTOCOL_MODE_BINARY,
+    PROTOCOL_MODE_TEXT,
     VALID_CLIENT_COMMANDS,
     VALID_SERVER_COMMANDS,
     ErrorCommand,
     NameCommand,
     PingCommand,
     PositionCommand,
+    ProtocolCommand,
+    RdataBatchCommand,
     RdataCommand,
     ReplicateCommand,
     ServerCommand,
@@ -98,6 +120,13 @@ PING_TIME = 5000
 PING_TIMEOUT_MULTIPLIER = 5
 PING_TIMEOUT_MS = PING_TIME * PING_TIMEOUT_MULTIPLIER
 
+# The header of each frame in binary framing, which is the length of the rest of
+# the frame.
+FRAME_HEADER = struct.Struct(">I")
+
+# The maximum number of rows the server puts in each RDATA_BATCH.
+RDATA_BATCH_SIZE = 500
+
 
 class ConnectionStates(object):
     CONNECTING = "connecting"
@@ -106,12 +135,13 @@ class ConnectionStates(object):
     CLOSED = "closed"
 
 
-class BaseReplicationStreamProtocol(LineOnlyReceiver):
+class BaseReplicationStreamProtocol(LineReceiver):
     """Base replication protocol shared between client and server.
 
-    Reads lines (ignoring blank ones) and parses them into command classes,
-    asserting that they are valid for the given direction, i.e. server commands
-    are only sent by the server.
+    Reads lines (ignoring blank ones), or frames once the remote has switched to
+    binary framing, and parses them into command classes, asserting that they
+    are valid for the given direction, i.e. server commands are only sent by
+    the server.
 
     On receiving a new command it calls `on_<COMMAND_NAME>` with the parsed
     command.
@@ -126,6 +156,8 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
 
     max_line_buffer = 10000
 
+    MAX_FRAME_LENGTH = 16 * 1024 * 1024
+
     def __init__(self, clock):
         self.clock = clock
 
@@ -149,6 +181,13 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
         self.inbound_commands_counter = defaultdict(int)
         self.outbound_commands_counter = defaultdict(int)
 
+        # The framing we're currently sending commands with. We switch after
+        # sending a PROTOCOL command.
+        self.outbound_mode = PROTOCOL_MODE_TEXT
+
+        # Data received in binary framing that doesn't yet make up a whole frame
+        self._frame_buffer = b""
+
     def connectionMade(self):
         logger.info("[%s] Connection established", self.id())
 
@@ -200,6 +239,60 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
         line = line.decode("utf-8")
         cmd_name, rest_of_line = line.split(" ", 1)
 
+        self._command_received(cmd_name, rest_of_line, is_binary=False)
+
+    def rawDataReceived(self, data):
+        """Called when we've received data after the remote switched to binary
+        framing
+        """
+        buf = self._frame_buffer + data
+        offset = 0
+
+        while len(buf) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(buf, offset)
+            if length > self.MAX_FRAME_LENGTH:
+                self._frame_buffer = b""
+                self.send_error("Frame length exceeded")
+                return
+
+            start = offset + FRAME_HEADER.size
+            end = start + length
+            if len(buf) < end:
+                break
+
+            offset = end
+            self._frame_received(buf[start:end])
+
+            if self.transport.disconnecting:
+                return
+
+        self._frame_buffer = buf[offset:]
+
+    def _frame_received(self, frame):
+        """Called when we've received a whole frame
+        """
+        try:
+            if PY3:
+                cmd_name, data = msgpack.loads(frame, raw=False)
+            else:
+                cmd_name, data = msgpack.loads(frame)
+        except Exception as e:
+            logger.exception("[%s] failed to decode frame", self.id())
+            self.send_error("failed to decode frame: %r" % (e,))
+            return
+
+        self._command_received(cmd_name, data, is_binary=True)
+
+    def _command_received(self, cmd_name, body, is_binary):
+        """Parses and handles a command received from the remote.
+
+        Args:
+            cmd_name (str): the name of the command
+            body: the rest of the line, or the decoded body of the frame if
+                `is_binary`
+            is_binary (bool): whether the command was received in binary
+                framing
+        """
         if cmd_name not in self.VALID_INBOUND_COMMANDS:
             logger.error("[%s] invalid command %s", self.id(), cmd_name)
             self.send_error("invalid command: %s", cmd_name)
@@ -212,16 +305,29 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
 
         cmd_cls = COMMAND_MAP[cmd_name]
         try:
-            cmd = cmd_cls.from_line(rest_of_line)
+            if is_binary:
+                cmd = cmd_cls.from_data(body)
+            else:
+                cmd = cmd_cls.from_line(body)
         except Exception as e:
             logger.exception(
-                "[%s] failed to parse line %r: %r", self.id(), cmd_name, rest_of_line
+                "[%s] failed to parse line %r: %r", self.id(), cmd_name, body
             )
             self.send_error(
-                "failed to parse line for  %r: %r (%r):" % (cmd_name, e, rest_of_line)
+                "failed to parse line for  %r: %r (%r):" % (cmd_name, e, body)
             )
             return
 
+        if cmd_name == ProtocolCommand.NAME:
+            # Everything the remote sends after this is in the new framing, so
+            # we have to switch before handling any more of the data we've
+            # received.
+            if cmd.mode == PROTOCOL_MODE_BINARY:
+                self.setRawMode()
+            elif is_binary:
+                self.send_error("can't switch back to text framing")
+                return
+
         # Now lets try and call on_<CMD_NAME> function
         try:
             run_as_background_process(
@@ -230,7 +336,9 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
                 cmd,
             )
         except Exception:
-            logger.exception("[%s] Failed to handle line: %r", self.id(), line)
+            logger.exception(
+                "[%s] Failed to handle command %s: %r", self.id(), cmd_name, body,
+            )
 
     def close(self):
         logger.warn("[%s] Closing connection", self.id())
@@ -264,6 +372,18 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
 
         self.outbound_commands_counter[cmd.NAME] = (
             self.outbound_commands_counter[cmd.NAME] + 1)
+
+        if self.outbound_mode == PROTOCOL_MODE_BINARY:
+            self._send_frame(cmd)
+        else:
+            self._send_line(cmd)
+
+        if cmd.NAME == ProtocolCommand.NAME:
+            self.outbound_mode = cmd.mode
+
+        self.last_sent_command = self.clock.time_msec()
+
+    def _send_line(self, cmd):
         string = "%s %s" % (cmd.NAME, cmd.to_line(),)
         if "\n" in string:
             raise Exception("Unexpected newline in command: %r", string)
@@ -280,7 +400,20 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
 
         self.sendLine(encoded_string)
 
-        self.last_sent_command = self.clock.time_msec()
+    def _send_frame(self, cmd):
+        # We don't use bin types so that, as with JSON, all strings come out as
+        # text on the other side.
+        frame = msgpack.dumps((cmd.NAME, cmd.to_data()), use_bin_type=False)
+
+        if len(frame) > self.MAX_FRAME_LENGTH:
+            raise Exception(
+                "Failed to send command %s as too long (%d > %d)" % (
+                    cmd.NAME,
+                    len(frame), self.MAX_FRAME_LENGTH,
+                )
+            )
+
+        self.transport.write(FRAME_HEADER.pack(len(frame)) + frame)
 
     def _queue_command(self, cmd):
         """Queue the command until the connection is ready to write to again.
@@ -310,6 +443,10 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
     def on_ERROR(self, cmd):
         logger.error("[%s] Remote reported error: %r", self.id(), cmd.data)
 
+    def on_PROTOCOL(self, cmd):
+        # We've already switched framing, in _command_received.
+        logger.info("[%s] Remote switched to %s framing", self.id(), cmd.mode)
+
     def pauseProducing(self):
         """This is called when both the kernel send buffer and the twisted
         tcp connection send buffers have become full.
@@ -407,6 +544,13 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
         logger.info("[%s] Renamed to %r", self.id(), cmd.data)
         self.name = cmd.data
 
+    def on_PROTOCOL(self, cmd):
+        BaseReplicationStreamProtocol.on_PROTOCOL(self, cmd)
+
+        # Agree to use the same framing.
+        if cmd.mode != self.outbound_mode:
+            self.send_command(ProtocolCommand(cmd.mode))
+
     def on_USER_SYNC(self, cmd):
         return self.streamer.on_user_sync(
             self.conn_id, cmd.user_id, cmd.is_syncing, cmd.last_sync_ms,
@@ -467,9 +611,9 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
             )
 
             # Send all the missing updates
-            for update in updates:
-                token, row = update[0], update[1]
-                self.send_command(RdataCommand(stream_name, token, row))
+            self._send_rdata(stream_name, [
+                (update[0], update[1]) for update in updates
+            ])
 
             # We send a POSITION command to ensure that they have an up to
             # date token (especially useful if we didn't send any updates
@@ -478,10 +622,11 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
 
             # Now we can send any updates that came in while we were subscribing
             pending_rdata = self.pending_rdata.pop(stream_name, [])
-            for token, update in pending_rdata:
+            self._send_rdata(stream_name, [
+                (token, update) for token, update in pending_rdata
                 # Only send updates newer than the current token
-                if token > current_token:
-                    self.send_command(RdataCommand(stream_name, token, update))
+                if token > current_token
+            ])
 
             # They're now fully subscribed
             self.replication_streams.add(stream_name)
@@ -491,21 +636,43 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
         finally:
             self.connecting_streams.discard(stream_name)
 
-    def stream_update(self, stream_name, token, data):
-        """Called when a new update is available to stream to clients.
+    def stream_updates(self, stream_name, updates):
+        """Called when new updates are available to stream to clients.
 
         We need to check if the client is interested in the stream or not
+
+        Args:
+            stream_name (str)
+            updates (list[tuple[int|None, tuple]]): list of (token, row) pairs,
+                batched as described in RdataCommand.
         """
         if stream_name in self.replication_streams:
             # The client is subscribed to the stream
-            self.send_command(RdataCommand(stream_name, token, data))
+            self._send_rdata(stream_name, updates)
         elif stream_name in self.connecting_streams:
             # The client is being subscribed to the stream
-            logger.debug("[%s] Queuing RDATA %r %r", self.id(), stream_name, token)
-            self.pending_rdata.setdefault(stream_name, []).append((token, data))
+            logger.debug(
+                "[%s] Queuing %d RDATA %r", self.id(), len(updates), stream_name,
+            )
+            self.pending_rdata.setdefault(stream_name, []).extend(updates)
         else:
             # The client isn't subscribed
-            logger.debug("[%s] Dropping RDATA %r %r", self.id(), stream_name, token)
+            logger.debug(
+                "[%s] Dropping %d RDATA %r", self.id(), len(updates), stream_name,
+            )
+
+    def _send_rdata(self, stream_name, updates):
+        """Sends a list of (token, row) pairs for a stream, either as RDATA
+        commands or, if we're using binary framing, in RDATA_BATCH commands.
+        """
+        if self.outbound_mode == PROTOCOL_MODE_BINARY:
+            for i in range(0, len(updates), RDATA_BATCH_SIZE):
+                self.send_command(RdataBatchCommand(
+                    stream_name, updates[i:i + RDATA_BATCH_SIZE],
+                ))
+        else:
+            for token, row in updates:
+                self.send_command(RdataCommand(stream_name, token, row))
 
     def send_sync(self, data):
         self.send_command(SyncCommand(data))
@@ -519,19 +686,25 @@ class ClientReplicationStreamProtocol(BaseReplicationStreamProtocol):
     VALID_INBOUND_COMMANDS = VALID_SERVER_COMMANDS
     VALID_OUTBOUND_COMMANDS = VALID_CLIENT_COMMANDS
 
-    def __init__(self, client_name, server_name, clock, handler):
+    def __init__(self, client_name, server_name, clock, handler,
+                 protocol_mode=PROTOCOL_MODE_TEXT):
         BaseReplicationStreamProtocol.__init__(self, clock)
 
         self.client_name = client_name
         self.server_name = server_name
         self.handler = handler
 
+        # The framing to ask the server to use
+        self.protocol_mode = protocol_mode
+
         # Map of stream to batched updates. See RdataCommand for info on how
         # batching works.
         self.pending_batches = {}
 
     def connectionMade(self):
         self.send_command(NameCommand(self.client_name))
+        if self.protocol_mode != PROTOCOL_MODE_TEXT:
+            self.send_command(ProtocolCommand(self.protocol_mode))
         BaseReplicationStreamProtocol.connectionMade(self)
 
         # Once we've connected subscribe to the necessary streams
@@ -554,19 +727,26 @@ class ClientReplicationStreamProtocol(BaseReplicationStreamProtocol):
             self.send_error("Wrong remote")
 
     def on_RDATA(self, cmd):
-        stream_name = cmd.stream_name
-        inbound_rdata_count.labels(stream_name).inc()
+        inbound_rdata_count.labels(cmd.stream_name).inc()
+        return self._process_rdata(cmd.stream_name, cmd.token, cmd.row)
+
+    @defer.inlineCallbacks
+    def on_RDATA_BATCH(self, cmd):
+        inbound_rdata_count.labels(cmd.stream_name).inc(len(cmd.updates))
+        for token, row in cmd.updates:
+            yield self._process_rdata(cmd.stream_name, token, row)
 
+    def _process_rdata(self, stream_name, token, raw_row):
         try:
-            row = STREAMS_MAP[stream_name].ROW_TYPE(*cmd.row)
+            row = STREAMS_MAP[stream_name].ROW_TYPE(*raw_row)
         except Exception:
             logger.exception(
                 "[%s] Failed to parse RDATA: %r %r",
-                self.id(), stream_name, cmd.row
+                self.id(), stream_name, raw_row
             )
             raise
 
-        if cmd.token is None:
+        if token is None:
             # I.e. this is part of a batch of updates for this stream. Batch
             # until we get an update for the stream with a non None token
             self.pending_batches.setdefault(stream_name, []).append(row)
@@ -574,7 +754,7 @@ class ClientReplicationStreamProtocol(BaseReplicationStreamProtocol):
             # Check if this is the last of a batch of updates
             rows = self.pending_batches.pop(stream_name, [])
             rows.append(row)
-            return self.handler.on_rdata(stream_name, cmd.token, rows)
+            return self.handler.on_rdata(stream_name, token, rows)
 
     def on_POSITION(self, cmd):
         return self.handler.on_position(cmd.stream_name, cmd.token)
@@ -190,11 +190,10 @@ class ReplicationStreamer(object):
                         batched_updates = _batch_updates(updates)
 
                         for conn in self.connections:
-                            for token, row in batched_updates:
-                                try:
-                                    conn.stream_update(stream.NAME, token, row)
-                                except Exception:
-                                    logger.exception("Failed to replicate")
+                            try:
+                                conn.stream_updates(stream.NAME, batched_updates)
+                            except Exception:
+                                logger.exception("Failed to replicate")
 
             logger.debug("No more pending updates, breaking poke loop")
         finally:
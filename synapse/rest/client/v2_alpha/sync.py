@@ -27,6 +27,7 @@ from synapse.events.utils import (
     format_event_for_client_v2_without_room_id,
     format_event_raw,
     serialize_event,
+    serialize_event_json,
 )
 from synapse.handlers.presence import format_user_presence_state
 from synapse.handlers.sync import SyncConfig
@@ -356,7 +357,7 @@ class SyncRestServlet(RestServlet):
             dict[str, object]: the room, encoded in our response format
         """
         def serialize(event):
-            return serialize_event(
+            return serialize_event_json(
                 event, time_now, token_id=token_id,
                 event_format=event_formatter,
                 only_event_fields=only_fields,
@@ -21,6 +21,7 @@
 # Imports required for the default HomeServer() implementation
 import abc
 import logging
+import os
 
 from twisted.enterprise import adbapi
 from twisted.mail.smtp import sendmail
@@ -87,9 +88,12 @@ from synapse.server_notices.server_notices_manager import ServerNoticesManager
 from synapse.server_notices.server_notices_sender import ServerNoticesSender
 from synapse.server_notices.worker_server_notices_sender import WorkerServerNoticesSender
 from synapse.state import StateHandler, StateResolutionHandler
+from synapse.storage.util.lanes import DatabaseLanes
 from synapse.streams.events import EventSources
 from synapse.util import Clock
+from synapse.util.caches.shared_cache import SharedCache
 from synapse.util.distributor import Distributor
+from synapse.visibility import ClientEventFilter
 
 logger = logging.getLogger(__name__)
 
@@ -123,6 +127,9 @@ class HomeServer(object):
     DEPENDENCIES = [
         'http_client',
         'db_pool',
+        'database_lanes',
+        'shared_event_cache',
+        'shared_state_group_cache',
         'federation_client',
         'federation_server',
         'handlers',
@@ -183,6 +190,7 @@ class HomeServer(object):
         'room_context_handler',
         'sendmail',
         'registration_handler',
+        'client_event_filter',
     ]
 
     # This is overridden in derived application classes
@@ -486,6 +494,31 @@ class HomeServer(object):
     def build_registration_handler(self):
         return RegistrationHandler(self)
 
+    def build_client_event_filter(self):
+        return ClientEventFilter(self)
+
+    def build_database_lanes(self):
+        return DatabaseLanes(self.config.database_lanes)
+
+    def build_shared_event_cache(self):
+        return self._build_shared_cache(
+            "events", self.config.shared_event_cache_size,
+        )
+
+    def build_shared_state_group_cache(self):
+        return self._build_shared_cache(
+            "state_groups", self.config.shared_state_group_cache_size,
+        )
+
+    def _build_shared_cache(self, name, size):
+        directory = self.config.shared_cache_directory
+        if directory is None:
+            return None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return SharedCache(name, os.path.join(directory, name + ".cache"), size)
+
     def remove_pusher(self, app_id, push_key, user_id):
         return self.get_pusherpool().remove_pusher(app_id, push_key, user_id)
 
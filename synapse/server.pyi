@@ -16,6 +16,9 @@ import synapse.server_notices.server_notices_manager
 import synapse.server_notices.server_notices_sender
 import synapse.state
 import synapse.storage
+import synapse.storage.util.lanes
+import synapse.util.caches.shared_cache
+import synapse.visibility
 
 
 class HomeServer(object):
@@ -79,3 +82,17 @@ class HomeServer(object):
 
     def get_server_notices_sender(self) -> synapse.server_notices.server_notices_sender.ServerNoticesSender:
         pass
+
+    def get_client_event_filter(self) -> synapse.visibility.ClientEventFilter:
+        pass
+
+    def get_database_lanes(self) -> synapse.storage.util.lanes.DatabaseLanes:
+        pass
+
+    def get_shared_event_cache(self) -> synapse.util.caches.shared_cache.SharedCache:
+        pass
+
+    def get_shared_state_group_cache(
+        self,
+    ) -> synapse.util.caches.shared_cache.SharedCache:
+        pass
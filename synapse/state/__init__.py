@@ -670,3 +670,21 @@ class StateResolutionStore(object):
         """
 
         return self.store.get_auth_chain_ids(event_ids, include_given=True)
+
+    def get_auth_chain_difference(self, state_sets):
+        """Given sets of state events figure out the auth chain difference (as
+        per state res v2 algorithm).
+
+        This is equivalent to fetching the full auth chain for each set of state
+        and returning the events that don't appear in each and every auth
+        chain.
+
+        Args:
+            state_sets (list[set[str]]): The event IDs of the state sets. Each
+                set of events is included in its own auth chain.
+
+        Returns:
+            Deferred[set[str]]: Set of event IDs.
+        """
+
+        return self.store.get_auth_chain_difference(state_sets)
@@ -17,6 +17,7 @@ import logging
 import sys
 import threading
 import time
+import weakref
 
 from six import PY2, iteritems, iterkeys, itervalues
 from six.moves import builtins, intern, range
@@ -72,21 +73,192 @@ UNIQUE_INDEX_BACKGROUND_UPDATES = {
 _CURRENT_STATE_CACHE_NAME = "cs_cache_fake"
 
 
+# The SQL generated by the _simple_* methods, by the kind of query and the table
+# and columns it uses. See _get_simple_sql.
+_simple_sql_cache = {}
+
+# The SQL generated by the _simple_* methods, mapped to the name to prepare it
+# as on postgres. These only use plain column comparisons and values as
+# parameters, so are safe to run as prepared statements. There are only so many
+# shapes of these queries, so this is never cleared: that way each one keeps
+# the same name, and is only prepared once on each connection.
+_preparable_sql = {}
+
+# The _SQLStatements for the SQL which has been run through LoggingTransaction,
+# by database engine and SQL. Most of our SQL is either constant or generated
+# by the _simple_* methods, so this stays small, but some queries are built
+# with a varying number of parameters, so we start again if it gets big.
+_sql_statement_cache = {}
+_SQL_STATEMENT_CACHE_MAX_ENTRIES = 10000
+
+_prepared_statement_ids = itertools.count()
+
+# The names of the statements which have been prepared on each connection, for
+# postgres, by DB-API connection. (Twisted gives us a new adbapi.Connection
+# wrapper every time we run something on the same underlying connection.)
+_connection_prepared_statements = weakref.WeakKeyDictionary()
+_connection_prepared_statements_lock = threading.Lock()
+
+
+def _get_simple_sql(key, make_sql):
+    """Get the SQL for a query built by one of the _simple_* methods.
+
+    The SQL only depends on the table and columns used by the query, so we
+    build it once for each shape of query, rather than on every call.
+
+    Args:
+        key (tuple): the kind of query, and the table and columns it uses, in
+            the order the parameters are given.
+        make_sql (callable[[], str]): called to build the SQL if we haven't
+            seen this shape of query before.
+
+    Returns:
+        str
+    """
+    sql = _simple_sql_cache.get(key)
+    if sql is None:
+        sql = make_sql()
+        if sql not in _preparable_sql:
+            _preparable_sql[sql] = "synapse_%d" % (next(_prepared_statement_ids),)
+        _simple_sql_cache[key] = sql
+    return sql
+
+
+class _SQLStatement(object):
+    """SQL which has been passed to LoggingTransaction, ready to be run.
+
+    Attributes:
+        one_line_sql (str): the SQL on one line, for logging.
+        sql (str): the SQL in the database's parameter style.
+        verb (str): the first word of the SQL, for metrics.
+        prepared_name (str|None): the name to prepare the SQL as on postgres,
+            or None if it isn't safe to prepare.
+        prepare_sql (str|None): the SQL to prepare it.
+        execute_sql (str|None): the SQL to run the prepared statement.
+    """
+
+    __slots__ = [
+        "one_line_sql", "sql", "verb", "prepared_name", "prepare_sql",
+        "execute_sql",
+    ]
+
+    def __init__(self, database_engine, sql):
+        self.one_line_sql = " ".join(
+            l.strip() for l in sql.splitlines() if l.strip()
+        )
+        self.sql = database_engine.convert_param_style(self.one_line_sql)
+        self.verb = self.sql.split()[0]
+
+        self.prepared_name = _preparable_sql.get(sql)
+        self.prepare_sql = self.execute_sql = None
+        if self.prepared_name is not None:
+            # PREPARE takes numbered parameters, and EXECUTE takes them in the
+            # usual style.
+            parts = self.one_line_sql.split("?")
+            self.prepare_sql = "PREPARE %s AS %s" % (
+                self.prepared_name,
+                "".join(
+                    part if i == 0 else "$%d%s" % (i, part)
+                    for i, part in enumerate(parts)
+                ),
+            )
+            if len(parts) > 1:
+                self.execute_sql = database_engine.convert_param_style(
+                    "EXECUTE %s(%s)" % (
+                        self.prepared_name, ", ".join("?" for _ in parts[1:]),
+                    )
+                )
+            else:
+                self.execute_sql = "EXECUTE %s" % (self.prepared_name,)
+
+
+def _get_sql_statement(database_engine, sql):
+    """Get the _SQLStatement for some SQL, reusing the one from last time it
+    was run if we can.
+
+    Args:
+        database_engine: the engine the SQL will be run with
+        sql (str)
+
+    Returns:
+        _SQLStatement
+    """
+    key = (database_engine, sql)
+    statement = _sql_statement_cache.get(key)
+    if statement is None:
+        if len(_sql_statement_cache) >= _SQL_STATEMENT_CACHE_MAX_ENTRIES:
+            _sql_statement_cache.clear()
+        statement = _SQLStatement(database_engine, sql)
+        _sql_statement_cache[key] = statement
+    return statement
+
+
+def _get_db_api_connection(conn):
+    """Get the DB-API connection underlying a database connection.
+
+    Args:
+        conn (twisted.enterprise.adbapi.Connection|Connection): either the
+            wrapper we are given by the connection pool, or, when we are
+            starting up, a DB-API connection.
+
+    Returns:
+        Connection
+    """
+    return getattr(conn, "_connection", conn)
+
+
+def _get_prepared_statements(conn):
+    """Get the names of the statements which have been prepared on a database
+    connection.
+
+    Args:
+        conn (twisted.enterprise.adbapi.Connection|Connection)
+
+    Returns:
+        set[str]: the names. Add to this after preparing a statement.
+    """
+    db_api_conn = _get_db_api_connection(conn)
+    with _connection_prepared_statements_lock:
+        prepared_statements = _connection_prepared_statements.get(db_api_conn)
+        if prepared_statements is None:
+            prepared_statements = set()
+            _connection_prepared_statements[db_api_conn] = prepared_statements
+        return prepared_statements
+
+
+def _forget_prepared_statements(conn):
+    """Forget the statements prepared on a connection, e.g. because it is
+    about to be reconnected.
+
+    Args:
+        conn (twisted.enterprise.adbapi.Connection|Connection)
+    """
+    with _connection_prepared_statements_lock:
+        _connection_prepared_statements.pop(_get_db_api_connection(conn), None)
+
+
 class LoggingTransaction(object):
     """An object that almost-transparently proxies for the 'txn' object
     passed to the constructor. Adds logging and metrics to the .execute()
-    method."""
+    method.
+
+    If a set of `prepared_statements` is given, the SQL built by the _simple_*
+    methods is run as prepared statements on the connection, which saves
+    postgres parsing and planning it each time.
+    """
     __slots__ = [
         "txn", "name", "database_engine", "after_callbacks", "exception_callbacks",
+        "prepared_statements",
     ]
 
     def __init__(self, txn, name, database_engine, after_callbacks,
-                 exception_callbacks):
+                 exception_callbacks, prepared_statements=None):
         object.__setattr__(self, "txn", txn)
         object.__setattr__(self, "name", name)
         object.__setattr__(self, "database_engine", database_engine)
         object.__setattr__(self, "after_callbacks", after_callbacks)
         object.__setattr__(self, "exception_callbacks", exception_callbacks)
+        object.__setattr__(self, "prepared_statements", prepared_statements)
 
     def call_after(self, callback, *args, **kwargs):
         """Call the given callback on the main twisted thread after the
@@ -112,8 +284,17 @@ class LoggingTransaction(object):
             from psycopg2.extras import execute_batch
             self._do_execute(lambda *x: execute_batch(self.txn, *x), sql, args)
         else:
-            for val in args:
-                self.execute(sql, val)
+            self.executemany(sql, args)
+
+    def execute_values(self, sql, args):
+        """Corresponds to psycopg2.extras.execute_values, which expands the
+        single placeholder in `sql` into a multi-row VALUES list.
+
+        Only available when using postgres.
+        """
+        assert isinstance(self.database_engine, PostgresEngine)
+        from psycopg2.extras import execute_values
+        self._do_execute(lambda *x: execute_values(self.txn, *x), sql, args)
 
     def execute(self, sql, *args):
         self._do_execute(self.txn.execute, sql, *args)
@@ -121,17 +302,13 @@ class LoggingTransaction(object):
     def executemany(self, sql, *args):
         self._do_execute(self.txn.executemany, sql, *args)
 
-    def _make_sql_one_line(self, sql):
-        "Strip newlines out of SQL so that the loggers in the DB are on one line"
-        return " ".join(l.strip() for l in sql.splitlines() if l.strip())
-
     def _do_execute(self, func, sql, *args):
-        sql = self._make_sql_one_line(sql)
+        statement = _get_sql_statement(self.database_engine, sql)
 
         # TODO(paul): Maybe use 'info' and 'debug' for values?
-        sql_logger.debug("[SQL] {%s} %s", self.name, sql)
+        sql_logger.debug("[SQL] {%s} %s", self.name, statement.one_line_sql)
 
-        sql = self.database_engine.convert_param_style(sql)
+        sql = statement.sql
         if args:
             try:
                 sql_logger.debug(
@@ -145,6 +322,15 @@ class LoggingTransaction(object):
         start = time.time()
 
         try:
+            if (
+                statement.prepared_name is not None
+                and self.prepared_statements is not None
+            ):
+                if statement.prepared_name not in self.prepared_statements:
+                    self.txn.execute(statement.prepare_sql)
+                    self.prepared_statements.add(statement.prepared_name)
+                sql = statement.execute_sql
+
             return func(
                 sql, *args
             )
@@ -154,7 +340,7 @@ class LoggingTransaction(object):
         finally:
             secs = time.time() - start
             sql_logger.debug("[SQL time] {%s} %f sec", self.name, secs)
-            sql_query_timer.labels(sql.split()[0]).observe(secs)
+            sql_query_timer.labels(statement.verb).observe(secs)
 
 
 class PerformanceCounters(object):
@@ -201,6 +387,7 @@ class SQLBaseStore(object):
         self.hs = hs
         self._clock = hs.get_clock()
         self._db_pool = hs.get_db_pool()
+        self._db_lanes = hs.get_database_lanes()
 
         self._previous_txn_total_time = 0
         self._current_txn_total_time = 0
@@ -215,6 +402,9 @@ class SQLBaseStore(object):
         self._get_event_cache = Cache("*getEvent*", keylen=3,
                                       max_entries=hs.config.event_cache_size)
 
+        # The rows for events, shared with the other processes on this machine.
+        self._shared_event_cache = hs.get_shared_event_cache()
+
         self._event_fetch_lock = threading.Condition()
         self._event_fetch_list = []
         self._event_fetch_ongoing = 0
@@ -316,6 +506,13 @@ class SQLBaseStore(object):
 
         transaction_logger.debug("[TXN START] {%s}", name)
 
+        prepared_statements = None
+        if (
+            isinstance(self.database_engine, PostgresEngine)
+            and self.database_engine.use_prepared_statements
+        ):
+            prepared_statements = _get_prepared_statements(conn)
+
         try:
             i = 0
             N = 5
@@ -324,7 +521,7 @@ class SQLBaseStore(object):
                     txn = conn.cursor()
                     txn = LoggingTransaction(
                         txn, name, self.database_engine, after_callbacks,
-                        exception_callbacks,
+                        exception_callbacks, prepared_statements,
                     )
                     r = func(txn, *args, **kwargs)
                     conn.commit()
@@ -402,7 +599,8 @@ class SQLBaseStore(object):
             )
 
         try:
-            result = yield self.runWithConnection(
+            result = yield self._run_with_connection_in_lane(
+                self._db_lanes.get_lane(desc),
                 self._new_transaction,
                 desc, after_callbacks, exception_callbacks, func,
                 *args, **kwargs
@@ -417,7 +615,6 @@ class SQLBaseStore(object):
 
         defer.returnValue(result)
 
-    @defer.inlineCallbacks
     def runWithConnection(self, func, *args, **kwargs):
         """Wraps the .runWithConnection() method on the underlying db_pool.
 
@@ -428,6 +625,23 @@ class SQLBaseStore(object):
             args (list): positional args to pass to `func`
             kwargs (dict): named args to pass to `func`
 
+        Returns:
+            Deferred: The result of func
+        """
+        return self._run_with_connection_in_lane(
+            self._db_lanes.get_lane(None), func, *args, **kwargs
+        )
+
+    @defer.inlineCallbacks
+    def _run_with_connection_in_lane(self, lane, func, *args, **kwargs):
+        """As runWithConnection, but waits for room in the given lane first.
+
+        Arguments:
+            lane (str): the lane to run in. See synapse.storage.util.lanes.
+            func (func): as for runWithConnection
+            args (list): positional args to pass to `func`
+            kwargs (dict): named args to pass to `func`
+
         Returns:
             Deferred: The result of func
         """
@@ -448,14 +662,16 @@ class SQLBaseStore(object):
 
                 if self.database_engine.is_connection_closed(conn):
                     logger.debug("Reconnecting closed database connection")
+                    _forget_prepared_statements(conn)
                     conn.reconnect()
 
                 return func(conn, *args, **kwargs)
 
-        with PreserveLoggingContext():
-            result = yield self._db_pool.runWithConnection(
-                inner_func, *args, **kwargs
-            )
+        with (yield self._db_lanes.queue(lane)):
+            with PreserveLoggingContext():
+                result = yield self._db_pool.runWithConnection(
+                    inner_func, *args, **kwargs
+                )
 
         defer.returnValue(result)
 
@@ -527,10 +743,13 @@ class SQLBaseStore(object):
     def _simple_insert_txn(txn, table, values):
         keys, vals = zip(*values.items())
 
-        sql = "INSERT INTO %s (%s) VALUES(%s)" % (
-            table,
-            ", ".join(k for k in keys),
-            ", ".join("?" for _ in keys)
+        sql = _get_simple_sql(
+            ("insert", table, keys),
+            lambda: "INSERT INTO %s (%s) VALUES(%s)" % (
+                table,
+                ", ".join(k for k in keys),
+                ", ".join("?" for _ in keys)
+            ),
         )
 
         txn.execute(sql, vals)
@@ -567,13 +786,22 @@ class SQLBaseStore(object):
                     "All items must have the same keys"
                 )
 
-        sql = "INSERT INTO %s (%s) VALUES(%s)" % (
-            table,
-            ", ".join(k for k in keys[0]),
-            ", ".join("?" for _ in keys[0])
-        )
+        if isinstance(txn.database_engine, PostgresEngine):
+            # On postgres we send the rows in a few multi-row INSERTs, rather
+            # than one statement (and round trip) per row.
+            sql = "INSERT INTO %s (%s) VALUES ?" % (
+                table,
+                ", ".join(k for k in keys[0]),
+            )
+            txn.execute_values(sql, vals)
+        else:
+            sql = "INSERT INTO %s (%s) VALUES(%s)" % (
+                table,
+                ", ".join(k for k in keys[0]),
+                ", ".join("?" for _ in keys[0])
+            )
 
-        txn.executemany(sql, vals)
+            txn.executemany(sql, vals)
 
     @defer.inlineCallbacks
     def _simple_upsert(
@@ -708,13 +936,24 @@ class SQLBaseStore(object):
             else:
                 return "%s = ?" % (key,)
 
+        # A NULL key needs an IS, which can't take a parameter in a prepared
+        # statement, so we only reuse the SQL when there aren't any.
+        if any(v is None for v in itervalues(keyvalues)):
+            def get_sql(key, make_sql):
+                return make_sql()
+        else:
+            get_sql = _get_simple_sql
+
         if not values:
             # If `values` is empty, then all of the values we care about are in
             # the unique key, so there is nothing to UPDATE. We can just do a
             # SELECT instead to see if it exists.
-            sql = "SELECT 1 FROM %s WHERE %s" % (
-                table,
-                " AND ".join(_getwhere(k) for k in keyvalues)
+            sql = get_sql(
+                ("upsert_select", table, tuple(keyvalues)),
+                lambda: "SELECT 1 FROM %s WHERE %s" % (
+                    table,
+                    " AND ".join(_getwhere(k) for k in keyvalues)
+                ),
             )
             sqlargs = list(keyvalues.values())
             txn.execute(sql, sqlargs)
@@ -723,10 +962,13 @@ class SQLBaseStore(object):
                 return False
         else:
             # First try to update.
-            sql = "UPDATE %s SET %s WHERE %s" % (
-                table,
-                ", ".join("%s = ?" % (k,) for k in values),
-                " AND ".join(_getwhere(k) for k in keyvalues)
+            sql = get_sql(
+                ("upsert_update", table, tuple(values), tuple(keyvalues)),
+                lambda: "UPDATE %s SET %s WHERE %s" % (
+                    table,
+                    ", ".join("%s = ?" % (k,) for k in values),
+                    " AND ".join(_getwhere(k) for k in keyvalues)
+                ),
             )
             sqlargs = list(values.values()) + list(keyvalues.values())
 
@@ -741,10 +983,13 @@ class SQLBaseStore(object):
         allvalues.update(values)
         allvalues.update(insertion_values)
 
-        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
-            table,
-            ", ".join(k for k in allvalues),
-            ", ".join("?" for _ in allvalues),
+        sql = _get_simple_sql(
+            ("upsert_insert", table, tuple(allvalues)),
+            lambda: "INSERT INTO %s (%s) VALUES (%s)" % (
+                table,
+                ", ".join(k for k in allvalues),
+                ", ".join("?" for _ in allvalues),
+            ),
         )
         txn.execute(sql, list(allvalues.values()))
         # successfully inserted
@@ -770,15 +1015,22 @@ class SQLBaseStore(object):
         allvalues.update(values)
         allvalues.update(insertion_values)
 
+        if not values:
+            latter = "NOTHING"
+        else:
+            latter = "UPDATE SET " + ", ".join(
+                k + "=EXCLUDED." + k for k in values
+            )
+
         sql = (
             "INSERT INTO %s (%s) VALUES (%s) "
-            "ON CONFLICT (%s) DO UPDATE SET %s"
+            "ON CONFLICT (%s) DO %s"
         ) % (
             table,
             ", ".join(k for k in allvalues),
             ", ".join("?" for _ in allvalues),
             ", ".join(k for k in keyvalues),
-            ", ".join(k + "=EXCLUDED." + k for k in values),
+            latter,
         )
         txn.execute(sql, list(allvalues.values()))
 
@@ -938,17 +1190,27 @@ class SQLBaseStore(object):
 
     @staticmethod
     def _simple_select_onecol_txn(txn, table, keyvalues, retcol):
-        sql = (
-            "SELECT %(retcol)s FROM %(table)s"
-        ) % {
-            "retcol": retcol,
-            "table": table,
-        }
+        def make_sql():
+            sql = (
+                "SELECT %(retcol)s FROM %(table)s"
+            ) % {
+                "retcol": retcol,
+                "table": table,
+            }
+
+            if keyvalues:
+                sql += " WHERE %s" % " AND ".join(
+                    "%s = ?" % k for k in iterkeys(keyvalues)
+                )
+            return sql
 
         if keyvalues:
-            sql += " WHERE %s" % " AND ".join("%s = ?" % k for k in iterkeys(keyvalues))
+            sql = _get_simple_sql(
+                ("select_onecol", table, retcol, tuple(keyvalues)), make_sql,
+            )
             txn.execute(sql, list(keyvalues.values()))
         else:
+            sql = _get_simple_sql(("select_onecol", table, retcol, ()), make_sql)
             txn.execute(sql)
 
         return [r[0] for r in txn]
@@ -1006,16 +1268,22 @@ class SQLBaseStore(object):
             retcols (iterable[str]): the names of the columns to return
         """
         if keyvalues:
-            sql = "SELECT %s FROM %s WHERE %s" % (
-                ", ".join(retcols),
-                table,
-                " AND ".join("%s = ?" % (k, ) for k in keyvalues)
+            sql = _get_simple_sql(
+                ("select_list", table, tuple(retcols), tuple(keyvalues)),
+                lambda: "SELECT %s FROM %s WHERE %s" % (
+                    ", ".join(retcols),
+                    table,
+                    " AND ".join("%s = ?" % (k, ) for k in keyvalues)
+                ),
             )
             txn.execute(sql, list(keyvalues.values()))
         else:
-            sql = "SELECT %s FROM %s" % (
-                ", ".join(retcols),
-                table
+            sql = _get_simple_sql(
+                ("select_list", table, tuple(retcols), ()),
+                lambda: "SELECT %s FROM %s" % (
+                    ", ".join(retcols),
+                    table
+                ),
             )
             txn.execute(sql)
 
@@ -1109,15 +1377,22 @@ class SQLBaseStore(object):
 
     @staticmethod
     def _simple_update_txn(txn, table, keyvalues, updatevalues):
-        if keyvalues:
-            where = "WHERE %s" % " AND ".join("%s = ?" % k for k in iterkeys(keyvalues))
-        else:
-            where = ""
+        def make_sql():
+            if keyvalues:
+                where = "WHERE %s" % " AND ".join(
+                    "%s = ?" % k for k in iterkeys(keyvalues)
+                )
+            else:
+                where = ""
 
-        update_sql = "UPDATE %s SET %s %s" % (
-            table,
-            ", ".join("%s = ?" % (k,) for k in updatevalues),
-            where,
+            return "UPDATE %s SET %s %s" % (
+                table,
+                ", ".join("%s = ?" % (k,) for k in updatevalues),
+                where,
+            )
+
+        update_sql = _get_simple_sql(
+            ("update", table, tuple(updatevalues), tuple(keyvalues)), make_sql,
         )
 
         txn.execute(
@@ -1164,10 +1439,13 @@ class SQLBaseStore(object):
     @staticmethod
     def _simple_select_one_txn(txn, table, keyvalues, retcols,
                                allow_none=False):
-        select_sql = "SELECT %s FROM %s WHERE %s" % (
-            ", ".join(retcols),
-            table,
-            " AND ".join("%s = ?" % (k,) for k in keyvalues)
+        select_sql = _get_simple_sql(
+            ("select_one", table, tuple(retcols), tuple(keyvalues)),
+            lambda: "SELECT %s FROM %s WHERE %s" % (
+                ", ".join(retcols),
+                table,
+                " AND ".join("%s = ?" % (k,) for k in keyvalues)
+            ),
         )
 
         txn.execute(select_sql, list(keyvalues.values()))
@@ -1203,9 +1481,12 @@ class SQLBaseStore(object):
             table : string giving the table name
             keyvalues : dict of column names and values to select the row with
         """
-        sql = "DELETE FROM %s WHERE %s" % (
-            table,
-            " AND ".join("%s = ?" % (k, ) for k in keyvalues)
+        sql = _get_simple_sql(
+            ("delete", table, tuple(keyvalues)),
+            lambda: "DELETE FROM %s WHERE %s" % (
+                table,
+                " AND ".join("%s = ?" % (k, ) for k in keyvalues)
+            ),
         )
 
         txn.execute(sql, list(keyvalues.values()))
@@ -1221,9 +1502,12 @@ class SQLBaseStore(object):
 
     @staticmethod
     def _simple_delete_txn(txn, table, keyvalues):
-        sql = "DELETE FROM %s WHERE %s" % (
-            table,
-            " AND ".join("%s = ?" % (k, ) for k in keyvalues)
+        sql = _get_simple_sql(
+            ("delete", table, tuple(keyvalues)),
+            lambda: "DELETE FROM %s WHERE %s" % (
+                table,
+                " AND ".join("%s = ?" % (k, ) for k in keyvalues)
+            ),
         )
 
         return txn.execute(sql, list(keyvalues.values()))
@@ -23,6 +23,7 @@ from synapse.metrics.background_process_metrics import run_as_background_process
 
 from . import engines
 from ._base import SQLBaseStore
+from .util.lanes import LANE_BACKGROUND
 
 logger = logging.getLogger(__name__)
 
@@ -247,6 +248,7 @@ class BackgroundUpdateStore(SQLBaseStore):
             update_handler(function): The function that does the update.
         """
         self._background_update_handlers[update_name] = update_handler
+        self._db_lanes.set_transaction_lane(update_name, LANE_BACKGROUND)
 
     def register_noop_background_update(self, update_name):
         """Register a noop handler for a background update.
@@ -359,7 +361,7 @@ class BackgroundUpdateStore(SQLBaseStore):
         def updater(progress, batch_size):
             if runner is not None:
                 logger.info("Adding index %s to %s", index_name, table)
-                yield self.runWithConnection(runner)
+                yield self._run_with_connection_in_lane(LANE_BACKGROUND, runner)
             yield self._end_background_update(update_name)
             defer.returnValue(1)
 
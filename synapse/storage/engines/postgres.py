@@ -23,6 +23,15 @@ class PostgresEngine(object):
         self.module = database_module
         self.module.extensions.register_type(self.module.extensions.UNICODE)
         self.synchronous_commit = database_config.get("synchronous_commit", True)
+
+        # Whether to run our most common queries as prepared statements, which
+        # saves postgres parsing and planning them each time. This has to be
+        # turned off if the connections are shared with other clients between
+        # transactions (e.g. by pgbouncer in transaction pooling mode), as
+        # prepared statements belong to the database session.
+        self.use_prepared_statements = database_config.get(
+            "prepared_statements", True,
+        )
         self._version = None   # unknown as yet
 
     def check_database(self, txn):
@@ -30,6 +30,12 @@ class Sqlite3Engine(object):
         self._current_state_group_id = None
         self._current_state_group_id_lock = threading.Lock()
 
+        # Can we use WITH RECURSIVE? This requires SQLite3 3.8.3+, which some
+        # older distributions (e.g. wheezy) don't ship.
+        self.supports_recursive_cte = (
+            database_module.sqlite_version_info >= (3, 8, 3)
+        )
+
     @property
     def can_native_upsert(self):
         """
@@ -15,6 +15,7 @@
 import logging
 import random
 
+from six import iteritems
 from six.moves import range
 from six.moves.queue import Empty, PriorityQueue
 
@@ -25,13 +26,21 @@ from twisted.internet import defer
 from synapse.api.errors import StoreError
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage._base import SQLBaseStore
+from synapse.storage.engines import PostgresEngine
 from synapse.storage.events_worker import EventsWorkerStore
 from synapse.storage.signatures import SignatureWorkerStore
+from synapse.util import batch_iter
 from synapse.util.caches.descriptors import cached
 
 logger = logging.getLogger(__name__)
 
 
+class _NoChainCoverIndex(Exception):
+    """Raised when we can't use the auth chain index to answer a query,
+    because some of the events involved haven't been indexed.
+    """
+
+
 class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore,
                                  SQLBaseStore):
     def get_auth_chain(self, event_ids, include_given=False):
@@ -65,6 +74,63 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore,
         )
 
     def _get_auth_chain_ids_txn(self, txn, event_ids, include_given):
+        try:
+            return self._get_auth_chain_ids_using_cover_index_txn(
+                txn, event_ids, include_given,
+            )
+        except _NoChainCoverIndex:
+            # For whatever reason we don't actually have a chain cover index
+            # for the events in question, so we fall back to the old method.
+            pass
+
+        return self._get_auth_chain_ids_by_traversal_txn(
+            txn, event_ids, include_given,
+        )
+
+    def _get_auth_chain_ids_using_cover_index_txn(self, txn, event_ids, include_given):
+        """Calculates the auth chain IDs using the chain cover index.
+
+        Raises:
+            _NoChainCoverIndex if any of the events haven't been indexed.
+        """
+        event_ids = set(event_ids)
+        chain_info = self._get_chain_info_txn(txn, event_ids)
+
+        # Map from chain ID to the max sequence number reachable in the chain
+        # from the given events.
+        chains = {}
+        for event_id in event_ids:
+            chain_id, seq_no = chain_info[event_id]
+
+            # Everything before the event in its own chain is in its auth
+            # chain; the event itself only if we've been asked to include it.
+            if not include_given:
+                seq_no -= 1
+            chains[chain_id] = max(seq_no, chains.get(chain_id, 0))
+
+        # Now look up the links from the events' chains. Links are transitively
+        # closed, so we only need to follow one hop.
+        origins = {}
+        for event_id in event_ids:
+            chain_id, seq_no = chain_info[event_id]
+            origins[chain_id] = max(seq_no, origins.get(chain_id, 0))
+
+        for (
+            origin_chain_id, origin_seq_no, target_chain_id, target_seq_no,
+        ) in self._get_chain_links_txn(txn, origins):
+            if origin_seq_no <= origins[origin_chain_id]:
+                chains[target_chain_id] = max(
+                    target_seq_no, chains.get(target_chain_id, 0),
+                )
+
+        gaps = {
+            chain_id: (0, max_seq_no)
+            for chain_id, max_seq_no in iteritems(chains)
+            if max_seq_no > 0
+        }
+        return list(self._get_events_in_chain_gaps_txn(txn, gaps))
+
+    def _get_auth_chain_ids_by_traversal_txn(self, txn, event_ids, include_given):
         if include_given:
             results = set(event_ids)
         else:
@@ -96,6 +162,217 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore,
 
         return list(results)
 
+    def get_auth_chain_difference(self, state_sets):
+        """Given sets of state events, calculate the auth chain difference:
+        the events which are in the auth chain of some, but not all, of the
+        sets. The events in the sets themselves count as part of their auth
+        chains.
+
+        Args:
+            state_sets (list[set[str]]): sets of state event IDs. The events
+                must be state events.
+
+        Returns:
+            Deferred[set[str]]
+        """
+        return self.runInteraction(
+            "get_auth_chain_difference",
+            self._get_auth_chain_difference_txn,
+            state_sets,
+        )
+
+    def _get_auth_chain_difference_txn(self, txn, state_sets):
+        try:
+            return self._get_auth_chain_difference_using_cover_index_txn(
+                txn, state_sets,
+            )
+        except _NoChainCoverIndex:
+            # For whatever reason we don't actually have a chain cover index
+            # for the events in question, so we fall back to the old method.
+            pass
+
+        auth_sets = []
+        for state_set in state_sets:
+            auth_sets.append(set(self._get_auth_chain_ids_by_traversal_txn(
+                txn, state_set, include_given=True,
+            )))
+
+        if not auth_sets:
+            return set()
+
+        intersection = auth_sets[0].intersection(*auth_sets[1:])
+        union = set().union(*auth_sets)
+
+        return union - intersection
+
+    def _get_auth_chain_difference_using_cover_index_txn(self, txn, state_sets):
+        """Calculates the auth chain difference using the chain cover index.
+
+        For each chain, every state set can reach the events up to some
+        sequence number in that chain. The events between the lowest and the
+        highest of those are the ones which some but not all of the sets can
+        reach, so are in the difference.
+
+        Raises:
+            _NoChainCoverIndex if any of the events haven't been indexed.
+        """
+        initial_events = set().union(*state_sets)
+        chain_info = self._get_chain_info_txn(txn, initial_events)
+
+        # Map from chain ID -> seq no -> event ID, for the events we've been
+        # given, so that we don't have to look them up again.
+        chain_to_event = {}
+        for event_id, (chain_id, seq_no) in iteritems(chain_info):
+            chain_to_event.setdefault(chain_id, {})[seq_no] = event_id
+
+        # Corresponds to `state_sets`, except as a map from chain ID to max
+        # sequence number reachable from the state set.
+        set_to_chain = []
+        for state_set in state_sets:
+            chains = {}
+            set_to_chain.append(chains)
+
+            for event_id in state_set:
+                chain_id, seq_no = chain_info[event_id]
+                chains[chain_id] = max(seq_no, chains.get(chain_id, 0))
+
+        # Now we look up all the links from the chains we have, adding the
+        # chains that each set can reach. Links are transitively closed, so we
+        # don't need to follow links from the chains we find this way.
+        origin_chains = set(chain_to_event)
+        seen_chains = set(origin_chains)
+        set_to_origins = [dict(chains) for chains in set_to_chain]
+
+        for (
+            origin_chain_id, origin_seq_no, target_chain_id, target_seq_no,
+        ) in self._get_chain_links_txn(txn, origin_chains):
+            for origins, chains in zip(set_to_origins, set_to_chain):
+                # the target is only reachable if the link starts at or below
+                # the set's events in the origin chain.
+                if origin_seq_no <= origins.get(origin_chain_id, 0):
+                    chains[target_chain_id] = max(
+                        target_seq_no, chains.get(target_chain_id, 0),
+                    )
+
+            seen_chains.add(target_chain_id)
+
+        result = set()
+
+        # Map from chain ID to the range of sequence numbers that we need to
+        # pull out of the database.
+        gaps = {}
+
+        for chain_id in seen_chains:
+            min_seq_no = min(chains.get(chain_id, 0) for chains in set_to_chain)
+            max_seq_no = max(chains.get(chain_id, 0) for chains in set_to_chain)
+
+            if min_seq_no < max_seq_no:
+                # We have a non empty gap: try and fill it from the events
+                # we've already got, otherwise look it up.
+                known_events = chain_to_event.get(chain_id, {})
+                for seq_no in range(min_seq_no + 1, max_seq_no + 1):
+                    event_id = known_events.get(seq_no)
+                    if event_id is None:
+                        gaps[chain_id] = (min_seq_no, max_seq_no)
+                        break
+                    result.add(event_id)
+
+        result.update(self._get_events_in_chain_gaps_txn(txn, gaps))
+        return result
+
+    def _get_chain_info_txn(self, txn, event_ids):
+        """Fetch the chain ID and sequence number of each of the given events.
+
+        Returns:
+            dict[str, tuple[int, int]]
+
+        Raises:
+            _NoChainCoverIndex if any of the events haven't been indexed.
+        """
+        rows = self._simple_select_many_txn(
+            txn,
+            table="event_auth_chains",
+            column="event_id",
+            iterable=event_ids,
+            keyvalues={},
+            retcols=("event_id", "chain_id", "sequence_number"),
+        )
+        chain_info = {
+            row["event_id"]: (row["chain_id"], row["sequence_number"])
+            for row in rows
+        }
+
+        if len(chain_info) != len(event_ids):
+            # This happens for rooms which the background update hasn't got
+            # to yet, and events which are missing some of their auth events.
+            raise _NoChainCoverIndex()
+
+        return chain_info
+
+    def _get_chain_links_txn(self, txn, chain_ids):
+        """Fetch the links from the given chains.
+
+        Returns:
+            list[tuple[int, int, int, int]]: the origin chain ID and sequence
+            number and the target chain ID and sequence number of each link.
+        """
+        sql = (
+            "SELECT origin_chain_id, origin_sequence_number,"
+            " target_chain_id, target_sequence_number"
+            " FROM event_auth_chain_links"
+            " WHERE origin_chain_id IN (%s)"
+        )
+
+        links = []
+        for batch in batch_iter(chain_ids, 500):
+            txn.execute(sql % (",".join("?" for _ in batch),), batch)
+            links.extend(txn)
+        return links
+
+    def _get_events_in_chain_gaps_txn(self, txn, gaps):
+        """Fetch the events within the given ranges of the given chains.
+
+        Args:
+            gaps (dict[int, tuple[int, int]]): map from chain ID to a
+                (min, max) pair of sequence numbers. The range excludes `min`
+                but includes `max`.
+
+        Returns:
+            set[str]: the event IDs
+        """
+        results = set()
+
+        if isinstance(self.database_engine, PostgresEngine):
+            # We can join against a VALUES list to fetch many ranges at once.
+            sql = (
+                "SELECT event_id FROM event_auth_chains AS c,"
+                " (VALUES %s) AS l(chain_id, min_seq, max_seq)"
+                " WHERE c.chain_id = l.chain_id"
+                " AND min_seq < sequence_number AND sequence_number <= max_seq"
+            )
+            for batch in batch_iter(iteritems(gaps), 500):
+                args = []
+                for chain_id, (min_seq_no, max_seq_no) in batch:
+                    args.extend((chain_id, min_seq_no, max_seq_no))
+
+                txn.execute(
+                    sql % (", ".join("(?, ?, ?)" for _ in batch),), args,
+                )
+                results.update(r for r, in txn)
+        else:
+            # On SQLite each of these is a cheap index range scan, so we just
+            # do them one at a time.
+            sql = (
+                "SELECT event_id FROM event_auth_chains"
+                " WHERE chain_id = ? AND ? < sequence_number"
+                " AND sequence_number <= ?"
+            )
+            for chain_id, (min_seq_no, max_seq_no) in iteritems(gaps):
+                txn.execute(sql, (chain_id, min_seq_no, max_seq_no))
+                results.update(r for r, in txn)
+
+        return results
+
     def get_oldest_events_in_room(self, room_id):
         return self.runInteraction(
             "get_oldest_events_in_room",
@@ -531,7 +808,7 @@ class EventFederationStore(EventFederationWorkerStore):
             " )"
         )
 
-        txn.executemany(query, [
+        txn.execute_batch(query, [
             (e_id, ev.room_id, e_id, ev.room_id, e_id, ev.room_id, False)
             for ev in events for e_id in ev.prev_event_ids()
             if not ev.internal_metadata.is_outlier()
@@ -541,7 +818,7 @@ class EventFederationStore(EventFederationWorkerStore):
             "DELETE FROM event_backward_extremities"
             " WHERE event_id = ? AND room_id = ?"
         )
-        txn.executemany(
+        txn.execute_batch(
             query,
             [
                 (ev.event_id, ev.room_id) for ev in events
@@ -424,7 +424,7 @@ class EventPushActionsWorkerStore(SQLBaseStore):
                 VALUES (?, ?, ?, ?, ?)
             """
 
-            txn.executemany(sql, (
+            txn.execute_batch(sql, (
                 _gen_entry(user_id, actions)
                 for user_id, actions in iteritems(user_id_actions)
             ))
@@ -19,11 +19,11 @@ import logging
 from collections import OrderedDict, deque, namedtuple
 from functools import wraps
 
-from six import iteritems, text_type
+from six import iteritems, itervalues, text_type
 from six.moves import range
 
 from canonicaljson import json
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -33,23 +33,36 @@ from synapse.api.errors import SynapseError
 # these are only included to make the type annotations work
 from synapse.events import EventBase  # noqa: F401
 from synapse.events.snapshot import EventContext  # noqa: F401
+from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.state import StateResolutionStore
-from synapse.storage.background_updates import BackgroundUpdateStore
+from synapse.storage.background_updates import (
+    BackgroundUpdatePerformance,
+    BackgroundUpdateStore,
+)
 from synapse.storage.event_federation import EventFederationStore
 from synapse.storage.events_worker import EventsWorkerStore
 from synapse.storage.state import StateGroupWorkerStore
+from synapse.storage.util.id_generators import IdGenerator
 from synapse.types import RoomStreamToken, get_domain_from_id
-from synapse.util import batch_iter
+from synapse.util import batch_iter, sorted_topologically
 from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.caches.descriptors import cached, cachedInlineCallbacks
 from synapse.util.frozenutils import frozendict_json_encoder
 from synapse.util.logcontext import PreserveLoggingContext, make_deferred_yieldable
 from synapse.util.logutils import log_function
 from synapse.util.metrics import Measure
+from synapse.util.stringutils import random_string
 
 logger = logging.getLogger(__name__)
 
+# The most events we persist in a single transaction. Events from several
+# rooms are batched up to this size.
+EVENT_PERSIST_BATCH_SIZE = 100
+
+# The most batches of events we persist at once.
+EVENT_PERSIST_MAX_CONCURRENT_BATCHES = 5
+
 persist_event_counter = Counter("synapse_storage_events_persisted_events", "")
 event_counter = Counter("synapse_storage_events_persisted_events_sep", "",
                         ["type", "origin_type", "origin_entity"])
@@ -68,6 +81,16 @@ state_delta_single_event_counter = Counter(
 state_delta_reuse_delta_counter = Counter(
     "synapse_storage_events_state_delta_reuse_delta", "")
 
+# The number of events, and rooms, in each batch we persist
+persist_batch_events = Histogram(
+    "synapse_storage_events_persist_batch_events", "",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, "+Inf"),
+)
+persist_batch_rooms = Histogram(
+    "synapse_storage_events_persist_batch_rooms", "",
+    buckets=(1, 2, 5, 10, 20, 50, 100, "+Inf"),
+)
+
 
 def encode_json(json_object):
     """
@@ -82,6 +105,10 @@ def encode_json(json_object):
 class _EventPeristenceQueue(object):
     """Queues up events so that they can be persisted in bulk with only one
     concurrent transaction per room.
+
+    Events for different rooms are coalesced into batches, so that events
+    arriving in many rooms at once can be persisted in a few transactions,
+    rather than one (or more) per room.
     """
 
     _EventPersistQueueItem = namedtuple("_EventPersistQueueItem", (
@@ -89,9 +116,28 @@ class _EventPeristenceQueue(object):
     ))
 
     def __init__(self):
-        self._event_persist_queues = {}
+        # map from room_id to the deque of items queued for that room. Rooms
+        # are moved to the end each time we take an item from their queue, so
+        # that no room can starve the others.
+        self._event_persist_queues = OrderedDict()
         self._currently_persisting_rooms = set()
 
+        # the number of batches currently being persisted
+        self._num_persisting_batches = 0
+
+        LaterGauge(
+            "synapse_storage_events_persist_queue_events", "", [],
+            lambda: sum(
+                len(item.events_and_contexts)
+                for queue in itervalues(self._event_persist_queues)
+                for item in queue
+            ),
+        )
+        LaterGauge(
+            "synapse_storage_events_persist_queue_rooms", "", [],
+            lambda: len(self._event_persist_queues),
+        )
+
     def add_to_queue(self, room_id, events_and_contexts, backfilled):
         """Add events to the queue, with the given persist_event options.
 
@@ -108,7 +154,9 @@ class _EventPeristenceQueue(object):
             defer.Deferred: a deferred which will resolve once the events are
                 persisted. Runs its callbacks *without* a logcontext.
         """
-        queue = self._event_persist_queues.setdefault(room_id, deque())
+        queue = self._event_persist_queues.get(room_id)
+        if queue is None:
+            queue = self._event_persist_queues[room_id] = deque()
         if queue:
             # if the last item in the queue has the same `backfilled` setting,
             # we can just add these new events to that item.
@@ -127,58 +175,115 @@ class _EventPeristenceQueue(object):
 
         return deferred.observe()
 
-    def handle_queue(self, room_id, per_item_callback):
-        """Attempts to handle the queue for a room if not already being handled.
-
-        The given callback will be invoked with for each item in the queue,
-        of type _EventPersistQueueItem. The per_item_callback will continuously
-        be called with new items, unless the queue becomnes empty. The return
-        value of the function will be given to the deferreds waiting on the item,
+    def handle_queue(self, per_batch_callback):
+        """Attempts to handle the queued events, unless we are already
+        persisting as many batches as we allow at once.
+
+        The given callback will be invoked with batches of items, of type
+        list[_EventPersistQueueItem], taken from the front of the queues of
+        rooms which are not already being persisted. The items in a batch are
+        all for different rooms, and share the same `backfilled` setting.
+        The callback will continuously be called with new batches, until there
+        are no more items which can be persisted. The return value of the
+        function will be given to the deferreds waiting on the items;
         exceptions will be passed to the deferreds as well.
 
         This function should therefore be called whenever anything is added
         to the queue.
-
-        If another callback is currently handling the queue then it will not be
-        invoked.
         """
 
-        if room_id in self._currently_persisting_rooms:
+        if self._num_persisting_batches >= EVENT_PERSIST_MAX_CONCURRENT_BATCHES:
             return
 
-        self._currently_persisting_rooms.add(room_id)
+        self._num_persisting_batches += 1
 
         @defer.inlineCallbacks
         def handle_queue_loop():
             try:
-                queue = self._get_drainining_queue(room_id)
-                for item in queue:
+                while True:
+                    batch = self._get_next_batch()
+                    if not batch:
+                        break
+
+                    room_ids = [
+                        item.events_and_contexts[0][0].room_id for item in batch
+                    ]
+                    self._currently_persisting_rooms.update(room_ids)
                     try:
-                        ret = yield per_item_callback(item)
-                    except Exception:
-                        with PreserveLoggingContext():
-                            item.deferred.errback()
-                    else:
-                        with PreserveLoggingContext():
-                            item.deferred.callback(ret)
+                        yield self._handle_batch(batch, per_batch_callback)
+                    finally:
+                        self._currently_persisting_rooms.difference_update(room_ids)
             finally:
-                queue = self._event_persist_queues.pop(room_id, None)
-                if queue:
-                    self._event_persist_queues[room_id] = queue
-                self._currently_persisting_rooms.discard(room_id)
+                self._num_persisting_batches -= 1
 
         # set handle_queue_loop off in the background
         run_as_background_process("persist_events", handle_queue_loop)
 
-    def _get_drainining_queue(self, room_id):
-        queue = self._event_persist_queues.setdefault(room_id, deque())
-
+    @defer.inlineCallbacks
+    def _handle_batch(self, batch, per_batch_callback):
         try:
-            while True:
-                yield queue.popleft()
-        except IndexError:
-            # Queue has been drained.
-            pass
+            ret = yield per_batch_callback(batch)
+        except Exception:
+            if len(batch) == 1:
+                with PreserveLoggingContext():
+                    batch[0].deferred.errback()
+                return
+
+            # Don't let a problem with one room hold up the others: retry each
+            # room's events on their own. (The batch is small enough to be
+            # persisted in a single transaction, so none of it will have been
+            # written.)
+            logger.exception(
+                "Failed to persist batch of events for %i rooms; retrying "
+                "each room separately", len(batch),
+            )
+            for item in batch:
+                yield self._handle_batch([item], per_batch_callback)
+        else:
+            for item in batch:
+                with PreserveLoggingContext():
+                    item.deferred.callback(ret)
+
+    def _get_next_batch(self):
+        """Take the next batch of items to persist off the queues.
+
+        Returns:
+            list[_EventPersistQueueItem]: the items, or an empty list if there is
+                nothing which can be persisted right now.
+        """
+        batch = []
+        num_events = 0
+        backfilled = None
+
+        for room_id in list(self._event_persist_queues):
+            if room_id in self._currently_persisting_rooms:
+                continue
+
+            queue = self._event_persist_queues[room_id]
+            item = queue[0]
+            if backfilled is None:
+                backfilled = item.backfilled
+            elif item.backfilled != backfilled:
+                continue
+
+            # The first item always goes into the batch, however big it is.
+            # After that, we only add items which keep the batch small enough
+            # to be persisted in one transaction.
+            item_events = len(item.events_and_contexts)
+            if batch and num_events + item_events > EVENT_PERSIST_BATCH_SIZE:
+                continue
+
+            queue.popleft()
+            del self._event_persist_queues[room_id]
+            if queue:
+                self._event_persist_queues[room_id] = queue
+
+            batch.append(item)
+            num_events += item_events
+            if num_events >= EVENT_PERSIST_BATCH_SIZE:
+                break
+
+        return batch
 
 
 _EventCacheEntry = namedtuple("_EventCacheEntry", ("event", "redacted_event"))
@@ -210,6 +315,14 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                   BackgroundUpdateStore):
     EVENT_ORIGIN_SERVER_TS_NAME = "event_origin_server_ts"
     EVENT_FIELDS_SENDER_URL_UPDATE_NAME = "event_fields_sender_url"
+    EVENT_AUTH_CHAIN_COVER_UPDATE_NAME = "chain_cover"
+
+    # History purges are done in batches, which are sized and spaced out in
+    # the same way as background updates.
+    MINIMUM_PURGE_BATCH_SIZE = 100
+    DEFAULT_PURGE_BATCH_SIZE = 100
+    PURGE_BATCH_INTERVAL_MS = 100
+    PURGE_BATCH_DURATION_MS = 500
 
     def __init__(self, db_conn, hs):
         super(EventsStore, self).__init__(db_conn, hs)
@@ -220,6 +333,10 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             self.EVENT_FIELDS_SENDER_URL_UPDATE_NAME,
             self._background_reindex_fields_sender,
         )
+        self.register_background_update_handler(
+            self.EVENT_AUTH_CHAIN_COVER_UPDATE_NAME,
+            self._background_chain_cover_index,
+        )
 
         self.register_background_index_update(
             "event_contains_url_index",
@@ -241,6 +358,8 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             psql_only=True,
         )
 
+        self._event_chain_id_gen = IdGenerator(db_conn, "event_auth_chains", "chain_id")
+
         self._event_persist_queue = _EventPeristenceQueue()
 
         self._state_resolution_handler = hs.get_state_resolution_handler()
@@ -270,8 +389,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             )
             deferreds.append(d)
 
-        for room_id in partitioned:
-            self._maybe_start_persisting(room_id)
+        self._maybe_start_persisting()
 
         yield make_deferred_yieldable(
             defer.gatherResults(deferreds, consumeErrors=True)
@@ -300,23 +418,29 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             backfilled=backfilled,
         )
 
-        self._maybe_start_persisting(event.room_id)
+        self._maybe_start_persisting()
 
         yield make_deferred_yieldable(deferred)
 
         max_persisted_id = yield self._stream_id_gen.get_current_token()
         defer.returnValue((event.internal_metadata.stream_ordering, max_persisted_id))
 
-    def _maybe_start_persisting(self, room_id):
+    def _maybe_start_persisting(self):
         @defer.inlineCallbacks
-        def persisting_queue(item):
+        def persisting_queue(batch):
+            events_and_contexts = [
+                ev_ctx for item in batch for ev_ctx in item.events_and_contexts
+            ]
+            persist_batch_events.observe(len(events_and_contexts))
+            persist_batch_rooms.observe(len(batch))
+
             with Measure(self._clock, "persist_events"):
                 yield self._persist_events(
-                    item.events_and_contexts,
-                    backfilled=item.backfilled,
+                    events_and_contexts,
+                    backfilled=batch[0].backfilled,
                 )
 
-        self._event_persist_queue.handle_queue(room_id, persisting_queue)
+        self._event_persist_queue.handle_queue(persisting_queue)
 
     @_retry_on_integrity_error
     @defer.inlineCallbacks
@@ -351,137 +475,26 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                 event.internal_metadata.stream_ordering = stream
 
             chunks = [
-                events_and_contexts[x:x + 100]
-                for x in range(0, len(events_and_contexts), 100)
+                events_and_contexts[x:x + EVENT_PERSIST_BATCH_SIZE]
+                for x in range(0, len(events_and_contexts), EVENT_PERSIST_BATCH_SIZE)
             ]
 
             for chunk in chunks:
                 # We can't easily parallelize these since different chunks
                 # might contain the same event. :(
 
-                # NB: Assumes that we are only persisting events for one room
-                # at a time.
-
-                # map room_id->list[event_ids] giving the new forward
-                # extremities in each room
-                new_forward_extremeties = {}
-
-                # map room_id->(type,state_key)->event_id tracking the full
-                # state in each room after adding these events.
-                # This is simply used to prefill the get_current_state_ids
-                # cache
-                current_state_for_room = {}
-
-                # map room_id->(to_delete, to_insert) where to_delete is a list
-                # of type/state keys to remove from current state, and to_insert
-                # is a map (type,key)->event_id giving the state delta in each
-                # room
-                state_delta_for_room = {}
-
-                if not backfilled:
+                if backfilled:
+                    new_forward_extremeties = {}
+                    current_state_for_room = {}
+                    state_delta_for_room = {}
+                else:
                     with Measure(self._clock, "_calculate_state_and_extrem"):
-                        # Work out the new "current state" for each room.
-                        # We do this by working out what the new extremities are and then
-                        # calculating the state from that.
-                        events_by_room = {}
-                        for event, context in chunk:
-                            events_by_room.setdefault(event.room_id, []).append(
-                                (event, context)
-                            )
-
-                        for room_id, ev_ctx_rm in iteritems(events_by_room):
-                            latest_event_ids = yield self.get_latest_event_ids_in_room(
-                                room_id
-                            )
-                            new_latest_event_ids = yield self._calculate_new_extremities(
-                                room_id, ev_ctx_rm, latest_event_ids
-                            )
-
-                            latest_event_ids = set(latest_event_ids)
-                            if new_latest_event_ids == latest_event_ids:
-                                # No change in extremities, so no change in state
-                                continue
-
-                            # there should always be at least one forward extremity.
-                            # (except during the initial persistence of the send_join
-                            # results, in which case there will be no existing
-                            # extremities, so we'll `continue` above and skip this bit.)
-                            assert new_latest_event_ids, "No forward extremities left!"
-
-                            new_forward_extremeties[room_id] = new_latest_event_ids
-
-                            len_1 = (
-                                len(latest_event_ids) == 1
-                                and len(new_latest_event_ids) == 1
-                            )
-                            if len_1:
-                                all_single_prev_not_state = all(
-                                    len(event.prev_event_ids()) == 1
-                                    and not event.is_state()
-                                    for event, ctx in ev_ctx_rm
-                                )
-                                # Don't bother calculating state if they're just
-                                # a long chain of single ancestor non-state events.
-                                if all_single_prev_not_state:
-                                    continue
-
-                            state_delta_counter.inc()
-                            if len(new_latest_event_ids) == 1:
-                                state_delta_single_event_counter.inc()
-
-                                # This is a fairly handwavey check to see if we could
-                                # have guessed what the delta would have been when
-                                # processing one of these events.
-                                # What we're interested in is if the latest extremities
-                                # were the same when we created the event as they are
-                                # now. When this server creates a new event (as opposed
-                                # to receiving it over federation) it will use the
-                                # forward extremities as the prev_events, so we can
-                                # guess this by looking at the prev_events and checking
-                                # if they match the current forward extremities.
-                                for ev, _ in ev_ctx_rm:
-                                    prev_event_ids = set(ev.prev_event_ids())
-                                    if latest_event_ids == prev_event_ids:
-                                        state_delta_reuse_delta_counter.inc()
-                                        break
-
-                            logger.info(
-                                "Calculating state delta for room %s", room_id,
-                            )
-                            with Measure(
-                                self._clock,
-                                "persist_events.get_new_state_after_events",
-                            ):
-                                res = yield self._get_new_state_after_events(
-                                    room_id,
-                                    ev_ctx_rm,
-                                    latest_event_ids,
-                                    new_latest_event_ids,
-                                )
-                                current_state, delta_ids = res
-
-                            # If either are not None then there has been a change,
-                            # and we need to work out the delta (or use that
-                            # given)
-                            if delta_ids is not None:
-                                # If there is a delta we know that we've
-                                # only added or replaced state, never
-                                # removed keys entirely.
-                                state_delta_for_room[room_id] = ([], delta_ids)
-                            elif current_state is not None:
-                                with Measure(
-                                    self._clock,
-                                    "persist_events.calculate_state_delta",
-                                ):
-                                    delta = yield self._calculate_state_delta(
-                                        room_id, current_state,
-                                    )
-                                state_delta_for_room[room_id] = delta
-
-                            # If we have the current_state then lets prefill
-                            # the cache with it.
-                            if current_state is not None:
-                                current_state_for_room[room_id] = current_state
+                        res = yield self._calculate_state_and_extremities(chunk)
+                    (
+                        new_forward_extremeties,
+                        current_state_for_room,
+                        state_delta_for_room,
+                    ) = res
 
                 yield self.runInteraction(
                     "persist_events",
@@ -525,40 +538,228 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                     )
 
     @defer.inlineCallbacks
-    def _calculate_new_extremities(self, room_id, event_contexts, latest_event_ids):
-        """Calculates the new forward extremities for a room given events to
-        persist.
+    def _calculate_state_and_extremities(self, events_and_contexts):
+        """Work out the new forward extremities and current state for each room
+        in a chunk of events which are about to be persisted.
 
-        Assumes that we are only persisting events for one room at a time.
-        """
+        The database lookups this needs are done for all the rooms at once.
 
-        # we're only interested in new events which aren't outliers and which aren't
-        # being rejected.
-        new_events = [
-            event for event, ctx in event_contexts
-            if not event.internal_metadata.is_outlier() and not ctx.rejected
-        ]
+        Args:
+            events_and_contexts (list[(EventBase, EventContext)]): events to
+                be persisted, which may be for any number of rooms
+
+        Returns:
+            Deferred[tuple[dict, dict, dict]]: a tuple of:
 
-        # start with the existing forward extremities
-        result = set(latest_event_ids)
+                map room_id->list[event_ids] giving the new forward extremities
+                in each room
 
-        # add all the new events to the list
-        result.update(
-            event.event_id for event in new_events
+                map room_id->(type,state_key)->event_id tracking the full state
+                in each room after adding these events. This is simply used to
+                prefill the get_current_state_ids cache
+
+                map room_id->(to_delete, to_insert) where to_delete is a list of
+                type/state keys to remove from current state, and to_insert is a
+                map (type,key)->event_id giving the state delta in each room
+        """
+        new_forward_extremeties = {}
+        current_state_for_room = {}
+        state_delta_for_room = {}
+
+        # Work out the new "current state" for each room.
+        # We do this by working out what the new extremities are and then
+        # calculating the state from that.
+        events_by_room = OrderedDict()
+        for event, context in events_and_contexts:
+            events_by_room.setdefault(event.room_id, []).append(
+                (event, context)
+            )
+
+        latest_event_ids_by_room = {}
+        for room_id in events_by_room:
+            latest_event_ids = yield self.get_latest_event_ids_in_room(room_id)
+            latest_event_ids_by_room[room_id] = set(latest_event_ids)
+
+        new_latest_event_ids_by_room = yield self._calculate_new_extremities(
+            events_by_room, latest_event_ids_by_room,
         )
 
-        # Now remove all events which are prev_events of any of the new events
-        result.difference_update(
-            e_id
-            for event in new_events
-            for e_id in event.prev_event_ids()
+        # the rooms where the state may have changed, with the old and new
+        # extremities
+        rooms_to_calculate = OrderedDict()
+
+        for room_id, ev_ctx_rm in iteritems(events_by_room):
+            latest_event_ids = latest_event_ids_by_room[room_id]
+            new_latest_event_ids = new_latest_event_ids_by_room[room_id]
+
+            if new_latest_event_ids == latest_event_ids:
+                # No change in extremities, so no change in state
+                continue
+
+            # there should always be at least one forward extremity.
+            # (except during the initial persistence of the send_join
+            # results, in which case there will be no existing
+            # extremities, so we'll `continue` above and skip this bit.)
+            assert new_latest_event_ids, "No forward extremities left!"
+
+            new_forward_extremeties[room_id] = new_latest_event_ids
+
+            len_1 = (
+                len(latest_event_ids) == 1
+                and len(new_latest_event_ids) == 1
+            )
+            if len_1:
+                all_single_prev_not_state = all(
+                    len(event.prev_event_ids()) == 1
+                    and not event.is_state()
+                    for event, ctx in ev_ctx_rm
+                )
+                # Don't bother calculating state if they're just
+                # a long chain of single ancestor non-state events.
+                if all_single_prev_not_state:
+                    continue
+
+            state_delta_counter.inc()
+            if len(new_latest_event_ids) == 1:
+                state_delta_single_event_counter.inc()
+
+                # This is a fairly handwavey check to see if we could
+                # have guessed what the delta would have been when
+                # processing one of these events.
+                # What we're interested in is if the latest extremities
+                # were the same when we created the event as they are
+                # now. When this server creates a new event (as opposed
+                # to receiving it over federation) it will use the
+                # forward extremities as the prev_events, so we can
+                # guess this by looking at the prev_events and checking
+                # if they match the current forward extremities.
+                for ev, _ in ev_ctx_rm:
+                    prev_event_ids = set(ev.prev_event_ids())
+                    if latest_event_ids == prev_event_ids:
+                        state_delta_reuse_delta_counter.inc()
+                        break
+
+            rooms_to_calculate[room_id] = (latest_event_ids, new_latest_event_ids)
+
+        if not rooms_to_calculate:
+            defer.returnValue((
+                new_forward_extremeties, current_state_for_room, state_delta_for_room,
+            ))
+
+        # Fetch the state groups of all the extremities which aren't being
+        # persisted now in one go, rather than room by room.
+        persisting_event_ids = set(
+            event.event_id for event, _ in events_and_contexts
         )
+        extremity_event_ids = set()
+        for latest_event_ids, new_latest_event_ids in itervalues(rooms_to_calculate):
+            extremity_event_ids.update(latest_event_ids)
+            extremity_event_ids.update(new_latest_event_ids)
+        extremity_event_ids -= persisting_event_ids
+
+        event_id_to_state_group = {}
+        if extremity_event_ids:
+            event_id_to_state_group = yield self._get_state_group_for_events(
+                extremity_event_ids,
+            )
+
+        for room_id, (latest_event_ids, new_latest_event_ids) in iteritems(
+            rooms_to_calculate
+        ):
+            logger.info(
+                "Calculating state delta for room %s", room_id,
+            )
+            with Measure(
+                self._clock,
+                "persist_events.get_new_state_after_events",
+            ):
+                res = yield self._get_new_state_after_events(
+                    room_id,
+                    events_by_room[room_id],
+                    latest_event_ids,
+                    new_latest_event_ids,
+                    event_id_to_state_group,
+                )
+                current_state, delta_ids = res
+
+            # If either are not None then there has been a change,
+            # and we need to work out the delta (or use that
+            # given)
+            if delta_ids is not None:
+                # If there is a delta we know that we've
+                # only added or replaced state, never
+                # removed keys entirely.
+                state_delta_for_room[room_id] = ([], delta_ids)
+            elif current_state is not None:
+                with Measure(
+                    self._clock,
+                    "persist_events.calculate_state_delta",
+                ):
+                    delta = yield self._calculate_state_delta(
+                        room_id, current_state,
+                    )
+                state_delta_for_room[room_id] = delta
+
+            # If we have the current_state then lets prefill
+            # the cache with it.
+            if current_state is not None:
+                current_state_for_room[room_id] = current_state
+
+        defer.returnValue((
+            new_forward_extremeties, current_state_for_room, state_delta_for_room,
+        ))
+
+    @defer.inlineCallbacks
+    def _calculate_new_extremities(self, events_by_room, latest_event_ids_by_room):
+        """Calculates the new forward extremities for some rooms given events to
+        persist.
+
+        Args:
+            events_by_room (dict[str, list[(EventBase, EventContext)]]): the
+                events being persisted in each room
+            latest_event_ids_by_room (dict[str, set[str]]): the current forward
+                extremities of each room
+
+        Returns:
+            Deferred[dict[str, set[str]]]: the new forward extremities of each
+                room
+        """
+        results = {}
+        for room_id, event_contexts in iteritems(events_by_room):
+            # we're only interested in new events which aren't outliers and which
+            # aren't being rejected.
+            new_events = [
+                event for event, ctx in event_contexts
+                if not event.internal_metadata.is_outlier() and not ctx.rejected
+            ]
+
+            # start with the existing forward extremities
+            result = set(latest_event_ids_by_room[room_id])
+
+            # add all the new events to the list
+            result.update(
+                event.event_id for event in new_events
+            )
+
+            # Now remove all events which are prev_events of any of the new events
+            result.difference_update(
+                e_id
+                for event in new_events
+                for e_id in event.prev_event_ids()
+            )
+
+            results[room_id] = result
 
         # Finally, remove any events which are prev_events of any existing events.
-        existing_prevs = yield self._get_events_which_are_prevs(result)
-        result.difference_update(existing_prevs)
+        # We look these up for all the rooms at once.
+        existing_prevs = yield self._get_events_which_are_prevs(
+            set().union(*itervalues(results)),
+        )
+        existing_prevs = set(existing_prevs)
+        for result in itervalues(results):
+            result.difference_update(existing_prevs)
 
-        defer.returnValue(result)
+        defer.returnValue(results)
 
     @defer.inlineCallbacks
     def _get_events_which_are_prevs(self, event_ids):
@@ -571,37 +772,38 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
         Returns:
             Deferred[List[str]]: filtered event ids
         """
-        results = []
-
-        def _get_events(txn, batch):
-            sql = """
-            SELECT prev_event_id
-            FROM event_edges
-                INNER JOIN events USING (event_id)
-                LEFT JOIN rejections USING (event_id)
-            WHERE
-                prev_event_id IN (%s)
-                AND NOT events.outlier
-                AND rejections.event_id IS NULL
-            """ % (
-                ",".join("?" for _ in batch),
-            )
+        def _get_events(txn):
+            results = []
+            for batch in batch_iter(event_ids, 100):
+                sql = """
+                SELECT prev_event_id
+                FROM event_edges
+                    INNER JOIN events USING (event_id)
+                    LEFT JOIN rejections USING (event_id)
+                WHERE
+                    prev_event_id IN (%s)
+                    AND NOT events.outlier
+                    AND rejections.event_id IS NULL
+                """ % (
+                    ",".join("?" for _ in batch),
+                )
 
-            txn.execute(sql, batch)
-            results.extend(r[0] for r in txn)
+                txn.execute(sql, batch)
+                results.extend(r[0] for r in txn)
+            return results
 
-        for chunk in batch_iter(event_ids, 100):
-            yield self.runInteraction(
-                "_get_events_which_are_prevs",
-                _get_events,
-                chunk,
-            )
+        if not event_ids:
+            defer.returnValue([])
 
+        results = yield self.runInteraction(
+            "_get_events_which_are_prevs",
+            _get_events,
+        )
         defer.returnValue(results)
 
     @defer.inlineCallbacks
     def _get_new_state_after_events(self, room_id, events_context, old_latest_event_ids,
-                                    new_latest_event_ids):
+                                    new_latest_event_ids, event_id_to_state_group=None):
         """Calculate the current state dict after adding some new events to
         a room
 
@@ -618,6 +820,10 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             new_latest_event_ids (iterable[str]):
                 the new forward extremities for the room.
 
+            event_id_to_state_group (dict[str, int]|None):
+                the state groups of any of the extremities which have already
+                been looked up.
+
         Returns:
             Deferred[tuple[dict[(str,str), str]|None, dict[(str,str), str]|None]]:
             Returns a tuple of two state maps, the first being the full new current
@@ -667,7 +873,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
         # extremities are going to be in events_context).
         missing_event_ids = set(old_latest_event_ids)
 
-        event_id_to_state_group = {}
+        event_id_to_state_group = dict(event_id_to_state_group or {})
         for event_id in new_latest_event_ids:
             # First search in the list of new events we're adding.
             for ev, ctx in events_context:
@@ -679,6 +885,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                 # the state from the database
                 missing_event_ids.add(event_id)
 
+        missing_event_ids.difference_update(event_id_to_state_group)
         if missing_event_ids:
             # Now pull out the state groups for any missing events from DB
             event_to_groups = yield self._get_state_group_for_events(
@@ -885,6 +1092,12 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             ],
         )
 
+        # ... and add them to the auth chain index, which we also do for
+        # rejected events for the same reason.
+        self._persist_event_auth_chain_txn(
+            txn, [event for event, _ in events_and_contexts],
+        )
+
         # _store_rejected_events_txn filters out any events which were
         # rejected, and returns the filtered list.
         events_and_contexts = self._store_rejected_events_txn(
@@ -902,6 +1115,383 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             backfilled=backfilled,
         )
 
+    def _persist_event_auth_chain_txn(self, txn, events):
+        """Add the given events to the auth chain index, if their rooms are
+        being indexed.
+
+        Args:
+            txn
+            events (list[EventBase]): events which are being persisted. Only
+                state events are indexed.
+        """
+        state_events = [event for event in events if event.is_state()]
+        if not state_events:
+            return
+
+        rows = self._simple_select_many_txn(
+            txn,
+            table="rooms",
+            column="room_id",
+            iterable=set(event.room_id for event in state_events),
+            keyvalues={},
+            retcols=("room_id", "has_auth_chain_index"),
+        )
+        indexed_rooms = set(
+            row["room_id"] for row in rows if row["has_auth_chain_index"]
+        )
+
+        event_to_room_id = {}
+        event_to_types = {}
+        event_to_auth_chain = {}
+        for event in state_events:
+            if event.room_id not in indexed_rooms:
+                continue
+
+            event_to_room_id[event.event_id] = event.room_id
+            event_to_types[event.event_id] = (event.type, event.state_key)
+            event_to_auth_chain[event.event_id] = event.auth_event_ids()
+
+        if event_to_room_id:
+            self._add_chain_cover_index(
+                txn, event_to_room_id, event_to_types, event_to_auth_chain,
+            )
+
+    def _add_chain_cover_index(
+        self, txn, event_to_room_id, event_to_types, event_to_auth_chain,
+    ):
+        """Calculate the chain cover index for the given events.
+
+        Each indexed event is given a chain ID and a sequence number within the
+        chain, such that earlier events in a chain are in the auth chain of
+        later ones. We then store links between chains such that, for any
+        events A at (CA, SA) and B at (CB, SB) in different chains, B is in A's
+        auth chain if and only if there is a link (CA, S1) -> (CB, S2) with
+        S1 <= SA and SB <= S2.
+
+        An event can only be indexed once all of its auth events have been, so
+        events whose auth events we don't have are stashed in
+        `event_auth_chain_to_calculate` and retried next time an event in the
+        room is indexed.
+
+        Args:
+            txn
+            event_to_room_id (dict[str, str]): event ID to the room ID of the
+                event, for the events to index.
+            event_to_types (dict[str, tuple[str, str]]): event ID to the type
+                and state key of the event.
+            event_to_auth_chain (dict[str, list[str]]): event ID to the auth
+                event IDs of the event.
+        """
+
+        # Map from event ID to chain ID/sequence number.
+        chain_map = {}
+
+        # Set of event IDs to calculate chain ID/seq numbers for.
+        events_to_calc_chain_id_for = set(event_to_room_id)
+
+        # Pick up any events in these rooms which we previously couldn't index.
+        rows = self._simple_select_many_txn(
+            txn,
+            table="event_auth_chain_to_calculate",
+            column="room_id",
+            iterable=set(itervalues(event_to_room_id)),
+            keyvalues={},
+            retcols=("event_id", "type", "state_key"),
+        )
+        for row in rows:
+            event_id = row["event_id"]
+
+            # (This happens rarely, and almost always with a single row, so we
+            # don't bother batching up the lookups.)
+            auth_events = self._simple_select_onecol_txn(
+                txn,
+                table="event_auth",
+                keyvalues={"event_id": event_id},
+                retcol="auth_id",
+            )
+
+            events_to_calc_chain_id_for.add(event_id)
+            event_to_types[event_id] = (row["type"], row["state_key"])
+            event_to_auth_chain[event_id] = auth_events
+
+        # Now we get the chain ID and sequence numbers of the events' auth
+        # events (that aren't also being indexed).
+        #
+        # Some of those may not have been indexed, for example if they were
+        # persisted before their own auth events. We handle that by adding them
+        # to the set of events to index, which means looking up their auth
+        # events in turn.
+        missing_auth_chains = set(
+            a_id
+            for auth_events in itervalues(event_to_auth_chain)
+            for a_id in auth_events
+            if a_id not in events_to_calc_chain_id_for
+        )
+
+        sql = (
+            "SELECT event_id, e.type, se.state_key, chain_id, sequence_number"
+            " FROM events AS e"
+            " INNER JOIN state_events AS se USING (event_id)"
+            " LEFT JOIN event_auth_chains USING (event_id)"
+            " WHERE event_id IN (%s)"
+        )
+
+        while missing_auth_chains:
+            batch = list(missing_auth_chains)
+            missing_auth_chains.clear()
+
+            rows = []
+            for chunk in batch_iter(batch, 100):
+                txn.execute(sql % (",".join("?" for _ in chunk),), chunk)
+                rows.extend(txn)
+
+            for auth_id, event_type, state_key, chain_id, sequence_number in rows:
+                event_to_types[auth_id] = (event_type, state_key)
+
+                if chain_id is None:
+                    events_to_calc_chain_id_for.add(auth_id)
+
+                    event_to_auth_chain[auth_id] = self._simple_select_onecol_txn(
+                        txn,
+                        table="event_auth",
+                        keyvalues={"event_id": auth_id},
+                        retcol="auth_id",
+                    )
+
+                    missing_auth_chains.update(
+                        e_id
+                        for e_id in event_to_auth_chain[auth_id]
+                        if e_id not in event_to_types
+                        and e_id not in events_to_calc_chain_id_for
+                    )
+                else:
+                    chain_map[auth_id] = (chain_id, sequence_number)
+
+        # Now drop any events for which we still don't have every auth event,
+        # along with anything that depends on them.
+        for event_id in sorted_topologically(
+            events_to_calc_chain_id_for, event_to_auth_chain,
+        ):
+            for auth_id in event_to_auth_chain.get(event_id, []):
+                if (
+                    auth_id not in chain_map
+                    and auth_id not in events_to_calc_chain_id_for
+                ):
+                    events_to_calc_chain_id_for.discard(event_id)
+
+                    # If this is one of the events we were asked to index then
+                    # we stash it to try again later. (Anything else is either
+                    # already stashed or not part of an indexed room.)
+                    room_id = event_to_room_id.get(event_id)
+                    if room_id:
+                        e_type, state_key = event_to_types[event_id]
+                        self._simple_insert_txn(
+                            txn,
+                            table="event_auth_chain_to_calculate",
+                            values={
+                                "event_id": event_id,
+                                "room_id": room_id,
+                                "type": e_type,
+                                "state_key": state_key,
+                            },
+                        )
+
+                    break
+
+        if not events_to_calc_chain_id_for:
+            return
+
+        new_chain_tuples = self._allocate_chain_ids(
+            txn, event_to_types, event_to_auth_chain,
+            events_to_calc_chain_id_for, chain_map,
+        )
+        chain_map.update(new_chain_tuples)
+
+        self._simple_insert_many_txn(
+            txn,
+            table="event_auth_chains",
+            values=[
+                {
+                    "event_id": event_id,
+                    "chain_id": chain_id,
+                    "sequence_number": sequence_number,
+                }
+                for event_id, (chain_id, sequence_number) in iteritems(
+                    new_chain_tuples
+                )
+            ],
+        )
+
+        self._simple_delete_many_txn(
+            txn,
+            table="event_auth_chain_to_calculate",
+            column="event_id",
+            iterable=list(new_chain_tuples),
+            keyvalues={},
+        )
+
+        # Now we need to add the links between chains caused by the new
+        # events. For each new event we:
+        #   1. fetch the chain IDs/sequence numbers of its auth events,
+        #      discarding any that are reachable from its other auth events or
+        #      that are in the event's own chain; and
+        #   2. for each remaining auth event, add a link from the event to the
+        #      auth event, and to every chain reachable from the auth event.
+        #
+        # This keeps the links transitively closed, so that we only ever need
+        # to follow one hop at query time.
+
+        chain_links = _LinkMap()
+        origin_chains = set(chain_id for chain_id, _ in itervalues(chain_map))
+        sql = (
+            "SELECT origin_chain_id, origin_sequence_number,"
+            " target_chain_id, target_sequence_number"
+            " FROM event_auth_chain_links"
+            " WHERE origin_chain_id IN (%s)"
+        )
+        for chunk in batch_iter(origin_chains, 100):
+            txn.execute(sql % (",".join("?" for _ in chunk),), chunk)
+            for origin_id, origin_seq, target_id, target_seq in txn:
+                chain_links.add_link(
+                    (origin_id, origin_seq), (target_id, target_seq), new=False,
+                )
+
+        # We do this in topological order to avoid adding redundant links.
+        for event_id in sorted_topologically(
+            events_to_calc_chain_id_for, event_to_auth_chain,
+        ):
+            chain_id, sequence_number = chain_map[event_id]
+
+            # Filter out auth events that are reachable by other auth events.
+            # We do this by looking at every permutation of pairs of auth
+            # events (A, B) to check if B is reachable from A.
+            auth_ids = set(event_to_auth_chain.get(event_id, []))
+            reduction = set(
+                a_id for a_id in auth_ids if chain_map[a_id][0] != chain_id
+            )
+            for start_auth_id, end_auth_id in itertools.permutations(auth_ids, r=2):
+                if chain_links.exists_path_from(
+                    chain_map[start_auth_id], chain_map[end_auth_id],
+                ):
+                    reduction.discard(end_auth_id)
+
+            for auth_id in reduction:
+                auth_chain_id, auth_sequence_number = chain_map[auth_id]
+
+                chain_links.add_link(
+                    (chain_id, sequence_number),
+                    (auth_chain_id, auth_sequence_number),
+                )
+
+                for target_id, target_seq in chain_links.get_links_from(
+                    (auth_chain_id, auth_sequence_number),
+                ):
+                    if target_id == chain_id:
+                        continue
+
+                    chain_links.add_link(
+                        (chain_id, sequence_number), (target_id, target_seq),
+                    )
+
+        self._simple_insert_many_txn(
+            txn,
+            table="event_auth_chain_links",
+            values=[
+                {
+                    "origin_chain_id": source_id,
+                    "origin_sequence_number": source_seq,
+                    "target_chain_id": target_id,
+                    "target_sequence_number": target_seq,
+                }
+                for (
+                    source_id, source_seq, target_id, target_seq,
+                ) in chain_links.get_additions()
+            ],
+        )
+
+    def _allocate_chain_ids(
+        self, txn, event_to_types, event_to_auth_chain,
+        events_to_calc_chain_id_for, chain_map,
+    ):
+        """Allocate a chain ID/sequence number to each of the given events.
+
+        An event continues the chain of its auth event with the same type and
+        state key (ie, the event it replaces in the state), if that auth event
+        is currently the last in its chain. Otherwise it starts a new chain.
+
+        Returns:
+            dict[str, tuple[int, int]]: event ID to chain ID/sequence number
+        """
+
+        # First, we work out which auth event (if any) each event will inherit
+        # its chain from, and which existing chains are involved. We do this in
+        # topological order so that an event's auth events come before it.
+        existing_chains = set()
+        tree = []
+
+        for event_id in sorted_topologically(
+            events_to_calc_chain_id_for, event_to_auth_chain,
+        ):
+            for auth_id in event_to_auth_chain.get(event_id, []):
+                if event_to_types.get(event_id) == event_to_types.get(auth_id):
+                    existing_chain_id = chain_map.get(auth_id)
+                    if existing_chain_id:
+                        existing_chains.add(existing_chain_id[0])
+
+                    tree.append((event_id, auth_id))
+                    break
+            else:
+                tree.append((event_id, None))
+
+        # Then we fetch the current max sequence number of each of the existing
+        # chains, so that we can check the inherited position isn't taken.
+        chain_to_max_seq_no = {}
+        sql = (
+            "SELECT chain_id, MAX(sequence_number) FROM event_auth_chains"
+            " WHERE chain_id IN (%s)"
+            " GROUP BY chain_id"
+        )
+        for chunk in batch_iter(existing_chains, 100):
+            txn.execute(sql % (",".join("?" for _ in chunk),), chunk)
+            chain_to_max_seq_no.update(txn)
+
+        # Finally, we allocate the positions. New chains are given a
+        # placeholder ID, which we swap for a real one at the end.
+        unallocated_chain_ids = []
+        new_chain_tuples = {}
+        for event_id, auth_event_id in tree:
+            existing_chain_id = None
+            if auth_event_id:
+                existing_chain_id = new_chain_tuples.get(auth_event_id)
+                if not existing_chain_id:
+                    existing_chain_id = chain_map[auth_event_id]
+
+            new_chain_tuple = None
+            if existing_chain_id:
+                proposed_new_id = existing_chain_id[0]
+                proposed_new_seq = existing_chain_id[1] + 1
+
+                if chain_to_max_seq_no[proposed_new_id] < proposed_new_seq:
+                    new_chain_tuple = (proposed_new_id, proposed_new_seq)
+
+            if not new_chain_tuple:
+                new_chain_tuple = (object(), 1)
+                unallocated_chain_ids.append(new_chain_tuple[0])
+
+            new_chain_tuples[event_id] = new_chain_tuple
+            chain_to_max_seq_no[new_chain_tuple[0]] = new_chain_tuple[1]
+
+        chain_id_to_allocated_map = {
+            placeholder: self._event_chain_id_gen.get_next()
+            for placeholder in unallocated_chain_ids
+        }
+        chain_id_to_allocated_map.update((c, c) for c in existing_chains)
+
+        return {
+            event_id: (chain_id_to_allocated_map[chain_id], seq)
+            for event_id, (chain_id, seq) in iteritems(new_chain_tuples)
+        }
+
     def _update_current_state_txn(self, txn, state_delta_by_room, max_stream_order):
         for room_id, current_state_tuple in iteritems(state_delta_by_room):
             to_delete, to_insert = current_state_tuple
@@ -919,7 +1509,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                     WHERE room_id = ? AND type = ? AND state_key = ?
                 )
             """
-            txn.executemany(sql, (
+            txn.execute_batch(sql, (
                 (
                     max_stream_order, room_id, etype, state_key, None,
                     room_id, etype, state_key,
@@ -928,7 +1518,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                 # We sanity check that we're deleting rather than updating
                 if (etype, state_key) not in to_insert
             ))
-            txn.executemany(sql, (
+            txn.execute_batch(sql, (
                 (
                     max_stream_order, room_id, etype, state_key, ev_id,
                     room_id, etype, state_key,
@@ -938,7 +1528,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
 
             # Now we actually update the current_state_events table
 
-            txn.executemany(
+            txn.execute_batch(
                 "DELETE FROM current_state_events"
                 " WHERE room_id = ? AND type = ? AND state_key = ?",
                 (
@@ -1182,6 +1772,8 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
         for table in (
                 "events",
                 "event_auth",
+                "event_auth_chains",
+                "event_auth_chain_to_calculate",
                 "event_json",
                 "event_content_hashes",
                 "event_destinations",
@@ -1202,7 +1794,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                 "room_memberships",
                 "topics"
         ):
-            txn.executemany(
+            txn.execute_batch(
                 "DELETE FROM %s WHERE event_id = ?" % (table,),
                 [(ev.event_id,) for ev, _ in events_and_contexts]
             )
@@ -1210,7 +1802,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
         for table in (
             "event_push_actions",
         ):
-            txn.executemany(
+            txn.execute_batch(
                 "DELETE FROM %s WHERE room_id = ? AND event_id = ?" % (table,),
                 [(ev.room_id, ev.event_id) for ev, _ in events_and_contexts]
             )
@@ -1682,6 +2274,187 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
 
         defer.returnValue(result)
 
+    def _index_room_auth_chains_txn(self, txn, room_id, after=None, limit=None):
+        """Adds a room's existing events to the auth chain index, in
+        topological order.
+
+        Args:
+            txn
+            room_id (str)
+            after (tuple[int, int]|None): if given, only index the events after
+                this (topological ordering, stream ordering).
+            limit (int|None): if given, only look at this many events.
+
+        Returns:
+            tuple[int, tuple[int, int]|None]: the number of events looked at,
+            and the (topological ordering, stream ordering) of the last one.
+        """
+        sql = (
+            "SELECT e.event_id, e.type, se.state_key,"
+            " e.topological_ordering, e.stream_ordering,"
+            " c.chain_id, t.event_id"
+            " FROM events AS e"
+            " LEFT JOIN state_events AS se USING (event_id)"
+            " LEFT JOIN event_auth_chains AS c USING (event_id)"
+            " LEFT JOIN event_auth_chain_to_calculate AS t USING (event_id)"
+            " WHERE e.room_id = ?"
+        )
+        args = [room_id]
+        if after is not None:
+            sql += (
+                " AND (e.topological_ordering > ?"
+                " OR (e.topological_ordering = ? AND e.stream_ordering > ?))"
+            )
+            args.extend((after[0], after[0], after[1]))
+        sql += " ORDER BY e.topological_ordering, e.stream_ordering"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+
+        txn.execute(sql, args)
+        rows = txn.fetchall()
+
+        # Rejected state events don't have a state_events row, so we need
+        # to check their JSON to find out if they are state events.
+        rejected = self._get_rejected_state_keys_txn(
+            txn, [r[0] for r in rows if r[2] is None],
+        )
+
+        event_to_room_id = {}
+        event_to_types = {}
+        for event_id, etype, state_key, _, _, chain_id, pending_id in rows:
+            if chain_id is not None or pending_id is not None:
+                # already indexed, or will be picked up with the rest of
+                # the room's pending events.
+                continue
+
+            if state_key is None:
+                state_key = rejected.get(event_id)
+                if state_key is None:
+                    continue
+
+            event_to_room_id[event_id] = room_id
+            event_to_types[event_id] = (etype, state_key)
+
+        event_to_auth_chain = {}
+        auth_rows = self._simple_select_many_txn(
+            txn,
+            table="event_auth",
+            column="event_id",
+            iterable=list(event_to_room_id),
+            keyvalues={},
+            retcols=("event_id", "auth_id"),
+        )
+        for auth_row in auth_rows:
+            event_to_auth_chain.setdefault(
+                auth_row["event_id"], [],
+            ).append(auth_row["auth_id"])
+
+        if event_to_room_id:
+            self._add_chain_cover_index(
+                txn, event_to_room_id, event_to_types, event_to_auth_chain,
+            )
+
+        if not rows:
+            return 0, None
+        return len(rows), (rows[-1][3], rows[-1][4])
+
+    @defer.inlineCallbacks
+    def _background_chain_cover_index(self, progress, batch_size):
+        """Builds the auth chain index for existing rooms.
+
+        We work through the rooms one at a time, indexing each room's events in
+        topological order, and then switch on incremental indexing for the
+        room once we've caught up.
+        """
+        current_room_id = progress.get("current_room_id", "")
+        last_depth = progress.get("last_depth")
+        last_stream = progress.get("last_stream")
+
+        def _chain_cover_index_txn(txn):
+            txn.execute(
+                "SELECT room_id FROM rooms"
+                " WHERE room_id >= ?"
+                " AND (has_auth_chain_index IS NULL OR has_auth_chain_index = ?)"
+                " ORDER BY room_id LIMIT 1",
+                (current_room_id, False),
+            )
+            row = txn.fetchone()
+            if not row:
+                return None
+
+            room_id = row[0]
+
+            after = None
+            if room_id == current_room_id and last_depth is not None:
+                after = (last_depth, last_stream)
+
+            count, last_position = self._index_room_auth_chains_txn(
+                txn, room_id, after=after, limit=batch_size,
+            )
+
+            if count < batch_size:
+                # We've reached the end of the room, so from now on we can
+                # index its events as they are persisted.
+                #
+                # Events persisted between our reading the room above and this
+                # committing won't get indexed. That's fine: auth chain queries
+                # which involve them fall back to walking the graph.
+                self._simple_update_one_txn(
+                    txn,
+                    table="rooms",
+                    keyvalues={"room_id": room_id},
+                    updatevalues={"has_auth_chain_index": True},
+                )
+                new_progress = {"current_room_id": room_id}
+            else:
+                new_progress = {
+                    "current_room_id": room_id,
+                    "last_depth": last_position[0],
+                    "last_stream": last_position[1],
+                }
+
+            self._background_update_progress_txn(
+                txn, self.EVENT_AUTH_CHAIN_COVER_UPDATE_NAME, new_progress,
+            )
+
+            # Count rooms with no events as one item, so that we make progress.
+            return max(count, 1)
+
+        result = yield self.runInteraction(
+            self.EVENT_AUTH_CHAIN_COVER_UPDATE_NAME, _chain_cover_index_txn,
+        )
+
+        if result is None:
+            yield self._end_background_update(
+                self.EVENT_AUTH_CHAIN_COVER_UPDATE_NAME,
+            )
+            result = 0
+
+        defer.returnValue(result)
+
+    def _get_rejected_state_keys_txn(self, txn, event_ids):
+        """Find the state keys of any rejected state events in the given list.
+
+        Returns:
+            dict[str, str]: event ID to state key, for the events which are
+            rejected state events.
+        """
+        results = {}
+        for chunk in batch_iter(event_ids, 100):
+            txn.execute(
+                "SELECT event_id, json FROM rejections"
+                " INNER JOIN event_json USING (event_id)"
+                " WHERE event_id IN (%s)" % (",".join("?" for _ in chunk),),
+                chunk,
+            )
+            for event_id, event_json in txn.fetchall():
+                state_key = json.loads(event_json).get("state_key")
+                if state_key is not None:
+                    results[event_id] = state_key
+
+        return results
+
     def get_current_backfill_token(self):
         """The current minimum token that backfilled events have reached"""
         return -self._backfill_id_gen.get_current_token()
@@ -1856,11 +2629,34 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             )
         return self.runInteraction("get_all_new_events", get_all_new_events_txn)
 
+    def get_unfinished_purges(self):
+        """Get the purges which were started but haven't finished, e.g. because
+        we were restarted part way through.
+
+        Returns:
+            Deferred[list[dict]]: the purges, with keys "purge_id", "room_id",
+            "token" and "delete_local_events".
+        """
+        return self._simple_select_list(
+            table="room_purges",
+            keyvalues={},
+            retcols=("purge_id", "room_id", "token", "delete_local_events"),
+            desc="get_unfinished_purges",
+        )
+
+    @defer.inlineCallbacks
     def purge_history(
-        self, room_id, token, delete_local_events,
+        self, room_id, token, delete_local_events, purge_id=None,
+        progress_callback=None,
     ):
         """Deletes room history before a certain point
 
+        The events are deleted a batch at a time, each in its own transaction,
+        pausing between the batches so that we don't starve everything else of
+        the database. Our progress is stored in the database, so if we are
+        interrupted, calling this again with the same purge_id carries on from
+        where we left off.
+
         Args:
             room_id (str):
 
@@ -1870,39 +2666,82 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                 if True, we will delete local events as well as remote ones
                 (instead of just marking them as outliers and deleting their
                 state groups).
+
+            purge_id (str|None): an ID for this purge, which it is stored
+                under. One is generated if not given.
+
+            progress_callback (callable|None): called with the number of
+                events processed so far and the total number of events to
+                process, after each batch.
         """
+        if purge_id is None:
+            purge_id = random_string(16)
 
-        return self.runInteraction(
-            "purge_history",
-            self._purge_history_txn, room_id, token,
+        events_total, events_processed = yield self.runInteraction(
+            "start_purge_history",
+            self._start_purge_history_txn, purge_id, room_id, token,
             delete_local_events,
         )
 
-    def _purge_history_txn(
-        self, txn, room_id, token_str, delete_local_events,
+        topological = RoomStreamToken.parse(token).topological
+        performance = BackgroundUpdatePerformance("purge_history")
+        batch_size = self.DEFAULT_PURGE_BATCH_SIZE
+
+        while True:
+            if progress_callback:
+                progress_callback(events_processed, events_total)
+
+            start_ms = self._clock.time_msec()
+            count = yield self.runInteraction(
+                "purge_history_batch",
+                self._purge_history_batch_txn, purge_id, room_id, topological,
+                delete_local_events, batch_size,
+            )
+            duration_ms = self._clock.time_msec() - start_ms
+
+            events_processed += count
+            if count < batch_size:
+                break
+
+            # As with background updates, we size the next batch so that it
+            # should take about PURGE_BATCH_DURATION_MS, and leave the database
+            # alone for a bit in between.
+            performance.update(count, max(duration_ms, 1))
+            items_per_ms = performance.average_items_per_ms()
+            batch_size = max(
+                int(items_per_ms * self.PURGE_BATCH_DURATION_MS),
+                self.MINIMUM_PURGE_BATCH_SIZE,
+            )
+
+            yield self._clock.sleep(self.PURGE_BATCH_INTERVAL_MS / 1000.)
+
+        yield self.runInteraction(
+            "finish_purge_history",
+            self._finish_purge_history_txn, purge_id, room_id,
+        )
+
+        if progress_callback:
+            progress_callback(events_processed, events_total)
+
+        logger.info("[purge] done")
+
+    def _insert_events_to_purge_txn(
+        self, txn, room_id, topological, delete_local_events, limit=None,
     ):
-        token = RoomStreamToken.parse(token_str)
+        """Builds a temporary table, events_to_purge, listing the events which
+        the purge still has to deal with.
 
-        # Tables that should be pruned:
-        #     event_auth
-        #     event_backward_extremities
-        #     event_content_hashes
-        #     event_destinations
-        #     event_edge_hashes
-        #     event_edges
-        #     event_forward_extremities
-        #     event_json
-        #     event_push_actions
-        #     event_reference_hashes
-        #     event_search
-        #     event_signatures
-        #     event_to_state_groups
-        #     events
-        #     rejections
-        #     room_depth
-        #     state_groups
-        #     state_groups_state
+        Args:
+            txn
+            room_id (str)
+            topological (int): the topological ordering to purge events before
+            delete_local_events (bool)
+            limit (int|None): if given, only list this many events, the oldest
+                first.
 
+        Returns:
+            int: the number of events listed
+        """
         # we will build a temporary table listing the events so that we don't
         # have to keep shovelling the list back and forth across the
         # connection. Annoyingly the python sqlite driver commits the
@@ -1920,28 +2759,6 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             ")"
         )
 
-        # First ensure that we're not about to delete all the forward extremeties
-        txn.execute(
-            "SELECT e.event_id, e.depth FROM events as e "
-            "INNER JOIN event_forward_extremities as f "
-            "ON e.event_id = f.event_id "
-            "AND e.room_id = f.room_id "
-            "WHERE f.room_id = ?",
-            (room_id,)
-        )
-        rows = txn.fetchall()
-        max_depth = max(row[1] for row in rows)
-
-        if max_depth < token.topological:
-            # We need to ensure we don't delete all the events from the database
-            # otherwise we wouldn't be able to send any events (due to not
-            # having any backwards extremeties)
-            raise SynapseError(
-                400, "topological_ordering is greater than forward extremeties"
-            )
-
-        logger.info("[purge] looking for events to delete")
-
         should_delete_expr = "state_key IS NULL"
         should_delete_params = ()
         if not delete_local_events:
@@ -1953,11 +2770,15 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                 "%:" + self.hs.hostname,
             )
 
-        should_delete_params += (room_id, token.topological)
+        should_delete_params += (room_id, topological)
 
         # Note that we insert events that are outliers and aren't going to be
         # deleted, as nothing will happen to them.
-        txn.execute(
+        #
+        # Once the purge has dealt with an event it is either deleted or an
+        # outlier which we aren't going to delete, so this only ever lists the
+        # events which are still to be done.
+        sql = (
             "INSERT INTO events_to_purge"
             " SELECT event_id, %s"
             " FROM events AS e LEFT JOIN state_events USING (event_id)"
@@ -1965,9 +2786,13 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             % (
                 should_delete_expr,
                 should_delete_expr,
-            ),
-            should_delete_params,
+            )
         )
+        if limit is not None:
+            sql += " ORDER BY stream_ordering LIMIT ?"
+            should_delete_params += (limit,)
+
+        txn.execute(sql, should_delete_params)
 
         # We create the indices *after* insertion as that's a lot faster.
 
@@ -1985,13 +2810,91 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             " ON events_to_purge(event_id)",
         )
 
+        txn.execute("SELECT COUNT(*) FROM events_to_purge")
+        count, = txn.fetchone()
+        return count
+
+    def _start_purge_history_txn(
+        self, txn, purge_id, room_id, token_str, delete_local_events,
+    ):
+        """Sets up a purge: checks that it is allowed, replaces the room's
+        backward extremities and records the purge in room_purges.
+
+        Does nothing if the purge has already been set up. Replaces any other
+        purge of the room which was left behind, e.g. because it failed.
+
+        Returns:
+            tuple[int, int]: the total number of events to process, and the
+            number processed so far.
+        """
+        row = self._simple_select_one_txn(
+            txn,
+            table="room_purges",
+            keyvalues={"purge_id": purge_id},
+            retcols=("events_total", "events_processed"),
+            allow_none=True,
+        )
+        if row:
+            logger.info("[purge] resuming purge %s", purge_id)
+            return row["events_total"], row["events_processed"]
+
+        token = RoomStreamToken.parse(token_str)
+
+        # Tables that should be pruned:
+        #     event_auth
+        #     event_backward_extremities
+        #     event_content_hashes
+        #     event_destinations
+        #     event_edge_hashes
+        #     event_edges
+        #     event_forward_extremities
+        #     event_json
+        #     event_push_actions
+        #     event_reference_hashes
+        #     event_search
+        #     event_signatures
+        #     event_to_state_groups
+        #     events
+        #     rejections
+        #     room_depth
+        #     state_groups
+        #     state_groups_state
+
+        # First ensure that we're not about to delete all the forward extremeties
+        txn.execute(
+            "SELECT e.event_id, e.depth FROM events as e "
+            "INNER JOIN event_forward_extremities as f "
+            "ON e.event_id = f.event_id "
+            "AND e.room_id = f.room_id "
+            "WHERE f.room_id = ?",
+            (room_id,)
+        )
+        rows = txn.fetchall()
+        max_depth = max(row[1] for row in rows)
+
+        if max_depth < token.topological:
+            # We need to ensure we don't delete all the events from the database
+            # otherwise we wouldn't be able to send any events (due to not
+            # having any backwards extremeties)
+            raise SynapseError(
+                400, "topological_ordering is greater than forward extremeties"
+            )
+
+        logger.info("[purge] looking for events to delete")
+
+        # Listing the events only writes to the temporary table, so is cheap
+        # compared to the deletions, which are done in batches later.
+        events_total = self._insert_events_to_purge_txn(
+            txn, room_id, token.topological, delete_local_events,
+        )
+
         txn.execute(
-            "SELECT event_id, should_delete FROM events_to_purge"
+            "SELECT COUNT(*) FROM events_to_purge WHERE should_delete"
         )
-        event_rows = txn.fetchall()
+        delete_count, = txn.fetchone()
         logger.info(
             "[purge] found %i events before cutoff, of which %i can be deleted",
-            len(event_rows), sum(1 for e in event_rows if e[1]),
+            events_total, delete_count,
         )
 
         logger.info("[purge] Finding new backward extremities")
@@ -2023,11 +2926,79 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             ]
         )
 
+        # A purge which failed without us being restarted is still listed, and
+        # would otherwise stop the room from being purged until we were. We
+        # have just listed the events which are left, so this purge takes over.
+        old_purge_id = self._simple_select_one_onecol_txn(
+            txn,
+            table="room_purges",
+            keyvalues={"room_id": room_id},
+            retcol="purge_id",
+            allow_none=True,
+        )
+        if old_purge_id is not None:
+            logger.info(
+                "[purge] replacing unfinished purge %s of %s",
+                old_purge_id, room_id,
+            )
+            self._simple_delete_txn(
+                txn,
+                table="room_purges",
+                keyvalues={"purge_id": old_purge_id},
+            )
+
+        self._simple_insert_txn(
+            txn,
+            table="room_purges",
+            values={
+                "purge_id": purge_id,
+                "room_id": room_id,
+                "token": token_str,
+                "delete_local_events": delete_local_events,
+                "events_total": events_total,
+                "events_processed": 0,
+            },
+        )
+
+        # finally, drop the temp table. this will commit the txn in sqlite,
+        # so make sure to keep this actually last.
+        txn.execute(
+            "DROP TABLE events_to_purge"
+        )
+
+        return events_total, 0
+
+    def _purge_history_batch_txn(
+        self, txn, purge_id, room_id, topological, delete_local_events,
+        batch_size,
+    ):
+        """Purges the oldest batch of events which the purge still has to deal
+        with, along with any state groups which are no longer needed.
+
+        Returns:
+            int: the number of events processed
+        """
+        count = self._insert_events_to_purge_txn(
+            txn, room_id, topological, delete_local_events, limit=batch_size,
+        )
+
+        txn.execute(
+            "SELECT event_id, should_delete FROM events_to_purge"
+        )
+        event_rows = txn.fetchall()
+        logger.info(
+            "[purge] processing %i events, of which %i can be deleted",
+            count, sum(1 for e in event_rows if e[1]),
+        )
+
         logger.info("[purge] finding redundant state groups")
 
         # Get all state groups that are referenced by events that are to be
         # deleted. We then go and check if they are referenced by other events
         # or state groups, and if not we delete them.
+        #
+        # Groups which are still referenced by events in later batches are
+        # kept until we get to those batches.
         txn.execute("""
             SELECT DISTINCT state_group FROM events_to_purge
             INNER JOIN event_to_state_groups USING (event_id)
@@ -2122,6 +3093,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             "events",
             "event_json",
             "event_auth",
+            "event_auth_chain_to_calculate",
             "event_content_hashes",
             "event_destinations",
             "event_edge_hashes",
@@ -2165,12 +3137,27 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             (True,),
         )
 
+        txn.execute(
+            "UPDATE room_purges SET events_processed = events_processed + ?"
+            " WHERE purge_id = ?",
+            (count, purge_id),
+        )
+
+        # finally, drop the temp table. this will commit the txn in sqlite,
+        # so make sure to keep this actually last.
+        txn.execute(
+            "DROP TABLE events_to_purge"
+        )
+
+        return count
+
+    def _finish_purge_history_txn(self, txn, purge_id, room_id):
         # synapse tries to take out an exclusive lock on room_depth whenever it
         # persists events (because upsert), and once we run this update, we
         # will block that for the rest of our transaction.
         #
-        # So, let's stick it at the end so that we don't block event
-        # persistence.
+        # So, we do it in its own transaction once all the events have been
+        # dealt with, so that we don't block event persistence.
         #
         # We do this by calculating the minimum depth of the backwards
         # extremities. However, the events in event_backward_extremities
@@ -2192,14 +3179,12 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             (min_depth, room_id,)
         )
 
-        # finally, drop the temp table. this will commit the txn in sqlite,
-        # so make sure to keep this actually last.
-        txn.execute(
-            "DROP TABLE events_to_purge"
+        self._simple_delete_txn(
+            txn,
+            table="room_purges",
+            keyvalues={"purge_id": purge_id},
         )
 
-        logger.info("[purge] done")
-
     def _find_unreferenced_groups_during_purge(self, txn, state_groups):
         """Used when purging history to figure out which state groups can be
         deleted and which need to be de-delta'ed (due to one of its prev groups
@@ -2324,3 +3309,126 @@ AllNewEventsResult = namedtuple("AllNewEventsResult", [
     "new_forward_events", "new_backfill_events",
     "forward_ex_outliers", "backward_ex_outliers",
 ])
+
+
+class _LinkMap(object):
+    """A helper type for tracking links between chains, when calculating the
+    auth chain index.
+    """
+
+    def __init__(self):
+        # Stores the set of links as nested maps: source chain ID -> target
+        # chain ID -> source sequence number -> target sequence number.
+        self.maps = {}
+
+        # Stores the links that have been added (with new set to true), as
+        # tuples of `(source chain ID, source sequence no, target chain ID)`.
+        self.additions = set()
+
+    def add_link(self, src_tuple, target_tuple, new=True):
+        """Add a new link between two chains, ensuring no redundant links are
+        added.
+
+        New links should be added in topological order.
+
+        Args:
+            src_tuple (tuple[int, int]): The chain ID/sequence number of the
+                source of the link.
+            target_tuple (tuple[int, int]): The chain ID/sequence number of the
+                target of the link.
+            new (bool): Whether this is a "new" link, i.e. should it be returned
+                by `get_additions`.
+
+        Returns:
+            bool: True if a link was added, false if the given link was dropped
+            as redundant
+        """
+        src_chain, src_seq = src_tuple
+        target_chain, target_seq = target_tuple
+
+        current_links = self.maps.setdefault(src_chain, {}).setdefault(target_chain, {})
+
+        assert src_chain != target_chain
+
+        if new:
+            # Check if the new link is redundant
+            for current_seq_src, current_seq_target in iteritems(current_links):
+                # If a link "crosses" another link then its redundant. For
+                # example in the following link 1 (L1) is redundant, as any
+                # event reachable via L1 is *also* reachable via L2.
+                #
+                #   Chain A     Chain B
+                #      |          |
+                #   L1 |------    |
+                #      |     |    |
+                #   L2 |---- | -->|
+                #      |     |    |
+                #      |     |--->|
+                #      |          |
+                #      |          |
+                #
+                # So we only need to keep links which *do not* cross, i.e.
+                # links that both start and end above or below an existing
+                # link.
+                #
+                # Note, since we add links in topological ordering we should
+                # never see `src_seq` less than `current_seq_src`.
+
+                if current_seq_src <= src_seq and target_seq <= current_seq_target:
+                    # This new link is redundant, nothing to do.
+                    return False
+
+            self.additions.add((src_chain, src_seq, target_chain))
+
+        current_links[src_seq] = target_seq
+        return True
+
+    def get_links_from(self, src_tuple):
+        """Gets the chains reachable from the given chain/sequence number.
+
+        Yields:
+            tuple[int, int]: The chain ID and sequence number the link points
+            to.
+        """
+        src_chain, src_seq = src_tuple
+        for target_id, sequence_numbers in iteritems(self.maps.get(src_chain, {})):
+            for link_src_seq, target_seq in iteritems(sequence_numbers):
+                if link_src_seq <= src_seq:
+                    yield target_id, target_seq
+
+    def get_links_between(self, source_chain, target_chain):
+        """Gets the links between two chains.
+
+        Returns:
+            iterable[tuple[int, int]]: The source and target sequence numbers.
+        """
+        return iteritems(self.maps.get(source_chain, {}).get(target_chain, {}))
+
+    def get_additions(self):
+        """Gets any newly added links.
+
+        Yields:
+            tuple[int, int, int, int]: The source chain ID/sequence number and
+            target chain ID/sequence number
+        """
+        for src_chain, src_seq, target_chain in self.additions:
+            target_seq = self.maps.get(src_chain, {}).get(target_chain, {}).get(src_seq)
+            if target_seq is not None:
+                yield (src_chain, src_seq, target_chain, target_seq)
+
+    def exists_path_from(self, src_tuple, target_tuple):
+        """Checks if there is a path between the source chain ID/sequence and
+        target chain ID/sequence.
+        """
+        src_chain, src_seq = src_tuple
+        target_chain, target_seq = target_tuple
+
+        if src_chain == target_chain:
+            return target_seq <= src_seq
+
+        links = self.get_links_between(src_chain, target_chain)
+        for link_start_seq, link_end_seq in links:
+            if link_start_seq <= src_seq and target_seq <= link_end_seq:
+                return True
+
+        return False
@@ -248,6 +248,8 @@ class EventsWorkerStore(SQLBaseStore):
 
     def _invalidate_get_event_cache(self, event_id):
         self._get_event_cache.invalidate((event_id,))
+        if self._shared_event_cache is not None:
+            self._shared_event_cache.invalidate(event_id)
 
     def _get_events_from_cache(self, events, allow_rejected, update_metrics=True):
         """Fetch events from the caches
@@ -368,6 +370,48 @@ class EventsWorkerStore(SQLBaseStore):
         if not events:
             defer.returnValue({})
 
+        rows = []
+        if self._shared_event_cache is not None:
+            rows, events = self._get_event_rows_from_shared_cache(events)
+
+        if events:
+            db_rows = yield self._fetch_event_rows_from_db(events)
+            if self._shared_event_cache is not None:
+                self._add_event_rows_to_shared_cache(db_rows)
+            rows.extend(db_rows)
+
+        if not allow_rejected:
+            rows[:] = [r for r in rows if not r["rejects"]]
+
+        res = yield make_deferred_yieldable(defer.gatherResults(
+            [
+                run_in_background(
+                    self._get_event_from_row,
+                    row["internal_metadata"], row["json"], row["redacts"],
+                    rejected_reason=row["rejects"],
+                    format_version=row["format_version"],
+                )
+                for row in rows
+            ],
+            consumeErrors=True
+        ))
+
+        defer.returnValue({
+            e.event.event_id: e
+            for e in res if e
+        })
+
+    @defer.inlineCallbacks
+    def _fetch_event_rows_from_db(self, events):
+        """Fetches the rows for some events from the database, using the
+        _event_fetch_list.
+
+        Args:
+            events (list[str]): the event IDs to fetch
+
+        Returns:
+            Deferred[list[dict]]: the rows for the events we found
+        """
         events_d = defer.Deferred()
         with self._event_fetch_lock:
             self._event_fetch_list.append(
@@ -394,26 +438,62 @@ class EventsWorkerStore(SQLBaseStore):
             rows = yield events_d
         logger.debug("Loaded %d events (%d rows)", len(events), len(rows))
 
-        if not allow_rejected:
-            rows[:] = [r for r in rows if not r["rejects"]]
+        defer.returnValue(rows)
 
-        res = yield make_deferred_yieldable(defer.gatherResults(
-            [
-                run_in_background(
-                    self._get_event_from_row,
-                    row["internal_metadata"], row["json"], row["redacts"],
-                    rejected_reason=row["rejects"],
-                    format_version=row["format_version"],
-                )
-                for row in rows
-            ],
-            consumeErrors=True
-        ))
+    def _get_event_rows_from_shared_cache(self, events):
+        """Looks up the rows for some events in the shared event cache.
 
-        defer.returnValue({
-            e.event.event_id: e
-            for e in res if e
-        })
+        Args:
+            events (list[str]): the event IDs to look up
+
+        Returns:
+            tuple[list[dict], list[str]]: the rows we found, and the IDs of the
+            events we didn't find.
+        """
+        rows = []
+        missing = []
+        for event_id in events:
+            # Some callers ask for an event ID of None, which won't be found.
+            value = None
+            if event_id is not None:
+                value = self._shared_event_cache.get(event_id)
+            if value is None:
+                missing.append(event_id)
+                continue
+
+            # See _add_event_rows_to_shared_cache
+            internal_metadata, js, format_version, redacts, rejects = (
+                value.decode("utf-8").split(u"\0")
+            )
+            rows.append({
+                "event_id": event_id,
+                "internal_metadata": internal_metadata,
+                "json": js,
+                "format_version": int(format_version) if format_version else None,
+                "redacts": redacts or None,
+                "rejects": rejects or None,
+            })
+
+        return rows, missing
+
+    def _add_event_rows_to_shared_cache(self, rows):
+        """Adds the rows for some events, as returned by _fetch_event_rows, to
+        the shared event cache.
+
+        Args:
+            rows (list[dict])
+        """
+        for row in rows:
+            # None of the fields can contain a NUL, as they are JSON or IDs, so
+            # we use it to separate them.
+            value = u"\0".join((
+                row["internal_metadata"],
+                row["json"],
+                str(row["format_version"] or ""),
+                row["redacts"] or "",
+                row["rejects"] or "",
+            ))
+            self._shared_event_cache.set(row["event_id"], value.encode("utf-8"))
 
     def _fetch_event_rows(self, txn, events):
         rows = []
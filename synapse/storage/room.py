@@ -232,6 +232,17 @@ class RoomStore(RoomWorkerStore, SearchStore):
         """
         try:
             def store_room_txn(txn, next_id):
+                # We can only maintain the auth chain index incrementally if we
+                # see all of the room's events. For rooms we hear about over
+                # federation we usually have a few already (such as an invite,
+                # or the event which told us about the room), so we index those
+                # now.
+                txn.execute(
+                    "SELECT 1 FROM events WHERE room_id = ? LIMIT 1", (room_id,),
+                )
+                if txn.fetchone() is not None:
+                    self._index_room_auth_chains_txn(txn, room_id)
+
                 self._simple_insert_txn(
                     txn,
                     "rooms",
@@ -239,6 +250,7 @@ class RoomStore(RoomWorkerStore, SearchStore):
                         "room_id": room_id,
                         "creator": room_creator_user_id,
                         "is_public": is_public,
+                        "has_auth_chain_index": True,
                     },
                 )
                 if is_public:
@@ -0,0 +1,64 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* A "chain cover" index of the auth DAG of each room, which lets us answer
+ * auth chain queries without walking event_auth.
+ *
+ * Every indexed state event belongs to a chain, at a given position (sequence
+ * number) in it. An event's auth chain is then the events at or below its
+ * position in its own chain, plus the events at or below the targets of the
+ * links from its chain (at or below its position) to other chains.
+ */
+CREATE TABLE event_auth_chains (
+    event_id TEXT NOT NULL,
+    chain_id BIGINT NOT NULL,
+    sequence_number BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX event_auth_chains_id ON event_auth_chains (event_id);
+CREATE UNIQUE INDEX event_auth_chains_c_seq_index ON event_auth_chains (chain_id, sequence_number);
+
+CREATE TABLE event_auth_chain_links (
+    origin_chain_id BIGINT NOT NULL,
+    origin_sequence_number BIGINT NOT NULL,
+
+    target_chain_id BIGINT NOT NULL,
+    target_sequence_number BIGINT NOT NULL
+);
+
+CREATE INDEX event_auth_chain_links_idx ON event_auth_chain_links (origin_chain_id, target_chain_id);
+
+/* Events which we couldn't index when they were persisted, because we didn't
+ * have all of their auth events yet. They are retried when more events are
+ * persisted to the room.
+ */
+CREATE TABLE event_auth_chain_to_calculate (
+    event_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    state_key TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX event_auth_chain_to_calculate_id ON event_auth_chain_to_calculate (event_id);
+CREATE INDEX event_auth_chain_to_calculate_rm_id ON event_auth_chain_to_calculate (room_id);
+
+/* Whether we index new events in the room as they are persisted. Rooms created
+ * after this point get indexed from the start; existing rooms are switched on
+ * by the chain_cover background update once it has indexed their history.
+ */
+ALTER TABLE rooms ADD COLUMN has_auth_chain_index BOOLEAN;
+
+INSERT INTO background_updates (update_name, progress_json) VALUES
+  ('chain_cover', '{}');
@@ -0,0 +1,29 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* History purges which are in progress, so that they can be resumed if we are
+ * restarted part way through.
+ */
+CREATE TABLE room_purges (
+    purge_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    token TEXT NOT NULL,
+    delete_local_events BOOLEAN NOT NULL,
+    events_total BIGINT NOT NULL,
+    events_processed BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX room_purges_purge_id ON room_purges (purge_id);
+CREATE UNIQUE INDEX room_purges_room_id ON room_purges (room_id);
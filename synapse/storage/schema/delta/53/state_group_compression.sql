@@ -0,0 +1,23 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- an index so that we can find the state groups for a room
+INSERT INTO background_updates (update_name, progress_json) VALUES
+  ('state_groups_room_id_idx', '{}');
+
+-- rewrite each room's state groups into a more compact layout of snapshots and
+-- deltas
+INSERT INTO background_updates (update_name, progress_json, depends_on) VALUES
+  ('state_group_compression', '{}', 'state_groups_room_id_idx');
@@ -14,12 +14,14 @@
 # limitations under the License.
 
 import logging
+import zlib
 from collections import namedtuple
 
 from six import iteritems, itervalues
 from six.moves import range
 
 import attr
+from canonicaljson import json
 
 from twisted.internet import defer
 
@@ -29,6 +31,7 @@ from synapse.storage._base import SQLBaseStore
 from synapse.storage.background_updates import BackgroundUpdateStore
 from synapse.storage.engines import PostgresEngine
 from synapse.storage.events_worker import EventsWorkerStore
+from synapse.util import batch_iter
 from synapse.util.caches import get_cache_factor_for, intern_string
 from synapse.util.caches.descriptors import cached, cachedList
 from synapse.util.caches.dictionary_cache import DictionaryCache
@@ -413,6 +416,10 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
             500000 * get_cache_factor_for("stateGroupMembersCache")
         )
 
+        # The full state of state groups, shared with the other processes on
+        # this machine.
+        self._shared_state_group_cache = hs.get_shared_state_group_cache()
+
     @defer.inlineCallbacks
     def get_room_version(self, room_id):
         """Get the room_version of a given room
@@ -756,11 +763,39 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                     typ, state_key, event_id = row
                     key = (typ, state_key)
                     results[group][key] = event_id
+        elif self.database_engine.supports_recursive_cte:
+            # As above, but SQLite doesn't have window functions until 3.25, so
+            # instead we record how far down the tree each state group is, and
+            # rely on SQLite taking the bare event_id column from the row with
+            # the MIN(depth) for each (type, state_key).
+            sql = """
+                WITH RECURSIVE state(state_group, depth) AS (
+                    VALUES(?, 0)
+                    UNION ALL
+                    SELECT prev_state_group, depth + 1
+                    FROM state_group_edges e, state s
+                    WHERE s.state_group = e.state_group
+                )
+                SELECT type, state_key, event_id, MIN(depth)
+                FROM state_groups_state INNER JOIN state USING (state_group)
+                WHERE 1 = 1 %s
+                GROUP BY type, state_key
+            """ % (where_clause,)
+
+            for group in groups:
+                args = [group]
+                args.extend(where_args)
+
+                txn.execute(sql, args)
+                results[group].update(
+                    ((typ, state_key), event_id)
+                    for typ, state_key, event_id, _ in txn
+                )
         else:
             max_entries_returned = state_filter.max_entries_returned()
 
-            # We don't use WITH RECURSIVE on sqlite3 as there are distributions
-            # that ship with an sqlite3 version that doesn't support it (e.g. wheezy)
+            # We don't use WITH RECURSIVE on sqlite3 if there's a chance that
+            # it doesn't support it (e.g. wheezy)
             for group in groups:
                 next_group = group
 
@@ -870,6 +905,34 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         defer.returnValue({event: event_to_state[event] for event in event_ids})
 
+    @defer.inlineCallbacks
+    def get_state_ids_for_events_by_group(self, event_ids,
+                                          state_filter=StateFilter.all()):
+        """
+        Like get_state_ids_for_events, except that rather than a state dict per
+        event, returns the state group of each event and the state dict of each
+        of those groups, so that callers can do any work on the state once per
+        group.
+
+        Args:
+            event_ids(list(str)): events whose state should be returned
+            state_filter (StateFilter): The state filter used to fetch state
+                from the database.
+
+        Returns:
+            Deferred[tuple[dict[str, int], dict[int, dict[tuple[str, str], str]]]]:
+                map from event_id to state group, and map from state group to
+                (type, state_key) -> event_id
+        """
+        event_to_groups = yield self._get_state_group_for_events(
+            event_ids,
+        )
+
+        groups = set(itervalues(event_to_groups))
+        group_to_state = yield self._get_state_for_groups(groups, state_filter)
+
+        defer.returnValue((event_to_groups, group_to_state))
+
     @defer.inlineCallbacks
     def get_state_for_event(self, event_id, state_filter=StateFilter.all()):
         """
@@ -1015,6 +1078,24 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
         cache_sequence_nm = self._state_group_cache.sequence
         cache_sequence_m = self._state_group_members_cache.sequence
 
+        if self._shared_state_group_cache is not None:
+            shared_state = self._get_state_groups_from_shared_cache(
+                incomplete_groups,
+            )
+            self._insert_into_cache(
+                shared_state,
+                StateFilter.all(),
+                cache_seq_num_members=cache_sequence_m,
+                cache_seq_num_non_members=cache_sequence_nm,
+            )
+
+            for group, group_state_dict in iteritems(shared_state):
+                state[group] = state_filter.filter_state(group_state_dict)
+                incomplete_groups.discard(group)
+
+            if not incomplete_groups:
+                defer.returnValue(state)
+
         # Help the cache hit ratio by expanding the filter a bit
         db_state_filter = state_filter.return_expanded()
 
@@ -1031,6 +1112,9 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
             cache_seq_num_non_members=cache_sequence_nm,
         )
 
+        if self._shared_state_group_cache is not None and db_state_filter.is_full():
+            self._add_state_groups_to_shared_cache(group_to_state_dict)
+
         # And finally update the result dict, by filtering out any extra
         # stuff we pulled out of the database.
         for group, group_state_dict in iteritems(group_to_state_dict):
@@ -1074,6 +1158,49 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         return results, incomplete_groups
 
+    def _get_state_groups_from_shared_cache(self, groups):
+        """Looks up the full state of some state groups in the shared state
+        group cache.
+
+        Args:
+            groups (iterable[int])
+
+        Returns:
+            dict[int, dict[tuple[str, str], str]]: the state of the groups we
+            found.
+        """
+        results = {}
+        for group in groups:
+            value = self._shared_state_group_cache.get(str(group))
+            if value is None:
+                continue
+
+            # See _add_state_groups_to_shared_cache
+            results[group] = {
+                (intern_string(typ), intern_string(state_key)): event_id
+                for typ, state_key, event_id in json.loads(
+                    zlib.decompress(value).decode("utf-8")
+                )
+            }
+
+        return results
+
+    def _add_state_groups_to_shared_cache(self, group_to_state_dict):
+        """Adds the full state of some state groups to the shared state group
+        cache.
+
+        Args:
+            group_to_state_dict (dict[int, dict[tuple[str, str], str]])
+        """
+        for group, group_state_dict in iteritems(group_to_state_dict):
+            value = json.dumps([
+                (typ, state_key, event_id)
+                for (typ, state_key), event_id in iteritems(group_state_dict)
+            ])
+            self._shared_state_group_cache.set(
+                str(group), zlib.compress(value.encode("utf-8")),
+            )
+
     def _insert_into_cache(self, group_to_state_dict, state_filter,
                            cache_seq_num_members, cache_seq_num_non_members):
         """Inserts results from querying the database into the relevant cache.
@@ -1230,6 +1357,12 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
             # is immutable. (If the map wasn't immutable then this prefill could
             # race with another update)
 
+            if self._shared_state_group_cache is not None:
+                txn.call_after(
+                    self._add_state_groups_to_shared_cache,
+                    {state_group: dict(current_state_ids)},
+                )
+
             current_member_state_ids = {
                 s: ev
                 for (s, ev) in iteritems(current_state_ids)
@@ -1280,9 +1413,24 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                 return row[0]
             else:
                 return 0
+        elif self.database_engine.supports_recursive_cte:
+            sql = ("""
+                WITH RECURSIVE state(state_group) AS (
+                    VALUES(?)
+                    UNION ALL
+                    SELECT prev_state_group FROM state_group_edges e, state s
+                    WHERE s.state_group = e.state_group
+                )
+                SELECT count(*) FROM state;
+            """)
+
+            # Unlike the query above, we don't count the state group itself.
+            txn.execute(sql, (state_group,))
+            row = txn.fetchone()
+            return row[0] - 1
         else:
-            # We don't use WITH RECURSIVE on sqlite3 as there are distributions
-            # that ship with an sqlite3 version that doesn't support it (e.g. wheezy)
+            # We don't use WITH RECURSIVE on sqlite3 if there's a chance that
+            # it doesn't support it (e.g. wheezy)
             next_group = state_group
             count = 0
 
@@ -1323,6 +1471,14 @@ class StateStore(StateGroupWorkerStore, BackgroundUpdateStore):
     STATE_GROUP_INDEX_UPDATE_NAME = "state_group_state_type_index"
     CURRENT_STATE_INDEX_UPDATE_NAME = "current_state_members_idx"
     EVENT_STATE_GROUP_INDEX_UPDATE_NAME = "event_to_state_groups_sg_index"
+    STATE_GROUP_ROOM_INDEX_UPDATE_NAME = "state_groups_room_id_idx"
+    STATE_GROUP_COMPRESSION_UPDATE_NAME = "state_group_compression"
+
+    # The maximum length of the delta chains at each level of the layout which
+    # _background_compress_state rewrites state groups into. These add up to
+    # less than MAX_STATE_DELTA_HOPS, so reads are no slower than for groups
+    # stored by store_state_group.
+    STATE_COMPRESSION_LEVELS = (40, 30, 20)
 
     def __init__(self, db_conn, hs):
         super(StateStore, self).__init__(db_conn, hs)
@@ -1347,6 +1503,16 @@ class StateStore(StateGroupWorkerStore, BackgroundUpdateStore):
             table="event_to_state_groups",
             columns=["state_group"],
         )
+        self.register_background_index_update(
+            self.STATE_GROUP_ROOM_INDEX_UPDATE_NAME,
+            index_name="state_groups_room_id_idx",
+            table="state_groups",
+            columns=["room_id", "id"],
+        )
+        self.register_background_update_handler(
+            self.STATE_GROUP_COMPRESSION_UPDATE_NAME,
+            self._background_compress_state,
+        )
 
     def _store_event_state_mappings_txn(self, txn, events_and_contexts):
         state_groups = {}
@@ -1558,3 +1724,269 @@ class StateStore(StateGroupWorkerStore, BackgroundUpdateStore):
         yield self._end_background_update(self.STATE_GROUP_INDEX_UPDATE_NAME)
 
         defer.returnValue(1)
+
+    @defer.inlineCallbacks
+    def _background_compress_state(self, progress, batch_size):
+        """This background update rewrites the state groups of each room, a
+        room at a time, into a layout which is cheap both to store and to read.
+
+        The groups are arranged in levels of delta chains, whose lengths are
+        bounded by STATE_COMPRESSION_LEVELS. Each group is stored as a delta
+        against the latest group at the first level which isn't full, and any
+        full levels before it start a new chain with the group. If every level
+        is full the group is stored as a snapshot, which starts them all again.
+        So a group is at most sum(STATE_COMPRESSION_LEVELS) hops from a
+        snapshot, but we only store a snapshot once every
+        product(STATE_COMPRESSION_LEVELS) groups.
+
+        The state of each group is unchanged, so we don't need to invalidate
+        any caches.
+        """
+        room_id = progress.get("room_id", "")
+        last_state_group = progress.get("last_state_group", 0)
+        levels = progress.get("levels") or [
+            [None, 0] for _ in self.STATE_COMPRESSION_LEVELS
+        ]
+        totals = progress.get("totals") or {
+            "groups": 0,
+            "rows_before": 0,
+            "rows_after": 0,
+            "hops_before": 0,
+            "hops_after": 0,
+        }
+
+        def compress_txn(txn):
+            stats = self._compress_state_groups_txn(
+                txn, room_id, last_state_group, levels, batch_size,
+            )
+
+            if stats is None:
+                # We've done this room, so move on to the next.
+                txn.execute(
+                    "SELECT room_id FROM rooms WHERE room_id > ?"
+                    " ORDER BY room_id ASC LIMIT 1",
+                    (room_id,),
+                )
+                row = txn.fetchone()
+                if not row:
+                    return True, 0
+
+                new_progress = {
+                    "room_id": row[0],
+                    "last_state_group": 0,
+                    "levels": None,
+                    "totals": totals,
+                }
+                groups = 0
+            else:
+                groups = stats.pop("groups")
+                logger.info(
+                    "Compressed %i state groups in %s: %i rows -> %i rows,"
+                    " %i hops -> %i hops",
+                    len(groups), room_id,
+                    stats["rows_before"], stats["rows_after"],
+                    stats["hops_before"], stats["hops_after"],
+                )
+
+                totals["groups"] += len(groups)
+                for key, value in iteritems(stats):
+                    totals[key] += value
+
+                new_progress = {
+                    "room_id": room_id,
+                    "last_state_group": groups[-1],
+                    "levels": levels,
+                    "totals": totals,
+                }
+                groups = len(groups)
+
+            self._background_update_progress_txn(
+                txn, self.STATE_GROUP_COMPRESSION_UPDATE_NAME, new_progress,
+            )
+            return False, groups
+
+        finished, result = yield self.runInteraction(
+            self.STATE_GROUP_COMPRESSION_UPDATE_NAME, compress_txn,
+        )
+
+        if finished:
+            group_count = max(totals["groups"], 1)
+            logger.info(
+                "Finished compressing %i state groups: %i rows -> %i rows"
+                " (%i saved), mean hops to read a group %.1f -> %.1f",
+                totals["groups"], totals["rows_before"], totals["rows_after"],
+                totals["rows_before"] - totals["rows_after"],
+                float(totals["hops_before"]) / group_count,
+                float(totals["hops_after"]) / group_count,
+            )
+            yield self._end_background_update(
+                self.STATE_GROUP_COMPRESSION_UPDATE_NAME,
+            )
+
+        defer.returnValue(result)
+
+    def _compress_state_groups_txn(
+        self, txn, room_id, last_state_group, levels, batch_size,
+    ):
+        """Rewrites the next batch of state groups in a room. See
+        _background_compress_state.
+
+        Args:
+            txn
+            room_id (str)
+            last_state_group (int): the last state group we've already done
+            levels (list[list]): the latest group and current chain length at
+                each level. Updated in place.
+            batch_size (int): the most state groups to rewrite
+
+        Returns:
+            dict|None: None if there are no more state groups in the room,
+            otherwise statistics on the groups which were rewritten: the
+            groups themselves, the number of rows in state_groups_state and
+            the total number of hops needed to read the groups, before and
+            after.
+        """
+        txn.execute(
+            "SELECT id FROM state_groups WHERE room_id = ? AND id > ?"
+            " ORDER BY id ASC LIMIT ?",
+            (room_id, last_state_group, batch_size),
+        )
+        groups = [sg for sg, in txn]
+        if not groups:
+            return None
+
+        rows = self._simple_select_many_txn(
+            txn,
+            table="state_group_edges",
+            column="state_group",
+            iterable=groups,
+            keyvalues={},
+            retcols=("state_group", "prev_state_group"),
+        )
+        old_prevs = {row["state_group"]: row["prev_state_group"] for row in rows}
+
+        row_counts = {}
+        for chunk in batch_iter(groups, 100):
+            txn.execute(
+                "SELECT state_group, COUNT(*) FROM state_groups_state"
+                " WHERE state_group IN (%s) GROUP BY state_group"
+                % (",".join("?" for _ in chunk),),
+                chunk,
+            )
+            row_counts.update(txn)
+
+        # We need the state of the groups themselves, and of the groups which
+        # were the latest at each level at the end of the last batch.
+        heads = [head for head, _ in levels if head is not None]
+        states = self._get_state_groups_from_groups_txn(txn, groups + heads)
+
+        hop_counts = {}
+
+        def count_hops(sg, prevs, depths):
+            prev = prevs.get(sg)
+            if prev is None:
+                return 0
+            if prev in depths:
+                return depths[prev] + 1
+            if prev not in hop_counts:
+                hop_counts[prev] = self._count_state_group_hops_txn(txn, prev)
+            return hop_counts[prev] + 1
+
+        depths_before = {}
+        for sg in groups:
+            depths_before[sg] = count_hops(sg, old_prevs, depths_before)
+
+        # hop counts for the groups from earlier batches are still right, as
+        # we've already rewritten them.
+        new_prevs = {}
+        depths_after = {}
+        rows_after = 0
+        for sg in groups:
+            prev = None
+            for level, max_length in zip(levels, self.STATE_COMPRESSION_LEVELS):
+                if level[1] < max_length:
+                    prev = level[0]
+                    level[0] = sg
+                    level[1] += 1
+                    break
+
+                # This level is full, so start a new chain at it.
+                level[0] = sg
+                level[1] = 1
+
+            curr_state = states[sg]
+            if prev is not None:
+                prev_state = states[prev]
+                if set(prev_state) - set(curr_state):
+                    # We can only do a delta if the current has a strict super
+                    # set of keys
+                    prev = None
+
+            if prev is None:
+                # Every level starts again from this snapshot.
+                for level in levels:
+                    level[0] = sg
+                    level[1] = 1
+
+                delta_state = curr_state
+            else:
+                delta_state = {
+                    key: value for key, value in iteritems(curr_state)
+                    if prev_state.get(key, None) != value
+                }
+
+            new_prevs[sg] = prev
+            depths_after[sg] = count_hops(sg, new_prevs, depths_after)
+            rows_after += len(delta_state)
+
+            if (
+                old_prevs.get(sg) == prev and
+                row_counts.get(sg, 0) == len(delta_state)
+            ):
+                # It's already stored like this.
+                continue
+
+            self._simple_delete_txn(
+                txn,
+                table="state_group_edges",
+                keyvalues={"state_group": sg},
+            )
+
+            self._simple_delete_txn(
+                txn,
+                table="state_groups_state",
+                keyvalues={"state_group": sg},
+            )
+
+            if prev is not None:
+                self._simple_insert_txn(
+                    txn,
+                    table="state_group_edges",
+                    values={
+                        "state_group": sg,
+                        "prev_state_group": prev,
+                    },
+                )
+
+            self._simple_insert_many_txn(
+                txn,
+                table="state_groups_state",
+                values=[
+                    {
+                        "state_group": sg,
+                        "room_id": room_id,
+                        "type": key[0],
+                        "state_key": key[1],
+                        "event_id": state_id,
+                    }
+                    for key, state_id in iteritems(delta_state)
+                ],
+            )
+
+        return {
+            "groups": groups,
+            "rows_before": sum(itervalues(row_counts)),
+            "rows_after": rows_after,
+            "hops_before": sum(itervalues(depths_before)),
+            "hops_after": sum(itervalues(depths_after)),
+        }
@@ -45,6 +45,7 @@ from synapse.storage._base import SQLBaseStore
 from synapse.storage.engines import PostgresEngine
 from synapse.storage.events_worker import EventsWorkerStore
 from synapse.types import RoomStreamToken
+from synapse.util.caches.descriptors import cached
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 
@@ -263,26 +264,26 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
         if not has_changed:
             defer.returnValue(([], from_key))
 
-        def f(txn):
-            sql = (
-                "SELECT event_id, stream_ordering FROM events WHERE"
-                " room_id = ?"
-                " AND not outlier"
-                " AND stream_ordering > ? AND stream_ordering <= ?"
-                " ORDER BY stream_ordering %s LIMIT ?"
-            ) % (order,)
-            txn.execute(sql, (room_id, from_id, to_id, limit))
+        # There can't be any events in the room after its last change, so we
+        # clamp the range to that. That way, the range is the same for all the
+        # users syncing the room between changes, and they can share the result.
+        last_change = self._events_stream_cache.get_max_pos_of_last_change(room_id)
+        to_id = min(to_id, last_change)
 
-            rows = [_EventDictReturn(row[0], None, row[1]) for row in txn]
-            return rows
-
-        rows = yield self.runInteraction("get_room_events_stream_for_room", f)
+        rows = yield self._get_room_event_rows_for_range(
+            room_id, from_id, to_id, limit, order.upper(),
+        )
 
         ret = yield self._get_events(
             [r.event_id for r in rows],
             get_prev_content=True
         )
 
+        if len(ret) != len(rows):
+            # some of the events have been purged since we cached the rows
+            event_ids = set(e.event_id for e in ret)
+            rows = [r for r in rows if r.event_id in event_ids]
+
         self._set_before_and_after(ret, rows, topo_order=from_id is None)
 
         if order.lower() == "desc":
@@ -297,6 +298,39 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         defer.returnValue((ret, key))
 
+    @cached(num_args=5, max_entries=10000)
+    def _get_room_event_rows_for_range(self, room_id, from_id, to_id, limit, order):
+        """Get the stream orderings of the events in a room in a given range of
+        the stream.
+
+        The range must end at or before the current stream position, so that the
+        result can't change.
+
+        Args:
+            room_id (str)
+            from_id (int): stream ordering to return events after
+            to_id (int): stream ordering to return events up to and including
+            limit (int): Maximum number of events to return
+            order (str): Either "DESC" or "ASC"
+
+        Returns:
+            Deferred[list[_EventDictReturn]]
+        """
+        def f(txn):
+            sql = (
+                "SELECT event_id, stream_ordering FROM events WHERE"
+                " room_id = ?"
+                " AND not outlier"
+                " AND stream_ordering > ? AND stream_ordering <= ?"
+                " ORDER BY stream_ordering %s LIMIT ?"
+            ) % (order,)
+            txn.execute(sql, (room_id, from_id, to_id, limit))
+
+            rows = [_EventDictReturn(row[0], None, row[1]) for row in txn]
+            return rows
+
+        return self.runInteraction("get_room_events_stream_for_room", f)
+
     @defer.inlineCallbacks
     def get_membership_changes_for_user(self, user_id, from_key, to_key):
         from_id = RoomStreamToken.parse_stream_token(from_key).stream
@@ -663,13 +697,19 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
             if len(rows) == limit:
                 upper_bound = rows[-1][0]
 
-            return upper_bound, [row[1] for row in rows]
+            return upper_bound, rows
 
-        upper_bound, event_ids = yield self.runInteraction(
+        upper_bound, rows = yield self.runInteraction(
             "get_all_new_events_stream", get_all_new_events_stream_txn,
         )
 
-        events = yield self._get_events(event_ids)
+        events = yield self._get_events([event_id for _, event_id in rows])
+
+        # the federation sender uses the stream orderings to track how far it
+        # has got sending events to each destination
+        stream_orderings = dict((event_id, ordering) for ordering, event_id in rows)
+        for event in events:
+            event.internal_metadata.stream_ordering = stream_orderings[event.event_id]
 
         defer.returnValue((upper_bound, events))
 
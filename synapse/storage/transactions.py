@@ -286,6 +286,162 @@ class TransactionStore(SQLBaseStore):
         txn.execute(query, (self._clock.time_msec(),))
         return self.cursor_to_dict(txn)
 
+    def store_destination_rooms_entries(self, destinations, room_id, stream_ordering):
+        """Records that an event is being sent to some destinations, so that
+        they can be caught up with it if sending it fails.
+
+        Args:
+            destinations (Iterable[str])
+            room_id (str): the room the event is in
+            stream_ordering (int): the stream ordering of the event
+
+        Returns:
+            Deferred
+        """
+        destinations = list(destinations)
+
+        def _store_destination_rooms_entries_txn(txn):
+            self._simple_upsert_many_txn(
+                txn,
+                table="destination_rooms",
+                key_names=("destination", "room_id"),
+                key_values=[(destination, room_id) for destination in destinations],
+                value_names=("stream_ordering",),
+                value_values=[(stream_ordering,)] * len(destinations),
+            )
+
+        return self.runInteraction(
+            "store_destination_rooms_entries",
+            _store_destination_rooms_entries_txn,
+        )
+
+    def get_destination_last_successful_stream_ordering(self, destination):
+        """Gets the stream ordering up to which we have successfully sent events
+        to the destination.
+
+        Args:
+            destination (str)
+
+        Returns:
+            Deferred[int|None]: None if we have never successfully sent it any.
+        """
+        return self._simple_select_one_onecol(
+            table="destinations",
+            keyvalues={"destination": destination},
+            retcol="last_successful_stream_ordering",
+            allow_none=True,
+            desc="get_destination_last_successful_stream_ordering",
+        )
+
+    def set_destination_last_successful_stream_ordering(
+        self, destination, stream_ordering, rewind=False,
+    ):
+        """Sets the stream ordering up to which we have successfully sent events
+        to the destination.
+
+        Args:
+            destination (str)
+            stream_ordering (int)
+            rewind (bool): if False, the stream ordering is only ever moved
+                forwards. If True, it is only ever moved backwards, which is
+                used when we fail to send events to the destination.
+
+        Returns:
+            Deferred
+        """
+        return self.runInteraction(
+            "set_destination_last_successful_stream_ordering",
+            self._set_destination_last_successful_stream_ordering_txn,
+            destination, stream_ordering, rewind,
+        )
+
+    def _set_destination_last_successful_stream_ordering_txn(
+        self, txn, destination, stream_ordering, rewind,
+    ):
+        # Rather than locking the table, only update the row if it moves the
+        # stream ordering in the right direction.
+        sql = """
+            UPDATE destinations SET last_successful_stream_ordering = ?
+            WHERE destination = ? AND (
+                last_successful_stream_ordering IS NULL
+                OR last_successful_stream_ordering %s ?
+            )
+        """ % (">" if rewind else "<",)
+        args = (stream_ordering, destination, stream_ordering)
+
+        txn.execute(sql, args)
+        if txn.rowcount:
+            return
+
+        # Either the destination already has a stream ordering at least as
+        # good, or it doesn't have a row yet. Make sure that it has one, then
+        # try again in case someone else inserted it first.
+        self._simple_upsert_txn(
+            txn,
+            table="destinations",
+            keyvalues={"destination": destination},
+            values={},
+            insertion_values={
+                "retry_last_ts": 0,
+                "retry_interval": 0,
+                "last_successful_stream_ordering": stream_ordering,
+            },
+            lock=False,
+        )
+        txn.execute(sql, args)
+
+    def get_catch_up_room_event_ids(self, destination, from_stream_ordering, limit):
+        """Gets the latest event we tried to send to the destination in each
+        room where that is after the given stream ordering.
+
+        Args:
+            destination (str)
+            from_stream_ordering (int): the stream ordering up to which the
+                destination has successfully been sent events.
+            limit (int): the most rooms to return.
+
+        Returns:
+            Deferred[list[tuple[int, str|None]]]: the stream ordering and event
+            ID of each event, in stream order. The event ID is None if the
+            event has since been purged.
+        """
+        def _get_catch_up_room_event_ids_txn(txn):
+            sql = (
+                "SELECT dr.stream_ordering, e.event_id FROM destination_rooms AS dr"
+                " LEFT JOIN events AS e USING (stream_ordering)"
+                " WHERE dr.destination = ? AND dr.stream_ordering > ?"
+                " ORDER BY dr.stream_ordering ASC"
+                " LIMIT ?"
+            )
+            txn.execute(sql, (destination, from_stream_ordering, limit))
+            return txn.fetchall()
+
+        return self.runInteraction(
+            "get_catch_up_room_event_ids", _get_catch_up_room_event_ids_txn,
+        )
+
+    def get_destinations_needing_catch_up(self):
+        """Gets the destinations which have events we haven't successfully
+        sent them.
+
+        Returns:
+            Deferred[list[str]]
+        """
+        def _get_destinations_needing_catch_up_txn(txn):
+            sql = (
+                "SELECT DISTINCT dr.destination FROM destination_rooms AS dr"
+                " LEFT JOIN destinations AS d USING (destination)"
+                " WHERE dr.stream_ordering"
+                " > COALESCE(d.last_successful_stream_ordering, 0)"
+            )
+            txn.execute(sql)
+            return [destination for destination, in txn]
+
+        return self.runInteraction(
+            "get_destinations_needing_catch_up",
+            _get_destinations_needing_catch_up_txn,
+        )
+
     def _start_cleanup_transactions(self):
         return run_as_background_process(
             "cleanup_transactions", self._cleanup_transactions,
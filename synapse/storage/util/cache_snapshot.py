@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Snapshots of which keys are in the caches, so that a restarted process can
+fetch them all again in bulk, rather than one request at a time as they are
+asked for.
+
+We only store the keys: the values are fetched from the database again when
+the snapshot is loaded, so they can't be stale.
+"""
+
+import errno
+import logging
+import os
+import time
+
+from six import integer_types, string_types
+
+from canonicaljson import json
+from prometheus_client import Gauge
+
+from twisted.internet import defer
+
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.util import batch_iter
+from synapse.util.async_helpers import concurrently_execute
+
+logger = logging.getLogger(__name__)
+
+# The caches which aren't @cached functions on the store, by the name used for
+# them in the config.
+EVENT_CACHE_NAME = "getEvent"
+STATE_GROUP_CACHE_NAME = "stateGroupCache"
+
+# How many keys to fetch in each batch for caches which can be fetched in bulk,
+# and how many keys to fetch at once for those which can't.
+_BATCH_SIZE = 100
+_CONCURRENCY = 5
+
+warm_start_duration = Gauge(
+    "synapse_util_caches_warm_start_seconds",
+    "How long it took to fetch the keys in the cache snapshot after starting",
+)
+
+
+def setup_cache_snapshots(hs):
+    """Loads the cache snapshot, if there is one, and arranges for a new one to
+    be written when we shut down.
+
+    Args:
+        hs (synapse.server.HomeServer)
+    """
+    path = hs.config.cache_snapshot_path
+    if path is None:
+        return
+
+    store = hs.get_datastore()
+    cache_names = hs.config.cache_snapshot_caches
+    max_keys = hs.config.cache_snapshot_max_keys
+
+    def write_snapshot():
+        try:
+            snapshot = get_cache_snapshot(store, cache_names, max_keys)
+            write_cache_snapshot(path, snapshot)
+        except Exception:
+            logger.exception("Failed to write cache snapshot to %s", path)
+
+    hs.get_reactor().addSystemEventTrigger("before", "shutdown", write_snapshot)
+
+    snapshot = read_cache_snapshot(path)
+    if snapshot:
+        run_as_background_process(
+            "warm_caches", warm_caches, store, snapshot,
+        )
+
+
+def _is_snapshottable(key):
+    """Whether a cache key can be written to a snapshot, i.e. whether it is a
+    string or number, or a tuple of them.
+    """
+    if isinstance(key, tuple):
+        return all(_is_snapshottable(k) for k in key)
+    return isinstance(key, string_types + integer_types)
+
+
+def get_cache_snapshot(store, cache_names, max_keys):
+    """Gets the most recently used keys in some of the store's caches.
+
+    Args:
+        store (synapse.storage.DataStore)
+        cache_names (list[str]): the caches to snapshot. These are either
+            EVENT_CACHE_NAME, STATE_GROUP_CACHE_NAME or the names of @cached
+            functions on the store.
+        max_keys (int): the most keys to take from each cache.
+
+    Returns:
+        dict[str, list]: the keys in each cache, most recently used first.
+    """
+    snapshot = {}
+    for name in cache_names:
+        if name == EVENT_CACHE_NAME:
+            lru_cache = store._get_event_cache.cache
+        elif name == STATE_GROUP_CACHE_NAME:
+            lru_cache = store._state_group_cache.cache
+        else:
+            cached_func = getattr(store, name, None)
+            if cached_func is None or not hasattr(cached_func, "cache"):
+                logger.warning("Not snapshotting unknown cache %r", name)
+                continue
+            lru_cache = cached_func.cache.cache
+
+        snapshot[name] = [
+            key for key in lru_cache.most_recent_keys(max_keys)
+            if _is_snapshottable(key)
+        ]
+
+    return snapshot
+
+
+def write_cache_snapshot(path, snapshot):
+    """Writes a cache snapshot to a file.
+
+    Args:
+        path (str)
+        snapshot (dict[str, list]): as returned by get_cache_snapshot
+    """
+    # Write to a temporary file and then move it into place, so that we don't
+    # leave half a snapshot behind if we are killed.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.rename(tmp_path, path)
+
+    logger.info(
+        "Wrote cache snapshot to %s: %s",
+        path,
+        ", ".join("%s: %d" % (name, len(keys)) for name, keys in snapshot.items()),
+    )
+
+
+def read_cache_snapshot(path):
+    """Reads a cache snapshot written by write_cache_snapshot.
+
+    Args:
+        path (str)
+
+    Returns:
+        dict[str, list]|None: the snapshot, or None if there wasn't one.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            logger.warning("Failed to read cache snapshot from %s: %s", path, e)
+    except ValueError as e:
+        logger.warning("Failed to read cache snapshot from %s: %s", path, e)
+    return None
+
+
+@defer.inlineCallbacks
+def warm_caches(store, snapshot):
+    """Fetches the keys in a cache snapshot, to fill the caches again.
+
+    Args:
+        store (synapse.storage.DataStore)
+        snapshot (dict[str, list]): as returned by get_cache_snapshot
+
+    Returns:
+        Deferred
+    """
+    start = time.time()
+
+    for name, keys in snapshot.items():
+        try:
+            yield _warm_cache(store, name, keys)
+        except Exception:
+            logger.exception("Failed to warm cache %s", name)
+
+    duration = time.time() - start
+    warm_start_duration.set(duration)
+    logger.info(
+        "Warmed caches from snapshot in %.2f sec: %s",
+        duration,
+        ", ".join("%s: %d" % (name, len(keys)) for name, keys in snapshot.items()),
+    )
+
+
+@defer.inlineCallbacks
+def _warm_cache(store, name, keys):
+    if name == EVENT_CACHE_NAME:
+        for batch in batch_iter((key[0] for key in keys), _BATCH_SIZE):
+            yield store.get_events(batch, allow_rejected=True)
+        return
+
+    if name == STATE_GROUP_CACHE_NAME:
+        for batch in batch_iter(keys, _BATCH_SIZE):
+            yield store._get_state_for_groups(batch)
+        return
+
+    cached_func = getattr(store, name, None)
+    if cached_func is None or not hasattr(cached_func, "cache"):
+        logger.warning("Not warming unknown cache %r", name)
+        return
+
+    @defer.inlineCallbacks
+    def fetch(key):
+        if cached_func.num_args != 1:
+            args = tuple(key)
+        else:
+            args = (key,)
+
+        try:
+            yield cached_func(*args)
+        except Exception as e:
+            logger.warning("Failed to warm %s%r: %s", name, args, e)
+
+    yield concurrently_execute(fetch, keys, _CONCURRENCY)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Limits on how much of the database connection pool each class of
+transaction can use at once.
+
+Every transaction is run in a lane, picked by the `desc` it is given. Each lane
+can be given a limit on how many of its transactions run at once; any more wait
+in a queue for the lane, rather than in the connection pool's queue, so that
+(for example) a burst of expensive reads can't starve event persistence of
+connections.
+"""
+
+import contextlib
+import logging
+import time
+from collections import deque
+
+from prometheus_client import Counter, Histogram
+
+from twisted.internet import defer
+
+from synapse.config import ConfigError
+from synapse.metrics import LaterGauge
+from synapse.util.logcontext import PreserveLoggingContext, make_deferred_yieldable
+
+logger = logging.getLogger(__name__)
+
+LANE_PERSIST = "persist"
+LANE_READ = "read"
+LANE_BACKGROUND = "background"
+LANE_ADMIN = "admin"
+
+LANES = (LANE_PERSIST, LANE_READ, LANE_BACKGROUND, LANE_ADMIN)
+
+# The lanes of transactions which aren't in the read lane, by their desc.
+# Transactions which aren't listed here (which are mostly reads) are in the
+# read lane.
+#
+# Background updates are added to the background lane as they are registered.
+DEFAULT_TRANSACTION_LANES = {
+    "persist_events": LANE_PERSIST,
+    "store_state_group": LANE_PERSIST,
+    "add_push_actions_to_staging": LANE_PERSIST,
+    "remove_push_actions_from_staging": LANE_PERSIST,
+
+    "start_purge_history": LANE_ADMIN,
+    "purge_history_batch": LANE_ADMIN,
+    "finish_purge_history": LANE_ADMIN,
+    "get_users": LANE_ADMIN,
+    "get_users_paginate": LANE_ADMIN,
+    "search_users": LANE_ADMIN,
+}
+
+lane_transactions_counter = Counter(
+    "synapse_storage_lane_transactions", "", ["lane"],
+)
+
+lane_queue_timer = Histogram(
+    "synapse_storage_lane_queue_time", "sec", ["lane"],
+)
+
+
+class _Lane(object):
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+
+        # The number of transactions running in this lane.
+        self.active = 0
+
+        # Deferreds for the transactions waiting to run in this lane.
+        self.waiting = deque()
+
+    @defer.inlineCallbacks
+    def queue(self):
+        if self.limit is not None and self.active >= self.limit:
+            start = time.time()
+
+            d = defer.Deferred()
+            self.waiting.append(d)
+            yield make_deferred_yieldable(d)
+
+            # the transaction which woke us up handed its place in the lane
+            # over to us
+            lane_queue_timer.labels(self.name).observe(time.time() - start)
+        else:
+            self.active += 1
+
+        lane_transactions_counter.labels(self.name).inc()
+
+        @contextlib.contextmanager
+        def _ctx_manager():
+            try:
+                yield
+            finally:
+                self._release()
+
+        defer.returnValue(_ctx_manager())
+
+    def _release(self):
+        if self.waiting:
+            d = self.waiting.popleft()
+            with PreserveLoggingContext():
+                d.callback(None)
+        else:
+            self.active -= 1
+
+
+class DatabaseLanes(object):
+    """Assigns transactions to lanes, and limits how many transactions run in
+    each lane at once.
+
+    Args:
+        limits (dict[str, int]): the most transactions which may run at once in
+            each lane. Lanes which aren't given are unlimited.
+    """
+
+    def __init__(self, limits):
+        for name in limits:
+            if name not in LANES:
+                raise ConfigError("Unknown database lane %r" % (name,))
+
+        self._lanes = {
+            name: _Lane(name, limits.get(name)) for name in LANES
+        }
+        self._transaction_lanes = dict(DEFAULT_TRANSACTION_LANES)
+
+        LaterGauge(
+            "synapse_storage_lane_active", "", ["lane"],
+            lambda: {(lane.name,): lane.active for lane in self._lanes.values()},
+        )
+        LaterGauge(
+            "synapse_storage_lane_waiting", "", ["lane"],
+            lambda: {
+                (lane.name,): len(lane.waiting) for lane in self._lanes.values()
+            },
+        )
+
+    def set_transaction_lane(self, desc, lane):
+        """Run the transactions with the given desc in the given lane.
+
+        Args:
+            desc (str): the desc passed to runInteraction
+            lane (str): one of LANES
+        """
+        self._transaction_lanes[desc] = lane
+
+    def get_lane(self, desc):
+        """Get the lane that transactions with the given desc run in.
+
+        Args:
+            desc (str|None): the desc passed to runInteraction, or None for
+                other uses of the connection pool.
+
+        Returns:
+            str: one of LANES
+        """
+        return self._transaction_lanes.get(desc, LANE_READ)
+
+    def queue(self, lane):
+        """Wait for room in a lane.
+
+        Use as:
+
+            with (yield lanes.queue(lane)):
+                ...
+
+        Args:
+            lane (str): one of LANES
+
+        Returns:
+            Deferred[context manager]: a context manager which keeps our place
+            in the lane until it exits.
+        """
+        return self._lanes[lane].queue()
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
 import logging
 import re
 from itertools import islice
@@ -115,6 +116,53 @@ def batch_iter(iterable, size):
     return iter(lambda: tuple(islice(sourceiter, size)), ())
 
 
+def sorted_topologically(nodes, graph):
+    """Given a set of nodes and a graph, yield the nodes in topological order.
+
+    For example `sorted_topologically([1, 2], {1: [2]})` will yield `2, 1`.
+
+    Edges to nodes which are not in `nodes` are ignored. Ties are broken by
+    the natural ordering of the nodes, so the output is deterministic.
+
+    Args:
+        nodes (iterable): the nodes to sort
+        graph (dict): a map from a node to the nodes it depends on (ie, which
+            must come before it in the output)
+
+    Returns:
+        an iterator over the nodes
+    """
+
+    # This is implemented by Kahn's algorithm.
+
+    degree_map = {node: 0 for node in nodes}
+    reverse_graph = {}
+
+    for node, edges in graph.items():
+        if node not in degree_map:
+            continue
+
+        for edge in set(edges):
+            if edge in degree_map:
+                degree_map[node] += 1
+
+            reverse_graph.setdefault(edge, set()).add(node)
+        reverse_graph.setdefault(node, set())
+
+    zero_degree = [node for node, degree in degree_map.items() if degree == 0]
+    heapq.heapify(zero_degree)
+
+    while zero_degree:
+        node = heapq.heappop(zero_degree)
+        yield node
+
+        for edge in reverse_graph.get(node, []):
+            if edge in degree_map:
+                degree_map[edge] -= 1
+                if degree_map[edge] == 0:
+                    heapq.heappush(zero_degree, edge)
+
+
 def log_failure(failure, msg, consumeErrors=True):
     """Creates a function suitable for passing to `Deferred.addErrback` that
     logs any failures that occur.
@@ -14,11 +14,136 @@
 # limitations under the License.
 
 
+import sys
 import threading
+import types
 from functools import wraps
 
+import six
+from six import integer_types, string_types
+
+from frozendict import frozendict
+
 from synapse.util.caches.treecache import TreeCache
 
+# The total memory, in bytes, which the entries in all LruCaches may use
+# between them, or None if caches are only limited by their number of entries.
+# See `set_cache_memory_budget`.
+_memory_budget = [None]
+
+# When a memory budget is set, every cache entry is also kept on a global list,
+# in least-recently-used order across all caches, so that we know which entry
+# to evict when we go over budget. `_global_memory` is the estimated size of
+# all the entries on the list.
+#
+# To avoid deadlocks, `_global_lock` is only ever taken while already holding
+# the lock of an individual cache, never the other way round.
+_global_lock = threading.Lock()
+_global_memory = [0]
+
+# Types which don't refer to anything we want to count towards the size of a
+# cache entry.
+_LEAF_TYPES = string_types + integer_types + (bytes, float, type(None))
+
+# Types which we shouldn't look inside when estimating the size of a cache
+# entry, as they are shared with the rest of the program.
+_SHARED_TYPES = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+    types.MethodType,
+)
+
+# The most objects we'll look at when estimating the size of a single entry
+_MAX_OBJECTS_TO_SIZE = 100000
+
+_slots_by_type = {}
+
+
+def set_cache_memory_budget(budget):
+    """Limit the total memory used by all LruCaches.
+
+    Once the estimated size of the entries across all caches exceeds the
+    budget, the least recently used entries are evicted, whichever cache
+    they are in. Each cache is still also limited by its maximum size.
+
+    Only entries added after the budget is set count towards it.
+
+    Args:
+        budget (int|None): the budget in bytes, or None to limit caches only by
+            their maximum size.
+    """
+    _memory_budget[0] = budget
+
+
+def get_cache_memory_usage():
+    """Get the estimated memory used by the entries in all LruCaches.
+
+    Returns:
+        int: size in bytes. Always zero if no memory budget has been set.
+    """
+    return _global_memory[0]
+
+
+def _slots_of(cls):
+    slots = _slots_by_type.get(cls)
+    if slots is None:
+        slots = []
+        for klass in cls.__mro__:
+            klass_slots = klass.__dict__.get("__slots__", ())
+            if isinstance(klass_slots, string_types):
+                klass_slots = (klass_slots,)
+            slots.extend(s for s in klass_slots if s not in ("__dict__", "__weakref__"))
+        _slots_by_type[cls] = slots
+    return slots
+
+
+def estimate_size_of(obj):
+    """Estimate the memory used by an object, including the objects it refers to.
+
+    Objects which are referred to more than once are only counted once, but no
+    account is taken of objects being shared with other cache entries (for
+    example, interned strings).
+
+    Args:
+        obj: the object to size
+
+    Returns:
+        int: estimated size in bytes
+    """
+    size = 0
+    seen = set()
+    to_visit = [obj]
+
+    while to_visit and len(seen) < _MAX_OBJECTS_TO_SIZE:
+        o = to_visit.pop()
+        if id(o) in seen or isinstance(o, _SHARED_TYPES):
+            continue
+        seen.add(id(o))
+
+        size += sys.getsizeof(o, 0)
+
+        if isinstance(o, _LEAF_TYPES):
+            continue
+
+        if isinstance(o, (dict, frozendict)):
+            for k, v in six.iteritems(o):
+                to_visit.append(k)
+                to_visit.append(v)
+        elif isinstance(o, tuple):
+            # some tuple subclasses, such as UserID, refuse to be iterated
+            to_visit.extend(tuple.__iter__(o))
+        elif isinstance(o, (list, set, frozenset)):
+            to_visit.extend(o)
+        else:
+            d = getattr(o, "__dict__", None)
+            if d is not None:
+                to_visit.append(d)
+            for slot in _slots_of(type(o)):
+                v = getattr(o, slot, None)
+                if v is not None:
+                    to_visit.append(v)
+
+    return size
+
 
 def enumerate_leaves(node, depth):
     if depth == 0:
@@ -30,7 +155,10 @@ def enumerate_leaves(node, depth):
 
 
 class _Node(object):
-    __slots__ = ["prev_node", "next_node", "key", "value", "callbacks"]
+    __slots__ = [
+        "prev_node", "next_node", "key", "value", "callbacks",
+        "global_prev_node", "global_next_node", "memory", "drop",
+    ]
 
     def __init__(self, prev_node, next_node, key, value, callbacks=set()):
         self.prev_node = prev_node
@@ -39,6 +167,86 @@ class _Node(object):
         self.value = value
         self.callbacks = callbacks
 
+        # The position of the node on the global list, its estimated size, and a
+        # function which removes it from its cache. Only set if the node is on
+        # the global list.
+        self.global_prev_node = None
+        self.global_next_node = None
+        self.memory = None
+        self.drop = None
+
+
+_global_list_root = _Node(None, None, None, None)
+_global_list_root.global_next_node = _global_list_root
+_global_list_root.global_prev_node = _global_list_root
+
+
+def _track_node(node, drop):
+    """Add a node to the front of the global list.
+
+    Args:
+        node (_Node)
+        drop (func(_Node)): removes the node from its cache
+    """
+    node.memory = estimate_size_of(node.key) + estimate_size_of(node.value)
+    node.drop = drop
+    with _global_lock:
+        prev_node = _global_list_root
+        next_node = prev_node.global_next_node
+        node.global_prev_node = prev_node
+        node.global_next_node = next_node
+        prev_node.global_next_node = node
+        next_node.global_prev_node = node
+        _global_memory[0] += node.memory
+
+
+def _untrack_node(node):
+    """Remove a node from the global list, if it is on it."""
+    with _global_lock:
+        if node.memory is None:
+            return
+        node.global_prev_node.global_next_node = node.global_next_node
+        node.global_next_node.global_prev_node = node.global_prev_node
+        node.global_prev_node = None
+        node.global_next_node = None
+        _global_memory[0] -= node.memory
+        node.memory = None
+        node.drop = None
+
+
+def _move_tracked_node_to_front(node):
+    with _global_lock:
+        if node.memory is None:
+            return
+        node.global_prev_node.global_next_node = node.global_next_node
+        node.global_next_node.global_prev_node = node.global_prev_node
+        prev_node = _global_list_root
+        next_node = prev_node.global_next_node
+        node.global_prev_node = prev_node
+        node.global_next_node = next_node
+        prev_node.global_next_node = node
+        next_node.global_prev_node = node
+
+
+def _evict_over_budget():
+    """Evict the least recently used entries across all caches until we are
+    back under the memory budget.
+
+    Must not be called while holding the lock of any cache.
+    """
+    while True:
+        with _global_lock:
+            budget = _memory_budget[0]
+            if budget is None or _global_memory[0] <= budget:
+                return
+            node = _global_list_root.global_prev_node
+            drop = node.drop
+            if drop is None:
+                # the list is empty
+                return
+
+        drop(node)
+
 
 class LruCache(object):
     """
@@ -48,6 +256,9 @@ class LruCache(object):
 
     Can also set callbacks on objects when getting/setting which are fired
     when that key gets invalidated/evicted.
+
+    If a memory budget has been set with `set_cache_memory_budget`, entries
+    may also be evicted to keep the total size of all caches within the budget.
     """
     def __init__(self, max_size, keylen=1, cache_type=dict, size_callback=None,
                  evicted_callback=None):
@@ -101,6 +312,18 @@ class LruCache(object):
 
         self.len = synchronized(cache_len)
 
+        # the estimated size of the entries in this cache, if there is a
+        # memory budget
+        cached_memory = [0]
+
+        def track_node(node):
+            _track_node(node, drop_node)
+            cached_memory[0] += node.memory
+
+        def untrack_node(node):
+            cached_memory[0] -= node.memory
+            _untrack_node(node)
+
         def add_node(key, value, callbacks=set()):
             prev_node = list_root
             next_node = prev_node.next_node
@@ -112,6 +335,9 @@ class LruCache(object):
             if size_callback:
                 cached_cache_len[0] += size_callback(node.value)
 
+            if _memory_budget[0] is not None:
+                track_node(node)
+
         def move_node_to_front(node):
             prev_node = node.prev_node
             next_node = node.next_node
@@ -124,6 +350,9 @@ class LruCache(object):
             prev_node.next_node = node
             next_node.prev_node = node
 
+            if node.memory is not None:
+                _move_tracked_node_to_front(node)
+
         def delete_node(node):
             prev_node = node.prev_node
             next_node = node.next_node
@@ -135,11 +364,23 @@ class LruCache(object):
                 deleted_len = size_callback(node.value)
                 cached_cache_len[0] -= deleted_len
 
+            if node.memory is not None:
+                untrack_node(node)
+
             for cb in node.callbacks:
                 cb()
             node.callbacks.clear()
             return deleted_len
 
+        @synchronized
+        def drop_node(node):
+            """Evict a node to bring the caches back under the memory budget"""
+            if cache.get(node.key, None) is node:
+                evicted_len = delete_node(node)
+                cache.pop(node.key, None)
+                if evicted_callback:
+                    evicted_callback(evicted_len)
+
         @synchronized
         def cache_get(key, default=None, callbacks=[]):
             node = cache.get(key, None)
@@ -151,7 +392,7 @@ class LruCache(object):
                 return default
 
         @synchronized
-        def cache_set(key, value, callbacks=[]):
+        def _cache_set(key, value, callbacks=[]):
             node = cache.get(key, None)
             if node is not None:
                 # We sometimes store large objects, e.g. dicts, which cause
@@ -174,13 +415,21 @@ class LruCache(object):
 
                 move_node_to_front(node)
                 node.value = value
+
+                if node.memory is not None:
+                    untrack_node(node)
+                    track_node(node)
             else:
                 add_node(key, value, set(callbacks))
 
             evict()
 
+        def cache_set(key, value, callbacks=[]):
+            _cache_set(key, value, callbacks)
+            _evict_over_budget()
+
         @synchronized
-        def cache_set_default(key, value):
+        def _cache_set_default(key, value):
             node = cache.get(key, None)
             if node is not None:
                 return node.value
@@ -189,6 +438,11 @@ class LruCache(object):
                 evict()
                 return value
 
+        def cache_set_default(key, value):
+            value = _cache_set_default(key, value)
+            _evict_over_budget()
+            return value
+
         @synchronized
         def cache_pop(key, default=None):
             node = cache.get(key, None)
@@ -215,6 +469,8 @@ class LruCache(object):
             list_root.next_node = list_root
             list_root.prev_node = list_root
             for node in cache.values():
+                if node.memory is not None:
+                    untrack_node(node)
                 for cb in node.callbacks:
                     cb()
             cache.clear()
@@ -225,6 +481,24 @@ class LruCache(object):
         def cache_contains(key):
             return key in cache
 
+        @synchronized
+        def cache_most_recent_keys(limit):
+            """Get the keys of the most recently used entries, most recent
+            first.
+
+            Args:
+                limit (int): the most keys to return
+            """
+            keys = []
+            node = list_root.next_node
+            while node is not list_root and len(keys) < limit:
+                keys.append(node.key)
+                node = node.next_node
+            return keys
+
+        def cache_memory_usage():
+            return cached_memory[0]
+
         self.sentinel = object()
         self.get = cache_get
         self.set = cache_set
@@ -234,7 +508,9 @@ class LruCache(object):
             self.del_multi = cache_del_multi
         self.len = synchronized(cache_len)
         self.contains = cache_contains
+        self.most_recent_keys = cache_most_recent_keys
         self.clear = cache_clear
+        self.memory_usage = cache_memory_usage
 
     def __getitem__(self, key):
         result = self.get(key, self.sentinel)
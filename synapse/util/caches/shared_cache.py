@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A cache which is shared between the processes on a machine (i.e. synapse
+and its workers), so that each process doesn't have to fetch the same things
+from the database for itself.
+
+The cache lives in a memory-mapped file. Values are appended to a ring buffer
+which takes up most of the file, and found through a hash table of the keys at
+the start of the file. Once the ring buffer wraps around, new values overwrite
+the oldest ones, so the cache only ever holds the most recently written values.
+
+Writes take an exclusive lock on the file. Reads don't take any locks: instead,
+they check after reading a value that nothing has started to overwrite it, and
+that its checksum matches.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+shared_cache_hits = Counter("synapse_util_caches_shared_cache_hits", "", ["name"])
+shared_cache_misses = Counter("synapse_util_caches_shared_cache_misses", "", ["name"])
+shared_cache_writes = Counter("synapse_util_caches_shared_cache_writes", "", ["name"])
+
+_MAGIC = b"SYNSHC01"
+
+# magic, number of index entries, size of the ring buffer, write position.
+#
+# The write position only ever increases: the position in the ring buffer is
+# it modulo the size of the buffer.
+_HEADER = struct.Struct("<8sQQQ")
+_HEADER_SIZE = 64
+_WRITE_POSITION_OFFSET = 24
+_WRITE_POSITION = struct.Struct("<Q")
+
+# digest of the key, write position of the value, length of the value.
+#
+# Entries whose digest is all zeroes are empty.
+_INDEX_ENTRY = struct.Struct("<16sQI4x")
+_EMPTY_DIGEST = b"\0" * 16
+
+# digest of the key, length of the value, CRC32 of the value
+_RECORD_HEADER = struct.Struct("<16sII")
+
+# We allocate one index entry for every this many bytes of the ring buffer.
+_BYTES_PER_INDEX_ENTRY = 1024
+
+# Values bigger than this fraction of the ring buffer aren't cached.
+_MAX_VALUE_FRACTION = 8
+
+
+class SharedCache(object):
+    """A cache of bytes, keyed by strings, which is shared between processes.
+
+    Args:
+        name (str): the name of the cache, for metrics.
+        path (str): the file to keep the cache in. All of the processes which
+            share the cache must use the same file, which should be on a
+            memory-backed filesystem such as /dev/shm.
+        size (int): the size of the cache in bytes, if we have to create the
+            file. If the file already exists we use the size it was created
+            with.
+    """
+
+    def __init__(self, name, path, size):
+        self.name = name
+        self.path = path
+
+        # Writes from the threads in this process are serialised by this lock,
+        # as well as the lock on the file (which only excludes other processes).
+        self._lock = threading.Lock()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._file_lock():
+            header = os.read(self._fd, _HEADER.size)
+            if len(header) == _HEADER.size and header[:8] == _MAGIC:
+                _, self._index_entries, self._data_size, _ = _HEADER.unpack(header)
+            else:
+                self._index_entries = max(size // _BYTES_PER_INDEX_ENTRY, 1024)
+                self._data_size = size
+                self._create_file()
+
+        self._data_offset = (
+            _HEADER_SIZE + self._index_entries * _INDEX_ENTRY.size
+        )
+        self._mmap = mmap.mmap(self._fd, self._data_offset + self._data_size)
+
+    def _create_file(self):
+        logger.info(
+            "Creating shared cache %s in %s (%d bytes)",
+            self.name, self.path, self._data_size,
+        )
+        total_size = (
+            _HEADER_SIZE
+            + self._index_entries * _INDEX_ENTRY.size
+            + self._data_size
+        )
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, total_size)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(
+            self._fd, _HEADER.pack(_MAGIC, self._index_entries, self._data_size, 0),
+        )
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    def _lookup(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).digest()[:16]
+        index, = struct.unpack_from("<Q", digest)
+        index_offset = (
+            _HEADER_SIZE + (index % self._index_entries) * _INDEX_ENTRY.size
+        )
+        return digest, index_offset
+
+    def _get_write_position(self):
+        return _WRITE_POSITION.unpack_from(self._mmap, _WRITE_POSITION_OFFSET)[0]
+
+    def get(self, key):
+        """Look up a key in the cache.
+
+        Args:
+            key (str)
+
+        Returns:
+            bytes|None: the value, or None if it isn't in the cache.
+        """
+        value = self._get(key)
+        if value is None:
+            shared_cache_misses.labels(self.name).inc()
+        else:
+            shared_cache_hits.labels(self.name).inc()
+        return value
+
+    def _get(self, key):
+        digest, index_offset = self._lookup(key)
+
+        entry_digest, position, length = _INDEX_ENTRY.unpack_from(
+            self._mmap, index_offset,
+        )
+        if entry_digest != digest:
+            return None
+
+        # A value is overwritten once the write position gets a whole buffer
+        # past where it was written.
+        if self._get_write_position() > position + self._data_size:
+            return None
+
+        offset = self._data_offset + position % self._data_size
+        record_digest, record_length, crc = _RECORD_HEADER.unpack_from(
+            self._mmap, offset,
+        )
+        if record_digest != digest or _RECORD_HEADER.size + record_length > length:
+            return None
+
+        value_offset = offset + _RECORD_HEADER.size
+        value = self._mmap[value_offset:value_offset + record_length]
+
+        # Check that no-one started to overwrite the value while we were
+        # reading it, and that we read what we were expecting to.
+        if self._get_write_position() > position + self._data_size:
+            return None
+        if zlib.crc32(value) & 0xffffffff != crc:
+            return None
+
+        return value
+
+    def set(self, key, value):
+        """Add a value to the cache, replacing any existing value for the key.
+
+        Values which are too big for the cache are ignored.
+
+        Args:
+            key (str)
+            value (bytes)
+        """
+        # Keep the records aligned
+        length = _RECORD_HEADER.size + len(value)
+        length += -length % 8
+        if length > self._data_size // _MAX_VALUE_FRACTION:
+            return
+
+        digest, index_offset = self._lookup(key)
+        record_header = _RECORD_HEADER.pack(
+            digest, len(value), zlib.crc32(value) & 0xffffffff,
+        )
+
+        with self._file_lock():
+            # First move the write position past the space for the record, so
+            # that readers of the values we are about to overwrite know that
+            # they have gone.
+            position = self._get_write_position()
+            offset = position % self._data_size
+            if offset + length > self._data_size:
+                # Records don't wrap around the end of the buffer.
+                position += self._data_size - offset
+                offset = 0
+
+            _WRITE_POSITION.pack_into(
+                self._mmap, _WRITE_POSITION_OFFSET, position + length,
+            )
+
+            offset += self._data_offset
+            self._mmap[offset:offset + _RECORD_HEADER.size] = record_header
+            offset += _RECORD_HEADER.size
+            self._mmap[offset:offset + len(value)] = value
+
+            _INDEX_ENTRY.pack_into(self._mmap, index_offset, digest, position, length)
+
+        shared_cache_writes.labels(self.name).inc()
+
+    def invalidate(self, key):
+        """Remove a key from the cache.
+
+        Args:
+            key (str)
+        """
+        digest, index_offset = self._lookup(key)
+
+        # Most of the things we invalidate aren't in the cache, so check before
+        # taking the lock.
+        entry_digest, = struct.unpack_from("<16s", self._mmap, index_offset)
+        if entry_digest != digest:
+            return
+
+        with self._file_lock():
+            entry_digest, = struct.unpack_from("<16s", self._mmap, index_offset)
+            if entry_digest == digest:
+                _INDEX_ENTRY.pack_into(self._mmap, index_offset, _EMPTY_DIGEST, 0, 0)
+
+    def clear(self):
+        """Remove everything from the cache."""
+        with self._file_lock():
+            self._mmap[_HEADER_SIZE:self._data_offset] = (
+                b"\0" * (self._data_offset - _HEADER_SIZE)
+            )
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Support for JSON responses which include objects that have already been
+encoded (such as events, whose encodings we cache), so that we can splice them
+into the response rather than encoding them again.
+"""
+
+import re
+import uuid
+
+from six import string_types
+
+from canonicaljson import json
+from frozendict import frozendict
+
+# How many levels of a JSON object iterencode_json splits up. This is enough to
+# encode each room in a sync response separately.
+ITERENCODE_MAX_DEPTH = 3
+
+# While encoding a response, we replace each EncodedJsonObject with a
+# placeholder string, and then swap the encoded objects in for the placeholders
+# afterwards. The placeholders start with a NUL (which always gets escaped) and
+# include a random nonce, so they can't clash with any strings in the response.
+_PLACEHOLDER_NONCE = uuid.uuid4().hex
+_PLACEHOLDER_FORMAT = u"\0" + _PLACEHOLDER_NONCE + u":%d"
+_PLACEHOLDER_RE = re.compile(
+    b'"\\\\u0000' + _PLACEHOLDER_NONCE.encode("ascii") + b':([0-9]+)"'
+)
+
+
+class EncodedJsonObject(object):
+    """A JSON object, some or all of whose fields have already been encoded.
+
+    These can be used anywhere in a JSON response passed to `encode_json`.
+    """
+
+    __slots__ = ["encoded", "fields"]
+
+    def __init__(self, encoded, fields=None):
+        """
+        Args:
+            encoded (bytes): the UTF-8 encoding of a JSON object.
+            fields (dict|None): any further fields of the object, which haven't
+                been encoded. These must not also appear in `encoded`.
+        """
+        self.encoded = encoded
+        self.fields = fields
+
+    def get_dict(self):
+        """Decode the object, for code which needs to look inside it.
+
+        Returns:
+            dict
+        """
+        d = json.loads(self.encoded.decode("utf-8"))
+        if self.fields:
+            d.update(self.fields)
+        return d
+
+
+def encode_json(json_object, canonical=False, pretty_print=False):
+    """Encode a JSON object, which may contain EncodedJsonObjects.
+
+    Note that the already-encoded parts of the object are included as they are,
+    so they are not re-ordered or pretty printed. The exception is canonical
+    JSON, where an EncodedJsonObject with extra fields is decoded and encoded
+    again, so that its keys come out in order. None of the hot paths ask for
+    canonical JSON.
+
+    Args:
+        json_object (object): the object to encode.
+        canonical (bool): whether to encode the object as canonical JSON.
+        pretty_print (bool): whether to encode the object in a human readable
+            format.
+
+    Returns:
+        bytes: the UTF-8 encoding of the object.
+    """
+    encoded_objects = []
+
+    def default(obj):
+        if isinstance(obj, EncodedJsonObject):
+            encoded_objects.append(obj)
+            return _PLACEHOLDER_FORMAT % (len(encoded_objects) - 1,)
+        if isinstance(obj, frozendict):
+            return dict(obj)
+        raise TypeError(
+            "Object of type %s is not JSON serializable" % (type(obj).__name__,)
+        )
+
+    if pretty_print:
+        encoder = json.JSONEncoder(
+            ensure_ascii=False, indent=4, sort_keys=True, default=default,
+        )
+    elif canonical:
+        encoder = json.JSONEncoder(
+            ensure_ascii=False, separators=(",", ":"), sort_keys=True,
+            default=default,
+        )
+    else:
+        encoder = json.JSONEncoder(default=default)
+
+    json_bytes = encoder.encode(json_object).encode("utf-8")
+    if not encoded_objects:
+        return json_bytes
+
+    def splice(match):
+        obj = encoded_objects[int(match.group(1))]
+        if not obj.fields:
+            return obj.encoded
+
+        if canonical:
+            # appending the fields to the encoded object would leave the keys
+            # out of order.
+            return encode_json(obj.get_dict(), canonical=True)
+
+        fields = encode_json(obj.fields)
+        if obj.encoded == b"{}":
+            return fields
+        return obj.encoded[:-1] + b"," + fields[1:]
+
+    return _PLACEHOLDER_RE.sub(splice, json_bytes)
+
+
+def iterencode_json(json_object, canonical=False, max_depth=ITERENCODE_MAX_DEPTH):
+    """Encode a JSON object, which may contain EncodedJsonObjects, a piece at a
+    time.
+
+    The top few levels of the object are split up, and the values below them
+    encoded one by one, so that a large response can be written out as it is
+    encoded rather than all at once.
+
+    Args:
+        json_object (object): the object to encode.
+        canonical (bool): whether to encode the object as canonical JSON.
+        max_depth (int): how many levels of the object to split up.
+
+    Returns:
+        iterator[bytes]: the UTF-8 encoding of the object, in pieces.
+    """
+    if canonical:
+        item_separator, key_separator = b",", b":"
+    else:
+        item_separator, key_separator = b", ", b": "
+
+    if max_depth and isinstance(json_object, (dict, frozendict)) and json_object:
+        keys = list(json_object)
+        if all(isinstance(key, string_types) for key in keys):
+            if canonical:
+                keys.sort()
+
+            yield b"{"
+            for i, key in enumerate(keys):
+                if i:
+                    yield item_separator
+                yield encode_json(key) + key_separator
+                for chunk in iterencode_json(
+                    json_object[key], canonical, max_depth - 1,
+                ):
+                    yield chunk
+            yield b"}"
+            return
+
+    if max_depth and isinstance(json_object, (list, tuple)) and json_object:
+        yield b"["
+        for i, value in enumerate(json_object):
+            if i:
+                yield item_separator
+            for chunk in iterencode_json(value, canonical, max_depth - 1):
+                yield chunk
+        yield b"]"
+        return
+
+    yield encode_json(json_object, canonical=canonical)
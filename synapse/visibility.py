@@ -14,17 +14,22 @@
 # limitations under the License.
 
 import logging
-import operator
 
 from six import iteritems, itervalues
-from six.moves import map
 
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.events.utils import prune_event
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage.state import StateFilter
 from synapse.types import get_domain_from_id
+from synapse.util.logcontext import (
+    PreserveLoggingContext,
+    make_deferred_yieldable,
+    run_in_background,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +50,11 @@ MEMBERSHIP_PRIORITY = (
     Membership.BAN,
 )
 
+# How many users filter_events_for_clients looks up the memberships of one by
+# one. Beyond this, it gets all of the memberships in the room, as a state
+# filter with one entry per user makes for an unmanageably large query.
+MAX_USERS_IN_STATE_FILTER = 100
+
 
 @defer.inlineCallbacks
 def filter_events_for_client(store, user_id, events, is_peeking=False,
@@ -67,51 +77,83 @@ def filter_events_for_client(store, user_id, events, is_peeking=False,
     Returns:
         Deferred[list[synapse.events.EventBase]]
     """
-    types = (
-        (EventTypes.RoomHistoryVisibility, ""),
-        (EventTypes.Member, user_id),
-    )
-    event_id_to_state = yield store.get_state_for_events(
-        frozenset(e.event_id for e in events),
-        state_filter=StateFilter.from_types(types),
+    results = yield filter_events_for_clients(
+        store, [user_id], events,
+        is_peeking=is_peeking, always_include_ids=always_include_ids,
     )
+    defer.returnValue(results[user_id])
 
-    ignore_dict_content = yield store.get_global_account_data_by_type_for_user(
-        "m.ignored_user_list", user_id,
-    )
 
-    # FIXME: This will explode if people upload something incorrect.
-    ignore_list = frozenset(
-        ignore_dict_content.get("ignored_users", {}).keys()
-        if ignore_dict_content else []
-    )
+@defer.inlineCallbacks
+def filter_events_for_clients(store, user_ids, events, is_peeking=False,
+                              always_include_ids=frozenset()):
+    """
+    Check which events each of a number of users is allowed to see
 
-    erased_senders = yield store.are_users_erased((e.sender for e in events))
+    This gives the same results as calling filter_events_for_client for each
+    user, but the history visibility and membership state is only looked up
+    and interpreted once for each state group, rather than once per user.
 
-    def allowed(event):
-        """
-        Args:
-            event (synapse.events.EventBase): event to check
+    Args:
+        store (synapse.storage.DataStore): our datastore (can also be a worker
+            store)
+        user_ids(iterable[str]): user ids to be checked
+        events(list[synapse.events.EventBase]): sequence of events to be checked
+        is_peeking(bool): should be True if, for every user:
+          * the user is not currently a member of the room, and:
+          * the user has not been a member of the room since the given
+            events
+        always_include_ids (set(event_id)): set of event ids to specifically
+            include (unless sender is ignored)
 
-        Returns:
-            None|EventBase:
-               None if the user cannot see this event at all
+    Returns:
+        Deferred[dict[str, list[synapse.events.EventBase]]]: map from user id
+            to the events that user may see
+    """
+    user_ids = frozenset(user_ids)
 
-               a redacted copy of the event if they can only see a redacted
-               version
+    types = [(EventTypes.RoomHistoryVisibility, "")]
+    if len(user_ids) > MAX_USERS_IN_STATE_FILTER:
+        # each member in the filter is another clause in the SQL, so for lots
+        # of users we get all the members and pick ours out.
+        types.append((EventTypes.Member, None))
+    else:
+        types.extend((EventTypes.Member, user_id) for user_id in user_ids)
 
-               the original event if they can see it as normal.
-        """
-        if not event.is_state() and event.sender in ignore_list:
-            return None
+    event_id_to_group, group_to_state_ids = (
+        yield store.get_state_ids_for_events_by_group(
+            frozenset(e.event_id for e in events),
+            state_filter=StateFilter.from_types(types),
+        )
+    )
 
-        if event.event_id in always_include_ids:
-            return event
+    if len(user_ids) > MAX_USERS_IN_STATE_FILTER:
+        group_to_state_ids = {
+            group: {
+                (typ, state_key): event_id
+                for (typ, state_key), event_id in iteritems(state_ids)
+                if typ != EventTypes.Member or state_key in user_ids
+            }
+            for group, state_ids in iteritems(group_to_state_ids)
+        }
 
-        state = event_id_to_state[event.event_id]
+    state_event_map = yield store.get_events(
+        [
+            ev_id
+            for state_ids in itervalues(group_to_state_ids)
+            for ev_id in itervalues(state_ids)
+        ],
+        get_prev_content=False,
+    )
 
-        # get the room_visibility at the time of the event.
-        visibility_event = state.get((EventTypes.RoomHistoryVisibility, ""), None)
+    # Work out the room visibility, and the membership of each user, in each of
+    # the state groups.
+    group_to_visibility = {}
+    group_to_memberships = {}
+    for group, state_ids in iteritems(group_to_state_ids):
+        visibility_event = state_event_map.get(
+            state_ids.get((EventTypes.RoomHistoryVisibility, ""))
+        )
         if visibility_event:
             visibility = visibility_event.content.get("history_visibility", "shared")
         else:
@@ -120,6 +162,38 @@ def filter_events_for_client(store, user_id, events, is_peeking=False,
         if visibility not in VISIBILITY_PRIORITY:
             visibility = "shared"
 
+        group_to_visibility[group] = visibility
+
+        memberships = {}
+        for (typ, state_key), event_id in iteritems(state_ids):
+            if typ != EventTypes.Member:
+                continue
+            membership_event = state_event_map.get(event_id)
+            if membership_event:
+                memberships[state_key] = membership_event.membership
+        group_to_memberships[group] = memberships
+
+    ignore_lists = yield make_deferred_yieldable(defer.gatherResults([
+        run_in_background(_get_ignore_list, store, user_id)
+        for user_id in user_ids
+    ], consumeErrors=True))
+    user_id_to_ignore_list = dict(zip(user_ids, ignore_lists))
+
+    erased_senders = yield store.are_users_erased((e.sender for e in events))
+
+    # the visibility of each event, and the redacted copies of events we've
+    # made, which are the same whichever user is looking at them.
+    event_id_to_visibility = {}
+    pruned_events = {}
+
+    def get_visibility(event):
+        visibility = event_id_to_visibility.get(event.event_id)
+        if visibility is not None:
+            return visibility
+
+        # get the room_visibility at the time of the event.
+        visibility = group_to_visibility[event_id_to_group[event.event_id]]
+
         # Always allow history visibility events on boundaries. This is done
         # by setting the effective visibility to the least restrictive
         # of the old vs new.
@@ -135,6 +209,33 @@ def filter_events_for_client(store, user_id, events, is_peeking=False,
             if old_priority < new_priority:
                 visibility = prev_visibility
 
+        event_id_to_visibility[event.event_id] = visibility
+        return visibility
+
+    def allowed(event, user_id, ignore_list):
+        """
+        Args:
+            event (synapse.events.EventBase): event to check
+            user_id (str): user to check the event for
+            ignore_list (frozenset[str]): users that the user has ignored
+
+        Returns:
+            None|EventBase:
+               None if the user cannot see this event at all
+
+               a redacted copy of the event if they can only see a redacted
+               version
+
+               the original event if they can see it as normal.
+        """
+        if not event.is_state() and event.sender in ignore_list:
+            return None
+
+        if event.event_id in always_include_ids:
+            return event
+
+        visibility = get_visibility(event)
+
         # likewise, if the event is the user's own membership event, use
         # the 'most joined' membership
         membership = None
@@ -162,9 +263,9 @@ def filter_events_for_client(store, user_id, events, is_peeking=False,
 
         # otherwise, get the user's membership at the time of the event.
         if membership is None:
-            membership_event = state.get((EventTypes.Member, user_id), None)
-            if membership_event:
-                membership = membership_event.membership
+            membership = group_to_memberships[
+                event_id_to_group[event.event_id]
+            ].get(user_id)
 
         # if the user was a member of the room at the time of the event,
         # they can see it.
@@ -201,18 +302,117 @@ def filter_events_for_client(store, user_id, events, is_peeking=False,
         # has not requested their data to be erased, in which case, we return
         # a redacted version.
         if erased_senders[event.sender]:
-            return prune_event(event)
+            pruned = pruned_events.get(event.event_id)
+            if pruned is None:
+                pruned = pruned_events[event.event_id] = prune_event(event)
+            return pruned
 
         return event
 
-    # check each event: gives an iterable[None|EventBase]
-    filtered_events = map(allowed, events)
+    results = {}
+    for user_id, ignore_list in iteritems(user_id_to_ignore_list):
+        # check each event, removing the None entries
+        results[user_id] = [
+            filtered for filtered in (
+                allowed(event, user_id, ignore_list) for event in events
+            )
+            if filtered
+        ]
+
+    defer.returnValue(results)
+
+
+class ClientEventFilter(object):
+    """Filters events for clients in the same way as filter_events_for_client,
+    but batches up concurrent requests to filter the same events for different
+    users.
+
+    When a new event arrives in a busy room, everyone in the room is woken up
+    at once and filters the same new events. Requests made in the same reactor
+    tick to filter the same events are handled by a single call to
+    filter_events_for_clients, so that the room state is only looked up and
+    interpreted once.
+    """
+
+    def __init__(self, hs):
+        self.store = hs.get_datastore()
+        self.clock = hs.get_clock()
+
+        # map from (event ids, is_peeking, always_include_ids) to the list of
+        # (user_id, Deferred) waiting for those events to be filtered.
+        self._pending = {}
+
+    def filter_events_for_client(self, user_id, events, is_peeking=False,
+                                 always_include_ids=frozenset()):
+        """
+        Check which events a user is allowed to see. See
+        filter_events_for_client for details of the arguments.
+
+        Returns:
+            Deferred[list[synapse.events.EventBase]]
+        """
+        if not events:
+            return defer.succeed([])
+
+        key = (
+            tuple(e.event_id for e in events),
+            is_peeking,
+            frozenset(always_include_ids),
+        )
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = []
+            self.clock.call_later(0, self._filter_pending, key, events)
+
+        d = defer.Deferred()
+        pending.append((user_id, d))
+        return make_deferred_yieldable(d)
+
+    def _filter_pending(self, key, events):
+        pending = self._pending.pop(key)
+        _, is_peeking, always_include_ids = key
+
+        return run_as_background_process(
+            "filter_events_for_clients", self._filter,
+            pending, events, is_peeking, always_include_ids,
+        )
+
+    @defer.inlineCallbacks
+    def _filter(self, pending, events, is_peeking, always_include_ids):
+        try:
+            results = yield filter_events_for_clients(
+                self.store, (user_id for user_id, _ in pending), events,
+                is_peeking=is_peeking, always_include_ids=always_include_ids,
+            )
+        except Exception:
+            failure = Failure()
+            with PreserveLoggingContext():
+                for _, d in pending:
+                    d.errback(failure)
+            return
+
+        with PreserveLoggingContext():
+            for user_id, d in pending:
+                d.callback(results[user_id])
+
 
-    # remove the None entries
-    filtered_events = filter(operator.truth, filtered_events)
+@defer.inlineCallbacks
+def _get_ignore_list(store, user_id):
+    """Get the set of users that the given user has ignored
+
+    Returns:
+        Deferred[frozenset[str]]
+    """
+    ignore_dict_content = yield store.get_global_account_data_by_type_for_user(
+        "m.ignored_user_list", user_id,
+    )
 
-    # we turn it into a list before returning it.
-    defer.returnValue(list(filtered_events))
+    # FIXME: This will explode if people upload something incorrect.
+    defer.returnValue(frozenset(
+        ignore_dict_content.get("ignored_users", {}).keys()
+        if ignore_dict_content else []
+    ))
 
 
 @defer.inlineCallbacks
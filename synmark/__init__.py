@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""synmark: a benchmark suite for synapse's hot paths.
+
+See synmark/README.rst for how to run it.
+"""
+
+import threading
+
+from twisted.internet import defer, threads
+
+from synapse.util import Clock
+from synapse.util.logcontext import LoggingContext, run_in_background
+
+from tests.utils import default_config, setup_test_homeserver
+
+
+def start_reactor(reactor):
+    """Run the given reactor in a daemon thread, so that benchmark runners
+    (which are synchronous) can drive it with `run_on_reactor`.
+
+    The reactor is kept running for the lifetime of the process, so that
+    expensive fixtures (eg, large synthetic rooms) can be shared between
+    successive runs of a benchmark.
+
+    Args:
+        reactor (IReactorCore)
+    """
+    thread = threading.Thread(
+        target=reactor.run,
+        kwargs={"installSignalHandlers": False},
+        name="synmark-reactor",
+    )
+    thread.daemon = True
+    thread.start()
+
+
+def run_on_reactor(reactor, f, *args, **kwargs):
+    """Call `f` on the reactor thread in a fresh logcontext and block until the
+    Deferred it returns has completed.
+
+    Args:
+        reactor (IReactorCore)
+        f (callable): function returning a Deferred
+
+    Returns:
+        the result of the Deferred returned by `f`
+    """
+    def _run():
+        with LoggingContext("synmark"):
+            return run_in_background(f, *args, **kwargs)
+
+    return threads.blockingCallFromThread(reactor, _run)
+
+
+@defer.inlineCallbacks
+def make_homeserver(reactor, config=None):
+    """Make a homeserver suitable for running benchmarks against.
+
+    The homeserver is backed by an in-memory SQLite database, or a fresh
+    Postgres database if SYNAPSE_POSTGRES is set (in the same way as the unit
+    tests).
+
+    Args:
+        reactor (IReactorCore): the reactor the homeserver should use. It must
+            be running. If using Postgres, `tests.utils.setupdb` must have
+            been called first.
+        config: homeserver config. Defaults to the unit test config, with
+            realistically sized caches.
+
+    Returns:
+        Deferred[tuple[HomeServer, callable]]: the homeserver and a function to
+        clean up after it.
+    """
+    cleanup_tasks = []
+
+    if config is None:
+        config = default_config("synmark")
+        # the unit tests use a tiny event cache to shake out caching bugs; we
+        # want something closer to a production deployment.
+        config.event_cache_size = 10000
+
+    hs = yield setup_test_homeserver(
+        cleanup_tasks.append,
+        name=config.server_name,
+        config=config,
+        reactor=reactor,
+        clock=Clock(reactor),
+    )
+
+    def cleanup():
+        for task in cleanup_tasks:
+            task()
+
+    defer.returnValue((hs, cleanup))
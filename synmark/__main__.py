@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the synmark benchmarks.
+
+Usage:
+
+    python -m synmark [--sizes 1000,10000] [--log] [pyperf options]
+
+Results are written by pyperf; pass `-o results.json` to save them, and use
+`python -m pyperf compare_to old.json new.json` to compare two runs. Set
+SYNAPSE_POSTGRES=1 to run against Postgres rather than SQLite.
+"""
+
+import logging
+import sys
+
+import pyperf
+
+from twisted.internet import reactor
+
+from synmark import run_on_reactor, start_reactor
+from synmark.suites import SUITES
+from tests.utils import setupdb
+
+DEFAULT_SIZES = "1000,10000,100000"
+
+
+def make_test(main, size):
+    def _main(loops):
+        # The reactor is started in each worker process the first time a
+        # benchmark is run, and then kept running so that fixtures can be
+        # shared between runs.
+        if not reactor.running:
+            # the postgres template database is created synchronously,
+            # before we start the reactor.
+            setupdb()
+            start_reactor(reactor)
+
+        return run_on_reactor(reactor, main, reactor, loops, size)
+
+    return _main
+
+
+def add_cmdline_args(cmd, args):
+    cmd.extend(["--sizes", args.sizes])
+    if args.log:
+        cmd.append("--log")
+
+
+if __name__ == "__main__":
+    runner = pyperf.Runner(
+        processes=3, min_time=1.5, show_name=True,
+        add_cmdline_args=add_cmdline_args,
+    )
+    runner.argparser.add_argument(
+        "--sizes", default=DEFAULT_SIZES,
+        help="comma-separated list of room sizes for the sized suites "
+             "(default: %(default)s)",
+    )
+    runner.argparser.add_argument(
+        "--log", action="store_true", help="log to stderr from the workers",
+    )
+    runner.parse_args()
+
+    runner.args.inherit_environ = ["SYNAPSE_POSTGRES"]
+
+    if runner.args.log:
+        logging.basicConfig(
+            stream=sys.stderr, level=logging.INFO,
+            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        )
+    else:
+        # otherwise warnings end up on stderr via logging's last resort
+        # handler, which clutters pyperf's output.
+        logging.getLogger().addHandler(logging.NullHandler())
+
+    sizes = [int(s) for s in runner.args.sizes.split(",")]
+
+    for name, main, sized in SUITES:
+        if sized:
+            for size in sizes:
+                runner.bench_time_func(
+                    "%s_%d" % (name, size), make_test(main, size),
+                )
+        else:
+            runner.bench_time_func(name, make_test(main, None))
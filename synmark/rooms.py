@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for quickly populating a homeserver with large synthetic rooms.
+
+Going through the event creation handler costs several database round trips
+per event, which makes building a room with tens of thousands of members
+impractically slow. Instead we build the events directly, track the room state
+ourselves, and persist the events in large batches.
+"""
+
+from twisted.internet import defer
+
+from synapse.api.constants import (
+    EventFormatVersions,
+    EventTypes,
+    JoinRules,
+    Membership,
+    RoomVersions,
+)
+from synapse.events import room_version_to_event_format
+from synapse.events.builder import create_local_event_from_event_dict
+from synapse.events.snapshot import EventContext
+
+# How many events to hand to persist_events at once
+PERSIST_BATCH_SIZE = 100
+
+
+class RoomBuilder(object):
+    """Builds a linear (or, via `fork`, branching) room DAG.
+
+    Events are signed and hashed as if they were created locally, and state
+    groups are stored as a chain of deltas, as the state handler would.
+
+    Args:
+        hs (HomeServer)
+        room_id (str)
+        room_version (str)
+    """
+
+    def __init__(self, hs, room_id, room_version=RoomVersions.V3):
+        self.hs = hs
+        self.store = hs.get_datastore()
+        self.clock = hs.get_clock()
+        self.room_id = room_id
+        self.room_version = room_version
+        self.format_version = room_version_to_event_format(room_version)
+
+        # the state after the latest event in this branch
+        self.state = {}
+        self.state_group = None
+        self.prev_event_ids = []
+        self.depth = 0
+
+        self._to_persist = []
+
+    @defer.inlineCallbacks
+    def fork(self):
+        """Start a new branch of the DAG from the current position.
+
+        Any unpersisted events are persisted first, so that both branches can
+        refer to them.
+
+        Returns:
+            Deferred[RoomBuilder]
+        """
+        yield self.flush()
+
+        branch = RoomBuilder(self.hs, self.room_id, self.room_version)
+        branch.state = self.state
+        branch.state_group = self.state_group
+        branch.prev_event_ids = list(self.prev_event_ids)
+        branch.depth = self.depth
+
+        defer.returnValue(branch)
+
+    @defer.inlineCallbacks
+    def add_event(self, etype, sender, content, state_key=None):
+        """Add an event to the end of this branch.
+
+        The event is persisted at the latest on the next call to `flush`.
+
+        Returns:
+            Deferred[EventBase]
+        """
+        event, context = yield self.build_event(etype, sender, content, state_key)
+
+        if event.is_state():
+            self.state = context.get_cached_current_state_ids()
+            self.state_group = context.state_group
+        self.prev_event_ids = [event.event_id]
+        self.depth += 1
+
+        self._to_persist.append((event, context))
+        if len(self._to_persist) >= PERSIST_BATCH_SIZE:
+            yield self.flush()
+
+        defer.returnValue(event)
+
+    @defer.inlineCallbacks
+    def build_event(self, etype, sender, content, state_key=None):
+        """Build an event which would come next in this branch, without adding
+        it to the room.
+
+        Returns:
+            Deferred[tuple[EventBase, EventContext]]
+        """
+        event_dict = {
+            "type": etype,
+            "room_id": self.room_id,
+            "sender": sender,
+            "content": content,
+            "auth_events": self._auth_event_ids(etype, sender, content, state_key),
+            "prev_events": self.prev_event_ids,
+            "depth": self.depth + 1,
+            "prev_state": [],
+        }
+        if state_key is not None:
+            event_dict["state_key"] = state_key
+
+        event = create_local_event_from_event_dict(
+            clock=self.clock,
+            hostname=self.hs.hostname,
+            signing_key=self.hs.config.signing_key[0],
+            format_version=self.format_version,
+            event_dict=event_dict,
+        )
+
+        prev_state_ids = self.state
+        if event.is_state():
+            current_state_ids = dict(prev_state_ids)
+            current_state_ids[(event.type, event.state_key)] = event.event_id
+
+            prev_group = self.state_group
+            delta_ids = None
+            if prev_group is not None:
+                delta_ids = {(event.type, event.state_key): event.event_id}
+
+            state_group = yield self.store.store_state_group(
+                event.event_id, self.room_id,
+                prev_group=prev_group,
+                delta_ids=delta_ids,
+                current_state_ids=current_state_ids,
+            )
+            context = EventContext.with_state(
+                state_group=state_group,
+                current_state_ids=current_state_ids,
+                prev_state_ids=prev_state_ids,
+                prev_group=prev_group,
+                delta_ids=delta_ids,
+            )
+        else:
+            context = EventContext.with_state(
+                state_group=self.state_group,
+                current_state_ids=prev_state_ids,
+                prev_state_ids=prev_state_ids,
+            )
+
+        defer.returnValue((event, context))
+
+    @defer.inlineCallbacks
+    def flush(self):
+        """Persist any events which have been built but not yet persisted.
+
+        Returns:
+            Deferred
+        """
+        to_persist, self._to_persist = self._to_persist, []
+        if to_persist:
+            yield self.store.persist_events(to_persist)
+
+    def _auth_event_ids(self, etype, sender, content, state_key):
+        # a simplified version of Auth.compute_auth_events, which doesn't
+        # need the auth events to have been persisted yet.
+        if etype == EventTypes.Create:
+            return []
+
+        keys = [
+            (EventTypes.Create, ""),
+            (EventTypes.PowerLevels, ""),
+            (EventTypes.Member, sender),
+        ]
+        if etype == EventTypes.Member:
+            if content["membership"] in (Membership.JOIN, Membership.INVITE):
+                keys.append((EventTypes.JoinRules, ""))
+            if state_key != sender:
+                keys.append((EventTypes.Member, state_key))
+
+        auth_ids = [self.state[key] for key in keys if key in self.state]
+        if self.format_version == EventFormatVersions.V1:
+            # v1 events refer to their auth events by (event_id, hashes), but
+            # we don't check the hashes anywhere we benchmark.
+            auth_ids = [(event_id, {}) for event_id in auth_ids]
+        return auth_ids
+
+
+@defer.inlineCallbacks
+def create_room(hs, room_id, num_members, room_version=RoomVersions.V3):
+    """Create a public room with `num_members` local users joined to it.
+
+    The members are the first `num_members` users returned by `member_ids`. The
+    first of them is the room creator, and has power level 100.
+
+    Args:
+        hs (HomeServer)
+        room_id (str)
+        num_members (int): total number of joined members
+        room_version (str)
+
+    Returns:
+        Deferred[RoomBuilder]: positioned at the end of the room, with all
+        events persisted.
+    """
+    members = member_ids(hs, num_members)
+    creator = members[0]
+
+    yield hs.get_datastore().store_room(room_id, creator, is_public=True)
+
+    builder = RoomBuilder(hs, room_id, room_version)
+
+    yield builder.add_event(
+        EventTypes.Create, creator,
+        {"creator": creator, "room_version": room_version}, state_key="",
+    )
+    yield builder.add_event(
+        EventTypes.Member, creator,
+        {"membership": Membership.JOIN}, state_key=creator,
+    )
+    yield builder.add_event(
+        EventTypes.PowerLevels, creator,
+        {"users": {creator: 100}, "users_default": 0}, state_key="",
+    )
+    yield builder.add_event(
+        EventTypes.JoinRules, creator,
+        {"join_rule": JoinRules.PUBLIC}, state_key="",
+    )
+
+    for user_id in members[1:]:
+        yield builder.add_event(
+            EventTypes.Member, user_id,
+            {"membership": Membership.JOIN}, state_key=user_id,
+        )
+
+    yield builder.flush()
+
+    defer.returnValue(builder)
+
+
+def member_ids(hs, count):
+    """The user IDs of the first `count` synthetic room members"""
+    return ["@user_%d:%s" % (i, hs.hostname) for i in range(count)]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from . import (
+    events_fetch,
+    lrucache,
+    push_eval,
+    replication,
+    state_groups,
+    state_res,
+    sync,
+)
+
+# A list of (name, main, sized) tuples. Each `main(reactor, loops, size)`
+# function returns a Deferred resolving to the time in seconds taken to run
+# `loops` iterations of the benchmark.
+#
+# Suites which are `sized` are run once for each of the configured room sizes
+# (see `--sizes`); for the others `size` is None.
+SUITES = [
+    ("lrucache", lrucache.main, False),
+    ("events_fetch", events_fetch.main, False),
+    ("state_res", state_res.main, True),
+    ("sync", sync.main, True),
+    ("push_eval", push_eval.main, True),
+    ("replication_text", replication.main_text, False),
+    ("replication_binary", replication.main_binary, False),
+    ("state_groups", state_groups.main, False),
+    ("state_groups_walk", state_groups.main_walk, False),
+]
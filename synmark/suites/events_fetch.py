@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from timeit import default_timer
+
+from twisted.internet import defer
+
+from synmark import make_homeserver
+from synmark.rooms import create_room
+
+# The number of events fetched by each iteration
+NUM_EVENTS = 1000
+
+# the fixture is kept between runs within a worker process, as it is expensive
+# to build.
+_fixture = []
+
+
+@defer.inlineCallbacks
+def _get_fixture(reactor):
+    if not _fixture:
+        hs, _ = yield make_homeserver(reactor)
+        room = yield create_room(hs, "!bench:synmark", NUM_EVENTS)
+        state_ids = list(room.state.values())
+        _fixture.append((hs, state_ids))
+
+    defer.returnValue(_fixture[0])
+
+
+@defer.inlineCallbacks
+def main(reactor, loops, size=None):
+    """Time `loops` fetches of a batch of events with a cold event cache.
+
+    This measures `EventsWorkerStore._get_events`: the database lookup, JSON
+    parsing and construction of the event objects.
+    """
+    hs, event_ids = yield _get_fixture(reactor)
+    store = hs.get_datastore()
+
+    elapsed = 0
+    for _ in range(loops):
+        store._get_event_cache.invalidate_all()
+
+        start = default_timer()
+        yield store._get_events(event_ids)
+        elapsed += default_timer() - start
+
+    defer.returnValue(elapsed)
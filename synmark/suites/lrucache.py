@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from timeit import default_timer
+
+from twisted.internet import defer
+
+from synapse.util.caches.lrucache import LruCache
+
+# The number of keys in the working set. The cache is half this size, so that
+# sets exercise the eviction path.
+KEYS = 10000
+
+
+def main(reactor, loops, size=None):
+    """Time `loops` rounds of setting and then getting every key in a working
+    set twice the size of the cache.
+    """
+    cache = LruCache(KEYS // 2)
+    keys = list(range(KEYS))
+
+    start = default_timer()
+
+    for _ in range(loops):
+        for key in keys:
+            cache[key] = key
+        for key in keys:
+            cache.get(key)
+
+    return defer.succeed(default_timer() - start)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from timeit import default_timer
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes
+from synapse.push.bulk_push_rule_evaluator import BulkPushRuleEvaluator
+
+from synmark import make_homeserver
+from synmark.rooms import create_room, member_ids
+
+_fixtures = {}
+
+
+@defer.inlineCallbacks
+def _get_fixture(reactor, size):
+    if size not in _fixtures:
+        hs, _ = yield make_homeserver(reactor)
+        store = hs.get_datastore()
+        room = yield create_room(hs, "!bench:synmark", size)
+
+        # only users with pushers have their push rules evaluated
+        for i, user_id in enumerate(member_ids(hs, size)):
+            yield store.add_pusher(
+                user_id=user_id,
+                access_token=None,
+                kind="http",
+                app_id="m.http",
+                app_display_name="synmark",
+                device_display_name="synmark",
+                pushkey="pushkey_%d" % (i,),
+                pushkey_ts=0,
+                lang=None,
+                data={"url": "https://push.synmark/_matrix/push/v1/notify"},
+                last_stream_ordering=0,
+            )
+
+        sender = member_ids(hs, 1)[0]
+        event, context = yield room.build_event(
+            EventTypes.Message, sender,
+            {"msgtype": "m.text", "body": "Hello @user_1:%s" % (hs.hostname,)},
+        )
+
+        # the evaluator caches the rules for the room, as it would in a
+        # running homeserver.
+        evaluator = BulkPushRuleEvaluator(hs)
+
+        _fixtures[size] = (hs, evaluator, event, context)
+
+    defer.returnValue(_fixtures[size])
+
+
+@defer.inlineCallbacks
+def main(reactor, loops, size):
+    """Time `loops` evaluations of the push rules of every member of a room with
+    `size` members, for a new message in that room.
+    """
+    hs, evaluator, event, context = yield _get_fixture(reactor, size)
+    store = hs.get_datastore()
+
+    elapsed = 0
+    for _ in range(loops):
+        start = default_timer()
+        yield evaluator.action_for_event_by_user(event, context)
+        elapsed += default_timer() - start
+
+        yield store.remove_push_actions_from_staging(event.event_id)
+
+    defer.returnValue(elapsed)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from timeit import default_timer
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from synapse.replication.tcp.protocol import (
+    ClientReplicationStreamProtocol,
+    ServerReplicationStreamProtocol,
+)
+from synapse.util import Clock
+
+# The number of events stream rows sent in each loop.
+ROWS = 1000
+
+
+class _Streamer(object):
+    """Just enough of a ReplicationStreamer for the server to subscribe the
+    client to the events stream.
+    """
+    def new_connection(self, conn):
+        pass
+
+    def lost_connection(self, conn):
+        pass
+
+    def get_stream_updates(self, stream_name, token):
+        return defer.succeed(([], token))
+
+
+class _Handler(object):
+    """A ReplicationClientHandler which counts the rows it receives.
+    """
+    def __init__(self):
+        self.rows = 0
+
+    def get_streams_to_replicate(self):
+        return {"events": 0}
+
+    def get_currently_syncing_users(self):
+        return []
+
+    def update_connection(self, conn):
+        pass
+
+    def on_position(self, stream_name, token):
+        pass
+
+    def on_rdata(self, stream_name, token, rows):
+        self.rows += len(rows)
+
+
+def _pump(src, dest):
+    data = src.transport.value()
+    src.transport.clear()
+    if data:
+        dest.dataReceived(data)
+    return bool(data)
+
+
+def _run(reactor, loops, protocol_mode):
+    clock = Clock(reactor)
+    handler = _Handler()
+
+    server = ServerReplicationStreamProtocol("synmark", clock, _Streamer(), None)
+    client = ClientReplicationStreamProtocol(
+        "synmark", "synmark", clock, handler, protocol_mode=protocol_mode,
+    )
+    server.makeConnection(StringTransport())
+    client.makeConnection(StringTransport())
+
+    # Let the two sides handshake.
+    while _pump(client, server) | _pump(server, client):
+        pass
+
+    updates = [
+        (
+            i + 1,
+            (
+                "$%d:synmark" % (i,), "!bench:synmark", "m.room.message", None,
+                None,
+            ),
+        )
+        for i in range(ROWS)
+    ]
+
+    start = default_timer()
+
+    for i in range(loops):
+        server.stream_updates("events", updates)
+        _pump(server, client)
+
+    elapsed = default_timer() - start
+
+    for conn in (server, client):
+        conn.connectionLost(Failure(ConnectionDone()))
+
+    assert handler.rows == loops * ROWS, handler.rows
+
+    return defer.succeed(elapsed)
+
+
+def main_text(reactor, loops, size=None):
+    """Time `loops` rounds of sending a batch of events stream rows from the
+    server side of a replication connection to the client, with text framing.
+    """
+    return _run(reactor, loops, "text")
+
+
+def main_binary(reactor, loops, size=None):
+    """As main_text, but with binary framing.
+    """
+    return _run(reactor, loops, "binary")
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from timeit import default_timer
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes
+from synapse.storage.engines import PostgresEngine
+from synapse.storage.state import MAX_STATE_DELTA_HOPS, StateFilter
+
+from synmark import make_homeserver
+
+# The number of members in the snapshot at the bottom of the chain.
+MEMBERS = 1000
+
+# The number of state groups, at the end of the chain, read by each iteration.
+NUM_GROUPS = 10
+
+ROOM_ID = "!bench:synmark"
+
+# the fixture is kept between runs within a worker process, as it is expensive
+# to build.
+_fixture = []
+
+
+@defer.inlineCallbacks
+def _get_fixture(reactor):
+    if not _fixture:
+        hs, _ = yield make_homeserver(reactor)
+        store = hs.get_datastore()
+
+        # A snapshot followed by as long a chain of deltas as store_state_group
+        # will make, each of which changes one member.
+        state = {
+            (EventTypes.Member, "@user%i:synmark" % (i,)): "$join%i:synmark" % (i,)
+            for i in range(MEMBERS)
+        }
+        prev_group = yield store.store_state_group(
+            "$join:synmark", ROOM_ID, None, None, state,
+        )
+        groups = [prev_group]
+        for i in range(MAX_STATE_DELTA_HOPS - 1):
+            delta = {
+                (EventTypes.Member, "@user%i:synmark" % (i,)):
+                    "$leave%i:synmark" % (i,),
+            }
+            state.update(delta)
+            prev_group = yield store.store_state_group(
+                "$leave%i:synmark" % (i,), ROOM_ID, prev_group, delta, state,
+            )
+            groups.append(prev_group)
+
+        _fixture.append((hs, groups[-NUM_GROUPS:]))
+
+    defer.returnValue(_fixture[0])
+
+
+@defer.inlineCallbacks
+def _run(reactor, loops, walk):
+    hs, groups = yield _get_fixture(reactor)
+    store = hs.get_datastore()
+    engine = store.database_engine
+
+    if not isinstance(engine, PostgresEngine):
+        supports_recursive_cte = engine.supports_recursive_cte
+        engine.supports_recursive_cte = supports_recursive_cte and not walk
+
+    try:
+        elapsed = 0
+        for _ in range(loops):
+            start = default_timer()
+            yield store._get_state_groups_from_groups(groups, StateFilter.all())
+            elapsed += default_timer() - start
+    finally:
+        if not isinstance(engine, PostgresEngine):
+            engine.supports_recursive_cte = supports_recursive_cte
+
+    defer.returnValue(elapsed)
+
+
+def main(reactor, loops, size=None):
+    """Time `loops` reads, from the database, of the state at the end of a long
+    chain of state group deltas, using the engine's usual query.
+
+    This measures `StateGroupWorkerStore._get_state_groups_from_groups_txn`.
+    """
+    return _run(reactor, loops, walk=False)
+
+
+def main_walk(reactor, loops, size=None):
+    """As `main`, but on SQLite walk the chain a hop at a time rather than
+    using a recursive query.
+    """
+    return _run(reactor, loops, walk=True)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from timeit import default_timer
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership, RoomVersions
+from synapse.state import StateResolutionStore
+from synapse.state.v2 import resolve_events_with_store
+
+from synmark import make_homeserver
+from synmark.rooms import create_room, member_ids
+
+# The number of events on each side of the fork
+FORK_LENGTH = 20
+
+_fixtures = {}
+
+
+@defer.inlineCallbacks
+def _get_fixture(reactor, size):
+    if size not in _fixtures:
+        hs, _ = yield make_homeserver(reactor)
+        room = yield create_room(hs, "!bench:synmark", size)
+        members = member_ids(hs, size)
+        creator = members[0]
+
+        # On one side of the fork the creator changes the power levels and
+        # kicks some users, while on the other the creator changes the topic
+        # and those users change their displaynames.
+        kicker = yield room.fork()
+        yield kicker.add_event(
+            EventTypes.PowerLevels, creator,
+            {"users": {creator: 100, members[1]: 50}, "users_default": 0},
+            state_key="",
+        )
+        for user_id in members[2:FORK_LENGTH + 1]:
+            yield kicker.add_event(
+                EventTypes.Member, creator,
+                {"membership": Membership.LEAVE}, state_key=user_id,
+            )
+        yield kicker.flush()
+
+        chatter = yield room.fork()
+        yield chatter.add_event(
+            EventTypes.Topic, creator, {"topic": "forked"}, state_key="",
+        )
+        for user_id in members[2:FORK_LENGTH + 1]:
+            yield chatter.add_event(
+                EventTypes.Member, user_id,
+                {"membership": Membership.JOIN, "displayname": "renamed"},
+                state_key=user_id,
+            )
+        yield chatter.flush()
+
+        _fixtures[size] = (hs, [kicker.state, chatter.state])
+
+    defer.returnValue(_fixtures[size])
+
+
+@defer.inlineCallbacks
+def main(reactor, loops, size):
+    """Time `loops` resolutions of a fork in a room with `size` members, using
+    the v2 state resolution algorithm.
+    """
+    hs, state_sets = yield _get_fixture(reactor, size)
+    state_res_store = StateResolutionStore(hs.get_datastore())
+
+    start = default_timer()
+
+    for _ in range(loops):
+        yield resolve_events_with_store(
+            RoomVersions.V3, state_sets, None, state_res_store,
+        )
+
+    defer.returnValue(default_timer() - start)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from timeit import default_timer
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes
+from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
+from synapse.handlers.sync import SyncConfig
+from synapse.types import UserID
+
+from synmark import make_homeserver
+from synmark.rooms import create_room, member_ids
+
+# The number of messages sent after everyone has joined
+NUM_MESSAGES = 20
+
+_fixtures = {}
+
+
+@defer.inlineCallbacks
+def _get_fixture(reactor, size):
+    if size not in _fixtures:
+        hs, _ = yield make_homeserver(reactor)
+        room = yield create_room(hs, "!bench:synmark", size)
+
+        senders = member_ids(hs, NUM_MESSAGES)
+        for i, sender in enumerate(senders):
+            yield room.add_event(
+                EventTypes.Message, sender, {"msgtype": "m.text", "body": str(i)},
+            )
+        yield room.flush()
+
+        _fixtures[size] = (hs, senders[-1])
+
+    defer.returnValue(_fixtures[size])
+
+
+@defer.inlineCallbacks
+def main(reactor, loops, size):
+    """Time `loops` initial syncs for a user in a room with `size` members."""
+    hs, user_id = yield _get_fixture(reactor, size)
+    sync_handler = hs.get_sync_handler()
+
+    sync_config = SyncConfig(
+        user=UserID.from_string(user_id),
+        filter_collection=DEFAULT_FILTER_COLLECTION,
+        is_guest=False,
+        request_key=None,
+        device_id="SYNMARK",
+    )
+
+    start = default_timer()
+
+    for _ in range(loops):
+        yield sync_handler.generate_sync_result(sync_config)
+
+    defer.returnValue(default_timer() - start)
@@ -14,7 +14,7 @@
 # limitations under the License.
 import time
 
-from mock import Mock
+from mock import Mock, patch
 
 import signedjson.key
 import signedjson.sign
@@ -223,3 +223,57 @@ class KeyringTestCase(unittest.TestCase):
             yield defer
 
             self.assertIs(LoggingContext.current_context(), context_one)
+
+    @defer.inlineCallbacks
+    def test_verify_json_objects_for_server_shares_checks(self):
+        kr = keyring.Keyring(self.hs)
+
+        key1 = signedjson.key.generate_signing_key(1)
+        yield self.hs.datastore.store_server_verify_key(
+            "server9", "", time.time() * 1000, signedjson.key.get_verify_key(key1)
+        )
+        json1 = {"a": 1}
+        signedjson.sign.sign_json(json1, "server9", key1)
+        json2 = {"a": 2}
+        signedjson.sign.sign_json(json2, "server9", key1)
+
+        with patch.object(
+            keyring, "verify_signed_json", side_effect=keyring.verify_signed_json,
+        ) as verify_signed_json:
+            # identical objects are only checked once
+            yield defer.gatherResults(kr.verify_json_objects_for_server(
+                [("server9", json1), ("server9", dict(json1)), ("server9", json2)]
+            ))
+            self.assertEqual(verify_signed_json.call_count, 2)
+
+            # and successful checks aren't done again
+            verify_signed_json.reset_mock()
+            yield kr.verify_json_for_server("server9", json1)
+            verify_signed_json.assert_not_called()
+
+            # but a different object with the same signature is still checked
+            json3 = dict(json1, a=3)
+            try:
+                yield kr.verify_json_for_server("server9", json3)
+                self.fail("should fail on a copied signature")
+            except SynapseError as e:
+                self.assertEqual(e.code, 401)
+            verify_signed_json.assert_called_once()
+
+    @defer.inlineCallbacks
+    def test_verify_json_for_server_bad_signature(self):
+        kr = keyring.Keyring(self.hs)
+
+        key1 = signedjson.key.generate_signing_key(1)
+        yield self.hs.datastore.store_server_verify_key(
+            "server9", "", time.time() * 1000, signedjson.key.get_verify_key(key1)
+        )
+        json1 = {"a": 1}
+        signedjson.sign.sign_json(json1, "server9", key1)
+        json1["a"] = 2
+
+        try:
+            yield kr.verify_json_for_server("server9", json1)
+            self.fail("should fail on a bad signature")
+        except SynapseError as e:
+            self.assertEqual(e.code, 401)
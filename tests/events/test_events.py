@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+
+from canonicaljson import json
+
+from synapse.events import FrozenEvent, FrozenEventV2, _EventInternalMetadata
+from synapse.util.encodedjson import encode_json
+
+from .. import unittest
+
+
+class FrozenEventTestCase(unittest.TestCase):
+    def test_fields(self):
+        event = FrozenEvent({
+            "event_id": "$test:domain",
+            "type": "m.room.member",
+            "state_key": "@user:domain",
+            "room_id": "!room:domain",
+            "sender": "@user:domain",
+            "content": {"membership": "join"},
+            "auth_events": [["$create:domain", {"sha256": "abc"}]],
+            "prev_events": [],
+            "signatures": {"domain": {"ed25519:1": "sig"}},
+            "unsigned": {"age_ts": 1000},
+            "custom": "value",
+        })
+
+        self.assertEqual(event.event_id, "$test:domain")
+        self.assertEqual(event.type, "m.room.member")
+        self.assertEqual(event.user_id, "@user:domain")
+        self.assertEqual(event.membership, "join")
+        self.assertEqual(event.auth_event_ids(), ["$create:domain"])
+        self.assertTrue(event.is_state())
+
+        # fields which aren't set behave as they would on a dict
+        self.assertFalse(hasattr(event, "redacts"))
+        self.assertNotIn("redacts", event)
+        self.assertIsNone(event.get("redacts"))
+        self.assertRaises(KeyError, lambda: event["redacts"])
+
+        # as do ones that we don't know about
+        self.assertIn("custom", event)
+        self.assertEqual(event["custom"], "value")
+        self.assertEqual(event.get("custom"), "value")
+
+        # signatures and unsigned aren't part of the event dict
+        self.assertNotIn("signatures", event)
+        self.assertIsNone(event.get("unsigned"))
+
+        self.assertEqual(
+            event.get_dict(),
+            {
+                "event_id": "$test:domain",
+                "type": "m.room.member",
+                "state_key": "@user:domain",
+                "room_id": "!room:domain",
+                "sender": "@user:domain",
+                "content": {"membership": "join"},
+                "auth_events": [["$create:domain", {"sha256": "abc"}]],
+                "prev_events": [],
+                "signatures": {"domain": {"ed25519:1": "sig"}},
+                "unsigned": {"age_ts": 1000},
+                "custom": "value",
+            },
+        )
+
+    def test_not_state(self):
+        event = FrozenEvent({"event_id": "$test:domain", "type": "m.room.message"})
+
+        self.assertFalse(event.is_state())
+        self.assertFalse(hasattr(event, "state_key"))
+        self.assertEqual(
+            sorted(event.keys()), ["event_id", "type"],
+        )
+
+    def test_event_id_v2(self):
+        event = FrozenEventV2({
+            "type": "m.room.message",
+            "room_id": "!room:domain",
+            "sender": "@user:domain",
+            "content": {},
+            "auth_events": [],
+            "prev_events": [],
+            "depth": 1,
+        })
+
+        self.assertTrue(event.event_id.startswith("$"))
+
+        # the event ID isn't part of a v2 event
+        self.assertNotIn("event_id", event)
+        self.assertNotIn("event_id", event.get_dict())
+
+    def test_encoded_pdu_json(self):
+        event = FrozenEvent({
+            "event_id": "$test:domain",
+            "type": "m.room.message",
+            "content": {"body": "Hi!"},
+            "signatures": {"domain": {"ed25519:1": "sig"}},
+            "unsigned": {"age_ts": 1000},
+        })
+
+        encoded = event.get_encoded_pdu_json(time_now=1500)
+        self.assertEqual(json.loads(encode_json(encoded)), event.get_pdu_json(1500))
+        self.assertEqual(encoded.fields["unsigned"], {"age": 500})
+
+        # the encoding of the event's fields is reused
+        self.assertIs(event.get_encoded_pdu_json().encoded, encoded.encoded)
+
+    def test_copy(self):
+        event = FrozenEvent(
+            {"event_id": "$test:domain", "type": "m.room.message"},
+            internal_metadata_dict={"outlier": True},
+        )
+
+        copied = copy.copy(event)
+        self.assertEqual(copied.get_dict(), event.get_dict())
+        self.assertTrue(copied.internal_metadata.is_outlier())
+
+
+class EventInternalMetadataTestCase(unittest.TestCase):
+    def test_known_fields(self):
+        metadata = _EventInternalMetadata({"outlier": True})
+
+        self.assertTrue(metadata.is_outlier())
+        self.assertFalse(metadata.is_out_of_band_membership())
+        self.assertFalse(hasattr(metadata, "stream_ordering"))
+
+        metadata.stream_ordering = 5
+        self.assertEqual(metadata.get_dict(), {"outlier": True, "stream_ordering": 5})
+
+    def test_unknown_fields(self):
+        metadata = _EventInternalMetadata({"something_new": 1})
+
+        self.assertEqual(metadata.something_new, 1)
+        self.assertFalse(hasattr(metadata, "something_else"))
+
+        metadata.something_else = 2
+        self.assertEqual(
+            metadata.get_dict(), {"something_new": 1, "something_else": 2},
+        )
+
+        copied = copy.deepcopy(metadata)
+        self.assertEqual(copied.get_dict(), metadata.get_dict())
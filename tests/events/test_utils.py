@@ -14,8 +14,17 @@
 # limitations under the License.
 
 
-from synapse.events import FrozenEvent
-from synapse.events.utils import prune_event, serialize_event
+from canonicaljson import json
+
+from synapse.events import FrozenEvent, FrozenEventV2
+from synapse.events.utils import (
+    format_event_for_client_v2,
+    format_event_raw,
+    prune_event,
+    serialize_event,
+    serialize_event_json,
+)
+from synapse.util.encodedjson import encode_json
 
 from .. import unittest
 
@@ -241,3 +250,82 @@ class SerializeEventTestCase(unittest.TestCase):
             self.serialize(
                 MockEvent(room_id="!foo:bar", content={"foo": "bar"}), ["room_id", 4]
             )
+
+
+class SerializeEventJsonTestCase(unittest.TestCase):
+    """serialize_event_json gives the same results as serialize_event"""
+
+    def assert_same(self, event, **kwargs):
+        expected = serialize_event(event, 1479807801915, **kwargs)
+        encoded = serialize_event_json(event, 1479807801915, **kwargs)
+        self.assertEqual(json.loads(encode_json(encoded)), expected)
+        return encoded
+
+    def _event(self, **kwargs):
+        event_dict = {
+            "type": "m.room.message",
+            "event_id": "$test:domain",
+            "room_id": "!room:domain",
+            "sender": "@user:domain",
+            "content": {"body": "Hi!"},
+            "signatures": {"domain": {"ed25519:1": "sig"}},
+            "unsigned": {"age_ts": 1479807800000},
+        }
+        event_dict.update(kwargs)
+        return FrozenEvent(event_dict, internal_metadata_dict={
+            "token_id": 1, "txn_id": "txn",
+        })
+
+    def test_formats(self):
+        event = self._event(prev_content={"body": "Hello"})
+        self.assert_same(event)
+        self.assert_same(event, event_format=format_event_for_client_v2)
+        self.assert_same(event, as_client_event=False)
+        self.assert_same(event, event_format=format_event_raw)
+        self.assert_same(event, token_id=1)
+
+    def test_v1_unsigned_fields(self):
+        event = self._event(unsigned={
+            "age_ts": 1479807800000,
+            "prev_content": {"body": "Hello"},
+            "invite_room_state": [],
+        })
+        self.assert_same(event)
+        self.assert_same(event, is_invite=True)
+
+        # fields copied from unsigned by the v1 format trump the event's own
+        event = self._event(age=5)
+        self.assertIsInstance(self.assert_same(event), dict)
+
+    def test_redacted(self):
+        redaction = self._event(
+            type="m.room.redaction", event_id="$redaction:domain",
+        )
+        event = self._event(content={})
+        event.unsigned["redacted_because"] = redaction
+
+        self.assert_same(event)
+        self.assert_same(event, event_format=format_event_for_client_v2)
+
+    def test_v2_event(self):
+        event = FrozenEventV2({
+            "type": "m.room.message",
+            "room_id": "!room:domain",
+            "sender": "@user:domain",
+            "content": {"body": "Hi!"},
+            "auth_events": [],
+            "prev_events": [],
+            "depth": 1,
+        })
+        self.assert_same(event)
+        self.assert_same(event, as_client_event=False)
+
+    def test_cached(self):
+        """The encoding of the event is cached, but the unsigned section isn't"""
+        event = self._event()
+        first = serialize_event_json(event, 1479807801915)
+        second = serialize_event_json(event, 1479807802915)
+
+        self.assertIs(first.encoded, second.encoded)
+        self.assertEqual(first.fields["unsigned"]["age"], 1915)
+        self.assertEqual(second.fields["unsigned"]["age"], 2915)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.api.errors import HttpResponseException
+from synapse.events import FrozenEvent
+from synapse.federation.transaction_queue import (
+    MAX_PDUS_PER_TRANSACTION,
+    MIN_PDUS_PER_TRANSACTION,
+    TARGET_TRANSACTION_TIME_MS,
+    TransactionQueue,
+    _TransactionBatchSizer,
+)
+from synapse.rest.client.v1 import room
+from synapse.util.logcontext import make_deferred_yieldable
+
+from tests import unittest
+
+
+def make_pdu(event_id, room_id, stream_ordering):
+    return FrozenEvent({
+        "event_id": event_id,
+        "room_id": room_id,
+        "type": "m.room.message",
+        "sender": "@user:server",
+        "content": {},
+        "depth": 1,
+        "prev_events": [],
+        "auth_events": [],
+        "origin_server_ts": 0,
+        "signatures": {},
+        "unsigned": {},
+    }, internal_metadata_dict={"stream_ordering": stream_ordering})
+
+
+class TransactionQueueTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.federation_transactions_in_flight_per_destination = 2
+        config.federation_max_pending_pdus_per_destination = 3
+        config.federation_max_pending_edus_per_destination = 2
+        return self.setup_test_homeserver("server", config=config, http_client=None)
+
+    def prepare(self, reactor, clock, hs):
+        self.queue = TransactionQueue(hs)
+
+        # list of (event ids in the transaction, deferred to complete it)
+        self.sent = []
+
+        def send_transaction(transaction, json_data_cb):
+            d = defer.Deferred()
+            self.sent.append(([p["event_id"] for p in transaction.pdus], d))
+            return make_deferred_yieldable(d)
+
+        self.queue.transport_layer = Mock()
+        self.queue.transport_layer.send_transaction.side_effect = send_transaction
+
+    def _sent_event_ids(self):
+        return [event_ids for event_ids, _ in self.sent]
+
+    def test_pipelined_transactions(self):
+        self.queue._send_pdu(make_pdu("$1:server", "!a:server", 1), ["remote"])
+        self.pump()
+        self.assertEqual(self._sent_event_ids(), [["$1:server"]])
+
+        # a PDU in another room can be sent while the first transaction is in
+        # flight, but one in the same room has to wait for it.
+        self.queue._send_pdu(make_pdu("$2:server", "!a:server", 2), ["remote"])
+        self.queue._send_pdu(make_pdu("$3:server", "!b:server", 3), ["remote"])
+        self.pump()
+        self.assertEqual(
+            self._sent_event_ids(), [["$1:server"], ["$3:server"]],
+        )
+
+        self.sent[0][1].callback({})
+        self.pump()
+        self.assertEqual(
+            self._sent_event_ids(), [["$1:server"], ["$3:server"], ["$2:server"]],
+        )
+
+        self.sent[1][1].callback({})
+        self.sent[2][1].callback({})
+        self.pump()
+        self.assertEqual(self.queue.pending_transactions, {})
+        self.assertEqual(self.queue._rooms_in_flight_by_dest, {})
+
+    def test_limit_transactions_in_flight(self):
+        for i in range(3):
+            self.queue._send_pdu(
+                make_pdu("$%d:server" % (i,), "!%d:server" % (i,), i), ["remote"],
+            )
+            self.pump()
+
+        # only two transactions are sent at once
+        self.assertEqual(
+            self._sent_event_ids(), [["$0:server"], ["$1:server"]],
+        )
+
+        self.sent[1][1].callback({})
+        self.pump()
+        self.assertEqual(
+            self._sent_event_ids(), [["$0:server"], ["$1:server"], ["$2:server"]],
+        )
+
+    def test_last_successful_stream_ordering(self):
+        store = self.hs.get_datastore()
+
+        def get_position():
+            return self.get_success(
+                store.get_destination_last_successful_stream_ordering("remote")
+            )
+
+        self.queue._send_pdu(make_pdu("$1:server", "!a:server", 1), ["remote"])
+        self.pump()
+        self.queue._send_pdu(make_pdu("$2:server", "!b:server", 2), ["remote"])
+        self.queue._send_pdu(make_pdu("$3:server", "!a:server", 3), ["remote"])
+        self.pump()
+        self.assertEqual(self._sent_event_ids(), [["$1:server"], ["$2:server"]])
+
+        # the second transaction completing doesn't mean the destination has
+        # had the first event, which is still in flight
+        self.sent[1][1].callback({})
+        self.pump()
+        self.assertEqual(get_position(), 0)
+
+        # nor does the first one completing mean it has had the third, which
+        # was queued behind it
+        self.sent[0][1].callback({})
+        self.pump()
+        self.assertEqual(get_position(), 1)
+
+        self.assertEqual(self._sent_event_ids()[2], ["$3:server"])
+        self.sent[2][1].callback({})
+        self.pump()
+        self.assertEqual(get_position(), 3)
+        self.assertEqual(self.queue._stream_orderings_in_flight_by_dest, {})
+
+    def test_pdu_queue_limit(self):
+        self.queue._send_pdu(make_pdu("$0:server", "!a:server", 0), ["remote"])
+        self.pump()
+
+        # the PDUs are queued behind the one in flight until there are too many,
+        # when we catch up instead.
+        for i in range(1, 4):
+            self.queue._send_pdu(
+                make_pdu("$%d:server" % (i,), "!a:server", i), ["remote"],
+            )
+        self.assertEqual(len(self.queue.pending_pdus_by_dest["remote"]), 3)
+        self.assertNotIn("remote", self.queue._catching_up_dests)
+
+        self.queue._send_pdu(make_pdu("$4:server", "!a:server", 4), ["remote"])
+        self.assertNotIn("remote", self.queue.pending_pdus_by_dest)
+        self.assertIn("remote", self.queue._catching_up_dests)
+
+    def test_edu_queue_limit(self):
+        self.queue._send_pdu(make_pdu("$0:server", "!a:server", 0), ["remote"])
+        self.pump()
+
+        for key in ("a", "b", "c", "b"):
+            self.queue.send_edu("remote", "m.typing", {}, key=key)
+        for i in range(3):
+            self.queue.send_edu("remote", "m.presence_invite", {"i": i})
+
+        # the oldest EDUs are dropped
+        self.assertEqual(
+            list(self.queue.pending_edus_keyed_by_dest["remote"]),
+            [("m.typing", "c"), ("m.typing", "b")],
+        )
+        self.assertEqual(
+            [edu.content for edu in self.queue.pending_edus_by_dest["remote"]],
+            [{"i": 1}, {"i": 2}],
+        )
+        self.assertEqual(self.queue._get_largest_queues(), {("remote",): 4})
+
+
+class CatchUpTestCase(unittest.HomeserverTestCase):
+    user_id = "@user:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver("server", http_client=None)
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.queue = TransactionQueue(hs)
+        self.queue._loaded_catching_up_dests = True
+
+        self.sent = []
+        self.remote_up = False
+
+        def send_transaction(transaction, json_data_cb):
+            self.sent.append([p["event_id"] for p in transaction.pdus])
+            if not self.remote_up:
+                return defer.fail(HttpResponseException(500, "Error", b""))
+            return defer.succeed({})
+
+        self.queue.transport_layer = Mock()
+        self.queue.transport_layer.send_transaction.side_effect = send_transaction
+
+        self.room_id = self.helper.create_room_as(self.user_id)
+        self.stream_ordering = self.store.get_room_max_stream_ordering()
+
+    def _send_events(self, count):
+        """Sends some events in the room, and queues them for sending to
+        "remote" as the federation sender would.
+        """
+        for i in range(count):
+            self.helper.send(self.room_id, body="test")
+
+        start = self.stream_ordering
+        self.stream_ordering = self.store.get_room_max_stream_ordering()
+        _, events = self.get_success(
+            self.store.get_all_new_events_stream(start, self.stream_ordering, 100)
+        )
+        for event in events:
+            self.get_success(self.store.store_destination_rooms_entries(
+                ["remote"], event.room_id, event.internal_metadata.stream_ordering,
+            ))
+        for event in events:
+            self.queue._send_pdu(event, ["remote"])
+        self.pump()
+
+        return events
+
+    def test_catch_up(self):
+        events = self._send_events(1)
+        self.assertEqual(self.sent, [[events[0].event_id]])
+
+        # the failed event is dropped from memory, and we'll catch up instead
+        self.assertIn("remote", self.queue._catching_up_dests)
+        self.assertEqual(self.queue.pending_pdus_by_dest, {})
+        self.assertEqual(
+            self.get_success(self.store.get_destinations_needing_catch_up()),
+            ["remote"],
+        )
+
+        # once the remote is back, it is only sent the latest event in the room
+        self.remote_up = True
+        events = self._send_events(3)
+        self.assertEqual(self.sent[1:], [[events[-1].event_id]])
+
+        self.assertNotIn("remote", self.queue._catching_up_dests)
+        self.assertEqual(
+            self.get_success(self.store.get_destinations_needing_catch_up()), [],
+        )
+
+        # and then later events are sent as normal
+        events = self._send_events(2)
+        self.assertEqual(
+            self.sent[2:], [[events[0].event_id, events[1].event_id]],
+        )
+
+
+class TransactionBatchSizerTestCase(unittest.TestCase):
+    def test_batch_size(self):
+        batch_sizer = _TransactionBatchSizer()
+        self.assertEqual(batch_sizer.pdus_per_transaction, MAX_PDUS_PER_TRANSACTION)
+
+        # slow responses make the transactions smaller...
+        for _ in range(10):
+            batch_sizer.record_response_time(TARGET_TRANSACTION_TIME_MS * 2)
+        self.assertEqual(batch_sizer.pdus_per_transaction, MIN_PDUS_PER_TRANSACTION)
+
+        # ... and fast ones make them bigger again.
+        for _ in range(20):
+            batch_sizer.record_response_time(TARGET_TRANSACTION_TIME_MS / 10)
+        self.assertEqual(batch_sizer.pdus_per_transaction, MAX_PDUS_PER_TRANSACTION)
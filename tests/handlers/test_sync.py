@@ -17,6 +17,8 @@ from twisted.internet import defer
 from synapse.api.errors import Codes, ResourceLimitError
 from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
 from synapse.handlers.sync import SyncConfig, SyncHandler
+from synapse.rest import admin
+from synapse.rest.client.v1 import login, room
 from synapse.types import UserID
 
 import tests.unittest
@@ -69,3 +71,93 @@ class SyncTestCase(tests.unittest.TestCase):
             request_key="request_key",
             device_id="device_id",
         )
+
+
+class SyncResultCacheTestCase(tests.unittest.HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.sync_handler = hs.get_sync_handler()
+        self.store = hs.get_datastore()
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        self.room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        self.other_user_id = self.register_user("other", "pass")
+        self.other_tok = self.login("other", "pass")
+
+        self.sync_config = SyncConfig(
+            user=UserID.from_string(self.user_id),
+            filter_collection=DEFAULT_FILTER_COLLECTION,
+            is_guest=False,
+            request_key="request_key",
+            device_id="device_id",
+        )
+
+    def _send_in_other_room(self):
+        room_id = self.helper.create_room_as(self.other_user_id, tok=self.other_tok)
+        self.helper.send(room_id, body="Hello?", tok=self.other_tok)
+
+    def _sync(self, since_token=None):
+        return self.get_success(
+            self.sync_handler.wait_for_sync_for_user(self.sync_config, since_token)
+        )
+
+    def test_repeated_sync(self):
+        """Repeating a sync request gets the same result, unless there is
+        something new for the user
+        """
+        since_token = self._sync().next_batch
+        self.helper.send(self.room_id, body="Hi!", tok=self.tok)
+
+        result = self._sync(since_token)
+        self.assertEqual(len(result.joined[0].timeline.events), 1)
+        self.assertIs(self._sync(since_token), result)
+
+        # activity in other rooms doesn't matter
+        self._send_in_other_room()
+        self.assertIs(self._sync(since_token), result)
+
+        # but new events in the user's rooms do
+        self.helper.send(self.room_id, body="There!", tok=self.tok)
+        new_result = self._sync(since_token)
+        self.assertIsNot(new_result, result)
+        self.assertEqual(len(new_result.joined[0].timeline.events), 2)
+
+        # as do changes to their account data
+        self.get_success(self.store.add_account_data_for_user(
+            self.user_id, "test.type", {"a": 1},
+        ))
+        self.assertIsNot(self._sync(since_token), new_result)
+
+    def test_shared_room_timeline(self):
+        """Syncs of a room from the same point share the database lookup, even
+        if they are for different positions in the stream
+        """
+        since_token = self._sync().next_batch
+        self.helper.send(self.room_id, body="Hi!", tok=self.tok)
+
+        lookups = self.store._get_room_event_rows_for_range.cache.cache
+        lookups.clear()
+
+        self._sync(since_token)
+        self.assertEqual(len(lookups), 1)
+
+        # something happens elsewhere, so the stream position moves on
+        self._send_in_other_room()
+
+        # sync asks for one more event than the timeline limit, to see if the
+        # timeline is limited
+        events, _ = self.get_success(self.store.get_room_events_stream_for_room(
+            self.room_id,
+            since_token.room_key,
+            "s%d" % (self.store.get_room_max_stream_ordering(),),
+            limit=DEFAULT_FILTER_COLLECTION.timeline_limit() + 1,
+        ))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(len(lookups), 1)
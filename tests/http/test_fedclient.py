@@ -329,3 +329,38 @@ class FederationClientTests(HomeserverTestCase):
         self.pump(120)
 
         self.assertTrue(conn.disconnecting)
+
+    def test_reuses_connection(self):
+        """Check that later requests to the same server reuse the connection"""
+        d = self.cl.get_json("testserv:8008", "foo/bar")
+
+        self.pump()
+
+        clients = self.reactor.tcpClients
+        self.assertEqual(len(clients), 1)
+        (_host, _port, factory, _timeout, _bindAddress) = clients[0]
+
+        client = factory.buildProtocol(None)
+        conn = StringTransport()
+        client.makeConnection(conn)
+
+        response = (
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Content-Length: 2\r\n"
+            b"\r\n"
+            b"{}"
+        )
+        client.dataReceived(response)
+        self.assertEqual(self.successResultOf(d), {})
+
+        # the second request should be sent over the same connection
+        conn.clear()
+        d = self.cl.get_json("testserv:8008", "foo/baz")
+        self.pump()
+
+        self.assertEqual(len(clients), 1)
+        self.assertRegex(conn.value(), b"^GET /foo/baz")
+
+        client.dataReceived(response)
+        self.assertEqual(self.successResultOf(d), {})
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.events import FrozenEvent
+from synapse.push.baserules import list_with_base_rules
+from synapse.push.bulk_push_rule_evaluator import _actions_for_users
+from synapse.push.push_rule_evaluator import PushRuleEvaluatorForEvent
+
+from tests import unittest
+
+DISPLAY_NAMES = {"@alice:test": "Alice", "@bob:test": "Robert"}
+
+
+class ActionsForUsersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event = FrozenEvent({
+            "event_id": "$event:test",
+            "type": "m.room.message",
+            "room_id": "!room:test",
+            "sender": "@sender:test",
+            "content": {"msgtype": "m.text", "body": "Hi Alice and bob!"},
+        })
+        self.evaluator = PushRuleEvaluatorForEvent(self.event, 5, 0, {})
+
+        # count how often we check each condition
+        self.checks = []
+        matches = self.evaluator.matches
+
+        def counting_matches(condition, user_id, display_name):
+            self.checks.append((condition.get("_id"), user_id))
+            return matches(condition, user_id, display_name)
+
+        self.evaluator.matches = counting_matches
+
+    def test_matches_individual_evaluation(self):
+        """Evaluating rules for a group of users gives the same result as
+        evaluating them for each user
+        """
+        default_rules = list_with_base_rules([])
+
+        # a user who has disabled notifications for messages
+        quiet_rules = list_with_base_rules([])
+        for i, rule in enumerate(quiet_rules):
+            if rule["rule_id"] == "global/underride/.m.rule.message":
+                quiet_rules[i] = dict(rule, enabled=False)
+
+        # a user with a keyword rule
+        keyword_rules = list_with_base_rules([{
+            "rule_id": "hi",
+            "priority_class": 2,
+            "conditions": [
+                {"kind": "event_match", "key": "content.body", "pattern": "hi"},
+            ],
+            "actions": ["notify", {"set_tweak": "sound", "value": "default"}],
+        }])
+
+        rules_by_user = {
+            "@alice:test": default_rules,
+            "@bob:test": default_rules,
+            "@carol:test": default_rules,
+            "@dave:test": quiet_rules,
+            "@eve:test": keyword_rules,
+        }
+
+        expected = {}
+        for uid, rules in rules_by_user.items():
+            for rule in rules:
+                if not rule.get("enabled", True):
+                    continue
+                if all(
+                    self.evaluator.matches(cond, uid, DISPLAY_NAMES.get(uid))
+                    for cond in rule["conditions"]
+                ):
+                    if "notify" in rule["actions"]:
+                        expected[uid] = rule["actions"]
+                    break
+
+        # alice is mentioned by display name, and bob by user name
+        self.assertEqual(
+            sorted(expected), ["@alice:test", "@bob:test", "@carol:test", "@eve:test"],
+        )
+        self.assertNotEqual(expected["@alice:test"], expected["@carol:test"])
+        self.assertNotEqual(expected["@bob:test"], expected["@carol:test"])
+        self.assertNotEqual(expected["@eve:test"], expected["@carol:test"])
+
+        cache = {}
+        result = _actions_for_users(
+            self.evaluator, default_rules,
+            ["@alice:test", "@bob:test", "@carol:test"],
+            DISPLAY_NAMES.get, cache,
+        )
+        result.update(_actions_for_users(
+            self.evaluator, quiet_rules, ["@dave:test"], DISPLAY_NAMES.get, cache,
+        ))
+        result.update(_actions_for_users(
+            self.evaluator, keyword_rules, ["@eve:test"], DISPLAY_NAMES.get, cache,
+        ))
+        self.assertEqual(result, expected)
+
+    def test_conditions_checked_once(self):
+        """Conditions which don't depend on the user are only checked once"""
+        rules = list_with_base_rules([])
+        user_ids = ["@user%d:test" % (i,) for i in range(100)]
+
+        result = _actions_for_users(
+            self.evaluator, rules, user_ids, DISPLAY_NAMES.get, {},
+        )
+        self.assertEqual(sorted(result), sorted(user_ids))
+
+        shared_checks = [c for c in self.checks if c[1] is None]
+        self.assertEqual(len(shared_checks), len(set(shared_checks)))
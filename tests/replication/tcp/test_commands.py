@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.replication.tcp.commands import (
+    PositionCommand,
+    ProtocolCommand,
+    RdataBatchCommand,
+    RdataCommand,
+)
+
+from tests import unittest
+
+
+class CommandsTestCase(unittest.TestCase):
+    def test_rdata_batch_line(self):
+        cmd = RdataBatchCommand("caches", [
+            (None, ("get_user_by_id", ["@a:test"], 1000)),
+            (5, ("get_user_by_id", ["@b:test"], 1000)),
+        ])
+        self.assertEqual(
+            cmd.to_line(),
+            'caches [[null, ["get_user_by_id", ["@a:test"], 1000]], '
+            '[5, ["get_user_by_id", ["@b:test"], 1000]]]',
+        )
+
+        parsed = RdataBatchCommand.from_line(cmd.to_line())
+        self.assertEqual(parsed.stream_name, "caches")
+        self.assertEqual(parsed.updates, [
+            [None, ["get_user_by_id", ["@a:test"], 1000]],
+            [5, ["get_user_by_id", ["@b:test"], 1000]],
+        ])
+
+    def test_data(self):
+        cmd = RdataCommand.from_data(RdataCommand("events", 3, ["$a:test"]).to_data())
+        self.assertEqual(
+            (cmd.stream_name, cmd.token, cmd.row), ("events", 3, ["$a:test"]),
+        )
+
+        # commands without their own binary format fall back to the line format
+        cmd = PositionCommand.from_data(PositionCommand("events", 3).to_data())
+        self.assertEqual((cmd.stream_name, cmd.token), ("events", 3))
+
+    def test_protocol(self):
+        self.assertEqual(ProtocolCommand.from_line("binary").mode, "binary")
+        self.assertRaises(Exception, ProtocolCommand.from_line, "morse")
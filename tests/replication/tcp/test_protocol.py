@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from synapse.replication.tcp.protocol import ClientReplicationStreamProtocol
+from synapse.replication.tcp.resource import ReplicationStreamProtocolFactory
+from synapse.replication.tcp.streams import CachesStreamRow
+
+from tests import unittest
+from tests.server import FakeTransport
+
+ROWS = [
+    (None, ("get_user_by_id", ["@a:test"], 1000)),
+    (5, ("get_user_by_id", ["@b:test"], 1000)),
+]
+
+
+class ReplicationProtocolTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver("blue", federation_client=Mock())
+
+    def prepare(self, reactor, clock, hs):
+        self.handler = Mock()
+        self.handler.get_streams_to_replicate.return_value = {"caches": "NOW"}
+        self.handler.get_currently_syncing_users.return_value = []
+        self.handler.on_rdata.return_value = None
+
+    def _connect(self, protocol_mode):
+        server_factory = ReplicationStreamProtocolFactory(self.hs)
+        server = server_factory.buildProtocol(None)
+        client = ClientReplicationStreamProtocol(
+            "client_name", "blue", self.clock, self.handler,
+            protocol_mode=protocol_mode,
+        )
+
+        client.makeConnection(FakeTransport(server, self.reactor))
+        server.makeConnection(FakeTransport(client, self.reactor))
+        self.pump(0.1)
+
+        self.assertIn("caches", server.replication_streams)
+        return server, client
+
+    def _assert_rows_received(self):
+        self.handler.on_rdata.assert_called_once_with("caches", 5, [
+            CachesStreamRow("get_user_by_id", ["@a:test"], 1000),
+            CachesStreamRow("get_user_by_id", ["@b:test"], 1000),
+        ])
+
+    def test_text(self):
+        server, client = self._connect("text")
+        self.assertEqual(server.outbound_mode, "text")
+        self.assertEqual(client.outbound_mode, "text")
+
+        server.stream_updates("caches", ROWS)
+        self.assertEqual(server.outbound_commands_counter["RDATA"], 2)
+
+        self.pump(0.1)
+        self._assert_rows_received()
+
+    def test_binary(self):
+        server, client = self._connect("binary")
+        self.assertEqual(server.outbound_mode, "binary")
+        self.assertEqual(client.outbound_mode, "binary")
+
+        # both sides are now reading frames rather than lines
+        self.assertFalse(server.line_mode)
+        self.assertFalse(client.line_mode)
+
+        server.stream_updates("caches", ROWS)
+        self.assertEqual(server.outbound_commands_counter["RDATA"], 0)
+        self.assertEqual(server.outbound_commands_counter["RDATA_BATCH"], 1)
+
+        self.pump(0.1)
+        self._assert_rows_received()
+
+        # other commands are sent as frames too
+        server.send_sync("sync_data")
+        self.pump(0.1)
+        self.handler.on_sync.assert_called_once_with("sync_data")
+
+    def test_partial_frames(self):
+        server, client = self._connect("binary")
+
+        server.stream_updates("caches", ROWS)
+        data = server.transport.buffer
+        server.transport.buffer = b""
+
+        for i in range(len(data)):
+            client.dataReceived(data[i:i + 1])
+
+        self._assert_rows_received()
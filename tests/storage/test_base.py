@@ -14,14 +14,17 @@
 # limitations under the License.
 
 
+import sys
 from collections import OrderedDict
 
-from mock import Mock
+from mock import Mock, call, patch
 
+from twisted.enterprise import adbapi
 from twisted.internet import defer
 
-from synapse.storage._base import SQLBaseStore
-from synapse.storage.engines import create_engine
+from synapse.storage import _base
+from synapse.storage._base import LoggingTransaction, SQLBaseStore
+from synapse.storage.engines import PostgresEngine, create_engine
 
 from tests import unittest
 from tests.utils import TestHomeServer
@@ -51,6 +54,8 @@ class SQLBaseStoreTestCase(unittest.TestCase):
         config = Mock()
         config._disable_native_upserts = True
         config.event_cache_size = 1
+        config.database_lanes = {}
+        config.shared_cache_directory = None
         config.database_config = {"name": "sqlite3"}
         engine = create_engine(config.database_config)
         fake_engine = Mock(wraps=engine)
@@ -90,6 +95,18 @@ class SQLBaseStoreTestCase(unittest.TestCase):
             "INSERT INTO tablename (colA, colB, colC) VALUES(?, ?, ?)", (1, 2, 3)
         )
 
+    @defer.inlineCallbacks
+    def test_insert_many(self):
+        yield self.datastore._simple_insert_many(
+            table="tablename",
+            values=[{"colA": 1, "colB": 2}, {"colA": 3, "colB": 4}],
+            desc="test",
+        )
+
+        self.mock_txn.executemany.assert_called_with(
+            "INSERT INTO tablename (colA, colB) VALUES(?, ?)", ((1, 2), (3, 4))
+        )
+
     @defer.inlineCallbacks
     def test_select_one_1col(self):
         self.mock_txn.rowcount = 1
@@ -190,3 +207,166 @@ class SQLBaseStoreTestCase(unittest.TestCase):
         self.mock_txn.execute.assert_called_with(
             "DELETE FROM tablename WHERE keycol = ?", ["Go away"]
         )
+
+    @defer.inlineCallbacks
+    def test_sql_reused(self):
+        for _ in range(2):
+            self.mock_txn.rowcount = 1
+            self.mock_txn.fetchone.return_value = (1,)
+            yield self.datastore._simple_select_one(
+                table="tablename", keyvalues={"keycol": "TheKey"}, retcols=["colA"],
+            )
+
+        first_call, second_call = self.mock_txn.execute.call_args_list
+        self.assertIs(first_call[0][0], second_call[0][0])
+
+
+class PreparedStatementTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_txn = Mock()
+        self.mock_txn.rowcount = 1
+        self.mock_txn.fetchone.return_value = ("Value",)
+
+        self.prepared_statements = set()
+        self.txn = LoggingTransaction(
+            self.mock_txn, "test", PostgresEngine(Mock(), {}), [], [],
+            self.prepared_statements,
+        )
+
+    def test_prepared_once(self):
+        for key in ("TheKey", "OtherKey"):
+            SQLBaseStore._simple_select_one_txn(
+                self.txn, "tablename", {"keycol": key}, ["colA"],
+            )
+
+        (name,) = self.prepared_statements
+        self.assertEqual(
+            self.mock_txn.execute.call_args_list,
+            [
+                call(
+                    "PREPARE %s AS SELECT colA FROM tablename WHERE keycol = $1"
+                    % (name,),
+                ),
+                call("EXECUTE %s(%%s)" % (name,), ["TheKey"]),
+                call("EXECUTE %s(%%s)" % (name,), ["OtherKey"]),
+            ],
+        )
+
+    def test_prepared_once_after_cache_reset(self):
+        SQLBaseStore._simple_select_one_txn(
+            self.txn, "tablename", {"keycol": "TheKey"}, ["colA"],
+        )
+
+        # the statement keeps its name when the cache of SQL is reset, so it
+        # isn't prepared again
+        _base._sql_statement_cache.clear()
+        SQLBaseStore._simple_select_one_txn(
+            self.txn, "tablename", {"keycol": "OtherKey"}, ["colA"],
+        )
+
+        (name,) = self.prepared_statements
+        self.assertEqual(
+            self.mock_txn.execute.call_args_list,
+            [
+                call(
+                    "PREPARE %s AS SELECT colA FROM tablename WHERE keycol = $1"
+                    % (name,),
+                ),
+                call("EXECUTE %s(%%s)" % (name,), ["TheKey"]),
+                call("EXECUTE %s(%%s)" % (name,), ["OtherKey"]),
+            ],
+        )
+
+    def test_other_sql_not_prepared(self):
+        self.txn.execute("SELECT colB FROM othertable WHERE keycol = ?", ("TheKey",))
+
+        self.mock_txn.execute.assert_called_once_with(
+            "SELECT colB FROM othertable WHERE keycol = %s", ("TheKey",)
+        )
+        self.assertFalse(self.prepared_statements)
+
+
+class PostgresSQLBaseStoreTestCase(unittest.TestCase):
+    """Tests SQLBaseStore with a postgres engine and a fake database connection.
+    """
+
+    def setUp(self):
+        self.mock_txn = Mock()
+        self.mock_txn.rowcount = 1
+        self.mock_txn.fetchone.return_value = ("Value",)
+
+        # the DB-API connection, which the connection pool gives a new
+        # adbapi.Connection wrapper each time it is used.
+        self.db_api_conn = Mock(closed=False)
+        self.db_api_conn.cursor.return_value = self.mock_txn
+        pool = Mock()
+        pool.connect.return_value = self.db_api_conn
+
+        self.db_pool = Mock(spec=["runInteraction", "runWithConnection"])
+
+        def runWithConnection(func, *args, **kwargs):
+            return defer.succeed(func(adbapi.Connection(pool), *args, **kwargs))
+
+        self.db_pool.runWithConnection = runWithConnection
+
+        config = Mock()
+        config.event_cache_size = 1
+        config.database_lanes = {}
+        config.shared_cache_directory = None
+        engine = PostgresEngine(Mock(), {})
+        # normally learnt from the first connection; pick a version without
+        # native upserts so that nothing gets run in the background.
+        engine._version = 90400
+        hs = TestHomeServer(
+            "test", db_pool=self.db_pool, config=config, database_engine=engine,
+        )
+
+        self.datastore = SQLBaseStore(None, hs)
+
+    @defer.inlineCallbacks
+    def test_prepared_once_per_connection(self):
+        for key in ("TheKey", "OtherKey"):
+            yield self.datastore._simple_select_one(
+                table="tablename", keyvalues={"keycol": key}, retcols=["colA"],
+            )
+
+        prepares = [
+            c for c in self.mock_txn.execute.call_args_list
+            if c[0][0].startswith("PREPARE ")
+        ]
+        self.assertEqual(len(prepares), 1)
+
+        # but it is prepared again after the connection is reconnected
+        self.db_api_conn.closed = True
+        yield self.datastore._simple_select_one(
+            table="tablename", keyvalues={"keycol": "TheKey"}, retcols=["colA"],
+        )
+        prepares = [
+            c for c in self.mock_txn.execute.call_args_list
+            if c[0][0].startswith("PREPARE ")
+        ]
+        self.assertEqual(len(prepares), 2)
+
+    @defer.inlineCallbacks
+    def test_insert_many(self):
+        # psycopg2 may not be installed, so provide our own execute_values
+        extras = Mock()
+        psycopg2 = Mock(extras=extras)
+        with patch.dict(
+            sys.modules, {"psycopg2": psycopg2, "psycopg2.extras": extras},
+        ):
+            yield self.datastore._simple_insert_many(
+                table="tablename",
+                values=[
+                    {"colB": "b1", "colA": "a1"},
+                    {"colB": "b2", "colA": "a2"},
+                ],
+                desc="test_insert_many",
+            )
+
+        extras.execute_values.assert_called_once_with(
+            self.mock_txn,
+            "INSERT INTO tablename (colA, colB) VALUES %s",
+            (("a1", "b1"), ("a2", "b2")),
+        )
+        self.mock_txn.executemany.assert_not_called()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from synapse.rest.client.v1 import room
+from synapse.storage.util.cache_snapshot import (
+    get_cache_snapshot,
+    read_cache_snapshot,
+    warm_caches,
+    write_cache_snapshot,
+)
+
+from tests.unittest import HomeserverTestCase
+
+
+class CacheSnapshotTestCase(HomeserverTestCase):
+
+    user_id = "@red:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver("server", http_client=None)
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.room_id = self.helper.create_room_as(self.user_id)
+        self.event_id = self.helper.send(self.room_id, body="test")["event_id"]
+
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_snapshot(self):
+        state_group = self.get_success(
+            self.store._get_state_group_for_event(self.event_id)
+        )
+        self.get_success(self.store._get_state_for_groups([state_group]))
+        self.get_success(self.store.get_users_in_room(self.room_id))
+
+        caches = ["getEvent", "stateGroupCache", "get_users_in_room", "not_a_cache"]
+        snapshot = get_cache_snapshot(self.store, caches, 10000)
+
+        self.assertIn((self.event_id,), snapshot["getEvent"])
+        self.assertIn(state_group, snapshot["stateGroupCache"])
+        self.assertEqual(snapshot["get_users_in_room"], [self.room_id])
+        self.assertNotIn("not_a_cache", snapshot)
+
+        path = os.path.join(self.dir, "snapshot.json")
+        write_cache_snapshot(path, snapshot)
+        self.assertEqual(
+            read_cache_snapshot(path)["get_users_in_room"], [self.room_id],
+        )
+
+        # after emptying the caches, warming them from the snapshot fills
+        # them again
+        self.store._get_event_cache.invalidate_all()
+        self.store._state_group_cache.invalidate_all()
+        self.store._state_group_members_cache.invalidate_all()
+        self.store.get_users_in_room.invalidate_all()
+
+        self.get_success(warm_caches(self.store, read_cache_snapshot(path)))
+
+        self.assertIn((self.event_id,), self.store._get_event_cache.cache)
+        self.assertIn(state_group, self.store._state_group_cache.cache)
+        self.assertIn(self.room_id, self.store.get_users_in_room.cache.cache)
+
+    def test_no_snapshot(self):
+        self.assertIsNone(read_cache_snapshot(os.path.join(self.dir, "missing")))
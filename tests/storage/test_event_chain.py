@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import json
+
+from synapse.api.constants import EventTypes, JoinRules, Membership
+from synapse.events import FrozenEvent
+from synapse.events.snapshot import EventContext
+from synapse.storage.events import _LinkMap
+
+from tests.unittest import HomeserverTestCase, TestCase
+
+ROOM_ID = "!room:test"
+ALICE = "@alice:test"
+BOB = "@bob:test"
+CHARLIE = "@charlie:test"
+
+
+class EventChainStoreTestCase(HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self._next_event_id = 0
+        self._room_id = ROOM_ID
+
+        self.get_success(self.store.store_room(ROOM_ID, ALICE, is_public=False))
+
+        # the events we've created, and the current state
+        self.events = {}
+        self.state = {}
+
+    def test_auth_chains(self):
+        """The index gives the same auth chains as walking the graph"""
+        self._persist(self._build_room())
+
+        self._assert_indexed(self.events)
+        for event_id in self.events:
+            self.assertEqual(
+                self._get_auth_chain_ids_using_index([event_id]),
+                self._expected_auth_chain([event_id]),
+            )
+
+        # and for some combinations of events
+        for event_ids in itertools.combinations(sorted(self.events), 3):
+            self.assertEqual(
+                self._get_auth_chain_ids_using_index(event_ids),
+                self._expected_auth_chain(event_ids),
+            )
+
+    def test_auth_chain_difference(self):
+        """The index gives the same auth difference as walking the graph"""
+        self._persist(self._build_room())
+
+        self._assert_indexed(self.events)
+        for state_sets in itertools.combinations(self._state_sets(), 2):
+            expected = self._expected_difference(state_sets)
+
+            self.assertEqual(
+                self.get_success(self.store.runInteraction(
+                    "test",
+                    self.store._get_auth_chain_difference_using_cover_index_txn,
+                    state_sets,
+                )),
+                expected,
+            )
+            self.assertEqual(
+                self.get_success(self.store.get_auth_chain_difference(state_sets)),
+                expected,
+            )
+
+    def test_out_of_order(self):
+        """Events persisted before their auth events are indexed once the auth
+        events turn up
+        """
+        events = self._build_room()
+
+        # persist the first few events, then the last few, and then the ones
+        # in the middle which some of the last few depend on.
+        self._persist(events[:3])
+        self._persist(events[-3:])
+
+        # the last event only depends on the first few, so can be indexed
+        # straight away. The others have to wait.
+        self._assert_indexed([e.event_id for e in events[:3] + events[-1:]])
+        rows = self.get_success(self.store._simple_select_onecol(
+            table="event_auth_chain_to_calculate",
+            keyvalues={"room_id": ROOM_ID},
+            retcol="event_id",
+        ))
+        self.assertEqual(set(rows), set(e.event_id for e in events[-3:-1]))
+
+        # until they are indexed, queries fall back to walking the graph.
+        self.assertEqual(
+            set(self.get_success(
+                self.store.get_auth_chain_ids([events[-2].event_id]),
+            )),
+            self._expected_auth_chain([events[-2].event_id]),
+        )
+
+        self._persist(events[3:-3])
+
+        self._assert_indexed(self.events)
+        for event_id in self.events:
+            self.assertEqual(
+                self._get_auth_chain_ids_using_index([event_id]),
+                self._expected_auth_chain([event_id]),
+            )
+
+    def test_room_stored_after_events(self):
+        """Rooms whose events we have before we store the room are indexed"""
+        room_id = "!other_room:test"
+        self._room_id = room_id
+
+        events = self._build_room()
+        self._persist(events[:3])
+
+        self.get_success(self.store.store_room(room_id, "", is_public=False))
+        self._assert_indexed([e.event_id for e in events[:3]])
+
+        # and the room's later events are indexed as they are persisted
+        self._persist(events[3:])
+        self._assert_indexed(self.events)
+        for event_id in self.events:
+            self.assertEqual(
+                self._get_auth_chain_ids_using_index([event_id]),
+                self._expected_auth_chain([event_id]),
+            )
+
+    def test_background_update(self):
+        """The background update indexes existing rooms"""
+        self.get_success(self.store._simple_update_one(
+            table="rooms",
+            keyvalues={"room_id": ROOM_ID},
+            updatevalues={"has_auth_chain_index": False},
+        ))
+
+        self._persist(self._build_room())
+
+        rows = self.get_success(self.store._simple_select_list(
+            table="event_auth_chains", keyvalues={}, retcols=("event_id",),
+        ))
+        self.assertEqual(rows, [])
+
+        # run the update by hand, so that we can use small batches and work
+        # through the room in stages.
+        self.get_success(self.store.start_background_update("chain_cover", {}))
+        progress = {}
+        while True:
+            self.get_success(self.store._background_chain_cover_index(progress, 3))
+            progress_json = self.get_success(self.store._simple_select_one_onecol(
+                table="background_updates",
+                keyvalues={"update_name": "chain_cover"},
+                retcol="progress_json",
+                allow_none=True,
+            ))
+            if progress_json is None:
+                break
+            progress = json.loads(progress_json)
+
+        self._assert_indexed(self.events)
+        for event_id in self.events:
+            self.assertEqual(
+                self._get_auth_chain_ids_using_index([event_id]),
+                self._expected_auth_chain([event_id]),
+            )
+
+        # new events are now indexed as they are persisted
+        self.assertTrue(self.get_success(self.store._simple_select_one_onecol(
+            table="rooms",
+            keyvalues={"room_id": ROOM_ID},
+            retcol="has_auth_chain_index",
+        )))
+
+        event = self._add_event(
+            EventTypes.Member, CHARLIE, {"membership": Membership.JOIN}, CHARLIE,
+        )
+        self._persist([event])
+        self._assert_indexed([event.event_id])
+
+    def _build_room(self):
+        """Build a room with a few forks in its auth DAG.
+
+        Returns:
+            list[FrozenEvent]: the events, in topological order.
+        """
+        events = []
+
+        def add(*args, **kwargs):
+            events.append(self._add_event(*args, **kwargs))
+            return events[-1]
+
+        add(EventTypes.Create, ALICE, {"creator": ALICE}, "")
+        add(EventTypes.Member, ALICE, {"membership": Membership.JOIN}, ALICE)
+        add(EventTypes.PowerLevels, ALICE, {"users": {ALICE: 100}}, "")
+        add(EventTypes.JoinRules, ALICE, {"join_rule": JoinRules.PUBLIC}, "")
+        add(EventTypes.Member, BOB, {"membership": Membership.JOIN}, BOB)
+        add(EventTypes.Member, CHARLIE, {"membership": Membership.JOIN}, CHARLIE)
+
+        # fork the state: on one side, alice bumps bob's power level; on the
+        # other, bob changes his display name and charlie leaves.
+        fork_state = dict(self.state)
+        add(EventTypes.PowerLevels, ALICE, {"users": {ALICE: 100, BOB: 50}}, "")
+        add(EventTypes.Topic, BOB, {"topic": "Power!"}, "")
+
+        self.state = fork_state
+        add(
+            EventTypes.Member, BOB,
+            {"membership": Membership.JOIN, "displayname": "Bob"}, BOB,
+        )
+        add(EventTypes.Member, CHARLIE, {"membership": Membership.LEAVE}, CHARLIE)
+        add(EventTypes.JoinRules, ALICE, {"join_rule": JoinRules.INVITE}, "")
+
+        return events
+
+    def _add_event(self, etype, sender, content, state_key):
+        keys = [
+            (EventTypes.Create, ""),
+            (EventTypes.PowerLevels, ""),
+            (EventTypes.Member, sender),
+        ]
+        if etype == EventTypes.Member:
+            keys.append((EventTypes.JoinRules, ""))
+        auth_events = [self.state[k] for k in keys if k in self.state]
+
+        event_id = "$%d:test" % (self._next_event_id,)
+        self._next_event_id += 1
+
+        event = FrozenEvent(
+            {
+                "event_id": event_id,
+                "type": etype,
+                "room_id": self._room_id,
+                "sender": sender,
+                "state_key": state_key,
+                "content": content,
+                "auth_events": [(e, {}) for e in auth_events],
+                "prev_events": [],
+                "prev_state": [],
+                "depth": self._next_event_id,
+                "origin_server_ts": self._next_event_id,
+            },
+            internal_metadata_dict={"outlier": True},
+        )
+
+        self.events[event_id] = auth_events
+        self.state[(etype, state_key)] = event_id
+        return event
+
+    def _persist(self, events):
+        self.get_success(
+            self.store.persist_events([(e, EventContext()) for e in events])
+        )
+
+    def _state_sets(self):
+        """Some plausible state sets for the room built by `_build_room`"""
+        ids = sorted(self.events, key=lambda e: int(e[1:].split(":")[0]))
+        base = ids[:6]
+        return [
+            set(base),
+            set(base[:2] + base[3:] + ids[6:8]),
+            set(base[:3] + ids[8:11]),
+            set(base[:4] + ids[8:10]),
+        ]
+
+    def _assert_indexed(self, event_ids):
+        rows = self.get_success(self.store._simple_select_many_batch(
+            table="event_auth_chains",
+            column="event_id",
+            iterable=list(event_ids),
+            retcols=("event_id",),
+        ))
+        self.assertEqual(set(r["event_id"] for r in rows), set(event_ids))
+
+    def _get_auth_chain_ids_using_index(self, event_ids):
+        return set(self.get_success(self.store.runInteraction(
+            "test",
+            self.store._get_auth_chain_ids_using_cover_index_txn,
+            event_ids,
+            False,
+        )))
+
+    def _expected_auth_chain(self, event_ids, include_given=False):
+        result = set(event_ids) if include_given else set()
+        stack = [a for e in event_ids for a in self.events[e]]
+        while stack:
+            event_id = stack.pop()
+            if event_id not in result:
+                result.add(event_id)
+                stack.extend(self.events[event_id])
+        return result
+
+    def _expected_difference(self, state_sets):
+        chains = [
+            self._expected_auth_chain(state_set, include_given=True)
+            for state_set in state_sets
+        ]
+        return set().union(*chains) - chains[0].intersection(*chains[1:])
+
+
+class LinkMapTestCase(TestCase):
+    def test_simple(self):
+        """Basic tests for the LinkMap.
+        """
+        link_map = _LinkMap()
+
+        link_map.add_link((1, 1), (2, 1), new=False)
+        self.assertEqual(sorted(link_map.get_links_between(1, 2)), [(1, 1)])
+        self.assertEqual(sorted(link_map.get_links_from((1, 1))), [(2, 1)])
+        self.assertEqual(sorted(link_map.get_additions()), [])
+        self.assertTrue(link_map.exists_path_from((1, 5), (2, 1)))
+        self.assertFalse(link_map.exists_path_from((1, 5), (2, 2)))
+        self.assertTrue(link_map.exists_path_from((1, 5), (1, 1)))
+        self.assertFalse(link_map.exists_path_from((1, 1), (1, 5)))
+
+        # Attempting to add a redundant link is ignored.
+        self.assertFalse(link_map.add_link((1, 4), (2, 1)))
+        self.assertEqual(sorted(link_map.get_links_between(1, 2)), [(1, 1)])
+
+        # Adding new non-redundant links works
+        self.assertTrue(link_map.add_link((1, 3), (2, 3)))
+        self.assertEqual(sorted(link_map.get_links_between(1, 2)), [(1, 1), (3, 3)])
+
+        self.assertTrue(link_map.add_link((2, 5), (1, 3)))
+        self.assertEqual(sorted(link_map.get_links_between(2, 1)), [(5, 3)])
+        self.assertEqual(sorted(link_map.get_links_between(1, 2)), [(1, 1), (3, 3)])
+
+        self.assertEqual(sorted(link_map.get_additions()), [(1, 3, 2, 3), (2, 5, 1, 3)])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.storage.events import _EventPeristenceQueue
+from synapse.util.logcontext import make_deferred_yieldable
+
+from tests import unittest
+
+
+class EventPersistenceQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.queue = _EventPeristenceQueue()
+
+        # the batches passed to the callback, and the deferreds it returned
+        self.batches = []
+        self.deferreds = []
+
+    def _callback(self, batch):
+        self.batches.append([item.events_and_contexts[0][0].room_id for item in batch])
+        d = defer.Deferred()
+        self.deferreds.append(d)
+        return make_deferred_yieldable(d)
+
+    def _add(self, room_id, num_events=1, backfilled=False):
+        events_and_contexts = [
+            (Mock(room_id=room_id), Mock()) for _ in range(num_events)
+        ]
+        return self.queue.add_to_queue(
+            room_id, events_and_contexts, backfilled=backfilled,
+        )
+
+    def test_batches_rooms(self):
+        """Events queued for different rooms are persisted together"""
+        d1 = self._add("!a:test")
+        d2 = self._add("!b:test")
+        d3 = self._add("!c:test", num_events=5)
+
+        self.queue.handle_queue(self._callback)
+        self.assertEqual(self.batches, [["!a:test", "!b:test", "!c:test"]])
+
+        self.deferreds[0].callback("result")
+        for d in (d1, d2, d3):
+            self.assertEqual(self.successResultOf(d), "result")
+
+    def test_one_batch_per_room(self):
+        """Events for a room which is being persisted wait for the current batch"""
+        d1 = self._add("!a:test")
+        self.queue.handle_queue(self._callback)
+        self.assertEqual(self.batches, [["!a:test"]])
+
+        d2 = self._add("!a:test")
+        d3 = self._add("!b:test")
+        self.queue.handle_queue(self._callback)
+        self.assertEqual(self.batches, [["!a:test"], ["!b:test"]])
+
+        self.deferreds[1].callback(None)
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        self.successResultOf(d3)
+
+        # once the first batch completes, the second event for the room is
+        # persisted
+        self.deferreds[0].callback(None)
+        self.successResultOf(d1)
+        self.assertEqual(self.batches, [["!a:test"], ["!b:test"], ["!a:test"]])
+
+        self.deferreds[2].callback(None)
+        self.successResultOf(d2)
+
+    def test_batch_size(self):
+        """Batches are limited in size, unless a single room has lots of events"""
+        self._add("!a:test", num_events=80)
+        self._add("!b:test", num_events=30)
+        self._add("!c:test", num_events=20)
+        self._add("!d:test", num_events=150)
+
+        self.queue.handle_queue(self._callback)
+        self.assertEqual(self.batches, [["!a:test", "!c:test"]])
+
+        self.deferreds[0].callback(None)
+        self.assertEqual(self.batches[1:], [["!b:test"]])
+
+        self.deferreds[1].callback(None)
+        self.assertEqual(self.batches[2:], [["!d:test"]])
+
+    def test_backfilled(self):
+        """Backfilled events are persisted separately from new events"""
+        self._add("!a:test")
+        self._add("!b:test", backfilled=True)
+        self._add("!c:test")
+
+        self.queue.handle_queue(self._callback)
+        self.assertEqual(self.batches, [["!a:test", "!c:test"]])
+
+        self.deferreds[0].callback(None)
+        self.assertEqual(self.batches[1:], [["!b:test"]])
+
+    def test_failure(self):
+        """A failure in one room doesn't fail the rest of the batch"""
+        def callback(batch):
+            room_ids = [item.events_and_contexts[0][0].room_id for item in batch]
+            self.batches.append(room_ids)
+            if "!bad:test" in room_ids:
+                return defer.fail(Exception("bad room"))
+            return defer.succeed("result")
+
+        d1 = self._add("!good:test")
+        d2 = self._add("!bad:test")
+
+        self.queue.handle_queue(callback)
+        self.assertEqual(
+            self.batches,
+            [["!good:test", "!bad:test"], ["!good:test"], ["!bad:test"]],
+        )
+        self.assertEqual(self.successResultOf(d1), "result")
+        self.failureResultOf(d2)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.config import ConfigError
+from synapse.storage.util.lanes import (
+    LANE_ADMIN,
+    LANE_BACKGROUND,
+    LANE_PERSIST,
+    LANE_READ,
+    DatabaseLanes,
+)
+
+from tests import unittest
+
+
+class DatabaseLanesTestCase(unittest.TestCase):
+    def test_get_lane(self):
+        lanes = DatabaseLanes({})
+
+        self.assertEqual(lanes.get_lane("persist_events"), LANE_PERSIST)
+        self.assertEqual(lanes.get_lane("purge_history_batch"), LANE_ADMIN)
+        self.assertEqual(lanes.get_lane("get_users_in_room"), LANE_READ)
+        self.assertEqual(lanes.get_lane(None), LANE_READ)
+
+        lanes.set_transaction_lane("my_background_update", LANE_BACKGROUND)
+        self.assertEqual(lanes.get_lane("my_background_update"), LANE_BACKGROUND)
+
+    def test_unknown_lane(self):
+        self.assertRaises(ConfigError, DatabaseLanes, {"writes": 1})
+
+    def test_limit(self):
+        lanes = DatabaseLanes({LANE_READ: 2})
+
+        d1 = lanes.queue(LANE_READ)
+        d2 = lanes.queue(LANE_READ)
+        d3 = lanes.queue(LANE_READ)
+        d4 = lanes.queue(LANE_READ)
+
+        # the first two get to run straight away, and the others wait
+        cm1 = self.successResultOf(d1)
+        cm2 = self.successResultOf(d2)
+        self.assertNoResult(d3)
+        self.assertNoResult(d4)
+
+        # other lanes aren't held up
+        with self.successResultOf(lanes.queue(LANE_PERSIST)):
+            pass
+
+        with cm1:
+            pass
+
+        cm3 = self.successResultOf(d3)
+        self.assertNoResult(d4)
+
+        with cm2:
+            pass
+        with cm3:
+            pass
+
+        with self.successResultOf(d4):
+            pass
+
+        # and once everything is done, there's room again
+        self.successResultOf(lanes.queue(LANE_READ))
+        self.successResultOf(lanes.queue(LANE_READ))
+        self.assertNoResult(lanes.queue(LANE_READ))
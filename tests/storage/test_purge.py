@@ -104,3 +104,145 @@ class PurgeTests(HomeserverTestCase):
         self.successResultOf(get_second)
         self.successResultOf(get_third)
         self.successResultOf(get_last)
+
+    def _send_and_get_token(self, count):
+        events = [
+            self.helper.send(self.room_id, body="test%i" % (i,))
+            for i in range(count)
+        ]
+        token = self.hs.get_datastore().get_topological_token_for_event(
+            events[-1]["event_id"],
+        )
+        self.pump()
+        return events, self.successResultOf(token)
+
+    def _get_event(self, event_id):
+        d = self.hs.get_datastore().get_event(event_id)
+        self.pump()
+        return d
+
+    def _use_small_batches(self, storage):
+        storage.MINIMUM_PURGE_BATCH_SIZE = 2
+        storage.DEFAULT_PURGE_BATCH_SIZE = 2
+        storage.PURGE_BATCH_DURATION_MS = 0
+
+    def test_purge_in_batches(self):
+        """
+        Large purges are done in several batches, reporting their progress.
+        """
+        events, token = self._send_and_get_token(6)
+
+        storage = self.hs.get_datastore()
+        self._use_small_batches(storage)
+
+        progress = []
+        purge = storage.purge_history(
+            self.room_id, token, True,
+            progress_callback=lambda *args: progress.append(args),
+        )
+        self.pump(0.1)
+        self.assertEqual(self.successResultOf(purge), None)
+
+        # the room's state events are kept as outliers, so everything before
+        # the last event is processed
+        total = progress[0][1]
+        self.assertGreater(total, 5)
+        self.assertEqual(progress[0], (0, total))
+        self.assertEqual(progress[1], (2, total))
+        self.assertEqual(progress[-1], (total, total))
+
+        for event in events[:-1]:
+            self.failureResultOf(self._get_event(event["event_id"]))
+        self.successResultOf(self._get_event(events[-1]["event_id"]))
+
+        # nothing is left behind to resume
+        unfinished = storage.get_unfinished_purges()
+        self.pump()
+        self.assertEqual(self.successResultOf(unfinished), [])
+
+    def test_resume_purge(self):
+        """
+        A purge which is interrupted part way through can be carried on with.
+        """
+        events, token = self._send_and_get_token(6)
+
+        storage = self.hs.get_datastore()
+        self._use_small_batches(storage)
+
+        # Fail the second batch, as if we had been restarted.
+        batch_txn = storage._purge_history_batch_txn
+        calls = []
+
+        def failing_batch_txn(txn, *args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise Exception("restarted")
+            return batch_txn(txn, *args)
+
+        storage._purge_history_batch_txn = failing_batch_txn
+
+        purge = storage.purge_history(self.room_id, token, True, purge_id="purge")
+        self.pump(0.1)
+        self.failureResultOf(purge)
+
+        unfinished = storage.get_unfinished_purges()
+        self.pump()
+        self.assertEqual(
+            self.successResultOf(unfinished),
+            [{
+                "purge_id": "purge",
+                "room_id": self.room_id,
+                "token": token,
+                "delete_local_events": True,
+            }],
+        )
+
+        progress = []
+        purge = storage.purge_history(
+            self.room_id, token, True, purge_id="purge",
+            progress_callback=lambda *args: progress.append(args),
+        )
+        self.pump(0.1)
+        self.assertEqual(self.successResultOf(purge), None)
+
+        # we carried on from the second batch
+        total = progress[0][1]
+        self.assertEqual(progress[0], (2, total))
+        self.assertEqual(progress[-1], (total, total))
+
+        for event in events[:-1]:
+            self.failureResultOf(self._get_event(event["event_id"]))
+        self.successResultOf(self._get_event(events[-1]["event_id"]))
+
+    def test_purge_after_failed_purge(self):
+        """
+        A room can be purged again after a purge of it fails.
+        """
+        events, token = self._send_and_get_token(6)
+
+        storage = self.hs.get_datastore()
+        self._use_small_batches(storage)
+
+        batch_txn = storage._purge_history_batch_txn
+
+        def failing_batch_txn(txn, *args):
+            raise Exception("failed")
+
+        storage._purge_history_batch_txn = failing_batch_txn
+        purge = storage.purge_history(self.room_id, token, True, purge_id="purge1")
+        self.pump(0.1)
+        self.failureResultOf(purge)
+
+        storage._purge_history_batch_txn = batch_txn
+        purge = storage.purge_history(self.room_id, token, True, purge_id="purge2")
+        self.pump(0.1)
+        self.assertEqual(self.successResultOf(purge), None)
+
+        for event in events[:-1]:
+            self.failureResultOf(self._get_event(event["event_id"]))
+        self.successResultOf(self._get_event(events[-1]["event_id"]))
+
+        # the failed purge isn't resumed later
+        unfinished = storage.get_unfinished_purges()
+        self.pump()
+        self.assertEqual(self.successResultOf(unfinished), [])
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import shutil
+import tempfile
+
+from mock import Mock
+
+from synapse.rest.client.v1 import room
+
+from tests.unittest import HomeserverTestCase
+
+
+class SharedCacheTestCase(HomeserverTestCase):
+    """Tests that events and state groups are shared between processes through
+    the shared caches.
+    """
+
+    user_id = "@red:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+        config = self.default_config()
+        config.shared_cache_directory = self.cache_dir
+        config.shared_event_cache_size = 1024 * 1024
+        config.shared_state_group_cache_size = 1024 * 1024
+
+        return self.setup_test_homeserver("server", config=config, http_client=None)
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.room_id = self.helper.create_room_as(self.user_id)
+        self.event_id = self.helper.send(self.room_id, body="test")["event_id"]
+
+    def test_get_event(self):
+        # the event is cached locally when it is persisted, so it gets to the
+        # shared cache the first time we fetch it from the database.
+        self.store._get_event_cache.invalidate_all()
+        event = self.get_success(self.store.get_event(self.event_id))
+
+        self.store._get_event_cache.invalidate_all()
+        self.store._fetch_event_rows_from_db = Mock(
+            side_effect=AssertionError("Fetched event from the database"),
+        )
+
+        shared_event = self.get_success(self.store.get_event(self.event_id))
+        self.assertEqual(shared_event.get_dict(), event.get_dict())
+        self.assertEqual(
+            shared_event.internal_metadata.get_dict(),
+            event.internal_metadata.get_dict(),
+        )
+
+        # invalidating the event removes it from the shared cache too
+        self.store._invalidate_get_event_cache(self.event_id)
+        d = self.store.get_event(self.event_id)
+        self.pump()
+        self.failureResultOf(d, AssertionError)
+
+    def test_get_state(self):
+        state = self.get_success(self.store.get_state_ids_for_event(self.event_id))
+
+        # state groups are added to the shared cache when they are stored
+        self.store._state_group_cache.invalidate_all()
+        self.store._state_group_members_cache.invalidate_all()
+        self.store._get_state_groups_from_groups = Mock(
+            side_effect=AssertionError("Fetched state from the database"),
+        )
+
+        shared_state = self.get_success(
+            self.store.get_state_ids_for_event(self.event_id)
+        )
+        self.assertEqual(shared_state, state)
@@ -489,3 +489,61 @@ class StateStoreTestCase(tests.unittest.TestCase):
 
         self.assertEqual(is_all, True)
         self.assertDictEqual({(e5.type, e5.state_key): e5.event_id}, state_dict)
+
+    @defer.inlineCallbacks
+    def test_get_state_groups_from_groups_sqlite_paths(self):
+        """The recursive query on SQLite gives the same answers as walking the
+        tree of state groups a hop at a time.
+        """
+        engine = self.store.database_engine
+
+        # a chain of deltas, each of which changes the room name and adds a
+        # member
+        room_id = self.room.to_string()
+        state = {(EventTypes.Create, ""): "$create:test"}
+        prev_group = yield self.store.store_state_group(
+            "$create:test", room_id, None, None, state,
+        )
+        groups = [prev_group]
+        for i in range(20):
+            delta = {
+                (EventTypes.Name, ""): "$name%i:test" % (i,),
+                (EventTypes.Member, "@user%i:test" % (i,)): "$join%i:test" % (i,),
+            }
+            state = dict(state)
+            state.update(delta)
+            prev_group = yield self.store.store_state_group(
+                "$join%i:test" % (i,), room_id, prev_group, delta, state,
+            )
+            groups.append(prev_group)
+
+        state_filters = [
+            StateFilter.all(),
+            StateFilter.from_types([(EventTypes.Name, "")]),
+            StateFilter.from_types([(EventTypes.Member, None)]),
+        ]
+
+        results = {}
+        for supports_recursive_cte in (True, False):
+            engine.supports_recursive_cte = supports_recursive_cte
+            for i, state_filter in enumerate(state_filters):
+                results[supports_recursive_cte, i] = (
+                    yield self.store._get_state_groups_from_groups(
+                        groups, state_filter,
+                    )
+                )
+
+            hops = yield self.store.runInteraction(
+                "count_hops", self.store._count_state_group_hops_txn, groups[-1],
+            )
+            self.assertEqual(hops, 20)
+
+        for i in range(len(state_filters)):
+            self.assertEqual(results[True, i], results[False, i])
+
+        self.assertEqual(results[True, 0][groups[-1]], state)
+
+    if tests.utils.USE_POSTGRES_FOR_TESTS:
+        test_get_state_groups_from_groups_sqlite_paths.skip = (
+            "Tests the SQLite query paths"
+        )
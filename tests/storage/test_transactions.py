@@ -43,3 +43,42 @@ class TransactionStoreTestCase(HomeserverTestCase):
         """
         d = self.store.set_destination_retry_timings("example.com", 50, 100)
         self.get_success(d)
+
+    def test_set_last_successful_stream_ordering(self):
+        """Tests that the stream ordering only moves in the requested direction
+        """
+        def set_and_get(stream_ordering, rewind=False):
+            self.get_success(
+                self.store.set_destination_last_successful_stream_ordering(
+                    "example.com", stream_ordering, rewind=rewind,
+                )
+            )
+            return self.get_success(
+                self.store.get_destination_last_successful_stream_ordering(
+                    "example.com",
+                )
+            )
+
+        # an existing row without a stream ordering gets one
+        self.get_success(
+            self.store.set_destination_retry_timings("example.com", 50, 100)
+        )
+        self.assertEqual(set_and_get(10), 10)
+
+        self.assertEqual(set_and_get(5), 10)
+        self.assertEqual(set_and_get(20), 20)
+        self.assertEqual(set_and_get(30, rewind=True), 20)
+        self.assertEqual(set_and_get(15, rewind=True), 15)
+
+        # and a destination we've never seen gets a row
+        self.get_success(
+            self.store.set_destination_last_successful_stream_ordering(
+                "other.example.com", 7,
+            )
+        )
+        r = self.get_success(
+            self.store.get_destination_last_successful_stream_ordering(
+                "other.example.com",
+            )
+        )
+        self.assertEqual(r, 7)
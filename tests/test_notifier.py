@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from synapse.notifier import _NotifierUserStream
+from synapse.types import StreamToken
+
+from tests import unittest
+
+ROOM_ID = "!room:test"
+
+
+class NotifierBatchingTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.notifier_batch_window_ms = 10
+        config.notifier_batch_size = 2
+        return self.setup_test_homeserver(config=config)
+
+    def prepare(self, reactor, clock, hs):
+        self.notifier = hs.get_notifier()
+
+        self.streams = []
+        for i in range(5):
+            stream = _NotifierUserStream(
+                user_id="@user%i:test" % (i,),
+                rooms=[ROOM_ID],
+                current_token=StreamToken.START,
+                time_now_ms=clock.time_msec(),
+            )
+            stream.notify_many = Mock(side_effect=stream.notify_many)
+            self.notifier._register_with_keys(stream)
+            self.streams.append(stream)
+
+    def test_batching(self):
+        listeners = [
+            stream.new_listener(StreamToken.START).deferred
+            for stream in self.streams
+        ]
+        wake_up_streams = Mock(side_effect=self.notifier._wake_up_streams)
+        self.notifier._wake_up_streams = wake_up_streams
+
+        self.notifier.on_new_event("typing_key", 1, rooms=[ROOM_ID])
+        self.notifier.on_new_event("typing_key", 2, rooms=[ROOM_ID])
+
+        # nobody is woken up until the window is over
+        self.reactor.advance(0.005)
+        for listener in listeners:
+            self.assertNoResult(listener)
+
+        self.reactor.advance(0.005)
+        for listener in listeners:
+            token = self.successResultOf(listener)
+            self.assertEqual(token.typing_key, 2)
+
+        # each stream is only woken once, for both notifications ...
+        for stream in self.streams:
+            stream.notify_many.assert_called_once_with(
+                [("typing_key", 1), ("typing_key", 2)], self.clock.time_msec(),
+            )
+
+        # ... and the streams were woken up in batches of two
+        self.assertEqual(wake_up_streams.call_count, 3)
+
+    def test_new_window(self):
+        """Notifications arriving after the window ends are batched separately
+        """
+        self.notifier.on_new_event("typing_key", 1, rooms=[ROOM_ID])
+        self.reactor.advance(0.01)
+
+        self.notifier.on_new_event("typing_key", 2, rooms=[ROOM_ID])
+        self.reactor.advance(0.005)
+        for stream in self.streams:
+            self.assertEqual(stream.current_token.typing_key, 1)
+
+        self.reactor.advance(0.005)
+        for stream in self.streams:
+            self.assertEqual(stream.current_token.typing_key, 2)
+            self.assertEqual(stream.notify_many.call_count, 2)
@@ -152,6 +152,36 @@ class JsonResourceTests(unittest.TestCase):
         self.assertEqual(channel.json_body["error"], "Unrecognized request")
         self.assertEqual(channel.json_body["errcode"], "M_UNRECOGNIZED")
 
+    def test_large_response(self):
+        """
+        Large responses are streamed to the client, small ones are sent with a
+        Content-Length.
+        """
+        response = {}
+
+        def _callback(request, **kwargs):
+            return (200, response)
+
+        res = JsonResource(self.homeserver)
+        res.register_paths("GET", [re.compile("^/_matrix/foo$")], _callback)
+
+        response["rooms"] = {"!small:test": {"events": ["event"]}}
+        request, channel = make_request(self.reactor, b"GET", b"/_matrix/foo")
+        render(request, res, self.reactor)
+
+        self.assertEqual(channel.json_body, response)
+        self.assertTrue(channel.headers.hasHeader(b"Content-Length"))
+
+        response["rooms"] = {
+            "!room%d:test" % (i,): {"events": ["event %d" % (j,) for j in range(100)]}
+            for i in range(100)
+        }
+        request, channel = make_request(self.reactor, b"GET", b"/_matrix/foo")
+        render(request, res, self.reactor)
+
+        self.assertEqual(channel.json_body, response)
+        self.assertFalse(channel.headers.hasHeader(b"Content-Length"))
+
 
 class SiteTestCase(unittest.HomeserverTestCase):
     def test_lose_connection(self):
@@ -14,12 +14,20 @@
 # limitations under the License.
 import logging
 
+from mock import Mock
+
 from twisted.internet import defer
 from twisted.internet.defer import succeed
 
 from synapse.api.constants import RoomVersions
 from synapse.events import FrozenEvent
-from synapse.visibility import filter_events_for_server
+from synapse.util.logcontext import make_deferred_yieldable, run_in_background
+from synapse.visibility import (
+    ClientEventFilter,
+    filter_events_for_client,
+    filter_events_for_clients,
+    filter_events_for_server,
+)
 
 import tests.unittest
 from tests.utils import create_room, setup_test_homeserver
@@ -331,3 +339,117 @@ class _TestStore(object):
 
     def are_users_erased(self, users):
         return succeed({u: False for u in users})
+
+
+class FilterEventsForClientsTestCase(tests.unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(self.addCleanup)
+        self.event_creation_handler = self.hs.get_event_creation_handler()
+        self.event_builder_factory = self.hs.get_event_builder_factory()
+        self.store = self.hs.get_datastore()
+
+        yield create_room(self.hs, TEST_ROOM_ID, "@someone:ROOM")
+
+        # a room where only members can see the history, with one member, one
+        # user who is invited, and one who isn't in the room.
+        yield self.inject_event({
+            "type": "m.room.history_visibility",
+            "sender": "@admin:hs",
+            "state_key": "",
+            "content": {"history_visibility": "invited"},
+        })
+        yield self.inject_member("@member:hs", "join")
+        yield self.inject_member("@invitee:hs", "invite")
+
+        self.messages = []
+        for i in range(3):
+            event = yield self.inject_event({
+                "type": "m.room.message",
+                "sender": "@member:hs",
+                "content": {"body": "message %i" % (i,), "msgtype": "m.text"},
+            })
+            self.messages.append(event)
+
+        self.user_ids = ["@member:hs", "@invitee:hs", "@outsider:hs"]
+
+    @defer.inlineCallbacks
+    def test_filter_for_clients(self):
+        results = yield filter_events_for_clients(
+            self.store, self.user_ids, self.messages,
+        )
+
+        self.assertEqual(results["@member:hs"], self.messages)
+        self.assertEqual(results["@invitee:hs"], self.messages)
+        self.assertEqual(results["@outsider:hs"], [])
+
+        # ... which is the same as filtering for each user separately
+        for user_id in self.user_ids:
+            filtered = yield filter_events_for_client(
+                self.store, user_id, self.messages,
+            )
+            self.assertEqual(filtered, results[user_id])
+
+    @defer.inlineCallbacks
+    def test_filter_for_many_clients(self):
+        user_ids = self.user_ids + [
+            "@user%i:hs" % (i,) for i in range(1100)
+        ]
+
+        # make sure that we look the state up in the database
+        self.store._state_group_cache.invalidate_all()
+        self.store._state_group_members_cache.invalidate_all()
+
+        results = yield filter_events_for_clients(
+            self.store, user_ids, self.messages,
+        )
+
+        self.assertEqual(results["@member:hs"], self.messages)
+        self.assertEqual(results["@invitee:hs"], self.messages)
+        self.assertEqual(results["@outsider:hs"], [])
+        self.assertEqual(results["@user0:hs"], [])
+
+    @defer.inlineCallbacks
+    def test_client_event_filter_batches(self):
+        client_event_filter = ClientEventFilter(self.hs)
+        get_state = Mock(side_effect=self.store.get_state_ids_for_events_by_group)
+        self.store.get_state_ids_for_events_by_group = get_state
+
+        d = defer.gatherResults([
+            run_in_background(
+                client_event_filter.filter_events_for_client,
+                user_id, self.messages,
+            )
+            for user_id in self.user_ids
+        ])
+
+        # the requests are batched up until the next reactor tick
+        self.assertEqual(get_state.call_count, 0)
+        self.hs.get_clock().advance_time(0)
+
+        results = yield make_deferred_yieldable(d)
+
+        self.assertEqual(results, [self.messages, self.messages, []])
+
+        # the state was only looked up once, for all of the users
+        self.assertEqual(get_state.call_count, 1)
+
+    def inject_member(self, user_id, membership):
+        return self.inject_event({
+            "type": "m.room.member",
+            "sender": user_id,
+            "state_key": user_id,
+            "content": {"membership": membership},
+        })
+
+    @defer.inlineCallbacks
+    def inject_event(self, event_dict):
+        event_dict["room_id"] = TEST_ROOM_ID
+        builder = self.event_builder_factory.new(RoomVersions.V1, event_dict)
+
+        event, context = yield self.event_creation_handler.create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+        defer.returnValue(event)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from synapse.util.caches.shared_cache import SharedCache
+
+from tests import unittest
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.cache")
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.dir)
+
+    def _open(self, size=64 * 1024):
+        cache = SharedCache("test", self.path, size)
+        self.caches.append(cache)
+        return cache
+
+    def test_get_set(self):
+        cache = self._open()
+
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", b"value")
+        self.assertEqual(cache.get("key"), b"value")
+
+        cache.set("key", b"new value")
+        self.assertEqual(cache.get("key"), b"new value")
+
+    def test_invalidate(self):
+        cache = self._open()
+
+        cache.set("key", b"value")
+        cache.set("other", b"other value")
+        cache.invalidate("key")
+
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.get("other"), b"other value")
+
+        cache.clear()
+        self.assertIsNone(cache.get("other"))
+
+    def test_shared(self):
+        """Processes using the same file see each other's changes"""
+        cache1 = self._open()
+        cache2 = self._open()
+
+        cache1.set("key", b"value")
+        self.assertEqual(cache2.get("key"), b"value")
+
+        cache2.invalidate("key")
+        self.assertIsNone(cache1.get("key"))
+
+    def test_size_fixed_on_creation(self):
+        cache1 = self._open(size=64 * 1024)
+        file_size = os.path.getsize(self.path)
+
+        # opening the cache with a different size uses the existing file
+        cache2 = self._open(size=128 * 1024)
+        self.assertEqual(os.path.getsize(self.path), file_size)
+
+        cache2.set("key", b"value")
+        self.assertEqual(cache1.get("key"), b"value")
+
+    def test_wrap_around(self):
+        """Once the cache is full, the oldest values are overwritten"""
+        cache = self._open(size=64 * 1024)
+        value = b"x" * 1000
+
+        for i in range(200):
+            cache.set("key%d" % (i,), value)
+
+        self.assertIsNone(cache.get("key0"))
+        self.assertEqual(cache.get("key199"), value)
+
+        # roughly the last buffer's worth of values are still there
+        found = [i for i in range(200) if cache.get("key%d" % (i,)) is not None]
+        self.assertGreater(len(found), 50)
+        self.assertGreater(min(found), 130)
+
+    def test_too_big(self):
+        cache = self._open(size=64 * 1024)
+
+        cache.set("key", b"x" * 32 * 1024)
+        self.assertIsNone(cache.get("key"))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from canonicaljson import json
+from frozendict import frozendict
+
+from synapse.util.encodedjson import EncodedJsonObject, encode_json, iterencode_json
+
+from tests import unittest
+
+
+class EncodeJsonTestCase(unittest.TestCase):
+    def test_plain(self):
+        obj = {"a": [1, u"é", None], "b": frozendict({"c": True})}
+
+        self.assertEqual(json.loads(encode_json(obj)), {
+            "a": [1, u"é", None], "b": {"c": True},
+        })
+        self.assertEqual(
+            encode_json(obj, canonical=True),
+            u'{"a":[1,"é",null],"b":{"c":true}}'.encode("utf-8"),
+        )
+
+    def test_encoded_objects(self):
+        obj = {
+            "events": [
+                EncodedJsonObject(b'{"a":1}'),
+                EncodedJsonObject(b'{"a":2}', {"b": 3}),
+                EncodedJsonObject(b'{}', {"b": 4}),
+                EncodedJsonObject(b'{"a":5}', {
+                    "nested": EncodedJsonObject(b'{"c":6}', {"d": 7}),
+                }),
+            ],
+            "other": "\0string",
+        }
+
+        expected = {
+            "events": [
+                {"a": 1},
+                {"a": 2, "b": 3},
+                {"b": 4},
+                {"a": 5, "nested": {"c": 6, "d": 7}},
+            ],
+            "other": "\0string",
+        }
+        self.assertEqual(json.loads(encode_json(obj)), expected)
+        self.assertEqual(json.loads(encode_json(obj, canonical=True)), expected)
+        self.assertEqual(json.loads(encode_json(obj, pretty_print=True)), expected)
+
+    def test_canonical_encoded_objects(self):
+        """The fields of an encoded object are merged in order in canonical JSON"""
+        obj = [
+            EncodedJsonObject(b'{"a":1,"c":3}', {"d": 4, "b": 2}),
+            EncodedJsonObject(b'{"b":1}', {
+                "a": EncodedJsonObject(b'{"y":1}', {"x": 2}),
+            }),
+        ]
+        self.assertEqual(
+            encode_json(obj, canonical=True),
+            b'[{"a":1,"b":2,"c":3,"d":4},{"a":{"x":2,"y":1},"b":1}]',
+        )
+
+    def test_iterencode(self):
+        """iterencode_json gives the same results as encode_json, in pieces"""
+        obj = {
+            "rooms": {
+                "join": {
+                    "!a:test": {"events": [EncodedJsonObject(b'{"a":1}'), {"b": 2}]},
+                    "!b:test": {},
+                },
+                "leave": {},
+            },
+            "next_batch": "s1",
+            "list": [1, [2, frozendict({"c": [3]})], []],
+            "other": {1: "non-string key"},
+        }
+
+        for canonical in (False, True):
+            chunks = list(iterencode_json(obj, canonical=canonical))
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(
+                b"".join(chunks), encode_json(obj, canonical=canonical),
+            )
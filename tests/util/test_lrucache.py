@@ -16,7 +16,12 @@
 
 from mock import Mock
 
-from synapse.util.caches.lrucache import LruCache
+from synapse.util.caches.lrucache import (
+    LruCache,
+    estimate_size_of,
+    get_cache_memory_usage,
+    set_cache_memory_budget,
+)
 from synapse.util.caches.treecache import TreeCache
 
 from .. import unittest
@@ -83,6 +88,16 @@ class LruCacheTestCase(unittest.TestCase):
         cache.clear()
         self.assertEquals(len(cache), 0)
 
+    def test_most_recent_keys(self):
+        cache = LruCache(5)
+        cache[1] = 1
+        cache[2] = 2
+        cache[3] = 3
+        cache.get(1)
+
+        self.assertEquals(cache.most_recent_keys(5), [1, 3, 2])
+        self.assertEquals(cache.most_recent_keys(2), [1, 3])
+
 
 class LruCacheCallbacksTestCase(unittest.TestCase):
     def test_get(self):
@@ -255,3 +270,76 @@ class LruCacheSizedTestCase(unittest.TestCase):
         self.assertEquals(cache["key3"], [3])
         self.assertEquals(cache["key4"], [4])
         self.assertEquals(cache["key5"], [5, 6])
+
+
+class LruCacheMemoryBudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.entry_size = estimate_size_of("key1") + estimate_size_of([0] * 10)
+
+    def tearDown(self):
+        set_cache_memory_budget(None)
+
+    def test_memory_usage(self):
+        set_cache_memory_budget(1000 * self.entry_size)
+
+        cache = LruCache(10)
+        start_usage = get_cache_memory_usage()
+
+        cache["key1"] = [0] * 10
+        cache["key2"] = [0] * 10
+        self.assertEquals(cache.memory_usage(), 2 * self.entry_size)
+        self.assertEquals(get_cache_memory_usage(), start_usage + 2 * self.entry_size)
+
+        cache["key2"] = [0] * 20
+        self.assertGreater(cache.memory_usage(), 2 * self.entry_size)
+
+        cache.pop("key1")
+        cache.pop("key2")
+        self.assertEquals(cache.memory_usage(), 0)
+        self.assertEquals(get_cache_memory_usage(), start_usage)
+
+    def test_evict_across_caches(self):
+        cache1 = LruCache(10)
+        cache2 = LruCache(10)
+
+        # leave room for three entries
+        set_cache_memory_budget(get_cache_memory_usage() + 3 * self.entry_size)
+
+        m = Mock()
+        cache1["key1"] = [0] * 10
+        cache2["key2"] = [0] * 10
+        cache1.set("key3", [0] * 10, callbacks=[m])
+
+        # touch key1, so that key2 is the least recently used
+        self.assertEquals(cache1["key1"], [0] * 10)
+
+        cache2["key4"] = [0] * 10
+
+        self.assertEquals(len(cache1), 2)
+        self.assertEquals(len(cache2), 1)
+        self.assertEquals(cache2.get("key2"), None)
+        self.assertEquals(cache2["key4"], [0] * 10)
+
+        cache1["key5"] = [0] * 10
+
+        self.assertEquals(cache1.get("key3"), None)
+        self.assertEquals(m.call_count, 1)
+        self.assertEquals(cache1["key1"], [0] * 10)
+        self.assertEquals(cache1["key5"], [0] * 10)
+
+    def test_clear(self):
+        set_cache_memory_budget(1000 * self.entry_size)
+
+        cache = LruCache(10, cache_type=TreeCache, keylen=2)
+        start_usage = get_cache_memory_usage()
+
+        cache[("a", "key1")] = [0] * 10
+        cache[("a", "key2")] = [0] * 10
+        cache[("b", "key1")] = [0] * 10
+
+        cache.del_multi(("a",))
+        self.assertEquals(get_cache_memory_usage(), start_usage + cache.memory_usage())
+
+        cache.clear()
+        self.assertEquals(cache.memory_usage(), 0)
+        self.assertEquals(get_cache_memory_usage(), start_usage)
@@ -103,6 +103,9 @@ def default_config(name):
     config = Mock()
     config.signing_key = [MockKey()]
     config.event_cache_size = 1
+    config.database_lanes = {}
+    config.shared_cache_directory = None
+    config.cache_snapshot_path = None
     config.enable_registration = True
     config.macaroon_secret_key = "not even a little secret"
     config.expire_access_token = False
@@ -111,15 +114,23 @@ def default_config(name):
     config.room_invite_state_types = []
     config.password_providers = []
     config.worker_replication_url = ""
+    config.worker_replication_protocol = "text"
     config.worker_app = None
     config.email_enable_notifs = False
     config.block_non_admin_invites = False
     config.federation_domain_whitelist = None
+    config.federation_max_idle_connections_per_destination = 5
+    config.federation_idle_connection_timeout = 2 * 60
+    config.federation_transactions_in_flight_per_destination = 1
+    config.federation_max_pending_pdus_per_destination = 1000
+    config.federation_max_pending_edus_per_destination = 5000
     config.federation_rc_reject_limit = 10
     config.federation_rc_sleep_limit = 10
     config.federation_rc_sleep_delay = 100
     config.federation_rc_concurrent = 10
     config.filter_timeline_limit = 5000
+    config.notifier_batch_window_ms = 0
+    config.notifier_batch_size = 1000
     config.user_directory_search_all_users = False
     config.user_consent_server_notice_content = None
     config.block_events_without_consent_error = None